@@ -1,7 +1,6 @@
 from flask import Flask, request, jsonify, render_template, send_from_directory, Response
 import os
-import base64
-import google.generativeai as genai
+import threading
 from dotenv import load_dotenv
 import logging
 import json
@@ -20,17 +19,28 @@ app = Flask(__name__,
     static_folder=os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'static'))
 )
 
-# Configure Gemini
+# Configure Gemini on first use: importing the SDK dominates cold starts
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
-genai.configure(api_key=GOOGLE_API_KEY)
-model = genai.GenerativeModel('gemini-1.5-pro-latest')
+model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """The Gemini model, created on the first request."""
+    global model
+    if model is None:
+        with _model_lock:
+            if model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=GOOGLE_API_KEY)
+                model = genai.GenerativeModel('gemini-1.5-pro-latest')
+    return model
 
 def process_image(image_data):
-    """Process image data and return base64 encoded parts."""
+    """Wrap image bytes as a model part (the SDK sends raw bytes, no base64 needed)."""
     try:
         return [{
             "mime_type": "image/jpeg",
-            "data": base64.b64encode(image_data).decode('utf-8')
+            "data": image_data
         }]
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
@@ -149,7 +159,7 @@ IMPORTANT: Return ONLY the JSON object, no other text."""
 
         # Log request to Gemini
         logger.info("Sending request to Gemini")
-        response = model.generate_content([prompt, image_parts[0]])
+        response = get_model().generate_content([prompt, image_parts[0]])
         logger.info("Received response from Gemini")
 
         # Log raw response
@@ -4,22 +4,51 @@ Vercel Serverless Compatible Version
 """
 
 import os
-import base64
-import json
+import sys
 import logging
-import re
-from typing import Dict, List, Union, Optional
-from flask import Flask, request, jsonify, render_template, make_response
-import google.generativeai as genai
+from typing import Any, Callable, Dict, List, Union, Optional
+from flask import Flask, Response, g, request, jsonify, render_template, make_response
 from dotenv import load_dotenv
 import traceback
 from io import BytesIO
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from concurrent.futures import TimeoutError
 import asyncio
+import contextvars
+import queue
+import threading
 from functools import partial
+from collections import deque
 import time
-import requests
+import hashlib
+import re
+import math
 from flask_cors import CORS
+from PIL import Image
+
+from redis_client import get_redis
+from result_cache import create_result_cache, make_cache_key
+from image_hash import DuplicateIndex, dhash, letterhead_hash
+from jobs import FINISHED_STATES, JOB_RETRY_AFTER, QueueFullError, SUCCEEDED, create_job_manager
+from executors import BackgroundLoop, ModelExecutor, register_shutdown
+from stream_parser import IncrementalInvoiceParser
+from image_pipeline import encode_jpeg, load_image
+from pdf_ingest import PdfDocument, is_pdf
+from resolution_ladder import LadderStats, Rung, parse_ladder
+from model_router import ModelRouter, parse_tiers
+from hedging import Hedger
+from rate_limiter import BULK, INTERACTIVE, RateLimitExceeded, create_rate_limiter
+from single_flight import LEADER, create_single_flight
+from invoice_model import VAT_RATE, LineItem, parse_invoice
+from invoice_diff import diff_invoices
+from invoice_store import (QUERY_FIELDS as INVOICE_QUERY_FIELDS, STORE_SAVE_WAIT,
+                           StoreBusyError, create_invoice_store)
+from search_index import create_search_index
+from prompt_profiles import BASE as BASE_PROMPT, Prompt, create_profile_store
+import fast_json
+from metrics import create_metrics, start_request
+from downloads import DOWNLOAD_CONCURRENCY, Downloader, DownloadTimeout
+import memory_budget
+from memory_budget import MemoryBudgetExceeded
 
 # Configuration and Setup
 # ----------------------
@@ -37,8 +66,13 @@ logger = logging.getLogger(__name__)
 
 # Initialize Flask app with serverless settings
 app = Flask(__name__)
-app.config['JSON_SORT_KEYS'] = False
-app.config['MAX_CONTENT_LENGTH'] = 6 * 1024 * 1024  # 6MB max for Vercel
+# Compact UTF-8 responses in insertion order (orjson when installed)
+app.json = fast_json.FastJSONProvider(app)
+# 6MB max for Vercel; raise MAX_CONTENT_LENGTH elsewhere for multi-file batch uploads
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 6 * 1024 * 1024))
+
+# Deployment-specific optimizations
+VERCEL_DEPLOYMENT = os.getenv('VERCEL_REGION') is not None
 
 # Initialize CORS
 CORS(app, resources={
@@ -56,29 +90,148 @@ CORS(app, resources={
 
 # Gemini AI Configuration
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL', 'gemini-1.5-pro-latest')
+# Models /upload, batch and job extractions try in order, fastest first; the
+# next one only when the result fails validation (see model_router)
+GEMINI_MODEL_TIERS = parse_tiers(
+    os.getenv('GEMINI_MODEL_TIERS', f'gemini-1.5-flash-latest,{GEMINI_MODEL_NAME}')
+)
+# 'lazy' defers the Gemini SDK (most of the import time) to the first request
+# or /warmup; 'eager' loads and configures it while the app is imported
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'lazy').lower()
 model = None
+# Models of the other tiers, by name
+tier_models = {}
+# The default model as initialize_gemini created it
+_sdk_model = None
+_model_initialized = False
+_model_lock = threading.Lock()
 
 def initialize_gemini():
     """Initialize Gemini model if API key is available."""
-    global model
+    global model, _sdk_model, _model_initialized
     if GOOGLE_API_KEY:
         try:
+            import google.generativeai as genai
             genai.configure(api_key=GOOGLE_API_KEY)
-            model = genai.GenerativeModel('gemini-1.5-pro-latest')
-            logger.info("Initialized Gemini model: gemini-1.5-pro-latest")
+            model = _sdk_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+            logger.info(f"Initialized Gemini model: {GEMINI_MODEL_NAME}")
         except Exception as e:
             logger.error(f"Failed to initialize Gemini model: {str(e)}")
             model = None
     else:
         logger.warning("GOOGLE_API_KEY not set - Gemini features will be disabled")
+    _model_initialized = True
+
+def get_model(name: Optional[str] = None):
+    """A Gemini model, initialized on first use (None when not configured).
+
+    Without ``name`` (or for ``GEMINI_MODEL``) this is the default model.
+    Other tiers' models are created when first asked for. A model assigned
+    to ``model`` directly (e.g. a fake in load tests) is used as is, for
+    every tier.
+    """
+    if model is None and not _model_initialized:
+        with _model_lock:
+            if model is None and not _model_initialized:
+                initialize_gemini()
+    if name is None or name == GEMINI_MODEL_NAME or model is None or model is not _sdk_model:
+        return model
+    if name not in tier_models:
+        with _model_lock:
+            if name not in tier_models:
+                import google.generativeai as genai
+                tier_models[name] = genai.GenerativeModel(name)
+                logger.info(f"Initialized Gemini model: {name}")
+    return tier_models[name]
+
+def reset_model():
+    """Drop the models so the next use builds new ones (after ``fork()``)."""
+    global model, _sdk_model, _model_initialized
+    with _model_lock:
+        model = _sdk_model = None
+        tier_models.clear()
+        _model_initialized = False
+
+def model_status() -> str:
+    """``active``, ``inactive``, or ``lazy`` when configured but not loaded yet."""
+    if model is not None:
+        return 'active'
+    return 'lazy' if GOOGLE_API_KEY and not _model_initialized else 'inactive'
+
+def is_deadline_exceeded(error: Exception) -> bool:
+    """Whether ``error`` is the SDK's deadline error, without importing the SDK."""
+    if 'google.api_core.exceptions' not in sys.modules:
+        return False
+    from google.api_core.exceptions import DeadlineExceeded
+    return isinstance(error, DeadlineExceeded)
+
+if STARTUP_MODE == 'eager':
+    initialize_gemini()
+
+# Model Call Execution
+# -------------------
+
+GEMINI_TIMEOUT = int(os.getenv('GEMINI_TIMEOUT', 30))
+TOTAL_REQUEST_TIMEOUT = int(os.getenv('TOTAL_REQUEST_TIMEOUT', 35))
+MODEL_MAX_WORKERS = int(os.getenv('MODEL_MAX_WORKERS', 3 if VERCEL_DEPLOYMENT else 8))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', os.cpu_count() or 2))
 
-# Initialize Gemini if possible
-initialize_gemini()
+# One sized pool for blocking model calls and one event loop for request
+# coroutines per worker process, instead of new ones for every request
+model_executor = ModelExecutor(max_workers=MODEL_MAX_WORKERS)
+background_loop = BackgroundLoop(cpu_workers=IMAGE_WORKERS)
+register_shutdown(model_executor, background_loop)
+
+# Cluster-wide Gemini budget (requests per minute and concurrent calls);
+# interactive uploads go ahead of bulk batch and job work
+rate_limiter = create_rate_limiter()
+# A call never queues for so long that less than this is left for the model
+RATE_LIMIT_MIN_CALL_SECONDS = int(os.getenv('RATE_LIMIT_MIN_CALL_SECONDS', 10))
+
+# Stage latencies, counters and gauges served on /metrics
+metrics = create_metrics()
+
+# Firebase downloads share one connection pool per worker; batch items are
+# downloaded ahead of their extraction on a separate small pool
+downloader = Downloader()
+download_executor = ModelExecutor(max_workers=DOWNLOAD_CONCURRENCY, name='download')
+register_shutdown(download_executor)
+
+# Reviewed invoices, written in batches by a background writer
+invoice_store = create_invoice_store()
+register_shutdown(invoice_store)
+# Full-text search over saved invoices, updated as the store commits
+search_index = create_search_index(invoice_store)
 
 # Upload Configuration
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB limit for Vercel
 
+# Image sent to Gemini; smaller and more compressed on Vercel
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', 500 if VERCEL_DEPLOYMENT else 600))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 60 if VERCEL_DEPLOYMENT else 70))
+
+# Resolution ladder for /upload, batch and job extractions: start with the
+# cheapest rung and retry at the next one only when validation fails
+DEFAULT_IMAGE_LADDER = '400:55,500:60,800:70' if VERCEL_DEPLOYMENT else '400:60,600:70,1000:80'
+IMAGE_LADDER = parse_ladder(os.getenv('IMAGE_LADDER', DEFAULT_IMAGE_LADDER))
+# Seconds all rungs of one extraction may take together
+LADDER_TIME_BUDGET = float(os.getenv('LADDER_TIME_BUDGET', TOTAL_REQUEST_TIMEOUT - 3))
+ladder_stats = LadderStats(IMAGE_LADDER)
+# Model tiers, escalated through before the ladder's larger rungs
+model_router = ModelRouter(GEMINI_MODEL_TIERS, record_latency=False)
+# Opt-in second calls for model calls running past their tier's usual latency.
+# It records every model call's latency in the router's tracker, so hedge
+# delays and escalation decisions come from the same calls.
+hedger = Hedger(latency=model_router.latency,
+                on_outcome=lambda outcome: metrics.inc('invoice_model_hedges_total',
+                                                       outcome=outcome))
+
+# Batch Upload Configuration
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 50))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+
 # Type Definitions and Utility Functions
 # --------------------------------
 
@@ -89,224 +242,210 @@ def allowed_file(filename: str) -> bool:
     """Check if file extension is allowed."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_image_memory(file_data: bytes) -> List[Dict[str, str]]:
-    """Process image data in memory with optimized size."""
+def encode_payload(img: Image.Image, quality: int) -> bytes:
+    """Encode a decoded image as the model's JPEG payload and free the image.
+
+    The JPEG bytes are passed to the SDK as they are: it sends raw bytes,
+    so base64 text would only be decoded again.
+    """
     try:
-        # Always compress image for consistent processing time
-        from PIL import Image
-        import io
-        
-        # Open image from bytes
-        img = Image.open(io.BytesIO(file_data))
-        
-        # Convert to RGB if needed
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Calculate new size while maintaining aspect ratio
-        max_size = (600, 600)  # Reduced size for faster processing
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        # Optimize image
-        output = io.BytesIO()
-        img.save(output, 
-                format='JPEG', 
-                quality=70,      # Reduced quality for smaller size
-                optimize=True,
-                progressive=True # Progressive loading
-        )
-        file_data = output.getvalue()
+        with memory_budget.hold('decoded', img.width * img.height * len(img.getbands())):
+            with metrics.stage('encode'):
+                jpeg = encode_jpeg(img, quality)
+    finally:
+        # Drop the pixels now rather than when the request ends
+        img.close()
+    memory_budget.charge('payload', len(jpeg))
+    metrics.observe('invoice_image_bytes', len(jpeg), kind='compressed')
+    return jpeg
+
+def process_image_memory(file_data: bytes, rung: Optional[Rung] = None,
+                         image: Optional[Image.Image] = None) -> List[Dict[str, Union[str, bytes]]]:
+    """Process image data in memory with optimized size.
+
+    Decodes close to the target size (see ``image_pipeline``), applies EXIF
+    orientation and re-encodes as a compact JPEG for Gemini.
+
+    Args:
+        file_data: Raw image bytes
+        rung: Size and quality to use; defaults to ``IMAGE_MAX_DIMENSION``
+            and ``IMAGE_QUALITY``
+        image: ``file_data`` already decoded for ``rung`` (e.g. while it was
+            downloading), so only the encoding is left; it is closed afterwards
+
+    Returns:
+        list: One ``{"mime_type": "image/jpeg", "data": <JPEG bytes>}`` part
+    """
+    try:
+        rung = rung or Rung(IMAGE_MAX_DIMENSION, IMAGE_QUALITY)
+        max_size = (rung.max_dimension, rung.max_dimension)
+        metrics.observe('invoice_image_bytes', len(file_data), kind='original')
+        if image is not None:
+            img = image
+        else:
+            with metrics.stage('decode'):
+                img = load_image(file_data, max_size)
+        data = encode_payload(img, rung.quality)
         
         # Log image size
-        logger.info(f"Processed image size: {len(file_data) / 1024:.2f}KB")
+        logger.info(f"Processed image size: {len(data) / 1024:.2f}KB")
         
         return [{
             "mime_type": "image/jpeg",
-            "data": base64.b64encode(file_data).decode('utf-8')
+            "data": data
         }]
+    except MemoryBudgetExceeded:
+        raise
     except Exception as e:
         logger.error(f"Error processing image in memory: {str(e)}")
+        metrics.inc('invoice_errors_total', cause='image')
         raise
 
 # Gemini Vision AI Prompt
 # ----------------------
 
-GEMINI_PROMPT = """Analyze this Hebrew invoice image and extract the data into a JSON object with PRECISE field mapping.
-
-CRITICAL RTL COLUMN ORDER AND MAPPING RULES:
-1. Hebrew invoices are read RIGHT to LEFT. The columns ALWAYS appear in this exact order:
-   RIGHT ➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔ LEFT
-   [תיאור] ➔ [כמות] ➔ [מחיר יחידה] ➔ [סה"כ]
-   [Description] ➔ [Quantity] ➔ [Unit Price] ➔ [Total]
-
-2. COLUMN HEADERS TO LOOK FOR:
-   - תיאור / פריט / שם פריט = Description
-   - כמות = Quantity (ALWAYS the smaller number)
-   - מחיר / מחיר יחידה = Unit Price
-   - סה"כ / סכום = Total (ALWAYS quantity × price)
-
-3. QUANTITY vs TOTAL DISAMBIGUATION RULES:
-   a) כמות (Quantity) is ALWAYS:
-      - The SMALLER number
-      - Usually less than 100 units
-      - When multiplied by price equals the total
-   
-   b) סה"כ (Total) is ALWAYS:
-      - The LARGER number
-      - Equal to quantity × price
-      - Usually the rightmost number column
-
-4. REAL EXAMPLES:
-   Example 1: If you see:
-   - מחיר יחידה (price) = 160.00
-   - One number is 2.20
-   - Other number is 352.00
-   Then:
-   - 2.20 MUST be כמות (quantity) because 2.20 × 160.00 = 352.00
-   - 352.00 MUST be סה"כ (total)
-
-   Example 2: If you see:
-   - מחיר יחידה (price) = 38.00
-   - One number is 266.00
-   - Other number is 7.00
-   Then:
-   - 7.00 MUST be כמות (quantity) because 7.00 × 38.00 = 266.00
-   - 266.00 MUST be סה"כ (total)
-
-5. VALIDATION RULES:
-   - ALWAYS verify: total = quantity × price
-   - If the calculation doesn't match, you mapped the columns wrong
-   - If total ÷ price gives a reasonable quantity (< 100), that's the correct mapping
-   - Never accept a mapping where total ≠ quantity × price
-
-Return this exact JSON structure:
-{
-    "company_details": {
-        "name": "",
-        "address": "",
-        "tax_id": ""
-    },
-    "invoice_details": {
-        "invoice_number": "",
-        "date": ""
-    },
-    "line_items": [
-        {
-            "item_code": "",
-            "description": "",
-            "quantity": 0,
-            "price": 0,
-            "total": 0
-        }
-    ],
-    "totals": {
-        "subtotal": 0,
-        "tax": 0,
-        "total": 0
-    }
+# A compact base prompt, plus a learned profile of the supplier when it is
+# recognized (see prompt_profiles); the prompt version is part of cache keys
+prompt_profiles = create_profile_store()
+
+# Extraction Result Cache
+# ----------------------
+
+result_cache = create_result_cache()
+
+async def cache_call(func: Callable, *args) -> Any:
+    """Run a ``result_cache`` call, on a thread when it may reach Redis."""
+    if result_cache.backend != 'redis':
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+# Identical extractions in flight anywhere in the cluster run only once
+single_flight = create_single_flight()
+
+# Perceptual hashes of prior extractions, pointing at their cache entries
+duplicate_index = DuplicateIndex()
+
+def find_probable_duplicate(image_hash: Optional[int]) -> Optional[Dict]:
+    """Return a prior extraction of a visually near-identical image, if any.
+
+    Invoices printed on the same supplier template are near-identical too, so
+    the match is only offered to the user alongside the new extraction.
+    """
+    if image_hash is None:
+        return None
+    match = duplicate_index.find(image_hash)
+    if not match:
+        return None
+    invoice_data = result_cache.get(match['key'])
+    if invoice_data is None:
+        return None
+    return {'invoice_data': invoice_data, 'distance': match['distance'],
+            'threshold': duplicate_index.threshold, 'key': match['key']}
+
+# Gemini generation settings shared by regular and streaming calls
+GENERATION_CONFIG = {
+    'temperature': 0.1,    # Lower temperature for more focused results
+    'top_p': 0.8,          # Reduce randomness
+    'top_k': 40,           # Limit token choices
+    'max_output_tokens': 800,   # Further reduced for faster processing
+    'candidate_count': 1,   # Only need one response
 }
 
-FINAL VERIFICATION CHECKLIST:
-1. Column order is correct (RTL: Description ➔ Quantity ➔ Price ➔ Total)
-2. Quantity is ALWAYS the smaller number
-3. Total is ALWAYS quantity × price
-4. All calculations are verified
-5. No null/None/undefined values
-6. All numbers are actual numbers (not strings)
-7. Subtotal = sum of all line totals
-8. Tax = 17% of subtotal
-9. Final total = subtotal + tax"""
-
-async def process_with_timeout(model, prompt, image_parts, timeout=30):
-    """Process with Gemini API using timeout."""
+async def process_with_timeout(model, prompt, image_parts, timeout=GEMINI_TIMEOUT,
+                               lane=INTERACTIVE, queue_wait: Optional[List[float]] = None,
+                               tier: Optional[str] = None):
+    """Process with Gemini API using timeout.
+
+    The call first waits for capacity from the rate limiter in ``lane``; the
+    wait counts against ``timeout`` and is appended to ``queue_wait`` when
+    given. The call then runs on the shared model executor. The model client
+    gets a deadline slightly shorter than what is left, so a hung call
+    releases its thread and connection instead of lingering after we stop
+    waiting. With hedging on, a call running late gets a second, identical
+    one if capacity is free right away (see ``hedging``). Its latency is
+    tracked under ``tier`` (default ``GEMINI_MODEL``).
+
+    Raises:
+        RateLimitExceeded: If capacity would not be available in time
+        TimeoutError: If Gemini did not answer within ``timeout`` seconds
+        Exception: On API errors or an empty response
+    """
     try:
-        start_time = time.time()
-        
-        # Create partial function for generate_content with optimized settings
-        generate_func = partial(
-            model.generate_content,
-            [prompt, image_parts[0]],
-            generation_config={
-                'temperature': 0.1,    # Lower temperature for more focused results
-                'top_p': 0.8,          # Reduce randomness
-                'top_k': 40,           # Limit token choices
-                'max_output_tokens': 800,   # Further reduced for faster processing
-                'candidate_count': 1,   # Only need one response
-            },
-            timeout=timeout-2  # Leave 2 seconds for processing
+        lease = await rate_limiter.acquire_async(
+            lane, max_wait=max(timeout - RATE_LIMIT_MIN_CALL_SECONDS, 0)
         )
-        
-        # Run with timeout
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(generate_func)
-            try:
-                response = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: future.result(timeout=timeout-1)  # Leave 1 second buffer
-                )
-                
-                process_time = time.time() - start_time
-                logger.info(f"Gemini API processing time: {process_time:.2f}s")
-                
-                # Debug log the raw response
-                logger.info(f"Raw Gemini response length: {len(response.text)}")
-                
-                if not response or not hasattr(response, 'text'):
-                    logger.error("Invalid response format from Gemini API")
-                    raise Exception("Invalid response format from Gemini API")
-                    
-                if not response.text or not response.text.strip():
-                    logger.error("Empty response text from Gemini API")
-                    raise Exception("Empty response from Gemini API")
-                
-                return response
-                
-            except TimeoutError:
-                process_time = time.time() - start_time
-                logger.error(f"Gemini API timeout after {process_time:.2f}s")
-                raise TimeoutError(f"Processing timed out after {process_time:.2f}s")
-            except Exception as e:
-                process_time = time.time() - start_time
-                logger.error(f"Gemini API error during generation after {process_time:.2f}s: {str(e)}")
-                raise
-                
-    except Exception as e:
-        logger.error(f"Error in process_with_timeout: {str(e)}")
-        raise Exception(f"Processing error: {str(e)}")
+    except RateLimitExceeded:
+        metrics.inc('invoice_errors_total', cause='rate_limited')
+        raise
+    metrics.record_stage('queue', lease.waited)
+    if queue_wait is not None:
+        queue_wait.append(lease.waited)
+    if lease.waited >= 0.01:
+        logger.info(f"Waited {lease.waited:.2f}s for Gemini capacity ({lane})")
+    timeout -= lease.waited
+
+    # Each call releases its lease when its thread is done
+    return await hedger.run(
+        tier or GEMINI_MODEL_NAME, partial(generate_with_timeout, model, prompt, image_parts),
+        timeout, acquire=partial(rate_limiter.acquire_async, lane, max_wait=0), lease=lease
+    )
+
+def model_request_timeout(timeout: float) -> float:
+    """API deadline for a call given ``timeout`` seconds: 2 are left for processing.
+
+    Short remaining budgets (a late ladder rung, the last PDF pages) still
+    give the API a positive deadline rather than 0 or less.
+    """
+    return max(timeout - 2, 1)
 
-def safe_float_convert(value: Union[str, int, float, None], field_name: str = "") -> float:
+async def generate_with_timeout(model, prompt, image_parts, timeout, lease=None):
+    """Run one ``generate_content`` call on the model executor with a deadline.
+
+    ``lease`` (rate limiter capacity) is released once the call is done in
+    its thread, which may be after we stopped waiting for it.
     """
-    Safely convert a value to float with comprehensive error handling.
+    start_time = time.time()
+    api_timeout = model_request_timeout(timeout)
     
-    Args:
-        value: The value to convert
-        field_name: Name of the field for logging purposes
+    # Create partial function for generate_content with optimized settings
+    generate_func = partial(
+        model.generate_content,
+        [prompt, image_parts[0]],
+        generation_config=GENERATION_CONFIG,
+        request_options={'timeout': api_timeout}
+    )
     
-    Returns:
-        float: The converted value or 0.0 if conversion fails
-    """
     try:
-        if value is None or str(value).lower().strip() in ('none', 'null', '', 'undefined', 'nan'):
-            logger.warning(f"Empty or None value for {field_name}, using 0.0")
-            return 0.0
-        
-        if isinstance(value, (int, float)):
-            return round(float(value), 2)
-        
-        # Clean the string value
-        cleaned = str(value).strip()
-        cleaned = re.sub(r'[^\d.-]', '', cleaned)
-        
-        if not cleaned:
-            logger.warning(f"No numeric value found in '{value}' for {field_name}, using 0.0")
-            return 0.0
-        
-        result = abs(float(cleaned))  # Convert to positive float
-        return round(result, 2)
-            
-    except (ValueError, TypeError) as e:
-        logger.warning(f"Could not convert value '{value}' for {field_name}: {str(e)}, using 0.0")
-        return 0.0
+        with metrics.in_flight('model_call'), metrics.stage('model'):
+            response = await model_executor.run_async(
+                generate_func, timeout=api_timeout + 1,
+                on_done=None if lease is None else lease.release
+            )
+    except Exception as e:
+        process_time = time.time() - start_time
+        if isinstance(e, TimeoutError) or is_deadline_exceeded(e):
+            logger.error(f"Gemini API timeout after {process_time:.2f}s")
+            metrics.inc('invoice_timeouts_total', cause='model')
+            raise TimeoutError(f"Processing timed out after {process_time:.2f}s")
+        logger.error(f"Gemini API error during generation after {process_time:.2f}s: {str(e)}")
+        metrics.inc('invoice_errors_total', cause='model')
+        raise Exception(f"Processing error: {str(e)}")
+    
+    process_time = time.time() - start_time
+    logger.info(f"Gemini API processing time: {process_time:.2f}s")
+    
+    if not response or not hasattr(response, 'text'):
+        logger.error("Invalid response format from Gemini API")
+        metrics.inc('invoice_errors_total', cause='empty_response')
+        raise Exception("Invalid response format from Gemini API")
+    
+    if not response.text or not response.text.strip():
+        logger.error("Empty response text from Gemini API")
+        metrics.inc('invoice_errors_total', cause='empty_response')
+        raise Exception("Empty response from Gemini API")
+    
+    logger.info(f"Raw Gemini response length: {len(response.text)}")
+    return response
 
 def create_empty_response() -> InvoiceData:
     """Create a valid empty response structure."""
@@ -329,116 +468,51 @@ def safe_json_response(data: Dict, status_code: int = 200) -> JsonResponse:
             'details': str(e)
         }), 500
 
+def rate_limited_response(error: RateLimitExceeded) -> JsonResponse:
+    """429 response telling the client when Gemini capacity is expected back."""
+    response, status_code = safe_json_response({
+        'status': 'error',
+        'error': str(error),
+        'retry_after': error.retry_after
+    }, 429)
+    response.headers['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return response, status_code
+
+def memory_budget_response(error: MemoryBudgetExceeded) -> JsonResponse:
+    """413 when the request needs too much memory, 503 when the worker is full."""
+    logger.warning(f"Memory budget exceeded: {str(error)}")
+    status_code = 413 if error.scope == memory_budget.REQUEST else 503
+    return safe_json_response({'status': 'error', 'error': str(error)}, status_code)
+
 # Core Processing Functions
 # -----------------------
 
-def process_gemini_response(response_text: str) -> InvoiceData:
-    """Process and validate Gemini's response with comprehensive error handling."""
+def calculate_totals(line_items: List[Dict]) -> Dict[str, float]:
+    """Subtotal, 17% VAT and total recomputed from validated line items."""
+    subtotal = round(sum(item['total'] for item in line_items), 2)
+    tax = round(subtotal * VAT_RATE, 2)
+    total = round(subtotal + tax, 2)
+    
+    logger.info(f"Calculated totals: subtotal={subtotal}, tax={tax}, total={total}")
+    return {'subtotal': subtotal, 'tax': tax, 'total': total}
+
+def process_gemini_response(response_text: str, issues: Optional[List[str]] = None,
+                            reported: Optional[Dict[str, float]] = None) -> InvoiceData:
+    """Parse and validate Gemini's response into the API's invoice shape.
+
+    Args:
+        response_text: Raw model output
+        issues: Optional list collecting failed arithmetic checks (line
+            totals, reported subtotal); an unusable response yields no line
+            items instead
+        reported: Optional dict filled with the totals as the model read them
+    """
     try:
-        # Log the incoming response for debugging
-        logger.info(f"Processing Gemini response: {response_text[:500]}...")  # Log first 500 chars
-        
-        # Clean and parse JSON response
-        cleaned_text = response_text.strip()
-        json_start = cleaned_text.find('{')
-        json_end = cleaned_text.rfind('}')
-        
-        if json_start == -1 or json_end == -1:
-            logger.error(f"No valid JSON object found in response: {cleaned_text}")
-            return create_empty_response()
-            
-        json_text = cleaned_text[json_start:json_end + 1]
-        logger.info(f"Extracted JSON text: {json_text[:500]}...")  # Log first 500 chars
-        
-        try:
-            data = json.loads(json_text)
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error: {str(e)}")
-            logger.error(f"Attempted to parse: {json_text}")
-            return create_empty_response()
-        
-        # Validate required structure
-        if not isinstance(data, dict):
-            logger.error(f"Response is not a dictionary: {type(data)}")
-            return create_empty_response()
-            
-        required_keys = {'company_details', 'invoice_details', 'line_items', 'totals'}
-        missing_keys = required_keys - set(data.keys())
-        if missing_keys:
-            logger.error(f"Missing required keys in response: {missing_keys}")
-            return create_empty_response()
-        
-        # Process line items with validation
-        processed_items = []
-        for idx, item in enumerate(data.get('line_items', [])):
-            try:
-                if not isinstance(item, dict):
-                    logger.warning(f"Invalid line item format at index {idx}: {item}")
-                    continue
-                
-                # Log raw values before conversion
-                logger.info(f"Processing line item {idx}: {item}")
-                
-                # Extract and convert values
-                quantity = safe_float_convert(item.get('quantity'), f'quantity_{idx}')
-                price = safe_float_convert(item.get('price'), f'price_{idx}')
-                total = safe_float_convert(item.get('total'), f'total_{idx}')
-                
-                # Verify calculations with logging
-                calculated_total = round(quantity * price, 2)
-                if abs(calculated_total - total) > 0.01:
-                    logger.warning(
-                        f"Total mismatch at index {idx}: "
-                        f"quantity={quantity}, price={price}, "
-                        f"calculated={calculated_total}, given={total}"
-                    )
-                    total = calculated_total
-                
-                processed_item = {
-                    'item_code': str(item.get('item_code', '')),
-                    'description': str(item.get('description', '')),
-                    'quantity': quantity,
-                    'price': price,
-                    'total': total
-                }
-                logger.info(f"Processed line item {idx}: {processed_item}")
-                processed_items.append(processed_item)
-                
-            except Exception as e:
-                logger.error(f"Error processing line item {idx}: {str(e)}")
-                continue
-        
-        # Calculate totals with validation
-        subtotal = round(sum(item['total'] for item in processed_items), 2)
-        tax = round(subtotal * 0.17, 2)  # 17% VAT
-        total = round(subtotal + tax, 2)
-        
-        logger.info(f"Calculated totals: subtotal={subtotal}, tax={tax}, total={total}")
-        
-        result = {
-            'company_details': {
-                'name': str(data.get('company_details', {}).get('name', '')),
-                'address': str(data.get('company_details', {}).get('address', '')),
-                'tax_id': str(data.get('company_details', {}).get('tax_id', ''))
-            },
-            'invoice_details': {
-                'invoice_number': str(data.get('invoice_details', {}).get('invoice_number', '')),
-                'date': str(data.get('invoice_details', {}).get('date', ''))
-            },
-            'line_items': processed_items,
-            'totals': {
-                'subtotal': subtotal,
-                'tax': tax,
-                'total': total
-            }
-        }
-        
-        # Log final result
-        logger.info("Successfully processed invoice data")
-        return result
-        
+        with metrics.stage('parse'):
+            return parse_invoice(response_text, issues, reported).to_dict()
     except Exception as e:
         logger.error(f"Error processing Gemini response: {str(e)}")
+        metrics.inc('invoice_errors_total', cause='parse')
         logger.error(f"Raw response: {response_text}")
         return create_empty_response()
 
@@ -464,15 +538,51 @@ def after_request(response):
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
     
     # Ensure JSON content type for API endpoints
-    if request.path.startswith(('/upload', '/save_changes', '/generate_report')):
+    if (request.path.startswith(('/upload', '/save_changes', '/generate_report'))
+            and response.mimetype != 'text/event-stream'):
         response.headers['Content-Type'] = 'application/json'
     
     return response
 
+@app.before_request
+def start_request_metrics():
+    """Start collecting stage timings and payload memory; count the request as in flight."""
+    if request.method == 'OPTIONS':
+        return
+    g.timings = start_request()
+    g.memory = memory_budget.start_request()
+    g.endpoint = request.endpoint or 'not_found'
+    metrics.add_gauge('invoice_in_flight', 1, what='request', endpoint=g.endpoint)
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the response and add the ``Server-Timing`` stage breakdown.
+
+    Streamed responses are measured up to their first byte.
+    """
+    timings = g.get('timings')
+    if timings is None:
+        return response
+    response.headers['Server-Timing'] = timings.server_timing()
+    metrics.inc('invoice_requests_total', endpoint=g.endpoint, status=str(response.status_code))
+    metrics.observe('invoice_request_duration_seconds', time.perf_counter() - timings.start,
+                    endpoint=g.endpoint)
+    if response.status_code == 408:
+        metrics.inc('invoice_timeouts_total', cause='request')
+    if g.memory.peak:
+        metrics.observe('invoice_request_memory_bytes', g.memory.peak, endpoint=g.endpoint)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if g.get('timings') is not None:
+        metrics.add_gauge('invoice_in_flight', -1, what='request', endpoint=g.endpoint)
+        g.memory.close()
+
 @app.route('/')
 def index():
     """Serve the main application page with API status."""
-    api_status = "active" if model else "inactive (API key not configured)"
+    api_status = "active" if model or GOOGLE_API_KEY else "inactive (API key not configured)"
     return render_template('index.html', api_status=api_status)
 
 @app.route('/favicon.ico')
@@ -486,58 +596,482 @@ def favicon():
         logger.error(f"Error serving favicon: {str(e)}")
         return '', 204
 
-# Deployment-specific optimizations
-VERCEL_DEPLOYMENT = os.getenv('VERCEL_REGION') is not None
-
 if VERCEL_DEPLOYMENT:
-    # Optimize for Vercel deployment
+    # Smaller images and model pool are selected in the configuration above
     logger.info("Running in Vercel environment - applying optimizations")
-    
-    # Reduce worker threads for Vercel
-    ThreadPoolExecutor = lambda max_workers=None: ThreadPoolExecutor(max_workers=3)
-    
-    # Optimize image processing for Vercel
-    def process_image_memory(file_data: bytes) -> List[Dict[str, str]]:
-        """Process image data with Vercel-optimized settings."""
+
+# Extraction Pipeline
+# ------------------
+
+def read_upload(file) -> bytes:
+    """Read an uploaded file, rejecting it by size before it is read.
+
+    Werkzeug spools uploads over 500KB to a temporary file; it is closed
+    right after reading, so the request holds a single copy of the file.
+
+    Raises:
+        ValueError: If the file is larger than ``MAX_FILE_SIZE``
+        MemoryBudgetExceeded: If the request or worker memory budget is exceeded
+    """
+    stream = file.stream
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(0)
+    if size > MAX_FILE_SIZE:
+        raise ValueError(f'File too large ({size / 1024:.2f}KB > {MAX_FILE_SIZE/1024:.2f}KB)')
+    memory_budget.charge('upload', size)
+    file_data = stream.read()
+    file.close()
+    return file_data
+
+def decode_while_downloading(body, rung: Rung) -> Image.Image:
+    """Decode a download that is still arriving for ``rung`` (see ``Downloader.fetch``)."""
+    img = load_image(body, (rung.max_dimension, rung.max_dimension))
+    # Pillow decodes lazily; do it now, while the rest of the file arrives
+    img.load()
+    return img
+
+def fetch_firebase_file(firebase_url: str,
+                        rung: Optional[Rung] = None) -> tuple[bytes, Optional[Image.Image]]:
+    """Download an uploaded invoice from Firebase Storage.
+
+    Files larger than ``MAX_FILE_SIZE`` are aborted as soon as that is known.
+
+    Args:
+        firebase_url: Download URL of the file
+        rung: Also decode the image for this rung while it downloads
+
+    Returns:
+        tuple: The file's bytes and the decoded image, or None when no
+        ``rung`` was given or the file is not a decodable image (e.g. a PDF)
+
+    Raises:
+        DownloadError: If the download failed, timed out or was too large
+        MemoryBudgetExceeded: If the request or worker memory budget is exceeded
+    """
+    decode = partial(decode_while_downloading, rung=rung) if rung is not None else None
+    try:
+        with metrics.stage('download'):
+            file_data, image = downloader.fetch(firebase_url, MAX_FILE_SIZE, decode=decode)
+    except DownloadTimeout:
+        metrics.inc('invoice_timeouts_total', cause='download')
+        raise
+    except Exception:
+        metrics.inc('invoice_errors_total', cause='download')
+        raise
+    memory_budget.charge('download', len(file_data))
+    return file_data, image
+
+def download_firebase_file(firebase_url: str) -> bytes:
+    """Download an uploaded invoice from Firebase Storage (see ``fetch_firebase_file``)."""
+    return fetch_firebase_file(firebase_url)[0]
+
+async def prepare_extraction(file_data: bytes, force: bool = False,
+                             rung: Optional[Rung] = None,
+                             image: Optional[Image.Image] = None,
+                             tax_id: Optional[str] = None,
+                             image_parts: Optional[List[Dict]] = None) -> Dict:
+    """Normalize the image and answer from the cache if possible.
+
+    Only an identical normalized image is answered from the cache; a prior
+    extraction of a near-identical one is returned as ``probable_duplicate``
+    for the user to accept, and the model is called all the same.
+
+    Args:
+        file_data: Raw uploaded image bytes
+        force: Skip near-duplicate detection
+        rung: Image size and quality (see ``process_image_memory``)
+        image: ``file_data`` already decoded for ``rung``
+        tax_id: Supplier tax id given by the client, selects its prompt profile
+        image_parts: ``process_image_memory`` output for ``rung``, already
+            computed elsewhere (e.g. in a process pool)
+
+    Returns:
+        dict: ``image_parts``, ``prompt``, ``cache_key``, ``image_hash`` and
+        ``letterhead`` for the model call, ``probable_duplicate`` (or None),
+        and ``result`` when the model call can be skipped (else None)
+    """
+    # Image decoding is CPU-bound, keep it off the event loop (to_thread keeps
+    # the request's stage timings)
+    if image_parts is None:
+        image_parts = await asyncio.to_thread(process_image_memory, file_data, rung, image)
+    prepared = {'image_parts': image_parts, 'image_hash': None, 'letterhead': None,
+                'probable_duplicate': None, 'result': None}
+
+    # The letterhead recognizes the supplier when no tax id is given, and is
+    # learned either way
+    if prompt_profiles.enabled:
         try:
-            from PIL import Image
-            import io
-            
-            # Open image from bytes
-            img = Image.open(io.BytesIO(file_data))
-            
-            # Convert to RGB if needed
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Aggressive size reduction for Vercel
-            max_size = (500, 500)  # Further reduced for Vercel
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            # Optimize image aggressively
-            output = io.BytesIO()
-            img.save(output, 
-                    format='JPEG', 
-                    quality=60,      # Further reduced quality for Vercel
-                    optimize=True,
-                    progressive=True
-            )
-            file_data = output.getvalue()
-            
-            logger.info(f"Vercel-optimized image size: {len(file_data) / 1024:.2f}KB")
-            
-            return [{
-                "mime_type": "image/jpeg",
-                "data": base64.b64encode(file_data).decode('utf-8')
-            }]
+            with metrics.stage('dhash'):
+                prepared['letterhead'] = letterhead_hash(image_parts[0]['data'])
         except Exception as e:
-            logger.error(f"Vercel image processing error: {str(e)}")
-            raise
+            logger.warning(f"Could not compute letterhead hash: {str(e)}")
+    # Profiles and letterheads may be read from Redis
+    prompt = await asyncio.to_thread(prompt_profiles.select, tax_id, prepared['letterhead'])
+    prepared['prompt'] = prompt
+
+    # Serve repeated uploads of the same image from the cache
+    cache_key = make_cache_key(image_parts[0]['data'], prompt.version, model_router.version)
+    prepared['cache_key'] = cache_key
+    with metrics.stage('cache'):
+        cached_data = await cache_call(result_cache.get, cache_key)
+        if cached_data is None and prompt.version != BASE_PROMPT.version:
+            # Extracted before its supplier had a profile (or a newer one)
+            cached_data = await cache_call(result_cache.get, make_cache_key(
+                image_parts[0]['data'], BASE_PROMPT.version, model_router.version))
+    if cached_data is not None:
+        logger.info("Result cache hit")
+        prepared['result'] = {'invoice_data': cached_data, 'cached': True}
+        return prepared
+
+    # Near-duplicate photos of an already processed invoice
+    if duplicate_index.enabled:
+        try:
+            with metrics.stage('dhash'):
+                prepared['image_hash'] = dhash(image_parts[0]['data'])
+        except Exception as e:
+            logger.warning(f"Could not compute perceptual hash: {str(e)}")
+
+    with metrics.stage('cache'):
+        # The index replays the shared Redis log (XRANGE) under its lock
+        duplicate = None if force else await asyncio.to_thread(find_probable_duplicate,
+                                                               prepared['image_hash'])
+    if duplicate is not None:
+        logger.info(f"Probable duplicate (distance {duplicate['distance']}), offered to the user")
+        prepared['probable_duplicate'] = duplicate
+    return prepared
+
+def store_extraction(prepared: Dict, invoice_data: InvoiceData,
+                     issues: Optional[List[str]] = None,
+                     reported: Optional[Dict[str, float]] = None) -> None:
+    """Cache a fresh extraction, index its perceptual hash and learn its supplier's profile."""
+    # Only cache usable extractions, never the empty fallback
+    if not invoice_data['line_items']:
+        return
+    result_cache.set(prepared['cache_key'], invoice_data)
+    if prepared['image_hash'] is not None:
+        duplicate_index.add(prepared['image_hash'], prepared['cache_key'])
+    prompt_profiles.observe(invoice_data, issues or (), reported, prepared['letterhead'],
+                            prepared['prompt'])
+
+async def extract_invoice(file_data: bytes, force: bool = False,
+                          timeout: int = GEMINI_TIMEOUT, lane: str = INTERACTIVE,
+                          image: Optional[Image.Image] = None,
+                          tax_id: Optional[str] = None,
+                          image_parts: Optional[List[Dict]] = None) -> Dict:
+    """Run the full extraction pipeline for one invoice image.
+
+    Images climb the resolution ladder (see ``extract_with_ladder``).
+    Identical extractions already in flight in any worker are joined rather
+    than repeated.
+
+    Args:
+        file_data: Raw uploaded image bytes
+        force: Skip near-duplicate detection
+        timeout: Model call timeout in seconds
+        lane: Rate limiter lane (``interactive`` or ``bulk``)
+        image: ``file_data`` already decoded for the first ladder rung
+        tax_id: Supplier tax id given by the client (see ``prepare_extraction``)
+        image_parts: ``file_data`` already processed for the first ladder rung
+
+    Returns:
+        dict: ``invoice_data`` plus ``cached`` when the model call was
+        skipped, ``probable_duplicate`` (a prior extraction of a
+        near-identical image, with its ``distance``), ``resolution`` and
+        ``queue_wait`` when the model was called, ``coalesced`` when the
+        result came from an identical in-flight extraction, and ``pages``
+        for PDFs
+
+    Raises:
+        RateLimitExceeded: If Gemini capacity was not available in time
+        TimeoutError: If the model call timed out
+        Exception: On image or model errors
+    """
+    if is_pdf(file_data):
+        return await extract_pdf_invoice(file_data, force=force, timeout=timeout, lane=lane,
+                                         tax_id=tax_id)
+
+    deadline = time.time() + LADDER_TIME_BUDGET
+    prepared = await prepare_extraction(file_data, force=force, rung=IMAGE_LADDER[0],
+                                        image=image, tax_id=tax_id, image_parts=image_parts)
+    if prepared['result'] is not None:
+        return prepared['result']
+
+    # Double-clicks and client retries wait for the extraction already running
+    result, role = await single_flight.run(
+        prepared['cache_key'],
+        partial(extract_with_ladder, file_data, prepared, deadline, timeout, lane),
+        timeout=LADDER_TIME_BUDGET
+    )
+    if role != LEADER:
+        logger.info(f"Joined identical in-flight extraction ({role})")
+        result = {**result, 'coalesced': True}
+    if prepared['probable_duplicate'] is not None:
+        result = {**result, 'probable_duplicate': prepared['probable_duplicate']}
+    return result
+
+async def extract_with_ladder(file_data: bytes, prepared: Dict, deadline: float,
+                              timeout: int = GEMINI_TIMEOUT, lane: str = INTERACTIVE) -> Dict:
+    """Call the model tiers, then climb the resolution ladder, until validation passes.
+
+    The fastest model tier is tried first on the first rung (already in
+    ``prepared``). Stronger tiers, then larger rungs at the last tier, are
+    tried only while the result scores below the router's confidence and
+    time remains before ``deadline`` (see ``ModelRouter.run``). The best
+    attempt is returned either way.
+
+    Raises:
+        RateLimitExceeded: If Gemini capacity was not available in time
+        TimeoutError: If the first model call timed out
+    """
+    images = {IMAGE_LADDER[0]: prepared['image_parts']}
+    queue_wait = []
+
+    async def call(tier: str, rung: Rung, remaining: float) -> Dict:
+        if rung not in images:
+            images[rung] = await asyncio.to_thread(process_image_memory, file_data, rung)
+        response = await process_with_timeout(
+            get_model(tier), prepared['prompt'].text, images[rung],
+            timeout=max(1, min(timeout, int(remaining))), lane=lane, queue_wait=queue_wait,
+            tier=tier
+        )
+        issues = []
+        reported = {}
+        invoice_data = process_gemini_response(response.text, issues, reported)
+        if not invoice_data['line_items']:
+            issues.append('no line items')
+        return {'invoice_data': invoice_data, 'issues': issues, 'reported': reported}
+
+    def record_rung(tier: str, rung: Rung, outcome: str, seconds: float) -> None:
+        ladder_stats.record(rung, outcome, len(images[rung][0]['data']), seconds)
+
+    best = await model_router.run(call, deadline, IMAGE_LADDER, on_attempt=record_rung)
+
+    # Cached under the first rung's key so repeats skip the ladder entirely; the
+    # profile update is a Redis read-modify-write, kept off the event loop
+    await asyncio.to_thread(store_extraction, prepared, best['invoice_data'], best['issues'],
+                            best['reported'])
+    return {
+        'invoice_data': best['invoice_data'],
+        'resolution': {
+            'model': best['tier'],
+            'rung': best['rung'].name,
+            'level': best['level'],
+            'attempts': best['attempts'],
+            'confidence': best['confidence'],
+            'validated': not best['issues'],
+            'issues': best['issues']
+        },
+        'queue_wait': round(sum(queue_wait), 3)
+    }
+
+# PDF Invoices
+# -----------
+
+# Pages extracted (and held in memory) at the same time for one PDF
+PDF_PAGE_CONCURRENCY = int(os.getenv('PDF_PAGE_CONCURRENCY', 4))
+# Whole-request deadline for PDFs; stays below the gunicorn worker timeout
+PDF_REQUEST_TIMEOUT = int(os.getenv('PDF_REQUEST_TIMEOUT', 110))
+# Pages still unfinished this long into a PDF extraction are given up; the
+# rest leaves time to merge and respond within PDF_REQUEST_TIMEOUT
+PDF_TIME_BUDGET = float(os.getenv('PDF_TIME_BUDGET', PDF_REQUEST_TIMEOUT - 5))
+
+def request_timeout(file_data: bytes) -> int:
+    """Deadline for a whole extraction: multi-page PDFs get longer."""
+    return PDF_REQUEST_TIMEOUT if is_pdf(file_data) else TOTAL_REQUEST_TIMEOUT
+
+def load_pdf_page(document: PdfDocument, index: int) -> tuple[str, List]:
+    """Model input for one PDF page: its text layer or a compact JPEG.
+
+    Returns:
+        tuple: ``(source, parts)`` where ``source`` is ``text``, ``image``
+        or ``render`` and ``parts`` is the content passed to the model
+    """
+    with metrics.stage('pdf_page'):
+        content = document.page_content(index, IMAGE_MAX_DIMENSION)
+    if content['kind'] == 'text':
+        text = f"Text layer of page {index + 1} of a PDF invoice:\n{content['text']}"
+        return 'text', [text]
+    if content['kind'] == 'image':
+        return 'image', process_image_memory(content['data'])
+
+    return 'render', [{'mime_type': 'image/jpeg',
+                       'data': encode_payload(content['image'], IMAGE_QUALITY)}]
+
+async def extract_pdf_page(document: PdfDocument, index: int, semaphore: asyncio.Semaphore,
+                           prompt: Prompt = BASE_PROMPT, force: bool = False,
+                           timeout: int = GEMINI_TIMEOUT, lane: str = INTERACTIVE,
+                           queue_wait: Optional[List[float]] = None) -> Dict:
+    """Extract one page, capturing its errors; releases a slot of ``semaphore``."""
+    page = {'page': index + 1}
+    start_time = time.time()
+    try:
+        source, parts = await asyncio.to_thread(load_pdf_page, document, index)
+        page['source'] = source
+
+        payload = parts[0]['data'] if isinstance(parts[0], dict) else parts[0].encode('utf-8')
+        cache_key = make_cache_key(payload, prompt.version, model_router.version)
+        invoice_data = None if force else await cache_call(result_cache.get, cache_key)
+        if invoice_data is not None:
+            page['cached'] = True
+        else:
+            response = await process_with_timeout(get_model(), prompt.text, parts,
+                                                  timeout=timeout, lane=lane,
+                                                  queue_wait=queue_wait)
+            invoice_data = process_gemini_response(response.text)
+            if invoice_data['line_items']:
+                await cache_call(result_cache.set, cache_key, invoice_data)
+
+        page.update(status='success', line_items=len(invoice_data['line_items']),
+                    invoice_data=invoice_data)
+    except RateLimitExceeded as e:
+        logger.warning(f"PDF page {index + 1} rate limited: {str(e)}")
+        page.update(status='rate_limited', error=str(e), retry_after=e.retry_after)
+    except TimeoutError:
+        logger.error(f"PDF page {index + 1} timed out after {time.time() - start_time:.2f}s")
+        page.update(status='timeout', error='Processing timeout')
+    except Exception as e:
+        logger.error(f"PDF page {index + 1} failed: {str(e)}")
+        page.update(status='error', error=str(e))
+    finally:
+        semaphore.release()
+    return page
+
+def merge_invoice_pages(pages: List[InvoiceData]) -> InvoiceData:
+    """Combine per-page extractions of one invoice.
+
+    Details come from the first page that has them, line items are kept in
+    page order and totals are recomputed over all of them, since per-page
+    totals are only page subtotals (or carried-forward sums).
+    """
+    merged = create_empty_response()
+    for section in ('company_details', 'invoice_details'):
+        for field in merged[section]:
+            values = [page[section][field] for page in pages if page[section][field]]
+            if values:
+                merged[section][field] = values[0]
+            if len(set(values)) > 1:
+                logger.warning(f"PDF pages disagree on {section}.{field}: {sorted(set(values))}")
+
+    merged['line_items'] = [item for page in pages for item in page['line_items']]
+    merged['totals'] = calculate_totals(merged['line_items'])
+    return merged
+
+async def extract_pdf_invoice(file_data: bytes, force: bool = False,
+                              timeout: int = GEMINI_TIMEOUT, lane: str = INTERACTIVE,
+                              tax_id: Optional[str] = None) -> Dict:
+    """Extract a (multi-page) PDF invoice, several pages at a time.
+
+    Pages are converted lazily and at most ``PDF_PAGE_CONCURRENCY`` of them
+    are in flight, so memory stays flat however long the document is. An
+    identical PDF already in flight is joined rather than extracted again.
+    Pages not extracted within ``PDF_TIME_BUDGET`` are given up, and the
+    others are returned as a partial result.
+
+    Args:
+        file_data: Raw PDF bytes
+        force: Extract every page again rather than serve cached results
+        timeout: Model call timeout in seconds, per page
+        lane: Rate limiter lane (``interactive`` or ``bulk``)
+        tax_id: Supplier tax id given by the client, selecting its prompt
+            profile (see ``PromptProfiles.select``)
+
+    Returns:
+        dict: merged ``invoice_data``, per-page ``pages`` status, total
+        ``queue_wait``, ``partial`` when some pages could not be extracted
+        and ``coalesced`` when joined
+
+    Raises:
+        RateLimitExceeded: If every page was rejected by the rate limiter
+        TimeoutError: If every page that failed did so by timing out
+        Exception: If the PDF is invalid or no page could be extracted
+    """
+    prompt = await asyncio.to_thread(prompt_profiles.select, tax_id)
+    document_key = make_cache_key(file_data, prompt.version, model_router.version)
+    cached_data = None if force else await cache_call(result_cache.get, document_key)
+    if cached_data is not None:
+        logger.info("Result cache hit for PDF")
+        return {'invoice_data': cached_data, 'cached': True}
+
+    result, role = await single_flight.run(
+        document_key,
+        partial(extract_pdf_pages, file_data, document_key, prompt, force, timeout, lane),
+        timeout=PDF_TIME_BUDGET
+    )
+    if role != LEADER:
+        logger.info(f"Joined identical in-flight PDF extraction ({role})")
+        result = {**result, 'coalesced': True}
+    return result
+
+async def extract_pdf_pages(file_data: bytes, document_key: str, prompt: Prompt = BASE_PROMPT,
+                            force: bool = False, timeout: int = GEMINI_TIMEOUT,
+                            lane: str = INTERACTIVE) -> Dict:
+    """Extract every page of a PDF and merge them (see ``extract_pdf_invoice``)."""
+    deadline = time.time() + PDF_TIME_BUDGET
+    loop = asyncio.get_running_loop()
+    document = await loop.run_in_executor(None, PdfDocument, file_data)
+    logger.info(f"Processing PDF with {document.page_count} pages")
+
+    semaphore = asyncio.Semaphore(PDF_PAGE_CONCURRENCY)
+    queue_wait = []
+    tasks = []
+    try:
+        for index in range(document.page_count):
+            # A page is only loaded once a slot is free, and only with time left for it
+            try:
+                await asyncio.wait_for(semaphore.acquire(), max(deadline - time.time(), 0))
+            except asyncio.TimeoutError:
+                break
+            remaining = deadline - time.time()
+            if remaining < 1:
+                semaphore.release()
+                break
+            tasks.append(asyncio.ensure_future(
+                extract_pdf_page(document, index, semaphore, prompt, force,
+                                 timeout=max(1, min(timeout, int(remaining))), lane=lane,
+                                 queue_wait=queue_wait)
+            ))
+        if tasks:
+            await asyncio.wait(tasks, timeout=max(deadline - time.time(), 0))
+        late = [task for task in tasks if not task.done()]
+        for task in late:
+            task.cancel()
+        await asyncio.gather(*late, return_exceptions=True)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        document.close()
+
+    pages = [tasks[index].result() if index < len(tasks) and not tasks[index].cancelled()
+             else {'page': index + 1, 'status': 'timeout', 'error': 'Request deadline reached'}
+             for index in range(document.page_count)]
+    if late or len(tasks) < document.page_count:
+        logger.warning(f"PDF deadline reached: {len(tasks) - len(late)} of "
+                       f"{document.page_count} pages finished")
+
+    extracted = [page.pop('invoice_data') for page in pages if page['status'] == 'success']
+    if not extracted:
+        if all(page['status'] == 'rate_limited' for page in pages):
+            raise RateLimitExceeded(pages[0]['error'],
+                                    retry_after=max(page['retry_after'] for page in pages))
+        if all(page['status'] == 'timeout' for page in pages):
+            raise TimeoutError('Processing timed out on every PDF page')
+        raise Exception(f"Could not extract any PDF page: {pages[0].get('error')}")
+
+    invoice_data = merge_invoice_pages(extracted)
+    result = {'invoice_data': invoice_data, 'pages': pages,
+              'queue_wait': round(sum(queue_wait), 3)}
+    if len(extracted) < len(pages):
+        result['partial'] = True
+    elif invoice_data['line_items']:
+        await cache_call(result_cache.set, document_key, invoice_data)
+    return result
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """Handle file uploads with Firebase integration."""
-    if not model:
+    if not get_model():
         return safe_json_response({
             'status': 'error',
             'error': 'Gemini API is not configured'
@@ -551,9 +1085,9 @@ def upload_file():
             # Download from Firebase
             firebase_url = request.form['firebase_url']
             try:
-                response = requests.get(firebase_url)
-                response.raise_for_status()
-                file_data = response.content
+                file_data, image = fetch_firebase_file(firebase_url, rung=IMAGE_LADDER[0])
+            except MemoryBudgetExceeded as e:
+                return memory_budget_response(e)
             except Exception as e:
                 logger.error(f"Error downloading from Firebase: {str(e)}")
                 return safe_json_response({
@@ -568,7 +1102,11 @@ def upload_file():
             if not allowed_file(file.filename):
                 return safe_json_response({'status': 'error', 'error': 'File type not allowed'}, 400)
             
-            file_data = file.read()
+            try:
+                file_data = read_upload(file)
+            except ValueError as e:
+                return safe_json_response({'status': 'error', 'error': str(e)}, 400)
+            image = None
         else:
             return safe_json_response({'status': 'error', 'error': 'No file provided'}, 400)
 
@@ -583,44 +1121,49 @@ def upload_file():
                     'error': f'File too large ({file_size:.2f}KB > {MAX_FILE_SIZE/1024:.2f}KB)'
                 }, 400)
             
-            # Process image
-            image_parts = process_image_memory(file_data)
+            force = request.form.get('force', '').lower() in ('1', 'true', 'yes')
+
+            # A reviewed and saved copy of this exact file is reopened as saved
+            image_hash = hashlib.sha256(file_data).hexdigest()
+            saved = None if force else find_saved_invoice(image_hash)
+            if saved is not None:
+                return safe_json_response({
+                    'status': 'success',
+                    **saved,
+                    'image_hash': image_hash,
+                    'processing_time': f"{time.time() - start_time:.2f}s"
+                })
             
             try:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
                 try:
-                    response = loop.run_until_complete(
-                        process_with_timeout(model, GEMINI_PROMPT, image_parts, timeout=30)
+                    result = background_loop.run(
+                        extract_invoice(file_data, force=force, image=image,
+                                        tax_id=request.form.get('tax_id')),
+                        timeout=request_timeout(file_data)
                     )
                     
-                    if not response or not response.text:
-                        raise Exception("Empty response from Gemini API")
-                    
-                    invoice_data = process_gemini_response(response.text)
-                    
                     total_time = time.time() - start_time
                     logger.info(f"Total processing time: {total_time:.2f}s")
                     
-                    return safe_json_response({
-                        'status': 'success',
-                        'invoice_data': invoice_data,
-                        'processing_time': f"{total_time:.2f}s"
-                    })
+                    with metrics.stage('serialize'):
+                        return safe_json_response({
+                            'status': 'success',
+                            **result,
+                            'image_hash': image_hash,
+                            'processing_time': f"{total_time:.2f}s"
+                        })
                     
+                except RateLimitExceeded as e:
+                    logger.warning(f"Upload rate limited: {str(e)}")
+                    return rate_limited_response(e)
+                except MemoryBudgetExceeded as e:
+                    return memory_budget_response(e)
                 except TimeoutError as e:
                     logger.error(f"Processing timeout after {time.time() - start_time:.2f}s")
                     return safe_json_response({
                         'status': 'error',
                         'error': 'Processing timeout'
                     }, 408)
-                    
-                finally:
-                    try:
-                        loop.close()
-                    except:
-                        pass
                         
             except Exception as e:
                 logger.error(f"Processing error: {str(e)}")
@@ -636,6 +1179,8 @@ def upload_file():
                 'error': str(e)
             }, 500)
                 
+    except MemoryBudgetExceeded as e:
+        return memory_budget_response(e)
     except Exception as e:
         logger.error(f"Upload error: {str(e)}")
         return safe_json_response({
@@ -643,12 +1188,614 @@ def upload_file():
             'error': str(e)
         }, 500)
 
+# Streaming Extraction
+# -------------------
+
+# Detail fields streamed as soon as their section is complete
+DETAIL_FIELDS = {
+    'company_details': ('name', 'address', 'tax_id'),
+    'invoice_details': ('invoice_number', 'date')
+}
+
+def stream_model_text(model, prompt, image_parts, timeout=GEMINI_TIMEOUT):
+    """Yield response text chunks from a streaming Gemini call.
+
+    The blocking stream is consumed on the shared model executor and handed
+    over through a queue, so the request deadline bounds the wait for every
+    chunk. Streaming calls use the interactive rate limiter lane.
+
+    Raises:
+        RateLimitExceeded: If Gemini capacity would not be available in time
+        TimeoutError: If the stream did not complete within ``timeout`` seconds
+    """
+    max_wait = max(timeout - RATE_LIMIT_MIN_CALL_SECONDS, 0)
+    try:
+        lease = rate_limiter.acquire(INTERACTIVE, max_wait=max_wait)
+    except RateLimitExceeded:
+        metrics.inc('invoice_errors_total', cause='rate_limited')
+        raise
+    metrics.record_stage('queue', lease.waited)
+    timeout -= lease.waited
+    api_timeout = model_request_timeout(timeout)
+    chunks = queue.Queue()
+    stop = threading.Event()
+
+    def produce():
+        metrics.add_gauge('invoice_in_flight', 1, what='model_call')
+        produce_start = time.perf_counter()
+        try:
+            response = model.generate_content(
+                [prompt, image_parts[0]],
+                generation_config=GENERATION_CONFIG,
+                stream=True,
+                request_options={'timeout': api_timeout}
+            )
+            for chunk in response:
+                if stop.is_set():
+                    break
+                chunks.put(('chunk', chunk.text))
+            chunks.put(('done', None))
+        except Exception as e:
+            chunks.put(('error', e))
+        finally:
+            # Capacity is held until the model stops generating
+            lease.release()
+            metrics.add_gauge('invoice_in_flight', -1, what='model_call')
+            metrics.record_stage('model', time.perf_counter() - produce_start)
+
+    start_time = time.time()
+    deadline = start_time + api_timeout + 1
+    try:
+        model_executor.submit(produce)
+    except Exception:
+        lease.release()
+        raise
+    try:
+        while True:
+            try:
+                kind, value = chunks.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                metrics.inc('invoice_timeouts_total', cause='model')
+                raise TimeoutError(f"Processing timed out after {time.time() - start_time:.2f}s")
+            if kind == 'done':
+                return
+            if kind == 'error':
+                if is_deadline_exceeded(value):
+                    elapsed = time.time() - start_time
+                    metrics.inc('invoice_timeouts_total', cause='model')
+                    raise TimeoutError(f"Processing timed out after {elapsed:.2f}s")
+                metrics.inc('invoice_errors_total', cause='model')
+                raise value
+            yield value
+    finally:
+        # Stop consuming the model stream if the client went away
+        stop.set()
+
+def sse_event(event: str, data: Dict) -> str:
+    """Format one Server-Sent Event."""
+    return f"event: {event}\ndata: {fast_json.dumps(data)}\n\n"
+
+def invoice_events(invoice_data: InvoiceData):
+    """SSE events for an already complete invoice (cache hits and PDFs)."""
+    for section in DETAIL_FIELDS:
+        yield sse_event(section, invoice_data[section])
+    for index, item in enumerate(invoice_data['line_items']):
+        yield sse_event('line_item', {'index': index, 'item': item})
+    yield sse_event('totals', invoice_data['totals'])
+
+def stream_extraction(prepared: Dict, start_time: float):
+    """Generate SSE events for one extraction as the model produces it."""
+    yield sse_event('status', {'stage': 'extracting'})
+
+    if prepared['result'] is not None:
+        yield from invoice_events(prepared['result']['invoice_data'])
+        yield sse_event('complete', {
+            'status': 'success',
+            **prepared['result'],
+            'processing_time': f"{time.time() - start_time:.2f}s"
+        })
+        return
+
+    parser = IncrementalInvoiceParser()
+    try:
+        for text in stream_model_text(get_model(), prepared['prompt'].text,
+                                      prepared['image_parts']):
+            for event, value in parser.feed(text):
+                if event == 'line_item':
+                    index, item = value
+                    line = LineItem.from_raw(item, index)
+                    if line is not None:
+                        yield sse_event('line_item', {'index': index, 'item': line.to_dict()})
+                elif event in DETAIL_FIELDS and isinstance(value, dict):
+                    yield sse_event(event, {
+                        field: str(value.get(field, '')) for field in DETAIL_FIELDS[event]
+                    })
+
+        # Totals are recomputed from the validated line items, as for /upload
+        issues = []
+        reported = {}
+        invoice_data = process_gemini_response(parser.text, issues, reported)
+        store_extraction(prepared, invoice_data, issues, reported)
+
+        total_time = time.time() - start_time
+        logger.info(f"Streamed extraction completed in {total_time:.2f}s")
+        yield sse_event('totals', invoice_data['totals'])
+        complete = {'status': 'success', 'invoice_data': invoice_data,
+                    'processing_time': f"{total_time:.2f}s"}
+        if prepared.get('probable_duplicate') is not None:
+            complete['probable_duplicate'] = prepared['probable_duplicate']
+        yield sse_event('complete', complete)
+
+    except RateLimitExceeded as e:
+        logger.warning(f"Streaming extraction rate limited: {str(e)}")
+        yield sse_event('error', {'status': 'error', 'error': str(e),
+                                  'retry_after': e.retry_after})
+    except TimeoutError:
+        logger.error(f"Streaming timeout after {time.time() - start_time:.2f}s")
+        yield sse_event('error', {'status': 'error', 'error': 'Processing timeout'})
+    except Exception as e:
+        logger.error(f"Streaming error: {str(e)}")
+        yield sse_event('error', {'status': 'error', 'error': str(e)})
+
+@app.route('/upload/stream', methods=['POST'])
+def upload_stream():
+    """Extract an invoice and stream sections as Server-Sent Events.
+
+    Accepts the same ``file`` or ``firebase_url`` fields as ``/upload``.
+    Events: ``status``, ``company_details``, ``invoice_details``, one
+    ``line_item`` per row as soon as it is generated, ``totals`` and finally
+    ``complete`` (the same payload ``/upload`` returns) or ``error``.
+    """
+    if not get_model():
+        return safe_json_response({
+            'status': 'error',
+            'error': 'Gemini API is not configured'
+        }, 503)
+
+    try:
+        start_time = time.time()
+
+        if 'firebase_url' in request.form:
+            try:
+                file_data, image = fetch_firebase_file(
+                    request.form['firebase_url'], rung=Rung(IMAGE_MAX_DIMENSION, IMAGE_QUALITY)
+                )
+            except MemoryBudgetExceeded:
+                raise
+            except Exception as e:
+                logger.error(f"Error downloading from Firebase: {str(e)}")
+                return safe_json_response({
+                    'status': 'error',
+                    'error': f'Failed to download file from Firebase: {str(e)}'
+                }, 400)
+        elif 'file' in request.files:
+            file = request.files['file']
+            if not file.filename:
+                return safe_json_response({'status': 'error', 'error': 'No selected file'}, 400)
+
+            if not allowed_file(file.filename):
+                return safe_json_response({'status': 'error', 'error': 'File type not allowed'}, 400)
+
+            try:
+                file_data = read_upload(file)
+            except ValueError as e:
+                return safe_json_response({'status': 'error', 'error': str(e)}, 400)
+            image = None
+        else:
+            return safe_json_response({'status': 'error', 'error': 'No file provided'}, 400)
+
+        if len(file_data) > MAX_FILE_SIZE:
+            file_size = len(file_data) / 1024
+            return safe_json_response({
+                'status': 'error',
+                'error': f'File too large ({file_size:.2f}KB > {MAX_FILE_SIZE/1024:.2f}KB)'
+            }, 400)
+
+        force = request.form.get('force', '').lower() in ('1', 'true', 'yes')
+        if is_pdf(file_data):
+            # PDF pages are extracted in parallel, then streamed as one invoice
+            prepared = {'result': background_loop.run(
+                extract_invoice(file_data, force=force, tax_id=request.form.get('tax_id')),
+                timeout=PDF_REQUEST_TIMEOUT
+            )}
+        else:
+            prepared = background_loop.run(
+                prepare_extraction(file_data, force=force, image=image,
+                                   tax_id=request.form.get('tax_id')),
+                timeout=TOTAL_REQUEST_TIMEOUT
+            )
+
+        return Response(stream_extraction(prepared, start_time), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    except RateLimitExceeded as e:
+        logger.warning(f"Streaming upload rate limited: {str(e)}")
+        return rate_limited_response(e)
+    except MemoryBudgetExceeded as e:
+        return memory_budget_response(e)
+    except TimeoutError:
+        logger.error(f"Processing timeout after {time.time() - start_time:.2f}s")
+        return safe_json_response({
+            'status': 'error',
+            'error': 'Processing timeout'
+        }, 408)
+    except Exception as e:
+        logger.error(f"Streaming upload error: {str(e)}")
+        return safe_json_response({
+            'status': 'error',
+            'error': str(e)
+        }, 500)
+
+async def process_batch_item(index: int, item: Dict, semaphore: asyncio.Semaphore,
+                             force: bool = False, timeout: int = GEMINI_TIMEOUT,
+                             prefetch: Optional[Callable[[], bool]] = None) -> Dict:
+    """Extract one batch item, capturing its errors instead of raising.
+
+    Uploaded files are only read once the item's turn comes, and the file is
+    dropped from ``item`` when taken, so it is freed as soon as the item is
+    done rather than with the whole batch.
+    """
+    result = {'index': index, 'source': item['source']}
+    async with semaphore:
+        start_time = time.time()
+        held = 0
+        held_kind = 'upload'
+        try:
+            if 'error' in item:
+                raise ValueError(item['error'])
+
+            if 'file' in item:
+                file_data = await asyncio.to_thread(read_upload, item.pop('file'))
+            else:
+                # Normally started long ago; keep the download window moving
+                while 'download' not in item and prefetch():
+                    pass
+                download = item.pop('download')
+                prefetch()
+                try:
+                    file_data = await asyncio.wrap_future(download)
+                except Exception as e:
+                    raise ValueError(f'Failed to download file from Firebase: {str(e)}')
+                # Charged by the download itself
+                held_kind = 'download'
+            held = len(file_data)
+
+            if len(file_data) > MAX_FILE_SIZE:
+                raise ValueError(
+                    f'File too large ({len(file_data) / 1024:.2f}KB > {MAX_FILE_SIZE/1024:.2f}KB)'
+                )
+
+            extraction = await extract_invoice(file_data, force=force, timeout=timeout, lane=BULK)
+            result.update(status='success', **extraction)
+        except RateLimitExceeded as e:
+            logger.warning(f"Batch item {index} rate limited: {str(e)}")
+            result.update(status='rate_limited', error=str(e), retry_after=e.retry_after)
+        except TimeoutError:
+            logger.error(f"Batch item {index} timed out after {time.time() - start_time:.2f}s")
+            result.update(status='timeout', error='Processing timeout')
+        except Exception as e:
+            logger.error(f"Batch item {index} failed: {str(e)}")
+            result.update(status='error', error=str(e))
+        finally:
+            memory_budget.release(held_kind, held)
+        result['processing_time'] = f"{time.time() - start_time:.2f}s"
+    return result
+
+async def process_batch(items: List[Dict], concurrency: int, force: bool = False) -> List[Dict]:
+    """Fan batch items out over at most ``concurrency`` concurrent extractions.
+
+    Firebase downloads run ahead of the extractions (``DOWNLOAD_CONCURRENCY``
+    at a time), so items are usually on hand when their turn comes. They run
+    only so far ahead, since a downloaded file stays in memory until its item
+    is done.
+    """
+    pending = deque(item for item in items if 'firebase_url' in item and 'error' not in item)
+
+    def prefetch() -> bool:
+        """Start the next queued download, if any."""
+        if not pending:
+            return False
+        item = pending.popleft()
+        # In this request's context, so the download is charged to its memory
+        # budget and timed among its stages
+        item['download'] = download_executor.submit(
+            contextvars.copy_context().run, download_firebase_file, item['firebase_url']
+        )
+        return True
+
+    for _ in range(concurrency + DOWNLOAD_CONCURRENCY):
+        prefetch()
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        return await asyncio.gather(*(
+            process_batch_item(index, item, semaphore, force=force, prefetch=prefetch)
+            for index, item in enumerate(items)
+        ))
+    finally:
+        # Only downloads still waiting for a thread when the batch gave up
+        for item in items:
+            if 'download' in item:
+                item['download'].cancel()
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Process many uploaded files and/or Firebase URLs in one request.
+
+    Accepts multipart ``files`` (repeatable) and ``firebase_url`` fields, or a
+    JSON body with a ``firebase_urls`` list. Each item is reported separately,
+    so one bad image does not fail the batch.
+    """
+    if not get_model():
+        return safe_json_response({
+            'status': 'error',
+            'error': 'Gemini API is not configured'
+        }, 503)
+
+    try:
+        start_time = time.time()
+        payload = request.get_json(silent=True) or {}
+
+        items = []
+        for file in request.files.getlist('files') + request.files.getlist('file'):
+            if not file.filename:
+                continue
+            if not allowed_file(file.filename):
+                items.append({'source': file.filename, 'error': 'File type not allowed'})
+            else:
+                # Read when the item is processed (see ``process_batch_item``)
+                items.append({'source': file.filename, 'file': file})
+
+        firebase_urls = request.form.getlist('firebase_url')
+        firebase_urls += list(payload.get('firebase_urls', []))
+        for firebase_url in firebase_urls:
+            items.append({'source': firebase_url, 'firebase_url': firebase_url})
+
+        if not items:
+            return safe_json_response({'status': 'error', 'error': 'No files provided'}, 400)
+
+        if len(items) > BATCH_MAX_ITEMS:
+            return safe_json_response({
+                'status': 'error',
+                'error': f'Too many items ({len(items)} > {BATCH_MAX_ITEMS})'
+            }, 400)
+
+        # Callers may lower the concurrency, never raise it above the configured limit
+        requested = request.values.get('concurrency', payload.get('concurrency'))
+        try:
+            concurrency = min(int(requested), BATCH_CONCURRENCY) if requested else BATCH_CONCURRENCY
+        except (TypeError, ValueError):
+            concurrency = BATCH_CONCURRENCY
+        concurrency = max(1, concurrency)
+
+        force = str(request.values.get('force', payload.get('force', '')))
+        force = force.lower() in ('1', 'true', 'yes')
+
+        results = background_loop.run(process_batch(items, concurrency, force=force))
+
+        elapsed = time.time() - start_time
+        succeeded = sum(1 for result in results if result['status'] == 'success')
+        timed_out = sum(1 for result in results if result['status'] == 'timeout')
+        rate_limited = sum(1 for result in results if result['status'] == 'rate_limited')
+        logger.info(f"Batch of {len(items)} processed in {elapsed:.2f}s "
+                    f"({succeeded} succeeded, concurrency {concurrency})")
+
+        return safe_json_response({
+            'status': 'success',
+            'results': results,
+            'summary': {
+                'total': len(results),
+                'succeeded': succeeded,
+                'failed': len(results) - succeeded - timed_out - rate_limited,
+                'timed_out': timed_out,
+                'rate_limited': rate_limited,
+                'cached': sum(1 for result in results if result.get('cached')),
+                'concurrency': concurrency,
+                'elapsed_seconds': round(elapsed, 3),
+                'items_per_second': round(len(results) / elapsed, 3) if elapsed else None,
+                'items_per_minute': round(len(results) * 60 / elapsed, 1) if elapsed else None
+            }
+        })
+
+    except MemoryBudgetExceeded as e:
+        return memory_budget_response(e)
+    except Exception as e:
+        logger.error(f"Batch upload error: {str(e)}")
+        return safe_json_response({
+            'status': 'error',
+            'error': str(e)
+        }, 500)
+
+# Asynchronous Jobs
+# ----------------
+
+job_manager = create_job_manager()
+
+def run_extraction_job(file_data: Optional[bytes], firebase_url: Optional[str] = None,
+                       force: bool = False) -> Dict:
+    """Job body: download if needed, then run the extraction pipeline in the bulk lane.
+
+    Payload memory is tracked and budgeted like a request's.
+    """
+    start_time = time.time()
+    with memory_budget.tracked() as memory:
+        if file_data is None:
+            try:
+                file_data = download_firebase_file(firebase_url)
+            except MemoryBudgetExceeded:
+                raise
+            except Exception as e:
+                raise ValueError(f'Failed to download file from Firebase: {str(e)}')
+        else:
+            memory.charge('upload', len(file_data))
+
+        if len(file_data) > MAX_FILE_SIZE:
+            raise ValueError(
+                f'File too large ({len(file_data) / 1024:.2f}KB > {MAX_FILE_SIZE/1024:.2f}KB)'
+            )
+
+        result = background_loop.run(extract_invoice(file_data, force=force, lane=BULK),
+                                     timeout=request_timeout(file_data))
+    result['processing_time'] = f"{time.time() - start_time:.2f}s"
+    return result
+
+def job_response(job: Dict) -> Dict:
+    """Public view of a job record."""
+    response = {
+        'status': 'success',
+        'job_id': job['id'],
+        'state': job['state'],
+        'source': job['source'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at']
+    }
+    if job['state'] == SUCCEEDED:
+        response.update(job['result'])
+    elif job['error']:
+        response['error'] = job['error']
+    return response
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue an extraction and return a job id immediately."""
+    if not get_model():
+        return safe_json_response({
+            'status': 'error',
+            'error': 'Gemini API is not configured'
+        }, 503)
+
+    try:
+        force = request.form.get('force', '').lower() in ('1', 'true', 'yes')
+
+        if 'firebase_url' in request.form:
+            firebase_url = request.form['firebase_url']
+            job = job_manager.submit(run_extraction_job, None, firebase_url, force=force,
+                                     source=firebase_url)
+        elif 'file' in request.files:
+            file = request.files['file']
+            if not file.filename:
+                return safe_json_response({'status': 'error', 'error': 'No selected file'}, 400)
+
+            if not allowed_file(file.filename):
+                return safe_json_response({'status': 'error', 'error': 'File type not allowed'}, 400)
+
+            try:
+                file_data = read_upload(file)
+            except ValueError as e:
+                return safe_json_response({'status': 'error', 'error': str(e)}, 400)
+            job = job_manager.submit(run_extraction_job, file_data, force=force,
+                                     source=file.filename)
+        else:
+            return safe_json_response({'status': 'error', 'error': 'No file provided'}, 400)
+
+        response = job_response(job)
+        response['job_url'] = f"/jobs/{job['id']}"
+        return safe_json_response(response, 202)
+
+    except QueueFullError as e:
+        logger.warning(str(e))
+        return safe_json_response({'status': 'error', 'error': str(e)}, 503)
+    except MemoryBudgetExceeded as e:
+        return memory_budget_response(e)
+    except Exception as e:
+        logger.error(f"Job submission error: {str(e)}")
+        return safe_json_response({
+            'status': 'error',
+            'error': str(e)
+        }, 500)
+
+@app.route('/jobs/stats')
+def job_stats():
+    """Expose job queue depth."""
+    try:
+        return safe_json_response({'status': 'success', 'jobs': job_manager.stats()})
+    except Exception as e:
+        logger.error(f"Error reading job stats: {str(e)}")
+        return safe_json_response({'status': 'error', 'error': str(e)}, 500)
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Return job state and, once finished, its invoice data.
+
+    Pass ``?wait=<seconds>`` to long-poll until the job finishes (at most
+    ``JOB_MAX_WAIT``). An unfinished job's response carries ``Retry-After``.
+    """
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return safe_json_response({'status': 'error', 'error': 'Invalid wait value'}, 400)
+
+    try:
+        job = job_manager.get(job_id, wait=wait)
+        if job is None:
+            return safe_json_response({'status': 'error', 'error': 'Job not found'}, 404)
+        response, status_code = safe_json_response(job_response(job))
+        if job['state'] not in FINISHED_STATES:
+            response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+        return response, status_code
+    except Exception as e:
+        logger.error(f"Error reading job {job_id}: {str(e)}")
+        return safe_json_response({'status': 'error', 'error': str(e)}, 500)
+
+# Saved Invoices
+# --------------
+
+_store_id = re.compile(r'[0-9a-f]{32}').fullmatch
+_sha256 = re.compile(r'[0-9a-f]{64}').fullmatch
+
+def find_saved_invoice(image_hash: str) -> Optional[Dict]:
+    """The latest saved invoice for an uploaded file, shaped like an extraction."""
+    if not invoice_store.enabled:
+        return None
+    try:
+        with metrics.stage('store'):
+            saved = invoice_store.find(image_hash=image_hash, limit=1)
+    except Exception as e:
+        logger.warning(f"Saved invoice lookup failed: {str(e)}")
+        return None
+    if not saved:
+        return None
+    logger.info(f"Reopening saved invoice {saved[0]['id']}, skipping model call")
+    return {
+        'invoice_data': saved[0]['invoice_data'],
+        'saved_invoice': {'id': saved[0]['id'], 'updated_at': saved[0]['updated_at']}
+    }
+
 @app.route('/save_changes', methods=['POST'])
 def save_changes():
-    """Save edited invoice data."""
+    """Save edited invoice data.
+
+    The body is the invoice JSON, plus ``invoice_id`` to replace an invoice
+    saved before and ``image_hash`` (returned by ``/upload``) to reopen it
+    when the same file is uploaded again. The invoice is written in the
+    background; the response waits up to ``INVOICE_STORE_SAVE_WAIT`` for it
+    and says whether it was ``written`` (``202`` while it is still queued).
+    """
     try:
-        data = request.json
-        return safe_json_response({'status': 'success'})
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('line_items'), list):
+            return safe_json_response({'status': 'error', 'error': 'Invoice data required'}, 400)
+        invoice_id = data.pop('invoice_id', None)
+        image_hash = data.pop('image_hash', None)
+        if invoice_id is not None and not (isinstance(invoice_id, str) and _store_id(invoice_id)):
+            return safe_json_response({'status': 'error', 'error': 'Invalid invoice_id'}, 400)
+        if image_hash is not None and not (isinstance(image_hash, str) and _sha256(image_hash)):
+            return safe_json_response({'status': 'error', 'error': 'Invalid image_hash'}, 400)
+
+        with metrics.stage('store'):
+            invoice_id = invoice_store.save(data, invoice_id=invoice_id, image_hash=image_hash)
+            written = invoice_store.wait_saved(invoice_id, timeout=STORE_SAVE_WAIT)
+        if not written:
+            logger.warning(f"Invoice {invoice_id} not written yet, still queued")
+        return safe_json_response({
+            'status': 'success',
+            'invoice_id': invoice_id,
+            'stored': invoice_store.enabled,
+            'written': written
+        }, 200 if written else 202)
+    except StoreBusyError as e:
+        logger.warning(f"Invoice store busy: {str(e)}")
+        return safe_json_response({'status': 'error', 'error': 'Server is busy, try again'}, 503)
     except Exception as e:
         logger.error(f"Error saving changes: {str(e)}")
         return safe_json_response({
@@ -657,6 +1804,51 @@ def save_changes():
             'details': traceback.format_exc()
         }, 500)
 
+@app.route('/invoices/<invoice_id>')
+def get_saved_invoice(invoice_id: str):
+    """A saved invoice by the id ``/save_changes`` returned."""
+    try:
+        with metrics.stage('store'):
+            saved = invoice_store.get(invoice_id) if _store_id(invoice_id) else None
+        if saved is None:
+            return safe_json_response({'status': 'error', 'error': 'Invoice not found'}, 404)
+        return safe_json_response({'status': 'success', **saved})
+    except Exception as e:
+        logger.error(f"Error reading invoice {invoice_id}: {str(e)}")
+        return safe_json_response({'status': 'error', 'error': str(e)}, 500)
+
+@app.route('/invoices')
+def find_saved_invoices():
+    """Saved invoices by ``tax_id``, ``invoice_number``, ``date`` and/or ``image_hash``."""
+    try:
+        criteria = {field: request.args[field] for field in INVOICE_QUERY_FIELDS
+                    if request.args.get(field)}
+        limit = request.args.get('limit', 20, type=int)
+        with metrics.stage('store'):
+            invoices = invoice_store.find(limit=limit, **criteria)
+        return safe_json_response({'status': 'success', 'invoices': invoices})
+    except ValueError as e:
+        return safe_json_response({'status': 'error', 'error': str(e)}, 400)
+    except Exception as e:
+        logger.error(f"Error searching invoices: {str(e)}")
+        return safe_json_response({'status': 'error', 'error': str(e)}, 500)
+
+@app.route('/search')
+def search_invoices():
+    """Saved invoices whose line items match ``q``, from ``supplier`` and/or ``tax_id``."""
+    try:
+        limit = request.args.get('limit', 20, type=int)
+        with metrics.stage('search'):
+            results = search_index.search(query=request.args.get('q', ''),
+                                          supplier=request.args.get('supplier', ''),
+                                          tax_id=request.args.get('tax_id', ''), limit=limit)
+        return safe_json_response({'status': 'success', **results})
+    except ValueError as e:
+        return safe_json_response({'status': 'error', 'error': str(e)}, 400)
+    except Exception as e:
+        logger.error(f"Error searching line items: {str(e)}")
+        return safe_json_response({'status': 'error', 'error': str(e)}, 500)
+
 @app.route('/generate_report', methods=['POST'])
 def generate_report():
     """Generate comparison report between original and edited invoice data."""
@@ -681,21 +1873,10 @@ def generate_report():
                 'error': 'Missing required fields in current_values'
             }, 400)
 
-        # Generate report
-        report = {
-            'line_items': {
-                'original': original_values.get('line_items', []),
-                'current': current_values.get('line_items', [])
-            },
-            'totals': {
-                'original': original_values.get('totals', {'subtotal': 0, 'tax': 0, 'total': 0}),
-                'current': current_values.get('totals', {'subtotal': 0, 'tax': 0, 'total': 0})
-            },
-            'changes': data.get('changes', []),
-            'changes_by_item': data.get('changes_by_item', {}),
-            'company_details': original_values.get('company_details', {}),
-            'invoice_details': original_values.get('invoice_details', {})
-        }
+        # Align line items and compute the changes here rather than trusting
+        # the client's index-by-index comparison
+        with metrics.stage('diff'):
+            report = diff_invoices(original_values, current_values)
 
         return safe_json_response({
             'status': 'success',
@@ -710,15 +1891,128 @@ def generate_report():
             'details': traceback.format_exc()
         }, 500)
 
+# Warmup
+# ------
+
+_warmed_up = False
+
+def warmup() -> Dict[str, float]:
+    """Load and start everything the first extraction would otherwise pay for.
+
+    Imports and configures the Gemini SDK and creates its client, starts the
+    executor threads and the event loop, loads the image codecs and PDF
+    renderer, and opens the Redis and storage connection pools. Each step is
+    idempotent, so calling this again is cheap.
+
+    Returns:
+        dict: Seconds spent per step
+    """
+    global _warmed_up
+    timings = {}
+
+    def step(name: str, func: Callable[[], object]) -> None:
+        start_time = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            logger.warning(f"Warmup step {name} failed: {str(e)}")
+        timings[name] = round(time.perf_counter() - start_time, 4)
+
+    def model_client():
+        # The SDK creates its gRPC client on the first call; do it here instead
+        if get_model() is not None and 'google.generativeai' in sys.modules:
+            from google.generativeai import client
+            client.get_default_generative_client()
+
+    def codecs():
+        Image.init()
+        sample = BytesIO()
+        Image.new('RGB', (64, 64), 'white').save(sample, format='PNG')
+        encode_jpeg(load_image(sample.getvalue(), (32, 32)), IMAGE_QUALITY)
+
+    def pdf():
+        import pypdfium2  # noqa: F401
+
+    step('model', get_model)
+    step('model_client', model_client)
+    step('executors', lambda: (model_executor.run(time.time),
+                               download_executor.run(time.time)))
+    step('event_loop', lambda: background_loop.run(asyncio.sleep(0)))
+    step('codecs', codecs)
+    step('pdf', pdf)
+    step('redis', get_redis)
+    step('downloads', downloader.session)
+    timings['total'] = round(sum(timings.values()), 4)
+    _warmed_up = True
+    return timings
+
+@app.route('/warmup', methods=['GET', 'POST'])
+def warmup_route():
+    """Warm this worker up ahead of traffic (e.g. from a platform's warmup hook)."""
+    timings = warmup()
+    return safe_json_response({
+        'status': 'success',
+        'startup_mode': STARTUP_MODE,
+        'gemini': model_status(),
+        'timings': timings
+    })
+
 @app.route('/health')
 def health_check():
     """Health check endpoint for Render."""
     return jsonify({
         'status': 'healthy',
-        'gemini': 'active' if model else 'inactive',
+        'gemini': model_status(),
+        'warmed_up': _warmed_up,
+        'executor': model_executor.stats(),
+        'downloads': {**downloader.stats(), 'prefetch': download_executor.stats()},
+        'memory': memory_budget.worker_memory.stats(),
+        'store': invoice_store.stats(),
+        'search': search_index.stats(),
+        'prompts': prompt_profiles.stats(),
         'timestamp': time.time()
     })
 
+@app.route('/cache/stats')
+def cache_stats():
+    """Expose cache hit/miss, duplicate and coalescing counters."""
+    return safe_json_response({
+        'status': 'success',
+        'cache': result_cache.stats(),
+        'duplicates': duplicate_index.stats(),
+        'single_flight': single_flight.stats()
+    })
+
+@app.route('/ratelimit/stats')
+def rate_limit_stats():
+    """Expose Gemini rate limiter budgets and per-lane queueing times."""
+    return safe_json_response({
+        'status': 'success',
+        'rate_limit': rate_limiter.stats()
+    })
+
+@app.route('/metrics')
+def metrics_route():
+    """Prometheus metrics, aggregated across workers when Redis is available."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/ladder/stats')
+def ladder_stats_route():
+    """Expose per-rung success rates of the resolution ladder."""
+    return safe_json_response({
+        'status': 'success',
+        **ladder_stats.stats()
+    })
+
+@app.route('/cascade/stats')
+def cascade_stats_route():
+    """Expose per-tier hit rates and latencies of the model cascade, and hedging counters."""
+    return safe_json_response({
+        'status': 'success',
+        **model_router.stats(),
+        'hedging': hedger.stats()
+    })
+
 # Error Handlers
 # -------------
 
@@ -0,0 +1 @@
+"""Offline benchmarks and stress tests (run with ``python -m benchmarks.<name>``)."""
@@ -0,0 +1,117 @@
+"""
+Benchmark of the bulk extraction CLI's throughput against preprocessing workers.
+
+A directory of full-size synthetic scans is extracted with ``bulk.run_bulk``
+and a fast fake model, so decoding and re-encoding the images is the
+bottleneck, as in a backfill with enough model quota.
+
+* ``threads``: preprocessing on ``--max-workers`` threads of this process,
+  as ``/upload/batch`` does it;
+* ``processes_<n>``: preprocessing in ``n`` worker processes (1, 2, 4 ...
+  up to ``--max-workers``), as the CLI does it.
+
+Reports invoices per second and the speedup over one process. Processes
+only help as far as there are cores (``cpu_count`` in the results).
+
+Usage:
+    python -m benchmarks.bench_bulk --invoices 64 --size 2480x3508
+"""
+
+import os
+import argparse
+import logging
+import multiprocessing
+import shutil
+import tempfile
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict
+
+os.environ.setdefault('GEMINI_API_KEY', 'offline-benchmark')
+for backend in ('RESULT_CACHE_BACKEND', 'RATE_LIMIT_BACKEND', 'SINGLE_FLIGHT_BACKEND',
+                'INVOICE_STORE_BACKEND', 'INVOICE_SEARCH_BACKEND'):
+    os.environ.setdefault(backend, 'off')
+# Here rather than in main(), as the worker processes import this module too
+logging.disable(logging.CRITICAL)
+
+from benchmarks.common import write_results
+from benchmarks.fake_model import FakeGenerativeModel
+from benchmarks.load_upload import make_images
+
+
+def run(pool: Executor, directory: str, args: argparse.Namespace) -> Dict:
+    import app as invoice_app
+    import bulk
+
+    invoice_app.model = FakeGenerativeModel(latency=args.latency)
+    sources = bulk.find_sources([directory])
+    output = os.path.join(directory, 'results.ndjson')
+    for path in (output, output + '.checkpoint'):
+        if os.path.exists(path):
+            os.remove(path)
+    writer = bulk.ResultWriter(output, 'ndjson')
+    checkpoint = bulk.Checkpoint(output + '.checkpoint')
+    progress = bulk.Progress(len(sources), interval=3600)
+    # Start the workers before the clock does, as a long run amortizes it
+    list(pool.map(bulk.read_source, sources[:1] * 16))
+    start_time = time.perf_counter()
+    try:
+        invoice_app.background_loop.run(bulk.run_bulk(
+            sources, pool, writer, checkpoint, progress, args.concurrency, read_ahead=16,
+            force=True))
+    finally:
+        writer.close()
+        checkpoint.close()
+    seconds = time.perf_counter() - start_time
+    return {'seconds': round(seconds, 3),
+            'invoices_per_sec': round(len(sources) / seconds, 2),
+            'succeeded': progress.statuses.get('success', 0)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--invoices', type=int, default=64)
+    parser.add_argument('--size', default='2480x3508', help='Scan size (A4 at 300dpi)')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.01, help='Fake model seconds per call')
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    width, height = (int(value) for value in args.size.split('x'))
+    directory = tempfile.mkdtemp(prefix='bench-bulk-')
+    results = {'cpu_count': os.cpu_count(), 'invoices': args.invoices, 'modes': {}}
+    try:
+        for index, data in enumerate(make_images(args.invoices, width, height)):
+            with open(os.path.join(directory, f'invoice-{index:04d}.jpg'), 'wb') as file:
+                file.write(data)
+
+        counts = [1]
+        while counts[-1] * 2 <= args.max_workers:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != args.max_workers:
+            counts.append(args.max_workers)
+        import bulk
+        pools = {'threads': lambda: ThreadPoolExecutor(args.max_workers)}
+        for count in counts:
+            pools[f'processes_{count}'] = lambda count=count: ProcessPoolExecutor(
+                count, mp_context=multiprocessing.get_context('spawn'),
+                initializer=bulk._init_worker, initargs=(logging.CRITICAL,))
+
+        print(f"{args.invoices} invoices of {args.size}, {os.cpu_count()} CPUs")
+        print(f"{'mode':14} {'seconds':>8} {'inv/s':>8} {'speedup':>8}")
+        for name, make_pool in pools.items():
+            with make_pool() as pool:
+                results['modes'][name] = run(pool, directory, args)
+        base = results['modes']['processes_1']['invoices_per_sec']
+        for name, result in results['modes'].items():
+            result['speedup'] = round(result['invoices_per_sec'] / base, 2)
+            print(f"{name:14} {result['seconds']:8} {result['invoices_per_sec']:8} "
+                  f"{result['speedup']:8}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(f"results: {write_results('bulk', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Benchmark of the model cascade with stub models of differing speed and accuracy.
+
+Invoices from two-line receipts to dense 40-line pages are extracted through
+``ModelRouter`` by two fake models: a fast one (``--fast-latency``) that
+slips on more lines (``--fast-error``) and a slow one that rarely does. A
+slip either misreads a quantity, which the arithmetic checks catch (swapped
+columns would be reconciled without another call), or misreads an item code,
+which nothing catches (``--silent-share``), so accepting a fast result has
+an accuracy cost too.
+
+* ``strong_only``: every invoice on the slow model, as before the cascade;
+* ``cascade``: the fast model first, the slow one when the result scores
+  below ``MODEL_CASCADE_MIN_CONFIDENCE``;
+* ``cascade_tight``: the same with a budget too short for most escalations,
+  once the slow model's latency has been learned.
+
+Reports latency percentiles, model calls per invoice, the share of invoices
+extracted fully correctly and the router's per-tier statistics.
+
+Usage:
+    python -m benchmarks.bench_cascade --invoices 400
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from benchmarks.common import latency_summary, write_results
+from benchmarks.fake_model import FakeGenerativeModel
+from invoice_model import parse_invoice
+from model_router import ModelRouter
+
+FAST = 'fast-model'
+STRONG = 'strong-model'
+
+
+def make_invoice(index: int, rng: random.Random) -> Dict:
+    # Mostly short receipts, some dense invoices
+    count = rng.choice((2, 2, 3, 4, 6, 8, 12, 20, 40))
+    items = []
+    for line in range(count):
+        quantity, price = rng.randint(1, 12), round(rng.uniform(2, 300), 2)
+        items.append({'item_code': str(1000 + line), 'description': f'מוצר {line}',
+                      'quantity': quantity, 'price': price, 'total': round(quantity * price, 2)})
+    return {
+        'company_details': {'name': 'ספק בע"מ', 'address': '', 'tax_id': '512345678'},
+        'invoice_details': {'invoice_number': str(5000 + index), 'date': '01/01/2025'},
+        'line_items': items,
+        'totals': {'subtotal': round(sum(item['total'] for item in items), 2), 'tax': 0,
+                   'total': 0}
+    }
+
+
+def answer(truth: Dict, error: float, silent_share: float, rng: random.Random) -> str:
+    data = json.loads(json.dumps(truth))
+    for item in data['line_items']:
+        if rng.random() < error:
+            if rng.random() < silent_share:
+                item['item_code'] += '7'
+            else:
+                item['quantity'] += 1
+    return json.dumps(data, ensure_ascii=False)
+
+
+def correct(invoice: Dict, truth: Dict) -> bool:
+    return len(invoice['line_items']) == len(truth['line_items']) and all(
+        item['item_code'] == expected['item_code']
+        and abs(item['quantity'] - expected['quantity']) < 0.005
+        and abs(item['total'] - expected['total']) < 0.01
+        for item, expected in zip(invoice['line_items'], truth['line_items']))
+
+
+def make_models(args: argparse.Namespace, corpus: List[Dict]) -> Dict[str, FakeGenerativeModel]:
+    def responder(error: float, seed: int):
+        rng = random.Random(seed)
+        return lambda contents: answer(corpus[int(contents[0])], error, args.silent_share, rng)
+
+    return {
+        FAST: FakeGenerativeModel(FAST, latency=args.fast_latency, distribution='lognormal',
+                                  spread=0.3, seed=1, respond=responder(args.fast_error, 2)),
+        STRONG: FakeGenerativeModel(STRONG, latency=args.strong_latency,
+                                    distribution='lognormal', spread=0.3, seed=3,
+                                    respond=responder(args.strong_error, 4)),
+    }
+
+
+async def run(tiers: List[str], corpus: List[Dict], args: argparse.Namespace,
+              budget: float) -> Dict[str, Any]:
+    models = make_models(args, corpus)
+    router = ModelRouter(tiers)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(args.concurrency))
+    if budget < args.budget:
+        # Learn the strong model's latency first, as a running worker has
+        for _ in range(router.latency.min_samples):
+            router.latency.record(STRONG, args.strong_latency)
+
+    def caller(index: int):
+        async def call(tier: str, rung: Any, remaining: float) -> Dict:
+            response = await asyncio.wait_for(
+                asyncio.to_thread(models[tier].generate_content, [str(index), b'']), remaining)
+            issues = []
+            invoice_data = parse_invoice(response.text, issues).to_dict()
+            return {'invoice_data': invoice_data, 'issues': issues}
+        return call
+
+    async def extract(index: int) -> Dict:
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                best = await router.run(caller(index), time.time() + budget)
+            except TimeoutError:
+                return {'seconds': time.perf_counter() - start_time, 'calls': 1,
+                        'correct': False, 'timeout': True}
+            return {'seconds': time.perf_counter() - start_time, 'calls': best['attempts'],
+                    'correct': correct(best['invoice_data'], corpus[index])}
+
+    outcomes = await asyncio.gather(*(extract(index) for index in range(len(corpus))))
+    stats = router.stats()
+    return {
+        'latency': latency_summary([outcome['seconds'] for outcome in outcomes]),
+        'calls_per_invoice': round(sum(o['calls'] for o in outcomes) / len(outcomes), 3),
+        'accuracy': round(sum(1 for o in outcomes if o['correct']) / len(outcomes), 4),
+        'timeouts': sum(1 for outcome in outcomes if outcome.get('timeout')),
+        'tiers': stats['worker'],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--invoices', type=int, default=400)
+    parser.add_argument('--fast-latency', type=float, default=0.08,
+                        help='Median seconds of the fast model')
+    parser.add_argument('--strong-latency', type=float, default=0.4,
+                        help='Median seconds of the strong model')
+    parser.add_argument('--fast-error', type=float, default=0.02, help='Fast model slips per line')
+    parser.add_argument('--strong-error', type=float, default=0.002,
+                        help='Strong model slips per line')
+    parser.add_argument('--silent-share', type=float, default=0.2,
+                        help='Share of slips the checks cannot see')
+    parser.add_argument('--budget', type=float, default=2.0, help='Seconds per extraction')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    rng = random.Random(11)
+    corpus = [make_invoice(index, rng) for index in range(args.invoices)]
+    modes = {
+        'strong_only': ([STRONG], args.budget),
+        'cascade': ([FAST, STRONG], args.budget),
+        # Room for the fast model, not for the strong one after it
+        'cascade_tight': ([FAST, STRONG], args.fast_latency * 3),
+    }
+    results = {}
+    print(f"{'mode':14} {'p50 ms':>8} {'p99 ms':>8} {'calls':>6} {'accuracy':>9}  served")
+    for name, (tiers, budget) in modes.items():
+        results[name] = result = asyncio.run(run(tiers, corpus, args, budget))
+        served = ', '.join(f"{tier['tier']} {tier['served_share']}" for tier in result['tiers'])
+        print(f"{name:14} {result['latency']['p50_ms']:8} {result['latency']['p99_ms']:8} "
+              f"{result['calls_per_invoice']:6} {result['accuracy']:9}  {served}")
+    print(f"results: {write_results('cascade', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
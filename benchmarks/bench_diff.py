@@ -0,0 +1,212 @@
+"""
+Benchmark of the ``/generate_report`` diff engine at 1k and 10k line items.
+
+A synthetic invoice is edited the way users edit extractions: rows
+reordered, quantities and prices corrected, descriptions retyped (on items
+without an item code, so only similarity can pair them), rows deleted and
+inserted. Compared on time and on the share of edited rows paired with
+their true original:
+
+* ``legacy``: the browser's original index-by-index comparison;
+* ``naive``: best description match over all pairs, O(n^2) (only up to
+  ``--naive-max`` items);
+* ``current``: ``invoice_diff.diff_invoices``, and the whole
+  ``/generate_report`` request through Flask's test client.
+
+Usage:
+    python -m benchmarks.bench_diff --sizes 1000 10000 --repeat 5
+"""
+
+import os
+import argparse
+import logging
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+os.environ.setdefault('GEMINI_API_KEY', 'offline-benchmark')
+for backend in ('RESULT_CACHE_BACKEND', 'RATE_LIMIT_BACKEND', 'SINGLE_FLIGHT_BACKEND'):
+    os.environ.setdefault(backend, 'off')
+
+from benchmarks.common import latency_summary, write_results
+from invoice_diff import diff_invoices, normalize, trigrams
+
+WORDS = ('חלב', 'לחם', 'גבינה', 'ביצים', 'שמן', 'סוכר', 'קמח', 'אורז', 'פסטה', 'קפה', 'תה',
+         'milk', 'bread', 'cheese', 'olive', 'flour', 'rice', 'sugar', 'coffee', 'tea', 'box',
+         'pack', 'bottle', 'white', 'whole', 'organic', 'large', 'small', 'fresh', 'frozen')
+
+
+def make_invoice(size: int, rng: random.Random) -> Dict:
+    items = []
+    for index in range(size):
+        quantity = rng.randint(1, 20)
+        price = round(rng.uniform(1, 300), 2)
+        description = ' '.join(rng.sample(WORDS, 3)) + f' {rng.choice((250, 500, 1000))}g #{index}'
+        items.append({
+            # A third of the rows have no item code
+            'item_code': f'SKU-{index:06d}' if rng.random() > 0.33 else '',
+            'description': description,
+            'quantity': quantity,
+            'price': price,
+            'total': round(quantity * price, 2)
+        })
+    subtotal = round(sum(item['total'] for item in items), 2)
+    return {'line_items': items,
+            'totals': {'subtotal': subtotal, 'tax': round(subtotal * 0.17, 2),
+                       'total': round(subtotal * 1.17, 2)},
+            'company_details': {'name': 'ספק בע"מ', 'address': '', 'tax_id': '512345678'},
+            'invoice_details': {'invoice_number': '1001', 'date': '01/01/2024'}}
+
+
+def retype(text: str, rng: random.Random) -> str:
+    """A description with a typo or two and different punctuation."""
+    chars = list(text)
+    for _ in range(rng.randint(1, 2)):
+        position = rng.randrange(len(chars))
+        chars[position] = rng.choice('abcdefghאבגדה')
+    return ''.join(chars).replace(' ', ', ', 1)
+
+
+def edit_invoice(original: Dict, rng: random.Random) -> Tuple[Dict, List[Optional[int]]]:
+    """The edited invoice and, per edited row, the index of its true original."""
+    rows = []
+    for index, item in enumerate(original['line_items']):
+        if rng.random() < 0.01:
+            continue  # deleted
+        item = dict(item)
+        if rng.random() < 0.05:
+            item['quantity'] += rng.randint(1, 3)
+        if rng.random() < 0.05:
+            item['price'] = round(item['price'] * rng.uniform(0.8, 1.2), 2)
+        item['total'] = round(item['quantity'] * item['price'], 2)
+        if not item['item_code'] and rng.random() < 0.1:
+            item['description'] = retype(item['description'], rng)
+        rows.append((index, item))
+
+    # Neighbouring rows swapped, as when the model read two columns out of order
+    for position in range(0, len(rows) - 1, 2):
+        if rng.random() < 0.1:
+            rows[position], rows[position + 1] = rows[position + 1], rows[position]
+    for _ in range(max(1, len(rows) // 100)):
+        rows.insert(rng.randrange(len(rows) + 1), (None, {
+            'item_code': '', 'description': f'new item {rng.random():.6f}',
+            'quantity': 1, 'price': 1.0, 'total': 1.0}))
+
+    items = [item for _, item in rows]
+    subtotal = round(sum(item['total'] for item in items), 2)
+    current = dict(original, line_items=items,
+                   totals={'subtotal': subtotal, 'tax': round(subtotal * 0.17, 2),
+                           'total': round(subtotal * 1.17, 2)})
+    return current, [index for index, _ in rows]
+
+
+# The original implementation
+# ---------------------------
+
+def legacy_diff(original: Dict, current: Dict) -> List[Optional[int]]:
+    """The browser's comparison: row i of the edit against row i of the original."""
+    changes_by_item = {}
+    for index, orig in enumerate(original['line_items']):
+        if index >= len(current['line_items']):
+            continue
+        curr = current['line_items'][index]
+        item_changes = []
+        for field in ('quantity', 'price', 'total'):
+            if abs(float(orig[field]) - float(curr[field])) > 0.001:
+                item_changes.append({'field': field, 'original': orig[field],
+                                     'current': curr[field]})
+        if item_changes:
+            changes_by_item[index] = item_changes
+    count = len(original['line_items'])
+    return [index if index < count else None for index in range(len(current['line_items']))]
+
+
+def naive_align(original: Dict, current: Dict, threshold: float = 0.5) -> List[Optional[int]]:
+    """Best description match of every edited row over all original rows."""
+    grams = [trigrams(normalize(item['description'])) for item in original['line_items']]
+    taken = set()
+    alignment = []
+    for item in current['line_items']:
+        mine = trigrams(normalize(item['description']))
+        best, best_score = None, threshold
+        for index, theirs in enumerate(grams):
+            if index in taken:
+                continue
+            score = 2 * len(mine & theirs) / (len(mine) + len(theirs))
+            if score >= best_score:
+                best, best_score = index, score
+        if best is not None:
+            taken.add(best)
+        alignment.append(best)
+    return alignment
+
+
+def accuracy(alignment: List[Optional[int]], truth: List[Optional[int]]) -> float:
+    return round(sum(1 for got, want in zip(alignment, truth) if got == want) / len(truth), 4)
+
+
+def timed(func, repeat: int):
+    latencies = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func()
+        latencies.append(time.perf_counter() - start_time)
+    return result, latency_summary(latencies)
+
+
+def bench_size(size: int, repeat: int, naive_max: int) -> Dict:
+    import app as invoice_app
+    rng = random.Random(size)
+    original = make_invoice(size, rng)
+    current, truth = edit_invoice(original, rng)
+    results = {'edited_items': len(current['line_items'])}
+
+    alignment, latency = timed(lambda: legacy_diff(original, current), repeat)
+    results['legacy'] = {'latency': latency, 'accuracy': accuracy(alignment, truth)}
+
+    if size <= naive_max:
+        alignment, latency = timed(lambda: naive_align(original, current), 1)
+        results['naive'] = {'latency': latency, 'accuracy': accuracy(alignment, truth)}
+
+    report, latency = timed(lambda: diff_invoices(original, current), repeat)
+    results['current'] = {'latency': latency, 'accuracy': accuracy(report['alignment'], truth),
+                          'summary': report['summary']}
+
+    client = invoice_app.app.test_client()
+    body = {'original_values': original, 'current_values': current}
+
+    def request():
+        response = client.post('/generate_report', json=body)
+        assert response.status_code == 200, response.get_data(as_text=True)[:200]
+        return response
+
+    _, latency = timed(request, repeat)
+    results['current']['endpoint_latency'] = latency
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--naive-max', type=int, default=2000,
+                        help='Largest invoice to align with the O(n^2) baseline')
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    results = {}
+    print(f"{'items':>6} {'impl':8} {'p50 ms':>9} {'accuracy':>9}")
+    for size in args.sizes:
+        results[str(size)] = case = bench_size(size, args.repeat, args.naive_max)
+        for name in ('legacy', 'naive', 'current'):
+            if name in case:
+                print(f"{size:6} {name:8} {case[name]['latency']['p50_ms']:9} "
+                      f"{case[name]['accuracy']:9}")
+        print(f"{size:6} {'endpoint':8} {case['current']['endpoint_latency']['p50_ms']:9}")
+
+    print(f"results: {write_results('diff', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+Benchmark of Firebase URL ingestion against a local storage stand-in.
+
+A threaded HTTP server plays Firebase Storage: keep-alive connections with a
+configurable setup cost (standing in for the TLS handshake), throttled
+transfer, and files sent with or without ``Content-Length``. The original
+code (``legacy``: one unpooled ``requests.get`` per file, no timeouts, size
+checked after the whole file arrived, batch items downloaded inside their
+extraction slot) is compared with ``downloads.Downloader`` and the app's
+batch prefetching (``current``) on:
+
+* ``pooled``: sequential downloads of one invoice photo;
+* ``oversize``: a file far above ``MAX_FILE_SIZE``, with and without
+  ``Content-Length`` (time until rejected and bytes the server sent);
+* ``stream_decode``: time until a throttled 12MP photo is decoded;
+* ``batch``: ``/upload/batch`` processing of Firebase URLs with the fake model.
+
+Usage:
+    python -m benchmarks.bench_downloads --handshake-ms 30 --batch-size 16
+"""
+
+import os
+import argparse
+import asyncio
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlsplit
+
+os.environ.setdefault('GEMINI_API_KEY', 'offline-benchmark')
+for backend in ('RESULT_CACHE_BACKEND', 'RATE_LIMIT_BACKEND', 'SINGLE_FLIGHT_BACKEND'):
+    os.environ.setdefault(backend, 'off')
+
+import requests
+
+from benchmarks.common import latency_summary, write_results
+from benchmarks.fake_model import FakeGenerativeModel
+from benchmarks.load_upload import make_images
+from downloads import Downloader, DownloadTooLarge
+from image_pipeline import load_image
+
+MAX_FILE_SIZE = 5 * 1024 * 1024
+SEND_CHUNK = 16 * 1024
+
+
+# Storage stand-in
+# ----------------
+
+class StorageHandler(BaseHTTPRequestHandler):
+    """Serves ``/<name>`` from ``server.files``; ``?kbps=`` throttles, ``?nolength`` chunks."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.count('connections', 1)
+        time.sleep(self.server.handshake)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        params = parse_qs(url.query, keep_blank_values=True)
+        data = self.server.files.get(url.path.strip('/'))
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        kbps = float(params.get('kbps', ['0'])[0])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if 'nolength' in params:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        else:
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        try:
+            for offset in range(0, len(data), SEND_CHUNK):
+                chunk = data[offset:offset + SEND_CHUNK]
+                self.wfile.write(chunk)
+                self.server.count('bytes_sent', len(chunk))
+                if kbps:
+                    time.sleep(len(chunk) / (kbps * 1024))
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+class StorageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files: Dict[str, bytes], handshake: float):
+        super().__init__(('127.0.0.1', 0), StorageHandler)
+        self.files = files
+        self.handshake = handshake
+        self.counters = {'connections': 0, 'bytes_sent': 0}
+        self._lock = threading.Lock()
+
+    def count(self, counter: str, amount: int) -> None:
+        with self._lock:
+            self.counters[counter] += amount
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters = {'connections': 0, 'bytes_sent': 0}
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+# The original implementation
+# -----------------------
+
+def legacy_download(url: str) -> bytes:
+    response = requests.get(url)
+    response.raise_for_status()
+    return response.content
+
+
+# Cases
+# -----
+
+def bench_pooled(server: StorageServer, repeat: int) -> Dict:
+    url = f'{server.base_url}/photo.jpg'
+    downloader = Downloader()
+    results = {}
+    for name, fetch in (('legacy', legacy_download),
+                        ('current', lambda url: downloader.fetch(url, MAX_FILE_SIZE)[0])):
+        server.reset()
+        latencies = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            fetch(url)
+            latencies.append(time.perf_counter() - start_time)
+        results[name] = {'latency': latency_summary(latencies),
+                         'connections': server.counters['connections']}
+    return results
+
+
+def bench_oversize(server: StorageServer) -> Dict:
+    results = {}
+    for variant, query in (('content_length', ''), ('no_content_length', '?nolength')):
+        url = f'{server.base_url}/huge.bin{query}'
+        results[variant] = {}
+        for name in ('legacy', 'current'):
+            server.reset()
+            start_time = time.perf_counter()
+            if name == 'legacy':
+                rejected = len(legacy_download(url)) > MAX_FILE_SIZE
+            else:
+                try:
+                    Downloader().fetch(url, MAX_FILE_SIZE)
+                    rejected = False
+                except DownloadTooLarge:
+                    rejected = True
+            elapsed = time.perf_counter() - start_time
+            # Let the server notice the closed connection
+            time.sleep(0.2)
+            results[variant][name] = {
+                'rejected': rejected,
+                'ms': round(elapsed * 1000, 1),
+                'server_sent_mb': round(server.counters['bytes_sent'] / 1024 / 1024, 2)
+            }
+    return results
+
+
+def bench_stream_decode(server: StorageServer, repeat: int, kbps: float) -> Dict:
+    url = f'{server.base_url}/photo_12mp.jpg?kbps={kbps}'
+    max_size = (600, 600)
+    downloader = Downloader()
+
+    def decode(body):
+        img = load_image(body, max_size)
+        img.load()
+        return img
+
+    def legacy():
+        img = load_image(legacy_download(url), max_size)
+        img.load()
+        return img
+
+    def current():
+        return downloader.fetch(url, MAX_FILE_SIZE, decode=decode)[1]
+
+    results = {'file_kb': round(len(server.files['photo_12mp.jpg']) / 1024, 1),
+               'kbps': kbps}
+    for name, run in (('legacy', legacy), ('current', current)):
+        latencies = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            img = run()
+            latencies.append(time.perf_counter() - start_time)
+            assert img is not None and max(img.size) <= 600
+        results[name] = latency_summary(latencies)
+    return results
+
+
+async def legacy_batch(invoice_app, items: List[Dict], concurrency: int) -> List[Dict]:
+    """The original batch flow: each item downloads once it holds an extraction slot."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def item_flow(item):
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            file_data = await loop.run_in_executor(None, legacy_download, item['firebase_url'])
+            return await invoice_app.extract_invoice(file_data, force=True,
+                                                     lane=invoice_app.BULK)
+
+    return await asyncio.gather(*(item_flow(item) for item in items))
+
+
+def bench_batch(server: StorageServer, size: int, concurrency: int, kbps: float,
+                latency: float) -> Dict:
+    import app as invoice_app
+    invoice_app.model = FakeGenerativeModel(latency=latency)
+
+    results = {'items': size, 'concurrency': concurrency, 'kbps': kbps,
+               'model_latency': latency}
+    for name in ('legacy', 'current'):
+        urls = [f'{server.base_url}/batch-{index}.jpg?kbps={kbps}&run={name}'
+                for index in range(size)]
+        items = [{'source': url, 'firebase_url': url} for url in urls]
+        if name == 'legacy':
+            flow = legacy_batch(invoice_app, items, concurrency)
+        else:
+            flow = invoice_app.process_batch(items, concurrency, force=True)
+        start_time = time.perf_counter()
+        outcome = invoice_app.background_loop.run(flow, timeout=600)
+        elapsed = time.perf_counter() - start_time
+        if name == 'current':
+            failed = [item for item in outcome if item['status'] != 'success']
+            assert not failed, failed
+        results[name] = {'wall_seconds': round(elapsed, 3),
+                         'items_per_sec': round(size / elapsed, 2)}
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--handshake-ms', type=float, default=30,
+                        help='Connection setup cost of the stand-in')
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--kbps', type=float, default=4096,
+                        help='Transfer rate for the stream decode case')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--batch-concurrency', type=int, default=4)
+    parser.add_argument('--batch-kbps', type=float, default=1024)
+    parser.add_argument('--model-latency', type=float, default=0.3)
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    files = {
+        'photo.jpg': make_images(1, 1600, 1200)[0],
+        'photo_12mp.jpg': make_images(1, 4032, 3024, seed=1)[0],
+        'huge.bin': os.urandom(4 * MAX_FILE_SIZE)
+    }
+    for index, image in enumerate(make_images(args.batch_size, 1240, 1754, seed=2)):
+        files[f'batch-{index}.jpg'] = image
+
+    server = StorageServer(files, args.handshake_ms / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        results = {
+            'handshake_ms': args.handshake_ms,
+            'pooled': bench_pooled(server, args.repeat),
+            'oversize': bench_oversize(server),
+            'stream_decode': bench_stream_decode(server, max(args.repeat // 6, 3), args.kbps),
+            'batch': bench_batch(server, args.batch_size, args.batch_concurrency,
+                                 args.batch_kbps, args.model_latency)
+        }
+    finally:
+        server.shutdown()
+
+    pooled = results['pooled']
+    print(f"pooled (p50 ms):        legacy {pooled['legacy']['latency']['p50_ms']} "
+          f"({pooled['legacy']['connections']} connections), "
+          f"current {pooled['current']['latency']['p50_ms']} "
+          f"({pooled['current']['connections']} connections)")
+    for variant, case in results['oversize'].items():
+        print(f"oversize {variant + ':':19} legacy {case['legacy']['ms']}ms / "
+              f"{case['legacy']['server_sent_mb']}MB, current {case['current']['ms']}ms / "
+              f"{case['current']['server_sent_mb']}MB")
+    decode = results['stream_decode']
+    print(f"stream decode (p50 ms): legacy {decode['legacy']['p50_ms']}, "
+          f"current {decode['current']['p50_ms']}")
+    batch = results['batch']
+    print(f"batch (items/s):        legacy {batch['legacy']['items_per_sec']}, "
+          f"current {batch['current']['items_per_sec']}")
+    print(f"results: {write_results('bench_downloads', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
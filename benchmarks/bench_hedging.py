@@ -0,0 +1,106 @@
+"""
+Benchmark of hedged model calls against a fake model with a long latency tail.
+
+Calls go through the app's ``process_with_timeout`` with a fake model whose
+latency is lognormal around ``--latency`` and whose ``--stall-rate`` of
+calls hang for ``--stall`` seconds, longer than the ``--timeout``. That is
+the shape behind the 408s on ``/upload``: most calls are quick, a few only
+end at the deadline, and a retry of one of those would be quick again.
+
+* ``off``: no hedging, as before;
+* ``on``: hedging at ``--percentile`` with a ``--budget`` of extra calls.
+
+Reports latency percentiles, timeouts, extra model calls and the hedger's
+fired/won/wasted counts.
+
+Usage:
+    python -m benchmarks.bench_hedging --calls 1000
+"""
+
+import os
+import argparse
+import asyncio
+import logging
+import time
+from typing import Dict
+
+os.environ.setdefault('GEMINI_API_KEY', 'offline-benchmark')
+for backend in ('RESULT_CACHE_BACKEND', 'RATE_LIMIT_BACKEND', 'SINGLE_FLIGHT_BACKEND'):
+    os.environ.setdefault(backend, 'off')
+
+from benchmarks.common import latency_summary, write_results
+from benchmarks.fake_model import FakeGenerativeModel
+from executors import ModelExecutor
+from hedging import Hedger
+
+
+def run(hedging: bool, args: argparse.Namespace) -> Dict:
+    import app as invoice_app
+
+    model = FakeGenerativeModel(latency=args.latency, distribution='lognormal', spread=0.3,
+                                stall_rate=args.stall_rate, stall_latency=args.stall,
+                                seed=args.seed)
+    # Stalled calls hold their thread until the deadline; leave room for them
+    invoice_app.model_executor = ModelExecutor(max_workers=args.concurrency * 3)
+    invoice_app.hedger = hedger = Hedger(enabled=hedging, percentile=args.percentile,
+                                         budget=args.budget, min_delay=0)
+    image_parts = [{'mime_type': 'image/jpeg', 'data': b'\xff\xd8'}]
+
+    async def one_call(semaphore: asyncio.Semaphore) -> Dict:
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                await invoice_app.process_with_timeout(model, 'prompt', image_parts,
+                                                       timeout=args.timeout)
+                outcome = 'success'
+            except TimeoutError:
+                outcome = 'timeout'
+            return {'seconds': time.perf_counter() - start_time, 'outcome': outcome}
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        return await asyncio.gather(*(one_call(semaphore) for _ in range(args.calls)))
+
+    outcomes = invoice_app.background_loop.run(run_all())
+    invoice_app.model_executor.shutdown()
+    stats = hedger.stats()
+    return {
+        'latency': latency_summary([outcome['seconds'] for outcome in outcomes]),
+        'timeouts': sum(1 for outcome in outcomes if outcome['outcome'] == 'timeout'),
+        'model_calls': model.stats()['calls'],
+        'extra_calls': round(model.stats()['calls'] / args.calls - 1, 4),
+        'stalled': model.stats()['stalled'],
+        'hedges': {key: stats[key] for key in ('fired', 'won', 'wasted', 'no_budget',
+                                               'no_capacity', 'no_time', 'hedge_rate')},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.2, help='Median seconds per call')
+    parser.add_argument('--stall-rate', type=float, default=0.02, help='Share of calls that hang')
+    parser.add_argument('--stall', type=float, default=5.0, help='Seconds a hanging call takes')
+    parser.add_argument('--timeout', type=float, default=3.0, help='Seconds per call')
+    parser.add_argument('--percentile', type=float, default=0.95)
+    parser.add_argument('--budget', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=5)
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    results = {}
+    print(f"{'hedging':8} {'p50 ms':>8} {'p99 ms':>9} {'max ms':>9} {'timeouts':>8} "
+          f"{'extra':>6} {'fired':>6} {'won':>5} {'wasted':>6}")
+    for name, hedging in (('off', False), ('on', True)):
+        results[name] = result = run(hedging, args)
+        latency, hedges = result['latency'], result['hedges']
+        print(f"{name:8} {latency['p50_ms']:8} {latency['p99_ms']:9} {latency['max_ms']:9} "
+              f"{result['timeouts']:8} {result['extra_calls']:6} {hedges['fired']:6} "
+              f"{hedges['won']:5} {hedges['wasted']:6}")
+    print(f"results: {write_results('hedging', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
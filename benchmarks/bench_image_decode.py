@@ -0,0 +1,132 @@
+"""
+Micro-benchmark of ``process_image_memory`` over realistic image sizes.
+
+Reports latency percentiles, single-core throughput (images/sec) and peak RSS
+for each size.
+
+Compares the original implementation (``legacy``: ``thumbnail`` with its
+default 2x draft margin, no EXIF orientation) with the current pipeline
+(``current``: draft decode close to the target, scale-aware resampling, EXIF
+orientation). Every case runs in a fresh process so peak RSS is attributable
+to that case alone.
+
+Usage:
+    python -m benchmarks.bench_image_decode --repeat 10
+"""
+
+import os
+import argparse
+import base64
+import io
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
+
+from PIL import Image, ImageDraw
+
+from benchmarks.common import latency_summary, peak_rss_mb, write_results
+
+# (name, width, height, format, exif orientation)
+CORPUS = [
+    ('vga_jpeg', 640, 480, 'JPEG', 1),
+    ('scan_a4_150dpi_png', 1240, 1754, 'PNG', 1),
+    ('photo_2mp_jpeg', 1600, 1200, 'JPEG', 1),
+    ('photo_8mp_jpeg', 3264, 2448, 'JPEG', 1),
+    ('photo_12mp_jpeg', 4032, 3024, 'JPEG', 1),
+    ('photo_12mp_rotated_jpeg', 4032, 3024, 'JPEG', 6),
+    ('scan_a4_300dpi_jpeg', 2480, 3508, 'JPEG', 1),
+]
+
+
+def make_image(width: int, height: int, fmt: str, orientation: int) -> bytes:
+    """Synthetic invoice-like page (dark text blocks on a light background)."""
+    img = Image.new('RGB', (width, height), (245, 243, 238))
+    draw = ImageDraw.Draw(img)
+    line = max(height // 60, 6)
+    for y in range(line * 3, height - line * 3, line * 2):
+        for x in range(width // 20, width - width // 10, width // 8):
+            draw.rectangle((x, y, x + width // 12, y + line), fill=(30, 30, 40))
+    output = io.BytesIO()
+    if fmt == 'JPEG':
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        img.save(output, format='JPEG', quality=90, exif=exif)
+    else:
+        img.save(output, format=fmt)
+    return output.getvalue()
+
+
+def legacy_process(file_data: bytes) -> str:
+    """The original implementation: LANCZOS thumbnail and re-encode."""
+    img = Image.open(io.BytesIO(file_data))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail((600, 600), Image.Resampling.LANCZOS)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=70, optimize=True, progressive=True)
+    return base64.b64encode(output.getvalue()).decode('utf-8')
+
+
+def run_case(implementation: str, file_data: bytes, repeat: int) -> Dict:
+    """Time one implementation on one image (runs in a child process)."""
+    logging.disable(logging.CRITICAL)
+    os.environ.setdefault('RESULT_CACHE_BACKEND', 'off')
+    # Import the app for both implementations so baselines are comparable
+    from app import process_image_memory
+
+    if implementation == 'legacy':
+        process = legacy_process
+    else:
+        def process(data):
+            return process_image_memory(data)[0]['data']
+
+    # Load codecs and plugins first so one-time setup is not counted
+    process(make_image(64, 48, 'JPEG', 6))
+    baseline_rss = peak_rss_mb()
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        payload = process(file_data)
+        timings.append(time.perf_counter() - start_time)
+
+    # The original returned base64 text, the current pipeline raw JPEG bytes
+    jpeg = payload if isinstance(payload, bytes) else base64.b64decode(payload)
+    output = Image.open(io.BytesIO(jpeg))
+    return {
+        'latency': latency_summary(timings),
+        'images_per_sec': round(len(timings) / sum(timings), 1),
+        'peak_rss_increase_mb': round(peak_rss_mb() - baseline_rss, 1),
+        'output_size': list(output.size),
+        'output_kb': round(len(jpeg) / 1024, 1)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    print(f"{'image':28} {'impl':8} {'p50 ms':>8} {'p95 ms':>8} {'img/s':>7} "
+          f"{'peak RSS +MB':>13} {'output':>10}")
+    for name, width, height, fmt, orientation in CORPUS:
+        file_data = make_image(width, height, fmt, orientation)
+        results[name] = {'input_kb': round(len(file_data) / 1024, 1), 'size': [width, height]}
+        for implementation in ('legacy', 'current'):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                case = pool.submit(run_case, implementation, file_data, args.repeat).result()
+            results[name][implementation] = case
+            print(f"{name:28} {implementation:8} {case['latency']['p50_ms']:8.1f} "
+                  f"{case['latency']['p95_ms']:8.1f} {case['images_per_sec']:7.1f} "
+                  f"{case['peak_rss_increase_mb']:13.1f} "
+                  f"{'x'.join(map(str, case['output_size'])):>10}")
+
+    print(f"results: {write_results('image_decode', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
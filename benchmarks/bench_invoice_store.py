@@ -0,0 +1,190 @@
+"""
+Benchmark of the saved invoice store at around a million invoices.
+
+* ``writes``: saves per second through ``InvoiceStore.save`` (queued and
+  committed in batches by the writer thread), what the writer alone
+  sustains, and how long ``save`` blocks the request, against one commit
+  per save as a plain implementation would do (``per_save_commit``, with
+  SQLite's default journal and in WAL mode, measured on a sample);
+* ``lookups``: latency of fetching by id and finding by tax id, invoice
+  number, date and image hash once ``--count`` invoices are stored, against
+  a scan of the JSON for the tax id (``unindexed``).
+
+The database is written to a temporary directory unless ``--path`` is given.
+
+Usage:
+    python -m benchmarks.bench_invoice_store --count 1000000
+"""
+
+import os
+import argparse
+import hashlib
+import logging
+import random
+import sqlite3
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from benchmarks.common import latency_summary, write_results
+from invoice_store import StoreBusyError, SQLiteInvoiceStore, make_record
+
+SUPPLIERS = 5000
+
+
+def make_invoice(index: int, rng: random.Random) -> Dict:
+    supplier = rng.randrange(SUPPLIERS)
+    items = []
+    for line in range(rng.randint(2, 6)):
+        quantity, price = rng.randint(1, 10), round(rng.uniform(1, 200), 2)
+        items.append({'item_code': f'{supplier}-{rng.randrange(500)}',
+                      'description': f'פריט {line} של ספק {supplier}',
+                      'quantity': quantity, 'price': price, 'total': round(quantity * price, 2)})
+    subtotal = round(sum(item['total'] for item in items), 2)
+    return {
+        'company_details': {'name': f'ספק {supplier} בע"מ', 'address': 'תל אביב',
+                            'tax_id': str(510000000 + supplier)},
+        'invoice_details': {'invoice_number': str(100000 + index),
+                            'date': f'{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/'
+                                    f'{rng.choice((2022, 2023, 2024))}'},
+        'line_items': items,
+        'totals': {'subtotal': subtotal, 'tax': round(subtotal * 0.17, 2),
+                   'total': round(subtotal * 1.17, 2)}
+    }
+
+
+def image_hash(index: int) -> str:
+    return hashlib.sha256(str(index).encode()).hexdigest()
+
+
+def bench_per_save_commit(path: str, sample: int, wal: bool) -> Dict:
+    """One INSERT and commit per save, with SQLite's defaults or in WAL mode."""
+    store = SQLiteInvoiceStore(path)
+    if wal:
+        connection = store._connect()
+    else:
+        connection = sqlite3.connect(path)
+        connection.execute('PRAGMA journal_mode=DELETE')
+    rng = random.Random(1)
+    start_time = time.perf_counter()
+    for index in range(sample):
+        record = make_record(make_invoice(index, rng), image_hash=image_hash(-index))
+        with connection:
+            connection.execute(
+                'INSERT INTO invoices (id, tax_id, invoice_number, date, image_hash, '
+                'created_at, updated_at, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (record['id'], record['tax_id'], record['invoice_number'], record['date'],
+                 record['image_hash'], record['created_at'], record['updated_at'],
+                 record['data']))
+    elapsed = time.perf_counter() - start_time
+    connection.close()
+    return {'saves': sample, 'saves_per_sec': round(sample / elapsed)}
+
+
+def bench_batched(store: SQLiteInvoiceStore, count: int, seed: int) -> Dict:
+    rng = random.Random(seed)
+    save_latencies = []
+    ids = []
+    busy = 0
+    start_time = time.perf_counter()
+    for index in range(count):
+        invoice = make_invoice(index, rng)
+        while True:
+            call_start = time.perf_counter()
+            try:
+                ids.append(store.save(invoice, image_hash=image_hash(index)))
+                break
+            except StoreBusyError:
+                # Back-pressure: the writer is behind, as a burst would see
+                busy += 1
+                time.sleep(0.001)
+        if index % 100 == 0:
+            save_latencies.append(time.perf_counter() - call_start)
+    store.flush()
+    elapsed = time.perf_counter() - start_time
+    writer = store.stats()
+    return {
+        'saves': count,
+        'saves_per_sec': round(count / elapsed),
+        # What the writer thread alone sustains, without building the invoices
+        'writer_saves_per_sec': round(writer['saved'] / writer['write_seconds']),
+        'save_call': latency_summary(save_latencies),
+        'busy_retries': busy,
+        'writer': writer
+    }, ids
+
+
+def time_lookups(lookup: Callable[[int], object], repeat: int) -> Dict:
+    latencies = []
+    for index in range(repeat):
+        start_time = time.perf_counter()
+        lookup(index)
+        latencies.append(time.perf_counter() - start_time)
+    return latency_summary(latencies)
+
+
+def bench_lookups(store: SQLiteInvoiceStore, ids: List[str], repeat: int) -> Dict:
+    rng = random.Random(7)
+    picks = [rng.randrange(len(ids)) for _ in range(repeat)]
+    sample = [store.get(ids[pick]) for pick in picks[:50]]
+    assert all(saved is not None for saved in sample)
+    dates = [saved['invoice_data']['invoice_details']['date'] for saved in sample]
+
+    results = {
+        'by_id': time_lookups(lambda i: store.get(ids[picks[i]]), repeat),
+        'by_tax_id': time_lookups(
+            lambda i: store.find(tax_id=str(510000000 + picks[i] % SUPPLIERS)), repeat),
+        'by_invoice_number': time_lookups(
+            lambda i: store.find(invoice_number=str(100000 + picks[i])), repeat),
+        'by_date': time_lookups(lambda i: store.find(date=dates[i % len(dates)]), repeat),
+        'by_image_hash': time_lookups(
+            lambda i: store.find(image_hash=image_hash(picks[i])), repeat),
+    }
+    connection = store._connection()
+    results['unindexed'] = time_lookups(lambda i: connection.execute(
+        "SELECT id FROM invoices WHERE json_extract(data, '$.company_details.tax_id') = ? "
+        "LIMIT 20", (str(510000000 + i),)).fetchall(), 3)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=1000000, help='Invoices stored')
+    parser.add_argument('--per-save-sample', type=int, default=2000,
+                        help='Saves timed with one commit each')
+    parser.add_argument('--repeat', type=int, default=1000, help='Lookups per index')
+    parser.add_argument('--path', help='Database directory (default: a temporary one)')
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    directory = args.path or tempfile.mkdtemp(prefix='invoice-store-')
+    results = {'count': args.count}
+
+    per_save = {
+        mode: bench_per_save_commit(os.path.join(directory, f'per-save-{mode}.db'),
+                                    args.per_save_sample, wal=mode == 'wal')
+        for mode in ('default', 'wal')
+    }
+    path = os.path.join(directory, 'invoices.db')
+    store = SQLiteInvoiceStore(path)
+    batched, ids = bench_batched(store, args.count, seed=2)
+    results['writes'] = {'per_save_commit': per_save, 'batched': batched}
+    print(f"writes (saves/s):   per-save commit {per_save['default']['saves_per_sec']} "
+          f"(WAL {per_save['wal']['saves_per_sec']}), batched {batched['saves_per_sec']} "
+          f"end to end, writer alone {batched['writer_saves_per_sec']}")
+    print(f"save() call: p50 {batched['save_call']['p50_ms']}ms, "
+          f"p99 {batched['save_call']['p99_ms']}ms, {batched['writer']['avg_batch']} per batch")
+
+    results['lookups'] = lookups = bench_lookups(store, ids, args.repeat)
+    results['db_mb'] = round(sum(os.path.getsize(os.path.join(directory, name))
+                                 for name in os.listdir(directory)
+                                 if name.startswith('invoices.db')) / 1024 / 1024, 1)
+    print(f"lookups at {store.count()} invoices ({results['db_mb']}MB), p50/p99 ms:")
+    for name, latency in lookups.items():
+        print(f"  {name:18} {latency['p50_ms']:>9} {latency['p99_ms']:>9}")
+    print(f"results: {write_results('invoice_store', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
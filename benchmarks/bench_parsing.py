@@ -0,0 +1,201 @@
+"""
+Micro-benchmark of response parsing and JSON serialization.
+
+Compares the original dict-based ``process_gemini_response`` (``legacy``,
+copied below, with per-item INFO logging to a discarded handler) against
+the single-pass ``invoice_model.parse_invoice`` (``current``) on synthetic
+Gemini responses with 10, 100 and 1000 line items, and checks that both
+produce the same invoice. Serialization compares Flask's default JSON
+provider with ``fast_json.FastJSONProvider`` on the ``/upload`` payload.
+
+Usage:
+    python -m benchmarks.bench_parsing --repeat 200
+"""
+
+import argparse
+import json
+import logging
+import random
+import re
+import time
+from typing import Callable, Dict, List
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from benchmarks.common import latency_summary, write_results
+from fast_json import FastJSONProvider
+from invoice_model import parse_invoice
+
+SIZES = (10, 100, 1000)
+
+legacy_logger = logging.getLogger('benchmarks.legacy_parser')
+
+
+def make_response(item_count: int, seed: int = 0) -> str:
+    """Gemini-like output: fenced JSON, mixed number formats, a few bad totals."""
+    rng = random.Random(seed)
+    items = []
+    subtotal = 0
+    for index in range(item_count):
+        quantity = rng.randint(1, 40)
+        price = round(rng.uniform(1, 900), 2)
+        total = round(quantity * price, 2)
+        subtotal += total
+        if index % 17 == 3:
+            total += 10  # Misread total the validator corrects
+        items.append({
+            'item_code': f'SKU-{index:05d}',
+            'description': f'מוצר מספר {index} - חבילה של {quantity % 6 + 1} יחידות',
+            'quantity': quantity if index % 3 else str(quantity),
+            'price': price if index % 4 else f'₪{price:,.2f}',
+            'total': total if index % 5 else f'{total:,.2f} ש"ח'
+        })
+    data = {
+        'company_details': {'name': 'ספק בע"מ', 'address': 'רחוב הרצל 1, תל אביב',
+                            'tax_id': '512345678'},
+        'invoice_details': {'invoice_number': 'INV-2024-0042', 'date': '2024-03-15'},
+        'line_items': items,
+        'totals': {'subtotal': round(subtotal, 2), 'tax': 0, 'total': 0}
+    }
+    return '```json\n' + json.dumps(data, ensure_ascii=False, indent=2) + '\n```'
+
+
+# The original implementation
+# -----------------------
+
+def legacy_float(value, field_name: str = '') -> float:
+    try:
+        if value is None or str(value).lower().strip() in ('none', 'null', '', 'undefined', 'nan'):
+            legacy_logger.warning(f"Empty or None value for {field_name}, using 0.0")
+            return 0.0
+        if isinstance(value, (int, float)):
+            return round(float(value), 2)
+        cleaned = re.sub(r'[^\d.-]', '', str(value).strip())
+        if not cleaned:
+            legacy_logger.warning(f"No numeric value found in '{value}' for {field_name}")
+            return 0.0
+        return round(abs(float(cleaned)), 2)
+    except (ValueError, TypeError) as e:
+        legacy_logger.warning(f"Could not convert value '{value}' for {field_name}: {str(e)}")
+        return 0.0
+
+
+def legacy_line_item(item: Dict, idx: int, issues: List[str]):
+    if not isinstance(item, dict):
+        issues.append(f'line item {idx}: not an object')
+        return None
+    legacy_logger.info(f"Processing line item {idx}: {item}")
+    quantity = legacy_float(item.get('quantity'), f'quantity_{idx}')
+    price = legacy_float(item.get('price'), f'price_{idx}')
+    total = legacy_float(item.get('total'), f'total_{idx}')
+    calculated_total = round(quantity * price, 2)
+    if abs(calculated_total - total) > 0.01:
+        legacy_logger.warning(f"Total mismatch at index {idx}: quantity={quantity}, "
+                              f"price={price}, calculated={calculated_total}, given={total}")
+        issues.append(f'line item {idx}: quantity x price != total')
+        total = calculated_total
+    processed_item = {
+        'item_code': str(item.get('item_code', '')),
+        'description': str(item.get('description', '')),
+        'quantity': quantity,
+        'price': price,
+        'total': total
+    }
+    legacy_logger.info(f"Processed line item {idx}: {processed_item}")
+    return processed_item
+
+
+def legacy_parse(response_text: str, issues: List[str]) -> Dict:
+    legacy_logger.info(f"Processing Gemini response: {response_text[:500]}...")
+    cleaned_text = response_text.strip()
+    json_text = cleaned_text[cleaned_text.find('{'):cleaned_text.rfind('}') + 1]
+    legacy_logger.info(f"Extracted JSON text: {json_text[:500]}...")
+    data = json.loads(json_text)
+    processed_items = []
+    for idx, item in enumerate(data.get('line_items', [])):
+        processed_item = legacy_line_item(item, idx, issues)
+        if processed_item is not None:
+            processed_items.append(processed_item)
+    subtotal = round(sum(item['total'] for item in processed_items), 2)
+    tax = round(subtotal * 0.17, 2)
+    total = round(subtotal + tax, 2)
+    legacy_logger.info(f"Calculated totals: subtotal={subtotal}, tax={tax}, total={total}")
+    reported = legacy_float(data['totals'].get('subtotal'), 'reported_subtotal')
+    if reported and abs(reported - subtotal) > max(0.05, subtotal * 0.005):
+        issues.append(f'reported subtotal {reported} != sum of line totals {subtotal}')
+    return {
+        'company_details': {
+            'name': str(data.get('company_details', {}).get('name', '')),
+            'address': str(data.get('company_details', {}).get('address', '')),
+            'tax_id': str(data.get('company_details', {}).get('tax_id', ''))
+        },
+        'invoice_details': {
+            'invoice_number': str(data.get('invoice_details', {}).get('invoice_number', '')),
+            'date': str(data.get('invoice_details', {}).get('date', ''))
+        },
+        'line_items': processed_items,
+        'totals': {'subtotal': subtotal, 'tax': tax, 'total': total}
+    }
+
+
+def current_parse(response_text: str, issues: List[str]) -> Dict:
+    return parse_invoice(response_text, issues).to_dict()
+
+
+def time_calls(func: Callable[[], object], repeat: int) -> Dict[str, float]:
+    func()
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start_time)
+    return latency_summary(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    # Log records are still built and handled at INFO, as in production,
+    # but written nowhere
+    logging.basicConfig(level=logging.INFO, handlers=[logging.NullHandler()], force=True)
+
+    app = Flask(__name__)
+    providers = {'flask_default': DefaultJSONProvider(app), 'fast_json': FastJSONProvider(app)}
+
+    results = {}
+    print(f"{'items':>6} {'stage':10} {'impl':14} {'p50 ms':>9} {'p95 ms':>9} {'bytes':>9}")
+    for size in SIZES:
+        response_text = make_response(size)
+        legacy_issues, current_issues = [], []
+        legacy = legacy_parse(response_text, legacy_issues)
+        current = current_parse(response_text, current_issues)
+        if legacy != current or legacy_issues != current_issues:
+            raise SystemExit(f'Parsers disagree on {size} line items')
+
+        case = {'parse': {}, 'serialize': {}}
+        for name, parse in (('legacy', legacy_parse), ('current', current_parse)):
+            case['parse'][name] = time_calls(lambda: parse(response_text, []), args.repeat)
+            print(f"{size:6} {'parse':10} {name:14} {case['parse'][name]['p50_ms']:9.3f} "
+                  f"{case['parse'][name]['p95_ms']:9.3f} {'':>9}")
+
+        payload = {'status': 'success', 'invoice_data': current, 'processing_time': '1.00s'}
+        for name, provider in providers.items():
+            body = provider.dumps(payload, separators=(',', ':'))
+            if json.loads(body) != payload:
+                raise SystemExit(f'{name} serialization does not round-trip')
+            latency = time_calls(lambda: provider.dumps(payload, separators=(',', ':')),
+                                 args.repeat)
+            case['serialize'][name] = {'latency': latency, 'bytes': len(body.encode('utf-8'))}
+            print(f"{size:6} {'serialize':10} {name:14} {latency['p50_ms']:9.3f} "
+                  f"{latency['p95_ms']:9.3f} {len(body.encode('utf-8')):9}")
+        results[f'{size}_items'] = case
+
+    print(f"results: {write_results('parsing', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
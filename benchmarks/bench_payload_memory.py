@@ -0,0 +1,172 @@
+"""
+Memory held on the way from uploaded files to the model SDK.
+
+``single``: one upload (spooled by Werkzeug like a real request) goes
+through reading, decoding, JPEG encoding and the SDK's conversion to a
+request ``Blob``, keeping every result alive as a request does. The original
+path (``legacy``: ``file.read()``, the decoded image kept, base64 text that
+the SDK decodes again) is compared with the current one (``current``:
+``read_upload`` and ``process_image_memory`` with raw JPEG bytes).
+
+``batch``: a multi-file batch with the fake model. The original flow read
+every file up front and kept them all until the batch finished; the current
+``process_batch`` reads each file when its item starts and drops it when
+the item is done.
+
+Reports the peak of Python allocations (``tracemalloc``; Pillow's pixel
+buffers are not included), what is still held at the end of the single
+upload, and the peak the request's memory accounting saw, each case in a
+fresh process.
+
+Usage:
+    python -m benchmarks.bench_payload_memory --size 4032x3024 --batch-size 16
+"""
+
+import os
+import argparse
+import base64
+import io
+import asyncio
+import logging
+import multiprocessing
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
+
+from benchmarks.common import write_results
+
+MB = 1024 * 1024
+
+
+def make_upload(file_data: bytes):
+    """A ``FileStorage`` spooled the way Werkzeug spools multipart files."""
+    from werkzeug.datastructures import FileStorage
+
+    stream = tempfile.SpooledTemporaryFile(max_size=500 * 1024, mode='rb+')
+    stream.write(file_data)
+    stream.seek(0)
+    return FileStorage(stream=stream, filename='invoice.jpg', content_type='image/jpeg')
+
+
+def legacy_path(upload) -> list:
+    """The original flow; returns everything a request kept referenced."""
+    from google.generativeai.types import content_types
+    from image_pipeline import encode_jpeg, load_image
+
+    file_data = upload.read()
+    img = load_image(file_data, (600, 600))
+    jpeg = encode_jpeg(img, 70)
+    data = base64.b64encode(jpeg).decode('utf-8')
+    blob = content_types.to_blob({'mime_type': 'image/jpeg', 'data': data})
+    return [upload, file_data, img, data, blob]
+
+
+def current_path(upload) -> list:
+    from google.generativeai.types import content_types
+    from app import process_image_memory, read_upload
+
+    file_data = read_upload(upload)
+    parts = process_image_memory(file_data)
+    blob = content_types.to_blob(parts[0])
+    return [file_data, parts, blob]
+
+
+async def legacy_batch(invoice_app, uploads: list, concurrency: int) -> list:
+    """The original batch flow: all files read up front and kept to the end."""
+    items = [{'data': upload.read()} for upload in uploads]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def item_flow(item):
+        async with semaphore:
+            return await invoice_app.extract_invoice(item['data'], force=True,
+                                                     lane=invoice_app.BULK)
+
+    return await asyncio.gather(*(item_flow(item) for item in items))
+
+
+def run_case(case: str, implementation: str, file_data: bytes, batch_size: int,
+             concurrency: int) -> Dict:
+    """Measure one path (runs in a child process)."""
+    logging.disable(logging.CRITICAL)
+    for name, value in (('GEMINI_API_KEY', 'offline-benchmark'), ('RESULT_CACHE_BACKEND', 'off'),
+                        ('RATE_LIMIT_BACKEND', 'off'), ('SINGLE_FLIGHT_BACKEND', 'off')):
+        os.environ.setdefault(name, value)
+    import app as invoice_app
+    import memory_budget
+    from benchmarks.bench_image_decode import make_image
+    from benchmarks.fake_model import FakeGenerativeModel
+    invoice_app.model = FakeGenerativeModel(latency=0.05)
+
+    if case == 'single':
+        path = legacy_path if implementation == 'legacy' else current_path
+        # Load codecs and the SDK first so one-time setup is not counted
+        path(make_upload(make_image(64, 48, 'JPEG', 1)))
+        uploads = [make_upload(file_data)]
+    else:
+        uploads = [make_upload(file_data) for _ in range(batch_size)]
+
+    with memory_budget.tracked() as memory:
+        tracemalloc.start()
+        if case == 'single':
+            kept = path(uploads[0])
+        elif implementation == 'legacy':
+            kept = invoice_app.background_loop.run(
+                legacy_batch(invoice_app, uploads, concurrency))
+        else:
+            items = [{'source': str(index), 'file': upload}
+                     for index, upload in enumerate(uploads)]
+            kept = invoice_app.background_loop.run(
+                invoice_app.process_batch(items, concurrency, force=True))
+        held, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        accounted_peak = memory.peak
+    del kept
+    return {
+        'traced_peak_mb': round(traced_peak / MB, 2),
+        'held_mb': round(held / MB, 2) if case == 'single' else None,
+        'accounted_peak_mb': round(accounted_peak / MB, 2) if implementation == 'current'
+        else None
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', default='4032x3024', help='Upload size WxH')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the upload')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--batch-concurrency', type=int, default=4)
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    from PIL import Image
+    from benchmarks.load_upload import make_images
+    width, height = (int(value) for value in args.size.split('x'))
+    # Sensor noise and a high quality bring the upload close to the 5MB limit
+    page = Image.open(io.BytesIO(make_images(1, width, height)[0]))
+    noise = Image.effect_noise((width, height), 24).convert('RGB')
+    output = io.BytesIO()
+    Image.blend(page, noise, 0.15).save(output, format='JPEG', quality=args.quality)
+    file_data = output.getvalue()
+
+    context = multiprocessing.get_context('spawn')
+    results = {'upload_mb': round(len(file_data) / MB, 2), 'size': [width, height]}
+    print(f"upload: {results['upload_mb']}MB ({args.size}), batch of {args.batch_size} "
+          f"at concurrency {args.batch_concurrency}")
+    print(f"{'case':8} {'impl':8} {'traced peak MB':>15} {'held MB':>8} {'accounted MB':>13}")
+    for case in ('single', 'batch'):
+        results[case] = {}
+        for implementation in ('legacy', 'current'):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                measured = pool.submit(run_case, case, implementation, file_data,
+                                       args.batch_size, args.batch_concurrency).result()
+            results[case][implementation] = measured
+            print(f"{case:8} {implementation:8} {measured['traced_peak_mb']:15} "
+                  f"{str(measured['held_mb'] or '-'):>8} "
+                  f"{str(measured['accounted_peak_mb'] or '-'):>13}")
+
+    print(f"results: {write_results('payload_memory', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
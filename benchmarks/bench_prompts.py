@@ -0,0 +1,358 @@
+"""
+Benchmark of extraction prompts: input tokens, latency and accuracy.
+
+Extracts a synthetic corpus (suppliers with their own letterhead, layout,
+item codes, weights and VAT, several invoices each) with the fake model
+under three prompts:
+
+* ``legacy``: the long prompt sent before profiles (copied below);
+* ``base``: ``prompt_profiles.BASE_PROMPT`` for every invoice;
+* ``profiles``: a ``ProfileStore`` recognizing suppliers by letterhead and
+  learning their profiles from the extractions, as the app does.
+
+Tokens are counted by ``FakeGenerativeModel.count_tokens`` and each one adds
+``--token-latency`` seconds. Accuracy is simulated: the fake model makes the
+mistakes real extractions make (quantity and total swapped, misread item
+codes, invented item codes, weights rounded) at rates that drop when the
+prompt carries the rule or the code that prevents them (``ERROR_RATES``).
+The token and latency numbers are measured; the accuracy numbers only show
+that profiles deliver their hints and must be checked against the real model.
+
+Usage:
+    python -m benchmarks.bench_prompts --suppliers 24 --invoices 10
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import logging
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from PIL import Image, ImageDraw
+
+from benchmarks.common import latency_summary, write_results
+from benchmarks.fake_model import FakeGenerativeModel
+from image_hash import letterhead_hash
+from invoice_model import parse_invoice
+from prompt_profiles import BASE, Prompt, ProfileStore, prompt_version
+
+# The prompt sent before profiles
+# -------------------------------
+
+LEGACY_PROMPT = """Analyze this Hebrew invoice image and extract the data into a JSON object with PRECISE field mapping.
+
+CRITICAL RTL COLUMN ORDER AND MAPPING RULES:
+1. Hebrew invoices are read RIGHT to LEFT. The columns ALWAYS appear in this exact order:
+   RIGHT ➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔➔ LEFT
+   [תיאור] ➔ [כמות] ➔ [מחיר יחידה] ➔ [סה"כ]
+   [Description] ➔ [Quantity] ➔ [Unit Price] ➔ [Total]
+
+2. COLUMN HEADERS TO LOOK FOR:
+   - תיאור / פריט / שם פריט = Description
+   - כמות = Quantity (ALWAYS the smaller number)
+   - מחיר / מחיר יחידה = Unit Price
+   - סה"כ / סכום = Total (ALWAYS quantity × price)
+
+3. QUANTITY vs TOTAL DISAMBIGUATION RULES:
+   a) כמות (Quantity) is ALWAYS:
+      - The SMALLER number
+      - Usually less than 100 units
+      - When multiplied by price equals the total
+   
+   b) סה"כ (Total) is ALWAYS:
+      - The LARGER number
+      - Equal to quantity × price
+      - Usually the rightmost number column
+
+4. REAL EXAMPLES:
+   Example 1: If you see:
+   - מחיר יחידה (price) = 160.00
+   - One number is 2.20
+   - Other number is 352.00
+   Then:
+   - 2.20 MUST be כמות (quantity) because 2.20 × 160.00 = 352.00
+   - 352.00 MUST be סה"כ (total)
+
+   Example 2: If you see:
+   - מחיר יחידה (price) = 38.00
+   - One number is 266.00
+   - Other number is 7.00
+   Then:
+   - 7.00 MUST be כמות (quantity) because 7.00 × 38.00 = 266.00
+   - 266.00 MUST be סה"כ (total)
+
+5. VALIDATION RULES:
+   - ALWAYS verify: total = quantity × price
+   - If the calculation doesn't match, you mapped the columns wrong
+   - If total ÷ price gives a reasonable quantity (< 100), that's the correct mapping
+   - Never accept a mapping where total ≠ quantity × price
+
+Return this exact JSON structure:
+{
+    "company_details": {
+        "name": "",
+        "address": "",
+        "tax_id": ""
+    },
+    "invoice_details": {
+        "invoice_number": "",
+        "date": ""
+    },
+    "line_items": [
+        {
+            "item_code": "",
+            "description": "",
+            "quantity": 0,
+            "price": 0,
+            "total": 0
+        }
+    ],
+    "totals": {
+        "subtotal": 0,
+        "tax": 0,
+        "total": 0
+    }
+}
+
+FINAL VERIFICATION CHECKLIST:
+1. Column order is correct (RTL: Description ➔ Quantity ➔ Price ➔ Total)
+2. Quantity is ALWAYS the smaller number
+3. Total is ALWAYS quantity × price
+4. All calculations are verified
+5. No null/None/undefined values
+6. All numbers are actual numbers (not strings)
+7. Subtotal = sum of all line totals
+8. Tax = 17% of subtotal
+9. Final total = subtotal + tax"""
+
+
+
+# Chance of each mistake per line: without and with the prompt's hint against it
+ERROR_RATES = {
+    'swap': (0.05, 0.01),             # the quantity x price = total rule
+    'swap_layout': (0.15, 0.03),      # suppliers with a confusing layout: the column rule
+    'code_misread': (0.10, 0.02),     # the code among the supplier's known codes
+    'code_invented': (0.08, 0.01),    # suppliers without codes: 'item_code is ""'
+    'weight_rounded': (0.10, 0.02),   # suppliers selling by weight: the decimals rule
+}
+WORDS = ('גבינה', 'חלב', 'לחם', 'שמן', 'קמח', 'סוכר', 'אורז', 'קפה', 'תה', 'זיתים', 'חומוס',
+         'טחינה', 'ביצים', 'חמאה', 'יוגורט', 'מלח', 'פסטה', 'עגבניות')
+VAT = ('added_17', 'added_18', 'included', 'none')
+
+
+def make_suppliers(count: int, seed: int) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    suppliers = []
+    for index in range(count):
+        coded = rng.random() < 0.65
+        suppliers.append({
+            'index': index,
+            'name': f'{rng.choice(WORDS)} {rng.choice(WORDS)} {index} בע"מ',
+            'tax_id': str(514000000 + index * 7919),
+            'layout': rng.random() < 0.35,
+            'weights': rng.random() < 0.3,
+            'codes': [str(rng.randrange(1000, 99999)) for _ in range(12)] if coded else [],
+            'vat': rng.choice(VAT),
+            'letterhead': [(rng.randrange(40, 700), rng.randrange(10, 150), rng.randrange(40, 260),
+                            rng.randrange(15, 60)) for _ in range(10)],
+        })
+    return suppliers
+
+
+def make_page(supplier: Dict[str, Any], rng: random.Random) -> bytes:
+    """A page with the supplier's letterhead over text-like blocks."""
+    img = Image.new('L', (800, 1100), 255)
+    draw = ImageDraw.Draw(img)
+    for x, y, width, height in supplier['letterhead']:
+        draw.rectangle((x, y, x + width, y + height), fill=rng.randint(0, 40))
+    for y in range(260, 1040, 26):
+        x = 40
+        while x < 720:
+            length = rng.randint(30, 120)
+            draw.rectangle((x, y, x + length, y + 10), fill=30)
+            x += length + rng.randint(15, 60)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=80)
+    return output.getvalue()
+
+
+def make_invoice(supplier: Dict[str, Any], number: int, rng: random.Random) -> Dict:
+    items = []
+    for _ in range(rng.randint(3, 8)):
+        if supplier['weights']:
+            quantity = round(rng.uniform(0.3, 9), 2)
+        else:
+            quantity = rng.randint(1, 30)
+        price = round(rng.uniform(3, 180), 2)
+        code = rng.choice(supplier['codes'][:8] * 3 + supplier['codes']) \
+            if supplier['codes'] else ''
+        items.append({'item_code': code, 'description': ' '.join(rng.sample(WORDS, 2)),
+                      'quantity': quantity, 'price': price, 'total': round(quantity * price, 2)})
+    lines = round(sum(item['total'] for item in items), 2)
+    if supplier['vat'] == 'none':
+        totals = {'subtotal': lines, 'tax': 0, 'total': lines}
+    elif supplier['vat'] == 'included':
+        subtotal = round(lines / 1.17, 2)
+        totals = {'subtotal': subtotal, 'tax': round(lines - subtotal, 2), 'total': lines}
+    else:
+        rate = 0.17 if supplier['vat'] == 'added_17' else 0.18
+        totals = {'subtotal': lines, 'tax': round(lines * rate, 2),
+                  'total': round(lines * (1 + rate), 2)}
+    return {
+        'company_details': {'name': supplier['name'], 'address': 'הרצל 1, חיפה',
+                            'tax_id': supplier['tax_id']},
+        'invoice_details': {'invoice_number': str(number), 'date': '01/03/2025'},
+        'line_items': items,
+        'totals': totals
+    }
+
+
+def make_corpus(suppliers: int, invoices: int, seed: int) -> List[Dict[str, Any]]:
+    """Invoices of every supplier, arriving interleaved."""
+    rng = random.Random(seed)
+    corpus = []
+    for supplier in make_suppliers(suppliers, seed):
+        for number in range(invoices):
+            corpus.append({'supplier': supplier, 'page': make_page(supplier, rng),
+                           'truth': make_invoice(supplier, 1000 + number, rng)})
+    rng.shuffle(corpus)
+    return corpus
+
+
+def simulate(truth: Dict, supplier: Dict[str, Any], prompt: str, seed: int) -> str:
+    """The model's answer for one invoice, given what the prompt tells it.
+
+    Draws are seeded per invoice, so every prompt sees the same dice and
+    differs only in the rates.
+    """
+    rng = random.Random(seed)
+    if supplier['layout']:
+        swap = ERROR_RATES['swap_layout'][1 if 'often swapped' in prompt else 0]
+    else:
+        swap = ERROR_RATES['swap'][1 if re.search('quantity [x×] price', prompt) else 0]
+    invented = ERROR_RATES['code_invented'][1 if 'item_code is ""' in prompt else 0]
+    rounded = ERROR_RATES['weight_rounded'][1 if 'weights with decimals' in prompt else 0]
+
+    answer = json.loads(json.dumps(truth))
+    for item in answer['line_items']:
+        draws = [rng.random() for _ in range(3)]
+        if draws[0] < swap:
+            item['quantity'], item['total'] = item['total'], item['quantity']
+        if item['item_code']:
+            misread = ERROR_RATES['code_misread'][1 if f"{item['item_code']} " in prompt else 0]
+            if draws[1] < misread:
+                code = item['item_code']
+                item['item_code'] = code[:-1] + str((int(code[-1]) + 3) % 10)
+        elif draws[1] < invented:
+            item['item_code'] = str(rng.randrange(100, 999))
+        if supplier['weights'] and draws[2] < rounded:
+            item['quantity'] = round(item['quantity'])
+    return '```json\n' + json.dumps(answer, ensure_ascii=False) + '\n```'
+
+
+def correct_lines(invoice: Dict, truth: Dict) -> int:
+    if len(invoice['line_items']) != len(truth['line_items']):
+        return 0
+    return sum(1 for item, expected in zip(invoice['line_items'], truth['line_items'])
+               if item['item_code'] == expected['item_code']
+               and abs(item['quantity'] - expected['quantity']) < 0.005
+               and abs(item['total'] - expected['total']) < 0.01)
+
+
+def run(name: str, corpus: List[Dict[str, Any]], args: argparse.Namespace) -> Dict:
+    pages = {hashlib.sha256(entry['page']).digest(): (index, entry)
+             for index, entry in enumerate(corpus)}
+
+    def respond(contents: Any) -> str:
+        index, entry = pages[hashlib.sha256(contents[1]['data']).digest()]
+        return simulate(entry['truth'], entry['supplier'], contents[0], index)
+
+    model = FakeGenerativeModel(latency=args.latency, input_token_latency=args.token_latency,
+                                respond=respond)
+    store = ProfileStore('memory') if name == 'profiles' else None
+    legacy = Prompt(LEGACY_PROMPT, prompt_version(LEGACY_PROMPT), 'legacy')
+
+    def extract(entry: Dict[str, Any]) -> Dict:
+        letterhead = letterhead_hash(entry['page']) if store is not None else None
+        prompt = store.select(letterhead=letterhead) if store is not None else \
+            legacy if name == 'legacy' else BASE
+        contents = [prompt.text, {'mime_type': 'image/jpeg', 'data': entry['page']}]
+        tokens = model.count_tokens(contents).total_tokens
+        start_time = time.perf_counter()
+        response = model.generate_content(contents)
+        latency = time.perf_counter() - start_time
+        issues, reported = [], {}
+        invoice = parse_invoice(response.text, issues, reported).to_dict()
+        if store is not None:
+            store.observe(invoice, issues, reported, letterhead, prompt)
+        return {'profile': 'vendor' if prompt.profile.startswith('vendor:') else prompt.profile,
+                'right_supplier': prompt.profile in (f"vendor:{entry['supplier']['tax_id']}",
+                                                     'base', 'legacy'),
+                'tokens': tokens, 'latency': latency,
+                'lines': len(entry['truth']['line_items']),
+                'correct': correct_lines(invoice, entry['truth'])}
+
+    outcomes = []
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        # Concurrent invoices select their prompt before the others are learned
+        for start in range(0, len(corpus), args.concurrency):
+            outcomes.extend(pool.map(extract, corpus[start:start + args.concurrency]))
+
+    result = {'all': summarize(outcomes)}
+    for profile in sorted({outcome['profile'] for outcome in outcomes}):
+        result[profile] = summarize([o for o in outcomes if o['profile'] == profile])
+    if store is not None:
+        result['wrong_supplier'] = sum(1 for o in outcomes if not o['right_supplier'])
+        result['store'] = store.stats()
+    return result
+
+
+def summarize(outcomes: List[Dict]) -> Dict:
+    lines = sum(outcome['lines'] for outcome in outcomes)
+    return {
+        'invoices': len(outcomes),
+        'input_tokens_mean': round(sum(o['tokens'] for o in outcomes) / len(outcomes), 1),
+        'latency': latency_summary([o['latency'] for o in outcomes]),
+        'line_accuracy': round(sum(o['correct'] for o in outcomes) / lines, 4),
+        'invoice_accuracy': round(sum(1 for o in outcomes if o['correct'] == o['lines'])
+                                  / len(outcomes), 4),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--suppliers', type=int, default=24)
+    parser.add_argument('--invoices', type=int, default=10, help='Invoices per supplier')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Model seconds per call before input tokens')
+    parser.add_argument('--token-latency', type=float, default=0.0001,
+                        help='Model seconds per input token')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    corpus = make_corpus(args.suppliers, args.invoices, args.seed)
+    results = {}
+    print(f"{'prompt':10} {'profile':8} {'invoices':>8} {'tokens':>7} {'p50 ms':>8} "
+          f"{'lines ok':>9} {'invoices ok':>11}")
+    for name in ('legacy', 'base', 'profiles'):
+        results[name] = result = run(name, corpus, args)
+        for profile, summary in result.items():
+            if not isinstance(summary, dict) or 'invoices' not in summary:
+                continue
+            print(f"{name:10} {profile:8} {summary['invoices']:8} "
+                  f"{summary['input_tokens_mean']:7} {summary['latency']['p50_ms']:8} "
+                  f"{summary['line_accuracy']:9} {summary['invoice_accuracy']:11}")
+    print(f"profiles: {results['profiles']['wrong_supplier']} invoices got another supplier's")
+    print(f"results: {write_results('prompts', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
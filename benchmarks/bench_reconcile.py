@@ -0,0 +1,161 @@
+"""
+Benchmark of column reconciliation on invoices with thousands of lines.
+
+Synthetic invoices are read with the model's usual slips: quantity and total
+swapped (``--swap-rate``) and totals misread outright (``--misread-rate``),
+with the printed subtotal always right. (Quantity and price swapped leave the
+arithmetic intact, so no check can see them; they are not simulated.) They
+are repaired three ways:
+
+* ``overwrite``: total = quantity x price, as before reconciliation;
+* ``python``: every column assignment tried line by line in plain Python;
+* ``numpy``: ``reconciliation.reconcile``, all lines at once, with the
+  subtotal check.
+
+Reports the time per invoice at each size, the share of lines and invoices
+restored exactly, and the end-to-end ``parse_invoice`` time.
+
+Usage:
+    python -m benchmarks.bench_reconcile --sizes 10 100 1000 10000
+"""
+
+import argparse
+import json
+import logging
+import random
+import time
+from typing import Callable, Dict, List, Tuple
+
+from benchmarks.common import latency_summary, write_results
+from invoice_model import parse_invoice
+from reconciliation import LINE_TOLERANCE, PERMUTATIONS, reconcile
+
+Lines = Tuple[List[float], List[float], List[float]]
+
+
+def make_invoice(size: int, args: argparse.Namespace, rng: random.Random) -> Dict:
+    """The true columns of an invoice and the columns as the model read them."""
+    truth = ([], [], [])
+    read = ([], [], [])
+    for _ in range(size):
+        quantity = rng.randint(1, 24) if rng.random() < 0.8 else round(rng.uniform(0.2, 6), 3)
+        price = round(rng.uniform(1, 400), 2)
+        row = (quantity, price, round(quantity * price, 2))
+        slip = rng.random()
+        if slip < args.swap_rate:
+            seen = (row[2], row[1], row[0])
+        elif slip < args.swap_rate + args.misread_rate:
+            seen = (row[0], row[1], round(row[2] + rng.choice((1, 10, 100)), 2))
+        else:
+            seen = row
+        for column in range(3):
+            truth[column].append(row[column])
+            read[column].append(seen[column])
+    return {'truth': truth, 'read': read, 'subtotal': round(sum(truth[2]), 2)}
+
+
+def overwrite(read: Lines, subtotal: float) -> Lines:
+    quantities, prices, _ = read
+    return quantities, prices, [round(q * p, 2) for q, p in zip(quantities, prices)]
+
+
+def python_loop(read: Lines, subtotal: float) -> Lines:
+    """Line by line, the same preferences as ``reconcile`` without the subtotal."""
+    assignments = PERMUTATIONS.tolist()
+    result = ([], [], [])
+    for line in zip(*read):
+        best = None
+        for rank, order in enumerate(assignments):
+            quantity, price, total = (line[index] for index in order)
+            if abs(round(quantity * price, 2) - total) <= LINE_TOLERANCE + 1e-9:
+                key = -1 if rank == 0 else 2 * rank + (quantity != round(quantity))
+                if best is None or key < best[0]:
+                    best = (key, (quantity, price, total))
+        if best is None:
+            best = (0, (line[0], line[1], round(line[0] * line[1], 2)))
+        for column in range(3):
+            result[column].append(best[1][column])
+    return result
+
+
+def vectorized(read: Lines, subtotal: float) -> Lines:
+    result = reconcile(*read, [subtotal])
+    return result.quantities.tolist(), result.prices.tolist(), result.totals.tolist()
+
+
+def accuracy(repaired: Lines, truth: Lines) -> Tuple[int, bool]:
+    """Lines restored exactly, and whether all were."""
+    correct = sum(1 for line, expected in zip(zip(*repaired), zip(*truth))
+                  if all(abs(value - true) < 0.005 for value, true in zip(line, expected)))
+    return correct, correct == len(truth[0])
+
+
+def response(invoice: Dict) -> str:
+    items = [{'item_code': str(index), 'description': 'מוצר', 'quantity': quantity,
+              'price': price, 'total': total}
+             for index, (quantity, price, total) in enumerate(zip(*invoice['read']))]
+    return json.dumps({'company_details': {'name': 'ספק', 'address': '', 'tax_id': ''},
+                       'invoice_details': {'invoice_number': '1', 'date': ''},
+                       'line_items': items,
+                       'totals': {'subtotal': invoice['subtotal'], 'tax': 0, 'total': 0}},
+                      ensure_ascii=False)
+
+
+def time_calls(func: Callable[[], object], repeat: int) -> Dict[str, float]:
+    func()
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start_time)
+    return latency_summary(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--invoices', type=int, default=20, help='Invoices per size')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--swap-rate', type=float, default=0.03,
+                        help='Lines with quantity and total swapped')
+    parser.add_argument('--misread-rate', type=float, default=0.005,
+                        help='Lines with a misread total')
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    rng = random.Random(7)
+    repairs = {'overwrite': overwrite, 'python': python_loop, 'numpy': vectorized}
+    results = {}
+    print(f"{'lines':>6} {'impl':10} {'p50 ms':>9} {'p95 ms':>9} {'lines ok':>9} "
+          f"{'invoices ok':>11}")
+    for size in args.sizes:
+        invoices = [make_invoice(size, args, rng) for _ in range(args.invoices)]
+        case = {}
+        for name, repair in repairs.items():
+            correct_lines, correct_invoices = 0, 0
+            for invoice in invoices:
+                lines, whole = accuracy(repair(invoice['read'], invoice['subtotal']),
+                                        invoice['truth'])
+                correct_lines += lines
+                correct_invoices += whole
+            latency = time_calls(lambda: repair(invoices[0]['read'], invoices[0]['subtotal']),
+                                 args.repeat)
+            case[name] = {
+                'latency': latency,
+                'line_accuracy': round(correct_lines / (size * len(invoices)), 4),
+                'invoice_accuracy': round(correct_invoices / len(invoices), 4),
+            }
+            print(f"{size:6} {name:10} {latency['p50_ms']:9.3f} {latency['p95_ms']:9.3f} "
+                  f"{case[name]['line_accuracy']:9} {case[name]['invoice_accuracy']:11}")
+        text = response(invoices[0])
+        case['parse_invoice'] = time_calls(lambda: parse_invoice(text, [], {}), args.repeat)
+        print(f"{size:6} {'parse':10} {case['parse_invoice']['p50_ms']:9.3f} "
+              f"{case['parse_invoice']['p95_ms']:9.3f}")
+        results[f'{size}_lines'] = case
+
+    print(f"results: {write_results('reconcile', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
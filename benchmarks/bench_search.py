@@ -0,0 +1,195 @@
+"""
+Benchmark of invoice search at around a million line items.
+
+Invoices with Hebrew descriptions are saved through the invoice store with
+the FTS5 search index listening, as in the app: descriptions carry prefix
+letters (והחלב, בשמן), some are pointed (חָלָב) and some use gershayim
+(סה"כ), and suppliers repeat across invoices.
+
+* ``indexing``: saves per second with and without the index listening
+  (the latter measured on a sample), and the index size;
+* ``queries``: latency of ``SearchIndex.search`` per kind of query, against
+  a scan of the stored JSON (``scan``, the only way to search before), which
+  also misses the pointed spellings (``scan_recall``).
+
+The database is written to a temporary directory unless ``--path`` is given.
+
+Usage:
+    python -m benchmarks.bench_search --lines 1000000
+"""
+
+import os
+import argparse
+import logging
+import random
+import tempfile
+import time
+from typing import Callable, Dict
+
+from benchmarks.common import latency_summary, write_results
+from invoice_store import SQLiteInvoiceStore, StoreBusyError
+from search_index import SQLiteSearchIndex
+
+PRODUCTS = ('חלב', 'גבינה', 'לחם', 'ביצים', 'שמן', 'סוכר', 'קמח', 'אורז', 'פסטה', 'קפה', 'תה',
+            'יוגורט', 'חמאה', 'שמנת', 'מלח', 'עגבניות', 'מלפפונים', 'תפוחים', 'בננות', 'שוקולד',
+            'עוגיות', 'מיץ', 'מים', 'סבון', 'נייר', 'שקיות', 'קרטון', 'משלוח', 'אריזה', 'פיקדון')
+ADJECTIVES = ('טרי', 'לבן', 'מלא', 'קפוא', 'אורגני', 'גדול', 'קטן', 'מתוק', 'מיוחד', 'ביתי')
+PREFIXES = ('', '', '', 'ה', 'ו', 'ב', 'ל', 'וה', 'מה', 'של')
+POINTED = {'חלב': 'חָלָב', 'לחם': 'לֶחֶם', 'שמן': 'שֶׁמֶן', 'מים': 'מַיִם'}
+SUPPLIER_WORDS = ('תנובה', 'שטראוס', 'אסם', 'טרה', 'יטבתה', 'מאפיית', 'אחים', 'שיווק', 'מזון',
+                  'הגליל', 'הצפון', 'הדרום', 'סחר', 'יבוא', 'כהן', 'לוי')
+SUPPLIERS = 5000
+
+
+def supplier_name(supplier: int) -> str:
+    rng = random.Random(supplier)
+    return ' '.join(rng.sample(SUPPLIER_WORDS, 2)) + f' {supplier} בע"מ'
+
+
+def describe(rng: random.Random) -> str:
+    words = []
+    for product in rng.sample(PRODUCTS, 2):
+        if product in POINTED and rng.random() < 0.2:
+            product = POINTED[product]
+        words.append(rng.choice(PREFIXES) + product)
+    words.append(rng.choice(ADJECTIVES))
+    if rng.random() < 0.05:
+        words.append('סה"כ')
+    return ' '.join(words) + f' {rng.choice((250, 500, 1000))} גרם'
+
+
+def make_invoice(index: int, rng: random.Random) -> Dict:
+    supplier = rng.randrange(SUPPLIERS)
+    items = []
+    for _ in range(rng.randint(3, 7)):
+        quantity, price = rng.randint(1, 10), round(rng.uniform(1, 200), 2)
+        items.append({'item_code': f'SKU-{supplier}-{rng.randrange(200)}',
+                      'description': describe(rng),
+                      'quantity': quantity, 'price': price, 'total': round(quantity * price, 2)})
+    return {
+        'company_details': {'name': supplier_name(supplier), 'tax_id': str(510000000 + supplier)},
+        'invoice_details': {'invoice_number': str(100000 + index), 'date': '01/01/2024'},
+        'line_items': items,
+        'totals': {}
+    }
+
+
+def save_all(store: SQLiteInvoiceStore, count: int, seed: int) -> Dict:
+    rng = random.Random(seed)
+    lines = 0
+    start_time = time.perf_counter()
+    for index in range(count):
+        invoice = make_invoice(index, rng)
+        lines += len(invoice['line_items'])
+        while True:
+            try:
+                store.save(invoice)
+                break
+            except StoreBusyError:
+                time.sleep(0.001)
+    store.flush()
+    elapsed = time.perf_counter() - start_time
+    return {'invoices': count, 'line_items': lines, 'saves_per_sec': round(count / elapsed),
+            'line_items_per_sec': round(lines / elapsed)}
+
+
+def time_queries(search: Callable[[int], object], repeat: int) -> Dict:
+    latencies = []
+    for index in range(repeat):
+        start_time = time.perf_counter()
+        search(index)
+        latencies.append(time.perf_counter() - start_time)
+    return latency_summary(latencies)
+
+
+def bench_queries(index: SQLiteSearchIndex, store: SQLiteInvoiceStore, repeat: int) -> Dict:
+    rng = random.Random(3)
+    suppliers = [rng.randrange(SUPPLIERS) for _ in range(repeat)]
+    cases = {
+        'one_word': lambda i: index.search(PRODUCTS[i % len(PRODUCTS)]),
+        'prefixed_word': lambda i: index.search('וה' + PRODUCTS[i % len(PRODUCTS)]),
+        'two_words': lambda i: index.search(
+            f'{PRODUCTS[i % len(PRODUCTS)]} {ADJECTIVES[i % len(ADJECTIVES)]}'),
+        'word_from_supplier': lambda i: index.search(
+            PRODUCTS[i % len(PRODUCTS)], supplier=supplier_name(suppliers[i]).split()[0]),
+        'word_and_tax_id': lambda i: index.search(
+            PRODUCTS[i % len(PRODUCTS)], tax_id=str(510000000 + suppliers[i])),
+        'item_code': lambda i: index.search(f'SKU-{suppliers[i]}-{i % 200}'),
+        'typeahead': lambda i: index.search(PRODUCTS[i % len(PRODUCTS)][:2] + '*'),
+        'rare_combination': lambda i: index.search(
+            f'{PRODUCTS[i % len(PRODUCTS)]} {PRODUCTS[(i + 7) % len(PRODUCTS)]} '
+            f'{ADJECTIVES[i % len(ADJECTIVES)]} 250', tax_id=str(510000000 + suppliers[i])),
+        'no_match': lambda i: index.search(f'לא-קיים-{i}'),
+    }
+    results = {name: time_queries(case, repeat) for name, case in cases.items()}
+
+    connection = store._connection()
+    # A LIKE scan finds the exact spelling only; a supplier's invoices for a product
+    results['scan'] = time_queries(lambda i: connection.execute(
+        'SELECT id FROM invoices WHERE data LIKE ? AND data LIKE ? LIMIT 20',
+        (f'%{PRODUCTS[i % len(PRODUCTS)]}%', f'%{510000000 + suppliers[i]}%')).fetchall(), 3)
+    return results
+
+
+def scan_recall(index: SQLiteSearchIndex, store: SQLiteInvoiceStore,
+                suppliers: int = 50) -> Dict:
+    """How many of the invoices search finds for חלב a LIKE scan finds too."""
+    found = scanned = 0
+    connection = store._connection()
+    for supplier in range(suppliers):
+        tax_id = str(510000000 + supplier)
+        ids = {invoice['invoice_id'] for invoice in
+               index.search('חלב', tax_id=tax_id, limit=100)['invoices']}
+        found += len(ids)
+        scanned += len(ids & {row[0] for row in connection.execute(
+            "SELECT id FROM invoices WHERE tax_id = ? AND data LIKE '%חלב%'", (tax_id,))})
+    return {'search': found, 'scan': scanned,
+            'recall': round(scanned / found, 3) if found else None}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--lines', type=int, default=1000000, help='Line items indexed')
+    parser.add_argument('--unindexed-sample', type=int, default=20000,
+                        help='Invoices saved without the index listening')
+    parser.add_argument('--repeat', type=int, default=300, help='Queries per kind')
+    parser.add_argument('--path', help='Database directory (default: a temporary one)')
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    directory = args.path or tempfile.mkdtemp(prefix='invoice-search-')
+    # Invoices average five line items
+    count = max(args.lines // 5, 1)
+
+    plain = SQLiteInvoiceStore(os.path.join(directory, 'unindexed.db'))
+    unindexed = save_all(plain, min(args.unindexed_sample, count), seed=1)
+
+    path = os.path.join(directory, 'invoices.db')
+    store = SQLiteInvoiceStore(path)
+    index = SQLiteSearchIndex(path)
+    store.add_listener(index.add_records)
+    indexed = save_all(store, count, seed=2)
+    indexed['index_seconds'] = index.stats()['index_seconds']
+    indexed['index_mb'] = index.size_mb()
+    start_time = time.perf_counter()
+    index.optimize()
+    indexed['optimize_seconds'] = round(time.perf_counter() - start_time, 1)
+    indexed['optimized_index_mb'] = index.size_mb()
+    results = {'indexing': {'unindexed': unindexed, 'indexed': indexed}}
+    print(f"saves/s: {unindexed['saves_per_sec']} without search, {indexed['saves_per_sec']} "
+          f"indexing ({indexed['line_items_per_sec']} line items/s)")
+    print(f"index: {indexed['line_items']} line items, {indexed['index_mb']}MB, "
+          f"{indexed['optimized_index_mb']}MB optimized")
+
+    results['queries'] = queries = bench_queries(index, store, args.repeat)
+    results['scan_recall'] = recall = scan_recall(index, store)
+    print('queries, p50/p99 ms:')
+    for name, latency in queries.items():
+        print(f"  {name:20} {latency['p50_ms']:>9} {latency['p99_ms']:>9}")
+    print(f"scan finds {recall['scan']} of the {recall['search']} invoices search finds")
+    print(f"results: {write_results('search', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Cold-start benchmark: import time, time to first response and worker memory.
+
+Every measurement starts a fresh interpreter, as a new serverless instance
+or autoscaled worker does. ``STARTUP_MODE=eager`` imports the Gemini SDK
+with the app like the original code did; ``lazy`` defers it to the first
+extraction; ``eager`` followed by ``warmup()`` is the production setup where
+the platform waits for the worker before routing traffic to it.
+
+* ``import``: seconds to ``import app``, per mode;
+* ``first_response``: from process start until ``/health`` answers and until
+  the first ``/upload`` returns, with the Gemini SDK really imported and
+  configured but the model replaced by the fake one;
+* ``gunicorn``: time until ``/health`` answers and the combined memory of
+  master and workers, with and without ``preload_app``.
+
+Usage:
+    python -m benchmarks.bench_startup --repeat 5 --workers 4
+"""
+
+import os
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import requests
+
+from benchmarks.common import process_tree_rss_mb, write_results
+from benchmarks.load_upload import REPO_ROOT, free_port, make_images
+
+MODES = ('eager', 'lazy', 'eager_warmup')
+
+
+def base_env(mode: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': os.pathsep.join(filter(None, [REPO_ROOT, env.get('PYTHONPATH')])),
+        'STARTUP_MODE': 'lazy' if mode == 'lazy' else 'eager',
+        'GOOGLE_API_KEY': 'offline-benchmark',
+        'RESULT_CACHE_BACKEND': 'off',
+        'RATE_LIMIT_BACKEND': 'off',
+        'SINGLE_FLIGHT_BACKEND': 'off',
+        'FAKE_MODEL_LATENCY': '0.05'
+    })
+    return env
+
+
+def serve(port: int, warm: bool) -> None:
+    """Child process: the app with the real SDK set-up and the fake model."""
+    import logging
+    logging.disable(logging.CRITICAL)
+    import app as invoice_app
+
+    initialize_gemini = invoice_app.initialize_gemini
+
+    def initialize_with_fake():
+        # Pay for importing and configuring the SDK, then answer offline
+        initialize_gemini()
+        from benchmarks.fake_model import FakeGenerativeModel
+        invoice_app.model = FakeGenerativeModel.from_env()
+
+    if invoice_app.model is not None:
+        initialize_with_fake()
+    invoice_app.initialize_gemini = initialize_with_fake
+    if warm:
+        invoice_app.warmup()
+    invoice_app.app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+def measure_import(mode: str) -> float:
+    code = ('import time; start = time.perf_counter(); import app; '
+            'print(time.perf_counter() - start)')
+    output = subprocess.run([sys.executable, '-c', code], cwd=REPO_ROOT, env=base_env(mode),
+                            capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def wait_for_health(base_url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'Server exited during startup with code {process.returncode}')
+        try:
+            if requests.get(f'{base_url}/health', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            time.sleep(0.01)
+    raise SystemExit(f'Server not ready after {timeout}s')
+
+
+def measure_first_response(mode: str, image: bytes) -> Dict[str, float]:
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    command = [sys.executable, '-m', 'benchmarks.bench_startup', '--serve', str(port)]
+    if mode == 'eager_warmup':
+        command.append('--warm')
+    start_time = time.monotonic()
+    process = subprocess.Popen(command, cwd=REPO_ROOT, env=base_env(mode),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_health(base_url, process)
+        ready = time.monotonic() - start_time
+        upload_start = time.monotonic()
+        response = requests.post(f'{base_url}/upload', timeout=60,
+                                 files={'file': ('invoice.jpg', image, 'image/jpeg')})
+        assert response.status_code == 200, response.text
+        done = time.monotonic()
+        return {'ready_s': ready, 'first_upload_s': done - upload_start,
+                'first_extraction_s': done - start_time}
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def measure_gunicorn(preload: bool, workers: int) -> Dict[str, float]:
+    port = free_port()
+    env = base_env('lazy')
+    env.update({'PORT': str(port), 'WEB_CONCURRENCY': str(workers),
+                'GUNICORN_PRELOAD': 'true' if preload else 'false', 'LOG_LEVEL': 'warning'})
+    start_time = time.monotonic()
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:app',
+                                '-c', 'gunicorn.conf.py'], cwd=REPO_ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_health(f'http://127.0.0.1:{port}', process)
+        ready = time.monotonic() - start_time
+        # Let every worker finish booting before measuring memory
+        time.sleep(3)
+        return {'ready_s': ready, 'rss_mb': process_tree_rss_mb(process.pid)}
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def median(samples: List[Dict[str, float]]) -> Dict[str, float]:
+    return {key: round(statistics.median(sample[key] for sample in samples), 3)
+            for key in samples[0]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--warm', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.warm)
+        return
+
+    image = make_images(1, 1240, 1754)[0]
+    results = {'import': {}, 'first_response': {}, 'gunicorn': {'workers': args.workers}}
+    print(f"{'mode':14} {'import s':>9} {'ready s':>8} {'1st upload s':>13} "
+          f"{'1st extraction s':>17}")
+    for mode in MODES:
+        if mode != 'eager_warmup':
+            results['import'][mode] = round(statistics.median(
+                measure_import(mode) for _ in range(args.repeat)), 3)
+        first = median([measure_first_response(mode, image) for _ in range(args.repeat)])
+        results['first_response'][mode] = first
+        print(f"{mode:14} {str(results['import'].get(mode, '-')):>9} {first['ready_s']:8} "
+              f"{first['first_upload_s']:13} {first['first_extraction_s']:17}")
+
+    for preload in (False, True):
+        name = 'preload' if preload else 'no_preload'
+        measured = median([measure_gunicorn(preload, args.workers)
+                           for _ in range(max(args.repeat // 2, 1))])
+        results['gunicorn'][name] = measured
+        print(f"gunicorn {name:11} ready {measured['ready_s']}s, "
+              f"{measured['rss_mb']}MB with {args.workers} workers")
+
+    print(f"results: {write_results('startup', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Time-to-first-data benchmark for ``/upload/stream`` against ``/upload``.
+
+Uses the fake streaming model so the numbers reflect our pipeline and event
+delivery, not network or model variance.
+
+Usage:
+    python -m benchmarks.bench_streaming --latency 12 --line-items 20
+"""
+
+import os
+import argparse
+import io
+import json
+import logging
+import time
+
+os.environ.setdefault('RESULT_CACHE_BACKEND', 'off')
+os.environ.setdefault('DUPLICATE_HASH_THRESHOLD', '0')
+
+import app as invoice_app
+from benchmarks.common import write_results
+from benchmarks.fake_model import CANNED_INVOICE, FakeGenerativeModel
+from benchmarks.stress_timeouts import make_invoice_image
+
+
+def invoice_with_items(count: int) -> str:
+    """Canned invoice JSON with ``count`` line items."""
+    template = CANNED_INVOICE['line_items'][0]
+    invoice = dict(CANNED_INVOICE)
+    invoice['line_items'] = [dict(template, item_code=str(1000 + i)) for i in range(count)]
+    return json.dumps(invoice, ensure_ascii=False, indent=2)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--latency', type=float, default=12.0,
+                        help='Fake model generation time in seconds')
+    parser.add_argument('--line-items', type=int, default=20)
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    invoice_app.model = FakeGenerativeModel(latency=args.latency,
+                                            response_text=invoice_with_items(args.line_items))
+    client = invoice_app.app.test_client()
+    image = make_invoice_image()
+
+    start_time = time.time()
+    client.post('/upload', data={'file': (io.BytesIO(image), 'invoice.jpg')})
+    blocking_total = time.time() - start_time
+
+    first_seen = {}
+    start_time = time.time()
+    response = client.post('/upload/stream', data={'file': (io.BytesIO(image), 'invoice.jpg')})
+    for raw in response.response:
+        text = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+        for block in text.split('\n\n'):
+            if block.startswith('event: '):
+                event = block.split('\n', 1)[0][len('event: '):]
+                first_seen.setdefault(event, time.time() - start_time)
+    streaming_total = time.time() - start_time
+
+    useful = [first_seen[e] for e in ('company_details', 'line_item') if e in first_seen]
+    results = {
+        'model_latency_s': args.latency,
+        'line_items': args.line_items,
+        'upload_total_s': round(blocking_total, 3),
+        'stream_total_s': round(streaming_total, 3),
+        'stream_first_useful_data_s': round(min(useful), 3) if useful else None,
+        'stream_first_event_s': {event: round(t, 3) for event, t in first_seen.items()}
+    }
+    for key, value in results.items():
+        print(f"{key:30} {value}")
+    print(f"{'results':30} {write_results('streaming', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
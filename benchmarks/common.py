@@ -0,0 +1,151 @@
+"""
+Shared helpers for benchmarks: resource sampling, percentiles and result files.
+"""
+
+import os
+import json
+import math
+import platform
+import resource
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process in MB."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Fall back to the peak value where /proc is unavailable (macOS reports bytes)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == 'Darwin' else peak / 1024
+
+
+def process_tree_rss_mb(pid: int) -> float:
+    """Combined resident set size of a process and its descendants in MB.
+
+    Linux only (reads ``/proc``); returns 0 where it is unavailable.
+    """
+    parents = {}
+    for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                # The command name may contain spaces; fields resume after ')'
+                parents[int(entry)] = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+
+    tree, pending = set(), [pid]
+    while pending:
+        current = pending.pop()
+        tree.add(current)
+        pending.extend(child for child, parent in parents.items()
+                       if parent == current and child not in tree)
+
+    total_kb = 0
+    for member in tree:
+        try:
+            with open(f'/proc/{member}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total_kb / 1024
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == 'Darwin' else peak / 1024
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of ``values`` (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100 * len(ordered))
+    return ordered[min(len(ordered), max(1, rank)) - 1]
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    """p50/p95/p99/max/mean of latencies given in seconds, reported in ms."""
+    if not latencies:
+        return {'count': 0}
+    return {
+        'count': len(latencies),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3)
+    }
+
+
+class ResourceSampler:
+    """Samples thread count and RSS in the background while a benchmark runs."""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_time = None
+
+    def __enter__(self) -> 'ResourceSampler':
+        self._start_time = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+    def sample(self) -> None:
+        self.samples.append({
+            'elapsed': round(time.time() - self._start_time, 2),
+            'threads': threading.active_count(),
+            'rss_mb': round(rss_mb(), 1)
+        })
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+
+def write_results(name: str, payload: Dict[str, Any], path: Optional[str] = None) -> str:
+    """Write benchmark results as JSON and return the file path.
+
+    Results are stored under ``benchmarks/results/<name>-<timestamp>.json``
+    with enough environment detail to compare runs.
+    """
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(RESULTS_DIR, f'{name}-{stamp}.json')
+    document = {
+        'benchmark': name,
+        'timestamp': time.time(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()
+        },
+        'results': payload
+    }
+    with open(path, 'w') as output:
+        json.dump(document, output, indent=2, ensure_ascii=False)
+    return path
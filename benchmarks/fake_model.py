@@ -0,0 +1,225 @@
+"""
+Local stand-in for ``genai.GenerativeModel``.
+
+Returns canned invoice JSON after a configurable delay and honours the
+``request_options={'timeout': ...}`` deadline the way the real client does,
+so timeout handling can be exercised without spending API quota. With
+``stream=True`` the text is delivered in chunks spread over the latency, like
+token-by-token generation.
+
+Latency can be fixed or drawn from a distribution (``uniform`` around the
+median, or a long-tailed ``lognormal``), a share of calls can stall (hang
+for ``stall_latency`` seconds, like calls that only end at the deadline),
+and a share of calls can fail the way the API does (503, 429, 500). ``FakeGenerativeModel.from_env()`` builds the
+model from ``FAKE_MODEL_*`` variables, which is how server processes started
+by the load tests pick up their configuration.
+
+Input tokens can be priced in too: ``count_tokens`` estimates them like the
+SDK method of that name, and ``input_token_latency`` adds time per token, so
+longer prompts are slower. ``respond`` makes the output depend on the input,
+for simulations of how a prompt affects the extraction.
+"""
+
+import os
+import json
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence
+
+from google.api_core.exceptions import (DeadlineExceeded, InternalServerError,
+                                        ResourceExhausted, ServiceUnavailable)
+
+from prompt_profiles import estimate_tokens
+
+CANNED_INVOICE = {
+    'company_details': {
+        'name': 'כרמל מעדנים בע"מ',
+        'address': 'סעדיה גאון 19, תל-אביב',
+        'tax_id': '513203414'
+    },
+    'invoice_details': {
+        'invoice_number': '10234',
+        'date': '12/12/2024'
+    },
+    'line_items': [
+        {'item_code': '1001', 'description': 'גבינה צהובה', 'quantity': 2.2, 'price': 160.0,
+         'total': 352.0},
+        {'item_code': '1002', 'description': 'זיתים', 'quantity': 7.0, 'price': 38.0,
+         'total': 266.0}
+    ],
+    'totals': {
+        'subtotal': 618.0,
+        'tax': 105.06,
+        'total': 723.06
+    }
+}
+
+
+class FakeResponse:
+    """Minimal response object exposing ``text`` like the SDK response."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeTokenCount:
+    """Minimal ``count_tokens`` result exposing ``total_tokens``."""
+
+    def __init__(self, total_tokens: int):
+        self.total_tokens = total_tokens
+
+
+# Tokens the API bills for one image, whatever its size
+IMAGE_TOKENS = 258
+
+
+DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+# Errors the real API raises for overload, quota and server faults
+FAILURES = {
+    'unavailable': lambda: ServiceUnavailable('Fake model is overloaded'),
+    'resource_exhausted': lambda: ResourceExhausted('Fake model quota exceeded'),
+    'internal': lambda: InternalServerError('Fake model internal error')
+}
+
+
+class FakeGenerativeModel:
+    """Fake model with configurable latency, failures and canned JSON output.
+
+    Args:
+        model_name: Reported model name
+        latency: Median seconds until the full response is available
+        response_text: Text to return (defaults to ``CANNED_INVOICE`` as JSON)
+        first_chunk_latency: Streaming only, seconds until the first chunk
+            (defaults to 10% of the call's latency)
+        chunk_size: Streaming only, characters per chunk
+        distribution: ``fixed``, ``uniform`` (latency x [1 - spread, 1 + spread])
+            or ``lognormal`` (median ``latency``, shape ``spread``)
+        spread: Width of the latency distribution
+        failure_rate: Share of calls that fail (0-1); streaming calls fail
+            halfway through
+        failures: Kinds of failure to pick from (keys of ``FAILURES``)
+        seed: Seed for reproducible latencies and failures
+        input_token_latency: Seconds added per input token (see ``count_tokens``)
+        stall_rate: Share of calls that stall (0-1)
+        stall_latency: Seconds a stalled call takes
+        respond: Function of the call's ``contents`` returning the response
+            text, instead of ``response_text``
+    """
+
+    def __init__(self, model_name: str = 'fake-model', latency: float = 0.0,
+                 response_text: Optional[str] = None,
+                 first_chunk_latency: Optional[float] = None, chunk_size: int = 40,
+                 distribution: str = 'fixed', spread: float = 0.5,
+                 failure_rate: float = 0.0, failures: Sequence[str] = tuple(FAILURES),
+                 seed: Optional[int] = None, input_token_latency: float = 0.0,
+                 respond: Optional[Callable[[Any], str]] = None, stall_rate: float = 0.0,
+                 stall_latency: float = 30.0):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution '{distribution}'")
+        unknown = set(failures) - set(FAILURES)
+        if unknown:
+            raise ValueError(f'Unknown failure kinds: {sorted(unknown)}')
+        self.model_name = model_name
+        self.latency = latency
+        self.response_text = response_text or json.dumps(CANNED_INVOICE, ensure_ascii=False)
+        self.first_chunk_latency = first_chunk_latency
+        self.chunk_size = chunk_size
+        self.distribution = distribution
+        self.spread = spread
+        self.failure_rate = failure_rate
+        self.failures = list(failures)
+        self.input_token_latency = input_token_latency
+        self.stall_rate = stall_rate
+        self.stall_latency = stall_latency
+        self.respond = respond
+        self.calls = 0
+        self.failed = 0
+        self.stalled = 0
+        self.input_tokens = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'FakeGenerativeModel':
+        """Model configured by ``FAKE_MODEL_*`` environment variables."""
+        failures = os.getenv('FAKE_MODEL_FAILURES')
+        seed = os.getenv('FAKE_MODEL_SEED')
+        return cls(
+            latency=float(os.getenv('FAKE_MODEL_LATENCY', 1.0)),
+            distribution=os.getenv('FAKE_MODEL_DISTRIBUTION', 'fixed'),
+            spread=float(os.getenv('FAKE_MODEL_SPREAD', 0.5)),
+            failure_rate=float(os.getenv('FAKE_MODEL_FAILURE_RATE', 0.0)),
+            failures=failures.split(',') if failures else tuple(FAILURES),
+            seed=int(seed) if seed else None,
+            input_token_latency=float(os.getenv('FAKE_MODEL_INPUT_TOKEN_LATENCY', 0.0)),
+            stall_rate=float(os.getenv('FAKE_MODEL_STALL_RATE', 0.0)),
+            stall_latency=float(os.getenv('FAKE_MODEL_STALL_LATENCY', 30.0))
+        )
+
+    def count_tokens(self, contents: Any) -> FakeTokenCount:
+        """Input tokens of ``contents``: text by ``estimate_tokens``, images at a flat rate."""
+        parts = contents if isinstance(contents, (list, tuple)) else [contents]
+        return FakeTokenCount(sum(estimate_tokens(part) if isinstance(part, str) else IMAGE_TOKENS
+                                  for part in parts))
+
+    def _draw(self, input_tokens: int = 0) -> Dict[str, Any]:
+        """Latency and failure (or None) for one call."""
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += input_tokens
+            if self.distribution == 'uniform':
+                latency = self.latency * self._random.uniform(1 - self.spread, 1 + self.spread)
+            elif self.distribution == 'lognormal':
+                latency = self.latency * self._random.lognormvariate(0, self.spread)
+            else:
+                latency = self.latency
+            if self.stall_rate and self._random.random() < self.stall_rate:
+                self.stalled += 1
+                latency = self.stall_latency
+            failure = None
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                self.failed += 1
+                failure = FAILURES[self._random.choice(self.failures)]()
+        latency += input_tokens * self.input_token_latency
+        return {'latency': max(latency, 0.0), 'failure': failure}
+
+    def generate_content(self, contents: Any, generation_config: Optional[Dict] = None,
+                         stream: bool = False, request_options: Optional[Dict] = None,
+                         **kwargs) -> Any:
+        call = self._draw(self.count_tokens(contents).total_tokens)
+        deadline = (request_options or {}).get('timeout')
+        text = self.respond(contents) if self.respond is not None else self.response_text
+        if stream:
+            return self._stream(text, call['latency'], call['failure'], deadline)
+        if deadline is not None and call['latency'] > deadline:
+            time.sleep(deadline)
+            raise DeadlineExceeded(f'Fake model exceeded {deadline}s deadline')
+        time.sleep(call['latency'])
+        if call['failure'] is not None:
+            raise call['failure']
+        return FakeResponse(text)
+
+    def _stream(self, text: str, latency: float, failure: Optional[Exception],
+                deadline: Optional[float]) -> Iterator[FakeResponse]:
+        """Yield the response in evenly spaced chunks after the first-chunk delay."""
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        first = latency * 0.1 if self.first_chunk_latency is None else self.first_chunk_latency
+        interval = max(latency - first, 0) / max(len(chunks) - 1, 1)
+
+        start_time = time.time()
+        for index, chunk in enumerate(chunks):
+            if failure is not None and index == len(chunks) // 2:
+                raise failure
+            due = first + index * interval
+            if deadline is not None and due > deadline:
+                time.sleep(max(deadline - (time.time() - start_time), 0))
+                raise DeadlineExceeded(f'Fake model exceeded {deadline}s deadline')
+            time.sleep(max(due - (time.time() - start_time), 0))
+            yield FakeResponse(chunk)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'calls': self.calls, 'failed': self.failed, 'stalled': self.stalled,
+                    'input_tokens': self.input_tokens}
@@ -0,0 +1,44 @@
+"""
+The real app served with the fake model, for load tests.
+
+Run directly it serves the app with Flask's threaded server; passed to
+gunicorn as a config module it swaps the model in every worker after the app
+is loaded, leaving the rest of the gunicorn configuration untouched:
+
+    python -m benchmarks.fake_server --port 8081
+    gunicorn app:app --workers 4 --timeout 120 -c python:benchmarks.fake_server
+
+The model is configured through ``FAKE_MODEL_*`` variables (see
+``FakeGenerativeModel.from_env``).
+"""
+
+import argparse
+import logging
+
+from benchmarks.fake_model import FakeGenerativeModel
+
+
+def install_fake_model() -> None:
+    import app as invoice_app
+    invoice_app.model = FakeGenerativeModel.from_env()
+
+
+def post_worker_init(worker) -> None:
+    """Gunicorn hook: runs in each worker once ``app:app`` is loaded."""
+    install_fake_model()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    install_fake_model()
+    from app import app
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
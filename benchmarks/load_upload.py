@@ -0,0 +1,220 @@
+"""
+Concurrent ``/upload`` load test against a real server process.
+
+Starts the app with the fake model either under Flask's threaded server or
+under gunicorn with the production settings (sync workers, 120s timeout),
+drives it over HTTP from a pool of clients, and reports latency percentiles,
+requests/sec, status counts and the server's peak RSS (all its processes
+together).
+
+Every request uploads a different image, so single-flight coalescing does not
+merge requests; the result cache and rate limiter are off unless ``--cache``
+or ``--rate-limit`` is given.
+
+Usage:
+    python -m benchmarks.load_upload --server flask --requests 400 --clients 16
+    python -m benchmarks.load_upload --server gunicorn --workers 4 --latency 1.5 \\
+        --distribution lognormal --spread 0.6 --failure-rate 0.02
+"""
+
+import os
+import argparse
+import io
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+from PIL import Image, ImageDraw
+
+from benchmarks.common import latency_summary, process_tree_rss_mb, write_results
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_images(count: int, width: int, height: int, seed: int = 0) -> List[bytes]:
+    """Distinct synthetic invoice pages (random text-like blocks) as JPEG."""
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        img = Image.new('RGB', (width, height), 'white')
+        draw = ImageDraw.Draw(img)
+        line = max(height // 60, 6)
+        for y in range(line * 3, height - line * 3, line * 2):
+            x = width // 20
+            while x < width - width // 10:
+                length = rng.randint(width // 30, width // 8)
+                draw.rectangle((x, y, x + length, y + line), fill=(20, 20, 30))
+                x += length + rng.randint(width // 60, width // 15)
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=85)
+        images.append(output.getvalue())
+    return images
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_command(args: argparse.Namespace, port: int) -> List[str]:
+    if args.server == 'flask':
+        return [sys.executable, '-m', 'benchmarks.fake_server', '--port', str(port)]
+    return [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+            '--workers', str(args.workers), '--threads', str(args.threads),
+            '--timeout', '120', '--log-level', 'warning',
+            '-c', 'python:benchmarks.fake_server']
+
+
+def server_env(args: argparse.Namespace) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': os.pathsep.join(filter(None, [REPO_ROOT, env.get('PYTHONPATH')])),
+        'FAKE_MODEL_LATENCY': str(args.latency),
+        'FAKE_MODEL_DISTRIBUTION': args.distribution,
+        'FAKE_MODEL_SPREAD': str(args.spread),
+        'FAKE_MODEL_FAILURE_RATE': str(args.failure_rate)
+    })
+    env.setdefault('GEMINI_API_KEY', 'offline-benchmark')
+    if not args.cache:
+        env['RESULT_CACHE_BACKEND'] = 'off'
+    if not args.rate_limit:
+        env['RATE_LIMIT_BACKEND'] = 'off'
+    return env
+
+
+def wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'Server exited during startup with code {process.returncode}')
+        try:
+            if requests.get(f'{base_url}/health', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f'Server not ready after {timeout}s')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', choices=('flask', 'gunicorn'), default='flask')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn threads per worker')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--warmup', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=1.0, help='Median fake model latency')
+    parser.add_argument('--distribution', choices=('fixed', 'uniform', 'lognormal'),
+                        default='fixed')
+    parser.add_argument('--spread', type=float, default=0.5)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--image-size', default='1240x1754', help='Upload size WxH')
+    parser.add_argument('--cache', action='store_true', help='Keep the result cache on')
+    parser.add_argument('--rate-limit', action='store_true', help='Keep the rate limiter on')
+    parser.add_argument('--server-log', help='Write server output here instead of discarding it')
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    width, height = (int(value) for value in args.image_size.split('x'))
+    images = make_images(max(args.clients * 4, 32), width, height)
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen(server_command(args, port), cwd=REPO_ROOT, env=server_env(args),
+                               stdout=log, stderr=subprocess.STDOUT)
+
+    statuses = {}
+    latencies, success_latencies = [], []
+    lock = threading.Lock()
+    local = threading.local()
+    peak_rss = {'mb': 0.0}
+    stop_sampling = threading.Event()
+
+    def sample_rss():
+        while not stop_sampling.wait(0.2):
+            peak_rss['mb'] = max(peak_rss['mb'], process_tree_rss_mb(process.pid))
+
+    def one_request(index: int) -> None:
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        image = images[index % len(images)]
+        start_time = time.perf_counter()
+        try:
+            response = local.session.post(f'{base_url}/upload', timeout=180,
+                                          files={'file': (f'invoice-{index}.jpg', image,
+                                                          'image/jpeg')})
+            status = response.status_code
+        except requests.RequestException:
+            status = 'connection_error'
+        elapsed = time.perf_counter() - start_time
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                success_latencies.append(elapsed)
+
+    try:
+        wait_until_ready(base_url, process)
+        idle_rss = process_tree_rss_mb(process.pid)
+        with ThreadPoolExecutor(max_workers=args.clients) as clients:
+            list(clients.map(one_request, range(-args.warmup, 0)))
+        latencies.clear()
+        success_latencies.clear()
+        statuses.clear()
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as clients:
+            list(clients.map(one_request, range(args.requests)))
+        wall_time = time.perf_counter() - start_time
+        stop_sampling.set()
+        sampler.join()
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        if args.server_log:
+            log.close()
+
+    results = {
+        'server': args.server,
+        'workers': args.workers if args.server == 'gunicorn' else None,
+        'threads': args.threads if args.server == 'gunicorn' else None,
+        'requests': args.requests,
+        'clients': args.clients,
+        'fake_model': {'latency': args.latency, 'distribution': args.distribution,
+                       'spread': args.spread, 'failure_rate': args.failure_rate},
+        'image': {'size': [width, height],
+                  'avg_kb': round(sum(map(len, images)) / len(images) / 1024, 1)},
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'wall_seconds': round(wall_time, 3),
+        'requests_per_sec': round(args.requests / wall_time, 2),
+        'latency': latency_summary(latencies),
+        'success_latency': latency_summary(success_latencies),
+        'rss_mb': {'idle': round(idle_rss, 1), 'peak': round(peak_rss['mb'], 1)}
+    }
+
+    print(f"server:        {args.server}"
+          + (f" ({args.workers} workers x {args.threads} threads)"
+             if args.server == 'gunicorn' else ''))
+    print(f"statuses:      {results['statuses']}")
+    print(f"throughput:    {results['requests_per_sec']} req/s over {results['wall_seconds']}s")
+    print(f"latency (ms):  p50 {results['latency']['p50_ms']}, p95 {results['latency']['p95_ms']}, "
+          f"p99 {results['latency']['p99_ms']}")
+    print(f"rss (MB):      idle {results['rss_mb']['idle']}, peak {results['rss_mb']['peak']}")
+    print(f"results:       {write_results(f'load_upload_{args.server}', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
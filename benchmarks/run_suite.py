@@ -0,0 +1,182 @@
+"""
+Run the offline benchmark suites and collect their headline numbers.
+
+Runs image preprocessing, response parsing, column reconciliation, Firebase
+downloads, payload memory, report diffing, the invoice store, invoice search,
+extraction prompts, the model cascade, hedged calls, bulk extraction, cold
+starts and ``/upload`` load (Flask and gunicorn) with the fake model, each in
+its own process, and writes one JSON file with the key metrics of every suite
+next to the suites' own result files. Pass an earlier summary with ``--compare`` to
+print the change of each metric.
+
+Usage:
+    python -m benchmarks.run_suite
+    python -m benchmarks.run_suite --quick --compare benchmarks/results/suite-20240101-120000.json
+"""
+
+import os
+import argparse
+import json
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmarks.common import RESULTS_DIR, write_results
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def suites(quick: bool) -> Dict[str, List[str]]:
+    """Module and arguments of each suite."""
+    load = ['--requests', '100' if quick else '400', '--clients', '16',
+            '--latency', '0.5' if quick else '1.5', '--distribution', 'lognormal',
+            '--spread', '0.5']
+    return {
+        'image_decode': ['benchmarks.bench_image_decode', '--repeat', '3' if quick else '10'],
+        'parsing': ['benchmarks.bench_parsing', '--repeat', '50' if quick else '200'],
+        'reconcile': ['benchmarks.bench_reconcile', '--repeat', '5' if quick else '20'],
+        'downloads': ['benchmarks.bench_downloads', '--repeat', '12' if quick else '30'],
+        'payload_memory': ['benchmarks.bench_payload_memory'],
+        'diff': ['benchmarks.bench_diff', '--repeat', '3' if quick else '5'],
+        'invoice_store': ['benchmarks.bench_invoice_store',
+                          '--count', '100000' if quick else '1000000'],
+        'search': ['benchmarks.bench_search', '--lines', '100000' if quick else '1000000'],
+        'prompts': ['benchmarks.bench_prompts', '--invoices', '4' if quick else '10'],
+        'cascade': ['benchmarks.bench_cascade', '--invoices', '100' if quick else '400'],
+        'hedging': ['benchmarks.bench_hedging', '--calls', '300' if quick else '1000'],
+        'bulk': ['benchmarks.bench_bulk', '--invoices', '24' if quick else '64'],
+        'startup': ['benchmarks.bench_startup', '--repeat', '2' if quick else '5'],
+        'load_flask': ['benchmarks.load_upload', '--server', 'flask'] + load,
+        'load_gunicorn': ['benchmarks.load_upload', '--server', 'gunicorn',
+                          '--workers', '4'] + load
+    }
+
+
+def headline(name: str, results: Dict[str, Any]) -> Dict[str, float]:
+    """The metrics worth comparing between runs, flattened."""
+    metrics = {}
+    if name == 'image_decode':
+        for image, case in results.items():
+            metrics[f'{image}.p50_ms'] = case['current']['latency']['p50_ms']
+            metrics[f'{image}.images_per_sec'] = case['current']['images_per_sec']
+            metrics[f'{image}.peak_rss_increase_mb'] = case['current']['peak_rss_increase_mb']
+    elif name == 'parsing':
+        for size, case in results.items():
+            metrics[f'{size}.parse_p50_ms'] = case['parse']['current']['p50_ms']
+            serialize = case['serialize']['fast_json']['latency']
+            metrics[f'{size}.serialize_p50_ms'] = serialize['p50_ms']
+    elif name == 'reconcile':
+        for size, case in results.items():
+            metrics[f'{size}.p50_ms'] = case['numpy']['latency']['p50_ms']
+            metrics[f'{size}.line_accuracy'] = case['numpy']['line_accuracy']
+            metrics[f'{size}.parse_p50_ms'] = case['parse_invoice']['p50_ms']
+    elif name == 'downloads':
+        metrics['pooled_p50_ms'] = results['pooled']['current']['latency']['p50_ms']
+        metrics['stream_decode_p50_ms'] = results['stream_decode']['current']['p50_ms']
+        metrics['oversize_sent_mb'] = (
+            results['oversize']['no_content_length']['current']['server_sent_mb']
+        )
+        metrics['batch_items_per_sec'] = results['batch']['current']['items_per_sec']
+    elif name == 'payload_memory':
+        for case in ('single', 'batch'):
+            metrics[f'{case}.traced_peak_mb'] = results[case]['current']['traced_peak_mb']
+    elif name == 'diff':
+        for size, case in results.items():
+            metrics[f'{size}.p50_ms'] = case['current']['latency']['p50_ms']
+            metrics[f'{size}.endpoint_p50_ms'] = case['current']['endpoint_latency']['p50_ms']
+            metrics[f'{size}.accuracy'] = case['current']['accuracy']
+    elif name == 'invoice_store':
+        metrics['saves_per_sec'] = results['writes']['batched']['saves_per_sec']
+        metrics['save_call_p99_ms'] = results['writes']['batched']['save_call']['p99_ms']
+        for lookup, latency in results['lookups'].items():
+            if lookup != 'unindexed':
+                metrics[f'{lookup}.p99_ms'] = latency['p99_ms']
+    elif name == 'search':
+        metrics['line_items_per_sec'] = results['indexing']['indexed']['line_items_per_sec']
+        metrics['index_mb'] = results['indexing']['indexed']['optimized_index_mb']
+        for query, latency in results['queries'].items():
+            if query != 'scan':
+                metrics[f'{query}.p99_ms'] = latency['p99_ms']
+    elif name == 'prompts':
+        for prompt in ('legacy', 'base', 'profiles'):
+            summary = results[prompt]['all']
+            metrics[f'{prompt}.input_tokens_mean'] = summary['input_tokens_mean']
+            metrics[f'{prompt}.p50_ms'] = summary['latency']['p50_ms']
+            metrics[f'{prompt}.line_accuracy'] = summary['line_accuracy']
+    elif name == 'cascade':
+        for mode, result in results.items():
+            metrics[f'{mode}.p50_ms'] = result['latency']['p50_ms']
+            metrics[f'{mode}.p99_ms'] = result['latency']['p99_ms']
+            metrics[f'{mode}.accuracy'] = result['accuracy']
+    elif name == 'hedging':
+        for mode, result in results.items():
+            metrics[f'{mode}.p99_ms'] = result['latency']['p99_ms']
+            metrics[f'{mode}.timeouts'] = result['timeouts']
+            metrics[f'{mode}.extra_calls'] = result['extra_calls']
+    elif name == 'bulk':
+        for mode, result in results['modes'].items():
+            metrics[f'{mode}.invoices_per_sec'] = result['invoices_per_sec']
+            metrics[f'{mode}.speedup'] = result['speedup']
+    elif name == 'startup':
+        for mode, case in results['first_response'].items():
+            metrics[f'{mode}.ready_s'] = case['ready_s']
+            metrics[f'{mode}.first_extraction_s'] = case['first_extraction_s']
+        metrics['import_lazy_s'] = results['import']['lazy']
+        metrics['gunicorn_preload_rss_mb'] = results['gunicorn']['preload']['rss_mb']
+    else:
+        metrics['requests_per_sec'] = results['requests_per_sec']
+        for pct in ('p50_ms', 'p95_ms', 'p99_ms'):
+            metrics[pct] = results['latency'][pct]
+        metrics['peak_rss_mb'] = results['rss_mb']['peak']
+        metrics['error_share'] = round(
+            1 - results['statuses'].get('200', 0) / results['requests'], 4
+        )
+    return metrics
+
+
+def compare(current: Dict[str, Dict[str, float]], previous_path: str) -> None:
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)['results']
+    print(f"\n{'metric':56} {'before':>10} {'after':>10} {'change':>8}")
+    for suite, metrics in current.items():
+        for metric, value in metrics.items():
+            before: Optional[float] = previous.get(suite, {}).get(metric)
+            if before is None:
+                continue
+            change = f'{(value - before) / before * 100:+.1f}%' if before else ''
+            print(f"{suite + '.' + metric:56} {before:10} {value:10} {change:>8}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--quick', action='store_true', help='Fewer repeats and requests')
+    parser.add_argument('--only', nargs='+', help='Suites to run (default: all)')
+    parser.add_argument('--compare', help='Earlier suite summary to compare against')
+    args = parser.parse_args()
+
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    run_dir = os.path.join(RESULTS_DIR, f'suite-{stamp}')
+    os.makedirs(run_dir, exist_ok=True)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_ROOT, env.get('PYTHONPATH')]))
+
+    summary = {}
+    for name, command in suites(args.quick).items():
+        if args.only and name not in args.only:
+            continue
+        output = os.path.join(run_dir, f'{name}.json')
+        print(f'== {name}')
+        subprocess.run([sys.executable, '-m'] + command + ['--output', output],
+                       cwd=REPO_ROOT, env=env, check=True)
+        with open(output) as result_file:
+            summary[name] = headline(name, json.load(result_file)['results'])
+
+    path = write_results('suite', summary, os.path.join(RESULTS_DIR, f'suite-{stamp}.json'))
+    print(f'summary: {path}')
+    if args.compare:
+        compare(summary, args.compare)
+
+
+if __name__ == '__main__':
+    main()
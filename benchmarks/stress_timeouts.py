@@ -0,0 +1,117 @@
+"""
+Stress test: sustained model timeouts must not leak threads or memory.
+
+Drives ``/upload`` through the Flask app with a fake model that never answers
+within the deadline, and samples thread count and RSS throughout. With the
+shared model executor and client deadlines, both must plateau instead of
+growing with the number of timed-out requests.
+
+Usage:
+    python -m benchmarks.stress_timeouts --requests 400 --clients 16
+"""
+
+import os
+import argparse
+import io
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Short deadlines so the run finishes quickly; must be set before importing app
+os.environ.setdefault('GEMINI_TIMEOUT', '4')
+os.environ.setdefault('TOTAL_REQUEST_TIMEOUT', '5')
+os.environ.setdefault('RESULT_CACHE_BACKEND', 'off')
+
+from PIL import Image, ImageDraw
+
+import app as invoice_app
+from benchmarks.common import ResourceSampler, latency_summary, write_results
+from benchmarks.fake_model import FakeGenerativeModel
+
+
+def make_invoice_image(width: int = 1240, height: int = 1754) -> bytes:
+    """A synthetic text-like invoice page encoded as JPEG."""
+    img = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(img)
+    for y in range(100, height - 50, 40):
+        for x in range(80, width - 150, 140):
+            draw.rectangle((x, y, x + 90, y + 14), fill=(0, 0, 0))
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=80)
+    return output.getvalue()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=60.0,
+                        help='Fake model latency in seconds (above the deadline)')
+    parser.add_argument('--output', help='Result JSON path')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    invoice_app.model = FakeGenerativeModel(latency=args.latency)
+    image = make_invoice_image()
+    statuses = {}
+    latencies = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one_request(_):
+        if not hasattr(local, 'client'):
+            local.client = invoice_app.app.test_client()
+        start_time = time.time()
+        response = local.client.post('/upload', data={'file': (io.BytesIO(image), 'invoice.jpg')})
+        with lock:
+            latencies.append(time.time() - start_time)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    with ResourceSampler(interval=0.5) as sampler:
+        with ThreadPoolExecutor(max_workers=args.clients) as clients:
+            list(clients.map(one_request, range(args.requests)))
+        # Let in-flight deadlines expire so lingering threads would show up
+        time.sleep(invoice_app.GEMINI_TIMEOUT)
+
+    samples = sampler.samples
+    half = samples[len(samples) // 2:]
+    results = {
+        'requests': args.requests,
+        'clients': args.clients,
+        'statuses': statuses,
+        'latency': latency_summary(latencies),
+        'threads': {
+            'max': max(s['threads'] for s in samples),
+            'final': samples[-1]['threads'],
+            'second_half_range': [min(s['threads'] for s in half), max(s['threads'] for s in half)]
+        },
+        'rss_mb': {
+            'first': samples[0]['rss_mb'],
+            'max': max(s['rss_mb'] for s in samples),
+            'final': samples[-1]['rss_mb'],
+            'second_half_range': [min(s['rss_mb'] for s in half), max(s['rss_mb'] for s in half)]
+        },
+        'executor': invoice_app.model_executor.stats(),
+        'samples': samples
+    }
+
+    # Bounded: model pool + CPU pool + loop thread + clients + sampler + main
+    thread_limit = (invoice_app.MODEL_MAX_WORKERS + invoice_app.IMAGE_WORKERS
+                    + args.clients + 8)
+    rss_growth = results['rss_mb']['second_half_range'][1] - results['rss_mb']['second_half_range'][0]
+    results['flat'] = results['threads']['max'] <= thread_limit and rss_growth < 25
+
+    print(f"statuses:      {statuses}")
+    print(f"latency:       {results['latency']}")
+    print(f"threads:       max {results['threads']['max']} (limit {thread_limit}), "
+          f"final {results['threads']['final']}")
+    print(f"rss (MB):      first {results['rss_mb']['first']}, max {results['rss_mb']['max']}, "
+          f"second-half growth {rss_growth:.1f}")
+    print(f"executor:      {results['executor']}")
+    print(f"flat:          {results['flat']}")
+    print(f"results:       {write_results('stress_timeouts', results, args.output)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+"""
+Bulk extraction from the command line, for backfills that need no server.
+
+Invoices are taken from directories (searched recursively), glob patterns
+and zip archives, and go through the same pipeline as ``/upload/batch``:
+result cache, near-duplicate detection, the model cascade and resolution
+ladder, on the rate limiter's bulk lane. Reading and preprocessing images
+(``process_image_memory``) is CPU-bound and runs in a pool of processes, so
+it scales with cores; at most ``--concurrency`` extractions wait on the
+model at once.
+
+Results are appended to the output as they finish: one JSON object per
+invoice (``.ndjson``/``.jsonl``), or one CSV row per line item. Each
+invoice extracted successfully is then added to a checkpoint file (the
+output's name plus ``.checkpoint``), and a later run with the same output
+skips it. Failed invoices are written too but retried by the next run. An
+invoice whose run was interrupted between the two writes is extracted, and
+written, again.
+
+Usage:
+    python -m bulk scans/2024/ archive.zip 'inbox/**/*.jpg' -o invoices.ndjson
+    python -m bulk scans/ -o invoices.csv --workers 8 --concurrency 4
+"""
+
+import os
+import argparse
+import asyncio
+import csv
+import glob
+import json
+import logging
+import multiprocessing
+import signal
+import sys
+import time
+import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, TextIO, Tuple
+
+if __name__ in ('__main__', '__mp_main__'):
+    # The command line and its worker processes only log problems unless
+    # asked to (the app keeps a logging setup that is already there)
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+import app as invoice_app
+import fast_json
+from pdf_ingest import is_pdf
+from rate_limiter import BULK, RateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+# Rate-limited invoices are retried this often, after the wait the limiter asks for
+RATE_LIMIT_RETRIES = 3
+
+CSV_FIELDS = ('source', 'status', 'error', 'supplier', 'tax_id', 'invoice_number', 'date',
+              'line', 'item_code', 'description', 'quantity', 'price', 'total',
+              'invoice_subtotal', 'invoice_tax', 'invoice_total')
+
+
+class Source(NamedTuple):
+    """One invoice file: ``name`` identifies it in the output and checkpoint."""
+    name: str
+    path: str
+    member: Optional[str] = None
+
+
+def find_sources(inputs: Iterable[str]) -> List[Source]:
+    """Invoice files in the given directories, glob patterns and zip archives."""
+    sources = {}
+
+    def add_file(path: str) -> None:
+        if path.lower().endswith('.zip') and zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                for member in archive.namelist():
+                    if not member.endswith('/') and invoice_app.allowed_file(member):
+                        name = f'{path}:{member}'
+                        sources.setdefault(name, Source(name, path, member))
+        elif invoice_app.allowed_file(path):
+            sources.setdefault(path, Source(path, path))
+
+    for spec in inputs:
+        if os.path.isdir(spec):
+            for root, dirs, files in os.walk(spec):
+                dirs.sort()
+                for file_name in sorted(files):
+                    add_file(os.path.normpath(os.path.join(root, file_name)))
+        elif os.path.isfile(spec):
+            add_file(os.path.normpath(spec))
+        else:
+            matches = sorted(glob.glob(spec, recursive=True))
+            if not matches:
+                logger.warning(f"Nothing matches {spec}")
+            for path in matches:
+                if os.path.isfile(path):
+                    add_file(os.path.normpath(path))
+    return list(sources.values())
+
+
+# Preprocessing, in the worker processes
+# ---------------------------------------
+
+# Open archives of this process, so members are read without parsing the
+# archive's directory each time
+_archives = {}
+
+
+def _init_worker(log_level: int) -> None:
+    # Ctrl-C reaches the whole process group: the parent stops the run
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger().setLevel(log_level)
+
+
+def read_source(source: Source) -> bytes:
+    if source.member is None:
+        with open(source.path, 'rb') as file:
+            return file.read()
+    archive = _archives.get(source.path)
+    if archive is None:
+        archive = _archives[source.path] = zipfile.ZipFile(source.path)
+    return archive.read(source.member)
+
+
+def preprocess(source: Source) -> Tuple[bytes, Optional[List[Dict]]]:
+    """Read an invoice and process it for the first ladder rung.
+
+    Returns:
+        tuple: the file's bytes and its ``process_image_memory`` output, or
+        None for PDFs, whose pages are processed as they are extracted
+    """
+    file_data = read_source(source)
+    if is_pdf(file_data):
+        return file_data, None
+    return file_data, invoice_app.process_image_memory(file_data, invoice_app.IMAGE_LADDER[0])
+
+
+# Output
+# ------
+
+class Checkpoint:
+    """Names of the invoices already extracted, one per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Set[str] = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                self.done.update(line.rstrip('\n') for line in file if line.strip())
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def add(self, name: str) -> None:
+        self.done.add(name)
+        self._file.write(name + '\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ResultWriter:
+    """Appends results to an NDJSON or CSV file, flushed as each is written."""
+
+    def __init__(self, path: str, output_format: str):
+        self.format = output_format
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file: TextIO = open(path, 'a', encoding='utf-8', newline='')
+        if output_format == 'csv':
+            self._csv = csv.DictWriter(self._file, CSV_FIELDS)
+            if new:
+                self._csv.writeheader()
+
+    def write(self, result: Dict) -> None:
+        if self.format == 'csv':
+            self._csv.writerows(csv_rows(result))
+        else:
+            self._file.write(fast_json.dumps(result) + '\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def csv_rows(result: Dict) -> List[Dict]:
+    """One row per line item of a result, or a single row for a failed one."""
+    row = {'source': result['source'], 'status': result['status'],
+           'error': result.get('error', '')}
+    invoice_data = result.get('invoice_data')
+    if invoice_data is None:
+        return [row]
+    totals = invoice_data['totals']
+    row.update(supplier=invoice_data['company_details']['name'],
+               tax_id=invoice_data['company_details']['tax_id'],
+               invoice_number=invoice_data['invoice_details']['invoice_number'],
+               date=invoice_data['invoice_details']['date'],
+               invoice_subtotal=totals['subtotal'], invoice_tax=totals['tax'],
+               invoice_total=totals['total'])
+    if not invoice_data['line_items']:
+        return [row]
+    return [dict(row, line=index + 1, **item)
+            for index, item in enumerate(invoice_data['line_items'])]
+
+
+def output_format(path: str, requested: Optional[str]) -> str:
+    if requested:
+        return requested
+    return 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+
+# Progress
+# --------
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class Progress:
+    """Counts finished invoices and reports throughput and the time left.
+
+    On a terminal the line is redrawn in place, otherwise a line is printed
+    every ``interval`` seconds.
+    """
+
+    def __init__(self, total: int, skipped: int = 0, stream: TextIO = sys.stderr,
+                 interval: float = 1.0):
+        self.total = total
+        self.skipped = skipped
+        self.stream = stream
+        self.interval = interval if stream.isatty() else max(interval, 10.0)
+        self.statuses: Dict[str, int] = {}
+        self.start_time = self._shown = time.monotonic()
+
+    @property
+    def finished(self) -> int:
+        return sum(self.statuses.values())
+
+    def add(self, status: str) -> None:
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if time.monotonic() - self._shown >= self.interval:
+            self.show()
+
+    def summary(self) -> Dict[str, float]:
+        elapsed = time.monotonic() - self.start_time
+        rate = self.finished / elapsed if elapsed else 0.0
+        left = self.total - self.finished
+        return {'finished': self.finished, 'total': self.total, 'skipped': self.skipped,
+                'elapsed_s': round(elapsed, 1), 'invoices_per_sec': round(rate, 3),
+                'eta_s': round(left / rate, 1) if rate else None, **self.statuses}
+
+    def show(self, final: bool = False) -> None:
+        self._shown = time.monotonic()
+        summary = self.summary()
+        failed = summary['finished'] - self.statuses.get('success', 0)
+        eta = format_duration(summary['eta_s']) if summary['eta_s'] is not None else '?'
+        line = (f"{summary['finished']}/{self.total} done, {failed} failed, "
+                f"{self.skipped} already done | {summary['invoices_per_sec']:.2f} invoices/s | "
+                f"{'elapsed ' + format_duration(summary['elapsed_s']) if final else 'ETA ' + eta}")
+        if self.stream.isatty():
+            self.stream.write('\r' + line.ljust(100) + ('\n' if final else ''))
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+
+# Extraction
+# ----------
+
+async def extract_source(source: Source, pool: Executor, slots: asyncio.Semaphore,
+                         force: bool = False,
+                         timeout: int = invoice_app.GEMINI_TIMEOUT) -> Dict:
+    """Extract one invoice, capturing its errors like a batch item."""
+    result = {'source': source.name}
+    start_time = time.time()
+    try:
+        file_data, image_parts = await asyncio.get_running_loop().run_in_executor(
+            pool, preprocess, source)
+        async with slots:
+            for attempt in range(RATE_LIMIT_RETRIES + 1):
+                try:
+                    extraction = await invoice_app.extract_invoice(
+                        file_data, force=force, timeout=timeout, lane=BULK,
+                        image_parts=image_parts)
+                    break
+                except RateLimitExceeded as e:
+                    if attempt == RATE_LIMIT_RETRIES:
+                        raise
+                    await asyncio.sleep(e.retry_after)
+        result.update(status='success', **extraction)
+    except RateLimitExceeded as e:
+        logger.warning(f"{source.name} rate limited: {str(e)}")
+        result.update(status='rate_limited', error=str(e), retry_after=e.retry_after)
+    except TimeoutError:
+        logger.error(f"{source.name} timed out after {time.time() - start_time:.2f}s")
+        result.update(status='timeout', error='Processing timeout')
+    except Exception as e:
+        logger.error(f"{source.name} failed: {str(e)}")
+        result.update(status='error', error=str(e))
+    result['processing_time'] = f"{time.time() - start_time:.2f}s"
+    return result
+
+
+async def run_bulk(sources: List[Source], pool: Executor, writer: ResultWriter,
+                   checkpoint: Checkpoint, progress: Progress, concurrency: int,
+                   read_ahead: int, force: bool = False,
+                   timeout: int = invoice_app.GEMINI_TIMEOUT) -> None:
+    """Extract ``sources``, writing each result as soon as it is ready.
+
+    Files are read and preprocessed on ``pool`` (worker processes when run
+    from the command line). At most ``concurrency`` invoices are with the
+    model at once; up to ``read_ahead`` more are read and preprocessed
+    meanwhile, so a model slot rarely waits for its image, while memory
+    stays bounded.
+    """
+    slots = asyncio.Semaphore(concurrency)
+    window = asyncio.Semaphore(concurrency + read_ahead)
+
+    async def one(source: Source) -> None:
+        try:
+            result = await extract_source(source, pool, slots, force=force, timeout=timeout)
+        finally:
+            window.release()
+        writer.write(result)
+        if result['status'] == 'success':
+            checkpoint.add(source.name)
+        progress.add(result['status'])
+
+    # Finished tasks are dropped, so a long backfill does not accumulate them;
+    # an error writing the results stops the run
+    running = set()
+    errors = []
+
+    def finished(task: asyncio.Task) -> None:
+        running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+
+    try:
+        for source in sources:
+            await window.acquire()
+            if errors:
+                break
+            task = asyncio.ensure_future(one(source))
+            running.add(task)
+            task.add_done_callback(finished)
+        await asyncio.gather(*running)
+    except asyncio.CancelledError:
+        # Interrupted: nothing more is written, the checkpoint has the rest
+        for task in list(running):
+            task.cancel()
+        raise
+    if errors:
+        raise errors[0]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('inputs', nargs='+', help='Directories, glob patterns or zip archives')
+    parser.add_argument('-o', '--output', required=True, help='Results file (.ndjson or .csv)')
+    parser.add_argument('--format', choices=('ndjson', 'csv'),
+                        help='Output format; by default from the output extension')
+    parser.add_argument('--checkpoint', help='Checkpoint file (default: <output>.checkpoint)')
+    parser.add_argument('--fresh', action='store_true',
+                        help='Start over: truncate the output and the checkpoint')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2,
+                        help='Preprocessing processes')
+    parser.add_argument('--concurrency', type=int, default=invoice_app.MODEL_MAX_WORKERS,
+                        help='Extractions waiting on the model at once')
+    parser.add_argument('--timeout', type=int, default=invoice_app.GEMINI_TIMEOUT,
+                        help='Model call timeout in seconds')
+    parser.add_argument('--force', action='store_true',
+                        help='Skip near-duplicate detection')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every extraction')
+    args = parser.parse_args(argv)
+
+    log_level = logging.INFO if args.verbose else logging.WARNING
+    logging.getLogger().setLevel(log_level)
+    if not invoice_app.get_model():
+        print('Gemini API is not configured (GOOGLE_API_KEY)', file=sys.stderr)
+        return 2
+    checkpoint_path = args.checkpoint or args.output + '.checkpoint'
+    if args.fresh:
+        for path in (args.output, checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    sources = find_sources(args.inputs)
+    checkpoint = Checkpoint(checkpoint_path)
+    pending = [source for source in sources if source.name not in checkpoint.done]
+    progress = Progress(len(pending), skipped=len(sources) - len(pending))
+    print(f"{len(sources)} invoices found, {len(pending)} to extract", file=sys.stderr)
+
+    writer = ResultWriter(args.output, output_format(args.output, args.format))
+    # The parent runs threads (event loop, model executor): new processes
+    # are started rather than forked from it
+    pool = ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker, initargs=(log_level,))
+    try:
+        invoice_app.background_loop.run(run_bulk(
+            pending, pool, writer, checkpoint, progress, args.concurrency,
+            read_ahead=args.workers * 2, force=args.force, timeout=args.timeout))
+    except KeyboardInterrupt:
+        progress.show(final=True)
+        print("Interrupted: run again with the same output to resume", file=sys.stderr)
+        return 130
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        writer.close()
+        checkpoint.close()
+
+    progress.show(final=True)
+    print(json.dumps(progress.summary()), file=sys.stderr)
+    return 0 if progress.statuses.get('success', 0) == progress.finished else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
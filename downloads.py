@@ -0,0 +1,246 @@
+"""
+Streaming, size-capped downloads of uploaded invoices (Firebase Storage URLs).
+
+Each worker process keeps one pooled ``requests`` session, so repeated
+downloads reuse TLS connections to the storage host instead of opening a new
+one per request. Every download has connect and read timeouts plus an
+overall deadline, and is read in chunks: it is aborted as soon as the
+``Content-Length`` header or the bytes received exceed the size cap, before
+the rest of the body is transferred.
+
+The body can be consumed while it arrives: ``fetch`` accepts a ``decode``
+callback that reads a file-like view of the stream (e.g. ``Image.open`` and
+a draft decode), and the downloaded bytes are still returned in full for
+everything that needs them afterwards.
+"""
+
+import os
+import io
+import logging
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv('DOWNLOAD_CONNECT_TIMEOUT', 5))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv('DOWNLOAD_READ_TIMEOUT', 15))
+# Whole download, so a server dripping bytes cannot hold a request forever
+DOWNLOAD_TIMEOUT = float(os.getenv('DOWNLOAD_TIMEOUT', 30))
+DOWNLOAD_POOL_SIZE = int(os.getenv('DOWNLOAD_POOL_SIZE', 16))
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', 2))
+# Batch items downloaded at the same time, ahead of their extraction
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', 8))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class DownloadError(Exception):
+    """The file could not be downloaded."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class DownloadTooLarge(DownloadError):
+    """The file is larger than the size cap."""
+
+
+class DownloadTimeout(DownloadError):
+    """The server was too slow to connect, answer or finish sending."""
+
+
+class StreamingBody(io.RawIOBase):
+    """Seekable, read-only view of a response body that is still arriving.
+
+    Bytes are kept as they are read, so readers may seek back (as
+    ``Image.open`` does while probing formats) and the full body is available
+    at the end.
+    """
+
+    def __init__(self, response: requests.Response, max_bytes: int, deadline: float,
+                 chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+        super().__init__()
+        self._chunks = response.iter_content(chunk_size)
+        self._buffer = bytearray()
+        self._position = 0
+        self._complete = False
+        self.max_bytes = max_bytes
+        self.deadline = deadline
+
+    def _fill(self, size: float) -> None:
+        """Receive until ``size`` bytes are buffered or the body ends."""
+        while not self._complete and len(self._buffer) < size:
+            if time.monotonic() > self.deadline:
+                raise DownloadTimeout('Download did not finish in time')
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                self._complete = True
+                break
+            except requests.RequestException as e:
+                # requests reports a read timeout mid-body as a ConnectionError
+                if isinstance(e, requests.exceptions.Timeout) or (
+                        e.args and isinstance(e.args[0], ReadTimeoutError)):
+                    raise DownloadTimeout(f'Download stalled: {str(e)}')
+                raise DownloadError(f'Download failed: {str(e)}')
+            self._buffer += chunk
+            if len(self._buffer) > self.max_bytes:
+                raise DownloadTooLarge(f'File too large (more than {self.max_bytes} bytes)')
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        self._fill(self._position + len(buffer))
+        count = max(0, min(len(buffer), len(self._buffer) - self._position))
+        buffer[:count] = self._buffer[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_END:
+            self._fill(math.inf)
+            offset += len(self._buffer)
+        elif whence == io.SEEK_CUR:
+            offset += self._position
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def getvalue(self) -> bytes:
+        """The complete body, receiving whatever has not arrived yet."""
+        self._fill(math.inf)
+        return bytes(self._buffer)
+
+
+class Downloader:
+    """Pooled, streaming HTTP downloads with timeouts and a size cap.
+
+    The session is created lazily and again after ``fork()``, so it is safe
+    to use under gunicorn.
+    """
+
+    def __init__(self, connect_timeout: float = DOWNLOAD_CONNECT_TIMEOUT,
+                 read_timeout: float = DOWNLOAD_READ_TIMEOUT,
+                 total_timeout: float = DOWNLOAD_TIMEOUT,
+                 pool_size: int = DOWNLOAD_POOL_SIZE, retries: int = DOWNLOAD_RETRIES):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'downloads': 0,
+            'failed': 0,
+            'too_large': 0,
+            'timeouts': 0,
+            'bytes': 0,
+            'total_seconds': 0.0
+        }
+
+    def session(self) -> requests.Session:
+        """The worker's shared session."""
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    session = requests.Session()
+                    # Only connection problems and gateway errors are retried
+                    retry = Retry(total=self.retries, connect=self.retries, read=0,
+                                  status=self.retries, backoff_factor=0.2,
+                                  status_forcelist=(502, 503, 504),
+                                  allowed_methods=frozenset(['GET']))
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size,
+                                          max_retries=retry)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def _count(self, **changes) -> None:
+        with self._lock:
+            for key, amount in changes.items():
+                self._stats[key] += amount
+
+    def fetch(self, url: str, max_bytes: int,
+              decode: Optional[Callable[[StreamingBody], Any]] = None) -> Tuple[bytes, Any]:
+        """Download ``url``, optionally decoding it while it arrives.
+
+        Args:
+            url: HTTP(S) URL of the file
+            max_bytes: Size cap; larger files are aborted early
+            decode: Called with the body as a seekable file object before
+                the download has finished. If it fails for any reason other
+                than the download itself (e.g. the file is a PDF, not an
+                image), its result is None and the download simply completes.
+
+        Returns:
+            tuple: ``(data, decoded)``
+
+        Raises:
+            DownloadTooLarge: If the file exceeds ``max_bytes``
+            DownloadTimeout: On connect, read or overall timeout
+            DownloadError: On HTTP errors and connection failures
+        """
+        start_time = time.monotonic()
+        try:
+            with self.session().get(url, stream=True,
+                                    timeout=(self.connect_timeout, self.read_timeout)) as response:
+                if response.status_code >= 400:
+                    raise DownloadError(f'HTTP {response.status_code} from storage',
+                                        status_code=response.status_code)
+                length = response.headers.get('Content-Length')
+                if length and length.isdigit() and int(length) > max_bytes:
+                    raise DownloadTooLarge(f'File too large ({int(length)} > {max_bytes} bytes)')
+
+                body = StreamingBody(response, max_bytes, start_time + self.total_timeout)
+                decoded = None
+                if decode is not None:
+                    try:
+                        decoded = decode(body)
+                    except DownloadError:
+                        raise
+                    except Exception as e:
+                        logger.debug(f"Could not decode while downloading: {str(e)}")
+                data = body.getvalue()
+        except DownloadTooLarge:
+            self._count(too_large=1)
+            raise
+        except DownloadTimeout:
+            self._count(timeouts=1)
+            raise
+        except DownloadError:
+            self._count(failed=1)
+            raise
+        except requests.exceptions.Timeout as e:
+            self._count(timeouts=1)
+            raise DownloadTimeout(f'Download timed out: {str(e)}')
+        except requests.RequestException as e:
+            self._count(failed=1)
+            raise DownloadError(f'Download failed: {str(e)}')
+
+        self._count(downloads=1, bytes=len(data), total_seconds=time.monotonic() - start_time)
+        return data, decoded
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['avg_seconds'] = (round(stats['total_seconds'] / stats['downloads'], 3)
+                                if stats['downloads'] else 0.0)
+        stats['total_seconds'] = round(stats['total_seconds'], 3)
+        return stats
@@ -0,0 +1,240 @@
+"""
+Process-wide executors for model calls and request coroutines.
+
+Every request used to create its own event loop plus a one-off thread pool,
+and a timed-out Gemini call kept running in an orphaned thread. Instead, each
+worker process now owns:
+
+* one sized ``ModelExecutor`` thread pool for blocking model calls, and
+* one ``BackgroundLoop`` event loop thread that runs request coroutines.
+
+Both are created lazily and re-created after ``fork()`` so they are safe to
+use under gunicorn. Timeouts are enforced twice: the model call receives a
+transport deadline so its thread is actually released, and the waiting side
+gives up at the request deadline and cancels the call if it has not started.
+"""
+
+import os
+import asyncio
+import atexit
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ModelExecutor:
+    """Sized, instrumented thread pool for blocking model calls."""
+
+    def __init__(self, max_workers: int = 8, name: str = 'model'):
+        self.max_workers = max_workers
+        self.name = name
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'timeouts': 0,
+            'cancelled': 0,
+            'queued': 0,
+            'in_flight': 0,
+            'total_seconds': 0.0
+        }
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix=self.name
+                    )
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _adjust(self, **changes) -> None:
+        with self._lock:
+            for key, amount in changes.items():
+                self._stats[key] += amount
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Future:
+        """Schedule ``func`` on the pool and return its future."""
+        def call():
+            self._adjust(queued=-1, in_flight=1)
+            start_time = time.time()
+            try:
+                result = func(*args, **kwargs)
+                self._adjust(completed=1)
+                return result
+            except BaseException:
+                self._adjust(failed=1)
+                raise
+            finally:
+                self._adjust(in_flight=-1, total_seconds=time.time() - start_time)
+
+        self._adjust(submitted=1, queued=1)
+        future = self._pool().submit(call)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future: Future) -> None:
+        # A call cancelled before it started never ran ``call`` and is still queued
+        if future.cancelled():
+            self._adjust(queued=-1, cancelled=1)
+
+    def _timed_out(self, future: Future) -> None:
+        self._adjust(timeouts=1)
+        # Only succeeds while the call is still waiting for a thread; a running
+        # call is bounded by the deadline passed to the model client.
+        future.cancel()
+
+    def run(self, func: Callable[..., Any], *args, timeout: Optional[float] = None,
+            **kwargs) -> Any:
+        """Run ``func`` on the pool and wait for its result.
+
+        Raises:
+            TimeoutError: If no result arrived within ``timeout`` seconds
+        """
+        future = self.submit(func, *args, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            self._timed_out(future)
+            raise
+
+    async def run_async(self, func: Callable[..., Any], *args,
+                        timeout: Optional[float] = None,
+                        on_done: Optional[Callable[[], None]] = None, **kwargs) -> Any:
+        """Awaitable variant of ``run``.
+
+        ``on_done`` is called once the call has finished in its thread, or
+        was cancelled before it started, even when the wait for it ended
+        earlier (e.g. to release what the call holds).
+
+        Raises:
+            TimeoutError: ``concurrent.futures.TimeoutError`` on timeout, the
+                same type ``run`` raises
+        """
+        try:
+            future = self.submit(func, *args, **kwargs)
+        except BaseException:
+            if on_done is not None:
+                on_done()
+            raise
+        if on_done is not None:
+            future.add_done_callback(lambda _: on_done())
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self._timed_out(future)
+            raise TimeoutError(f'Call did not finish within {timeout}s')
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters and gauges describing the pool."""
+        with self._lock:
+            stats = dict(self._stats)
+        finished = stats['completed'] + stats['failed']
+        stats['avg_seconds'] = round(stats['total_seconds'] / finished, 3) if finished else 0.0
+        stats['total_seconds'] = round(stats['total_seconds'], 3)
+        stats['max_workers'] = self.max_workers
+        return stats
+
+    def shutdown(self) -> None:
+        """Stop accepting work; running calls finish on their own deadlines."""
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+async def _in_context(context: contextvars.Context, coro: Awaitable) -> Any:
+    # The task runs in its own copy of the loop thread's context
+    for variable, value in context.items():
+        variable.set(value)
+    return await coro
+
+
+class BackgroundLoop:
+    """A single event loop running in a daemon thread, shared by all requests.
+
+    Sync request handlers submit coroutines with ``run`` instead of creating
+    and tearing down an event loop per request.
+    """
+
+    def __init__(self, cpu_workers: Optional[int] = None, name: str = 'event-loop'):
+        self.cpu_workers = cpu_workers
+        self.name = name
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Return the running background loop, starting it if needed."""
+        if self._loop is None or self._pid != os.getpid():
+            with self._lock:
+                if self._loop is None or self._pid != os.getpid():
+                    self._start()
+        return self._loop
+
+    def _start(self) -> None:
+        loop = asyncio.new_event_loop()
+        # Default executor for CPU-bound work such as image decoding
+        loop.set_default_executor(ThreadPoolExecutor(
+            max_workers=self.cpu_workers,
+            thread_name_prefix='cpu'
+        ))
+        ready = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        threading.Thread(target=serve, name=self.name, daemon=True).start()
+        ready.wait()
+        self._loop = loop
+        self._pid = os.getpid()
+
+    def run(self, coro: Awaitable, timeout: Optional[float] = None) -> Any:
+        """Run a coroutine on the background loop and wait for its result.
+
+        The coroutine sees the caller's context variables (e.g. the
+        request's stage timings).
+
+        Raises:
+            TimeoutError: If the coroutine did not finish within ``timeout``;
+                the coroutine is cancelled, as it is when the wait is interrupted
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            _in_context(contextvars.copy_context(), coro), self.loop()
+        )
+        try:
+            return future.result(timeout=timeout)
+        except (TimeoutError, KeyboardInterrupt):
+            future.cancel()
+            raise
+
+    def shutdown(self) -> None:
+        """Stop the loop thread."""
+        if self._loop is not None and self._pid == os.getpid():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+
+def shutdown_all(*executors) -> None:
+    """Shut down executors, ignoring errors during interpreter exit."""
+    for executor in executors:
+        try:
+            executor.shutdown()
+        except Exception:
+            pass
+
+
+def register_shutdown(*executors) -> None:
+    """Shut executors down cleanly when the process exits."""
+    atexit.register(shutdown_all, *executors)
@@ -0,0 +1,67 @@
+"""
+JSON encoding and decoding for model output and API responses.
+
+Uses ``orjson`` when it is installed and falls back to the standard library
+otherwise, so the app runs either way. Output is UTF-8 without ``\\u``
+escapes (Hebrew invoices are a third of the size) and keys keep their
+insertion order instead of being sorted.
+"""
+
+import json
+from typing import Any
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(text: str) -> Any:
+    """Parse JSON text.
+
+    Raises:
+        json.JSONDecodeError: If the text is not valid JSON
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # orjson is stricter (NaN, huge integers, lone surrogates);
+            # let the standard library decide
+            pass
+    return json.loads(text)
+
+
+def dumps(obj: Any) -> str:
+    """Compact JSON text, keys in insertion order."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=DefaultJSONProvider.default,
+                                option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'),
+                      default=DefaultJSONProvider.default)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by :func:`dumps` for compact responses.
+
+    Indented output (debug mode or ``JSONIFY_PRETTYPRINT_REGULAR``) still goes
+    through the standard library.
+    """
+
+    ensure_ascii = False
+    sort_keys = False
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if kwargs.get('indent') is None and set(kwargs) <= {'separators'}:
+            return dumps(obj)
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs: Any) -> Any:
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return loads(s)
@@ -0,0 +1,43 @@
+"""
+Gunicorn configuration (loaded automatically from the working directory).
+
+With ``GUNICORN_PRELOAD`` on (the default) the master imports the app once
+before forking, so workers start in milliseconds and share the imported
+modules' memory copy-on-write. Nothing fork-unsafe is created before the
+fork: executors, the event loop and connection pools are per-process and
+created lazily, and each worker builds its own Gemini model, gRPC client and
+Redis client after it has been forked. Backends set to ``auto`` follow
+``REDIS_URL`` without connecting, so a Redis that is down does not slow the
+master's import.
+
+``STARTUP_MODE=eager`` also imports the Gemini SDK in the master and warms
+every worker up (model client, executors, codecs, connection pools) before
+it accepts requests; ``lazy`` leaves that to the first request or
+``/warmup``.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 4))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info')
+
+
+def post_fork(server, worker) -> None:
+    """Drop the model and Redis client built in the master; the worker creates its own."""
+    import app as invoice_app
+    from redis_client import reset_redis
+    invoice_app.reset_model()
+    reset_redis()
+
+
+def post_worker_init(worker) -> None:
+    """Warm the worker up before it takes traffic in eager mode."""
+    import app as invoice_app
+    if invoice_app.STARTUP_MODE == 'eager':
+        timings = invoice_app.warmup()
+        worker.log.info(f"Worker {worker.pid} warmed up in {timings['total']:.2f}s")
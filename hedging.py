@@ -0,0 +1,235 @@
+"""
+Hedged model calls: a second, identical call when the first is running late.
+
+A few Gemini calls hang far beyond the usual latency, and a retry of the
+same request usually finishes quickly. With hedging on (``MODEL_HEDGING``),
+a call still running after the ``HEDGE_PERCENTILE`` latency of its model
+(tracked live over recent calls) gets an identical second call. Whichever
+succeeds first is used, and the other is cancelled: dropped before it
+starts, or no longer waited for if it already runs (the model client's own
+deadline ends it). Each call holds its rate limiter lease until its thread
+is done, so capacity is not given back while a cancelled call still runs.
+
+Latencies are tracked per model tier in the model router's tracker, so hedge
+delays and escalation decisions come from the same recent calls.
+
+Extra calls spend quota, so hedges are paid from a budget. Every call earns
+``HEDGE_BUDGET`` of a hedge (0.05: at most one extra call per twenty), and
+up to ``HEDGE_BURST`` unspent hedges are kept. A hedge also needs immediate
+capacity from the rate limiter and is never fired without it.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from model_router import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+MODEL_HEDGING = os.getenv('MODEL_HEDGING', 'off').lower() in ('1', 'true', 'yes', 'on')
+# Latency percentile of a model after which a call is hedged
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 0.95))
+# Hedges earned per call, and the most kept for bursts
+HEDGE_BUDGET = float(os.getenv('HEDGE_BUDGET', 0.05))
+HEDGE_BURST = float(os.getenv('HEDGE_BURST', 5))
+# Never hedge calls younger than this, whatever the percentile says
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 1.0))
+
+# Outcomes counted per call that could have been hedged
+FIRED = 'fired'
+WON = 'won'
+WASTED = 'wasted'
+NO_BUDGET = 'no_budget'
+NO_CAPACITY = 'no_capacity'
+NO_TIME = 'no_time'
+OUTCOMES = (FIRED, WON, WASTED, NO_BUDGET, NO_CAPACITY, NO_TIME)
+
+
+class Hedger:
+    """Hedges model calls that run past their model's latency percentile.
+
+    Args:
+        enabled: Hedge at all; latencies are tracked either way
+        percentile: Latency percentile that triggers the hedge
+        budget: Hedges earned per call
+        burst: Most unspent hedges kept
+        min_delay: Shortest wait before hedging, in seconds
+        latency: Model call latencies by tier, e.g. ``ModelRouter.latency``
+            (failed calls too: one that timed out counts as its whole
+            timeout, one cancelled for a hedge with the time it had run)
+        on_outcome: Called with each outcome, e.g. to count it in metrics
+    """
+
+    def __init__(self, enabled: bool = MODEL_HEDGING, percentile: float = HEDGE_PERCENTILE,
+                 budget: float = HEDGE_BUDGET, burst: float = HEDGE_BURST,
+                 min_delay: float = HEDGE_MIN_DELAY, latency: Optional[LatencyTracker] = None,
+                 on_outcome: Optional[Callable[[str], None]] = None):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.min_delay = min_delay
+        self.latency = latency or LatencyTracker()
+        self.on_outcome = on_outcome
+        self._tokens = burst
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(('calls',) + OUTCOMES, 0)
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self._stats[outcome] += 1
+        if self.on_outcome is not None and outcome != 'calls':
+            self.on_outcome(outcome)
+
+    def _earn(self) -> None:
+        with self._lock:
+            self._stats['calls'] += 1
+            self._tokens = min(self.burst, self._tokens + self.budget)
+
+    def _spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _refund(self) -> None:
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+    def delay(self, model: str) -> Optional[float]:
+        """Seconds after which a call of ``model`` is hedged, or None while its
+        latency is unknown."""
+        latency = self.latency.percentile(model, self.percentile)
+        return None if latency is None else max(latency, self.min_delay)
+
+    async def run(self, model: str, call: Callable[[float, Any], Awaitable[Any]],
+                  timeout: float, acquire: Optional[Callable[[], Awaitable[Any]]] = None,
+                  lease: Any = None) -> Any:
+        """Run ``call(timeout, lease)``, hedged with a second one if it runs late.
+
+        Args:
+            model: Tier the latency is tracked under
+            call: Makes one model call with the given timeout, holding the
+                given lease (or None) and releasing it once the call is done
+                in its thread, even if it was cancelled here before that
+            timeout: Seconds the call may take; a hedge gets what is left
+            acquire: Capacity for the hedge: returns a lease (an object with
+                ``release()``) or raises when there is none right now
+            lease: Capacity held by the first call
+
+        Returns:
+            The result of the first call to succeed
+
+        Raises:
+            Exception: The first call's error if neither call succeeded
+        """
+        self._earn()
+        start_time = time.monotonic()
+        primary = asyncio.ensure_future(call(timeout, lease))
+        try:
+            return await self._hedged(model, call, timeout, acquire, primary, start_time)
+        except asyncio.CancelledError:
+            # The caller gave up: neither call is needed any more
+            primary.cancel()
+            raise
+
+    async def _hedged(self, model: str, call: Callable[[float, Any], Awaitable[Any]],
+                      timeout: float, acquire: Optional[Callable[[], Awaitable[Any]]],
+                      primary: asyncio.Future, start_time: float) -> Any:
+        delay = self.delay(model) if self.enabled else None
+        if delay is None or delay >= timeout:
+            return await self._timed(model, primary, start_time, timeout)
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return await self._timed(model, primary, start_time, timeout)
+
+        remaining = timeout - (time.monotonic() - start_time)
+        slow = self.latency.percentile(model, 0.5)
+        if slow is not None and remaining < slow:
+            # A fresh call would not finish in time either
+            self._count(NO_TIME)
+            return await self._timed(model, primary, start_time, timeout)
+        if not self._spend():
+            self._count(NO_BUDGET)
+            return await self._timed(model, primary, start_time, timeout)
+        lease = None
+        if acquire is not None:
+            try:
+                lease = await acquire()
+            except Exception:
+                self._refund()
+                self._count(NO_CAPACITY)
+                return await self._timed(model, primary, start_time, timeout)
+
+        self._count(FIRED)
+        logger.info(f"Hedging {model} call after {time.monotonic() - start_time:.2f}s")
+        hedge = asyncio.ensure_future(call(remaining, lease))
+        hedge_start = time.monotonic()
+        return await self._race(model, primary, start_time, timeout, hedge, hedge_start,
+                                remaining)
+
+    async def _race(self, model: str, primary: asyncio.Future, start_time: float,
+                    timeout: float, hedge: asyncio.Future, hedge_start: float,
+                    hedge_timeout: float) -> Any:
+        """Result of whichever call succeeds first; the other is cancelled."""
+        started = {primary: start_time, hedge: hedge_start}
+        timeouts = {primary: timeout, hedge: hedge_timeout}
+        pending = {primary, hedge}
+        while pending:
+            try:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                hedge.cancel()
+                raise
+            for task in done:
+                if task.exception() is not None:
+                    self._record(model, time.monotonic() - started[task], timeouts[task],
+                                 task.exception())
+                    continue
+                for loser in pending:
+                    loser.cancel()
+                    self.latency.record(model, time.monotonic() - started[loser])
+                self.latency.record(model, time.monotonic() - started[task])
+                self._count(WON if task is hedge else WASTED)
+                return task.result()
+        # Both failed: the hedge was spent for nothing
+        self._count(WASTED)
+        hedge.exception()
+        return primary.result()
+
+    async def _timed(self, model: str, call: asyncio.Future, start_time: float,
+                     timeout: float) -> Any:
+        try:
+            result = await call
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record(model, time.monotonic() - start_time, timeout, e)
+            raise
+        self.latency.record(model, time.monotonic() - start_time)
+        return result
+
+    def _record(self, model: str, seconds: float, timeout: float, error: BaseException) -> None:
+        """Record a failed call: the slowest calls are the ones that time out, and
+        leaving them out would make the percentiles (and hedge delays) too short."""
+        if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+            seconds = max(seconds, timeout)
+        self.latency.record(model, seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        """Calls, hedge outcomes, the share of extra calls and the budget left."""
+        with self._lock:
+            stats = dict(self._stats, tokens=round(self._tokens, 2))
+        stats['enabled'] = self.enabled
+        stats['hedge_rate'] = round(stats[FIRED] / stats['calls'], 4) if stats['calls'] else None
+        stats['delays'] = {}
+        for model in self.latency.stats():
+            delay = self.delay(model)
+            stats['delays'][model] = None if delay is None else round(delay, 3)
+        return stats
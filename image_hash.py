@@ -0,0 +1,294 @@
+"""
+Perceptual hashing and near-duplicate lookup for invoice images.
+
+A 64-bit difference hash (dHash) is computed with NumPy on the normalized
+JPEG produced by ``process_image_memory``. Hashes of previous extractions are
+kept in a multi-index hash table so photos of the same paper invoice
+(different crop, lighting or re-encode) can be matched within a
+Hamming-distance threshold in sub-linear time, even with hundreds of
+thousands of stored hashes.
+
+A match is only a hint: different invoices printed on one supplier's
+template hash a bit or two apart, so a near-duplicate is never served as
+an extraction (see ``prepare_extraction``), and detection is off unless
+``DUPLICATE_HASH_THRESHOLD`` is set.
+"""
+
+import os
+import base64
+import logging
+import threading
+import time
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_HASH_THRESHOLD = int(os.getenv('DUPLICATE_HASH_THRESHOLD', 0))  # 0 disables
+DUPLICATE_HASH_SIZE = int(os.getenv('DUPLICATE_HASH_SIZE', 8))
+DUPLICATE_SYNC_INTERVAL = float(os.getenv('DUPLICATE_SYNC_INTERVAL', 5))
+# Hashes kept, in each worker and in the shared log; the oldest go first
+DUPLICATE_MAX_ENTRIES = int(os.getenv('DUPLICATE_MAX_ENTRIES', 100000))
+# A Redis stream, capped at about DUPLICATE_MAX_ENTRIES (the ids of its
+# entries stay valid as it is trimmed, unlike list offsets)
+PHASH_LOG_KEY = 'invoice:phash:stream'
+# Log entries read per round trip when syncing
+SYNC_BATCH = 1000
+
+# Blank or flat images hash to (nearly) all-zero/all-one values and would
+# match each other; such hashes carry no identity and are never indexed.
+MIN_HASH_BITS = 4
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two hashes."""
+    return bin(a ^ b).count('1')
+
+
+def is_informative(hash_value: int, bits: int = DUPLICATE_HASH_SIZE ** 2) -> bool:
+    """Whether a hash has enough structure to identify an image."""
+    set_bits = bin(hash_value).count('1')
+    return MIN_HASH_BITS <= set_bits <= bits - MIN_HASH_BITS
+
+
+def dhash(image_data: Union[bytes, str], hash_size: int = DUPLICATE_HASH_SIZE) -> int:
+    """Compute a difference hash of an image.
+
+    Args:
+        image_data: Encoded image bytes, or base64 text as produced by
+            ``process_image_memory``
+        hash_size: Hash side length; the hash has ``hash_size ** 2`` bits
+
+    Returns:
+        int: The perceptual hash
+    """
+    from PIL import Image
+
+    if isinstance(image_data, str):
+        image_data = base64.b64decode(image_data)
+
+    img = Image.open(BytesIO(image_data))
+    # Let the JPEG decoder downscale for us; we only need a tiny thumbnail
+    img.draft('L', (hash_size * 4, hash_size * 4))
+    img = img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+
+    return _difference_bits(img)
+
+
+def _difference_bits(img) -> int:
+    """dHash bits of a grayscale image already resized to ``(size + 1, size)``."""
+    pixels = np.asarray(img, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def letterhead_hash(image_data: Union[bytes, str], fraction: float = 0.2,
+                    hash_size: int = DUPLICATE_HASH_SIZE) -> int:
+    """Difference hash of the top ``fraction`` of the page.
+
+    Invoices from one supplier share their letterhead while everything below
+    it changes, so this hash recognizes the supplier rather than the invoice.
+    """
+    from PIL import Image
+
+    if isinstance(image_data, str):
+        image_data = base64.b64decode(image_data)
+
+    img = Image.open(BytesIO(image_data))
+    img.draft('L', (hash_size * 16, hash_size * 16))
+    img = img.convert('L')
+    img = img.crop((0, 0, img.width, max(1, int(img.height * fraction))))
+    return _difference_bits(img.resize((hash_size + 1, hash_size), Image.Resampling.BOX))
+
+
+class MultiIndexHash:
+    """Multi-index hashing table for Hamming-space range queries.
+
+    Each hash is split into ``chunks`` substrings and indexed in one exact
+    table per substring. By the pigeonhole principle, any stored hash within
+    ``r`` bits of the query differs by at most ``r // chunks`` bits in at
+    least one substring, so a query only probes the few buckets within that
+    small radius instead of scanning the whole index.
+    """
+
+    def __init__(self, bits: int = DUPLICATE_HASH_SIZE ** 2, chunks: int = 4):
+        self.bits = bits
+        self.chunks = chunks
+        self.chunk_bits = bits // chunks
+        self._mask = (1 << self.chunk_bits) - 1
+        self._tables = [{} for _ in range(chunks)]
+        self._hashes = []
+        self._values = []
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def keep_latest(self, count: int) -> None:
+        """Drop all but the ``count`` most recently added hashes."""
+        hashes, values = self._hashes[-count:], self._values[-count:]
+        self._tables = [{} for _ in range(self.chunks)]
+        self._hashes = []
+        self._values = []
+        for hash_value, value in zip(hashes, values):
+            self.add(hash_value, value)
+
+    def _substrings(self, hash_value: int) -> List[int]:
+        return [(hash_value >> (i * self.chunk_bits)) & self._mask for i in range(self.chunks)]
+
+    def _neighbours(self, value: int, radius: int) -> List[int]:
+        """All chunk values within ``radius`` bits of ``value``."""
+        results = [value]
+        frontier = [(value, -1)]
+        for _ in range(radius):
+            next_frontier = []
+            for current, last_bit in frontier:
+                for bit in range(last_bit + 1, self.chunk_bits):
+                    flipped = current ^ (1 << bit)
+                    results.append(flipped)
+                    next_frontier.append((flipped, bit))
+            frontier = next_frontier
+        return results
+
+    def add(self, hash_value: int, value: Any) -> None:
+        """Insert a hash with an associated value."""
+        entry = len(self._hashes)
+        self._hashes.append(hash_value)
+        self._values.append(value)
+        for table, substring in zip(self._tables, self._substrings(hash_value)):
+            table.setdefault(substring, []).append(entry)
+
+    def search(self, hash_value: int, max_distance: int) -> List[Tuple[int, int, Any]]:
+        """Find all stored hashes within ``max_distance`` bits.
+
+        Returns:
+            list: ``(distance, hash, value)`` tuples sorted by distance, most
+            recently added first among equal distances
+        """
+        radius = max_distance // self.chunks
+        candidates = set()
+        for table, substring in zip(self._tables, self._substrings(hash_value)):
+            for neighbour in self._neighbours(substring, radius):
+                bucket = table.get(neighbour)
+                if bucket:
+                    candidates.update(bucket)
+
+        matches = []
+        for entry in sorted(candidates, reverse=True):
+            stored = self._hashes[entry]
+            distance = hamming_distance(hash_value, stored)
+            if distance <= max_distance:
+                matches.append((distance, stored, self._values[entry]))
+
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+class DuplicateIndex:
+    """Thread-safe near-duplicate index shared across workers through Redis.
+
+    Each worker holds its own index. New hashes are appended to a Redis
+    stream and other workers replay the entries after the last one they saw
+    at most every ``DUPLICATE_SYNC_INTERVAL`` seconds, so every worker
+    converges on the same index without reloading it. Both keep about the
+    latest ``max_entries`` hashes.
+    """
+
+    def __init__(self, threshold: int = DUPLICATE_HASH_THRESHOLD,
+                 sync_interval: float = DUPLICATE_SYNC_INTERVAL, log_key: str = PHASH_LOG_KEY,
+                 max_entries: int = DUPLICATE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.sync_interval = sync_interval
+        self.log_key = log_key
+        self.max_entries = max_entries
+        self._index = MultiIndexHash()
+        self._lock = threading.Lock()
+        self._log_id = '-'
+        self._last_sync = 0.0
+        self._stats = {'lookups': 0, 'matches': 0, 'added': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def _sync(self, force: bool = False) -> None:
+        """Replay hashes added by other workers since the last sync."""
+        client = get_redis()
+        if client is None:
+            return
+        if not force and time.time() - self._last_sync < self.sync_interval:
+            return
+        self._last_sync = time.time()
+        while True:
+            try:
+                start = '-' if self._log_id == '-' else f'({self._log_id}'
+                entries = client.xrange(self.log_key, min=start, count=SYNC_BATCH)
+            except Exception as e:
+                logger.warning(f"Duplicate index sync failed: {str(e)}")
+                return
+            for _, fields in entries:
+                self._add_local(int(fields[b'hash'], 16), fields[b'key'].decode())
+            if entries:
+                self._log_id = entries[-1][0].decode()
+            if len(entries) < SYNC_BATCH:
+                return
+
+    def _add_local(self, hash_value: int, key: str) -> None:
+        self._index.add(hash_value, key)
+        if len(self._index) > self.max_entries:
+            # Trimmed by a quarter at a time, so rebuilding the tables is rare
+            self._index.keep_latest(self.max_entries * 3 // 4)
+
+    def find(self, hash_value: int,
+             max_distance: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Return the closest prior extraction within the threshold.
+
+        Args:
+            hash_value: Perceptual hash of the new image
+            max_distance: Override for the configured threshold
+
+        Returns:
+            dict or None: ``{'key', 'distance'}`` of the best match, and
+            ``keys``, the distinct keys of every match, closest first
+        """
+        if not self.enabled or not is_informative(hash_value):
+            return None
+        max_distance = self.threshold if max_distance is None else max_distance
+        with self._lock:
+            self._sync()
+            matches = self._index.search(hash_value, max_distance)
+            self._stats['lookups'] += 1
+            if not matches:
+                return None
+            self._stats['matches'] += 1
+        distance, _, key = matches[0]
+        keys = list(dict.fromkeys(value for _, _, value in matches))
+        return {'key': key, 'distance': distance, 'keys': keys}
+
+    def add(self, hash_value: int, key: str) -> None:
+        """Record the hash of a completed extraction."""
+        if not self.enabled or not is_informative(hash_value):
+            return
+        client = get_redis()
+        with self._lock:
+            if client is not None:
+                try:
+                    # The shared log is the source of truth; replaying it picks up
+                    # our own entry along with anything other workers added.
+                    client.xadd(self.log_key, {'hash': f'{hash_value:x}', 'key': key},
+                                maxlen=self.max_entries, approximate=True)
+                    self._sync(force=True)
+                    self._stats['added'] += 1
+                    return
+                except Exception as e:
+                    logger.warning(f"Could not publish perceptual hash: {str(e)}")
+            self._add_local(hash_value, key)
+            self._stats['added'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Return index size and lookup counters for this worker."""
+        with self._lock:
+            return dict(self._stats, size=len(self._index), threshold=self.threshold)
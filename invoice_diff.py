@@ -0,0 +1,300 @@
+"""
+Server-side comparison of an extracted invoice with its edited version.
+
+``diff_invoices`` aligns the original and edited line items and builds the
+``/generate_report`` report: field-level changes per item, quantity, price
+and total deltas, added and removed lines, and how the edits move the
+invoice totals. It works on the API's invoice JSON, so batch jobs can diff
+stored results the same way the editor does.
+
+Items are aligned in passes that each cost about O(n):
+
+1. equal ``item_code`` (duplicates pair up in order);
+2. equal normalized description among the items left;
+3. description similarity among the items left: character trigrams are
+   indexed once, so each item is only scored against the few items it shares
+   the most distinctive trigrams with, and pairs are taken best first (Dice coefficient at least
+   ``SIMILARITY_THRESHOLD``, ties going to the closer position).
+
+Whatever is left over was removed from the original or added in the edit.
+"""
+
+import re
+from collections import defaultdict, deque
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+NUMERIC_FIELDS = ('quantity', 'price', 'total')
+TEXT_FIELDS = ('item_code', 'description')
+TOTAL_FIELDS = ('subtotal', 'tax', 'total')
+DETAIL_FIELDS = {
+    'company_details': ('name', 'address', 'tax_id'),
+    'invoice_details': ('invoice_number', 'date')
+}
+
+# Numbers closer than this are equal (amounts are rounded to 2 decimals)
+TOLERANCE = 0.001
+SIMILARITY_THRESHOLD = 0.5
+# Trigrams shared by more items than this say little and are not indexed
+MAX_POSTING = 64
+# Items scored exactly per edited item, out of those sharing indexed trigrams
+MAX_CANDIDATES = 8
+
+# Matched by
+CODE = 'item_code'
+DESCRIPTION = 'description'
+SIMILARITY = 'similarity'
+
+_separators = re.compile(r'[\W_]+')
+
+
+def _number(value: Any) -> Optional[float]:
+    """A field value as a float, or None when it is not a number."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace(',', '').strip())
+    except ValueError:
+        return None
+
+
+def _text(value: Any) -> str:
+    return '' if value is None else str(value).strip()
+
+
+def normalize(text: Any) -> str:
+    """Case-folded text with punctuation and repeated whitespace collapsed."""
+    if not text:
+        return ''
+    return _separators.sub(' ', str(text).casefold()).strip()
+
+
+def trigrams(text: str) -> frozenset:
+    padded = f' {text} '
+    return frozenset(padded[index:index + 3] for index in range(len(padded) - 2))
+
+
+def _pair_by_key(keys_original: Union[List[str], Dict[int, str]],
+                 keys_current: Union[List[str], Dict[int, str]],
+                 original_left: List[int], current_left: List[int],
+                 matches: Dict[int, Tuple[int, str, float]], method: str) -> None:
+    """Pair items with equal non-empty keys; duplicates pair up in order."""
+    by_key = defaultdict(deque)
+    for index in original_left:
+        if keys_original[index]:
+            by_key[keys_original[index]].append(index)
+    for index in current_left:
+        candidates = by_key.get(keys_current[index])
+        if candidates:
+            matches[index] = (candidates.popleft(), method, 1.0)
+
+
+def _pair_by_similarity(descriptions_original: Dict[int, str],
+                        descriptions_current: Dict[int, str],
+                        original_left: List[int], current_left: List[int],
+                        matches: Dict[int, Tuple[int, str, float]],
+                        threshold: float) -> None:
+    grams_original = {index: trigrams(descriptions_original[index]) for index in original_left
+                      if descriptions_original[index]}
+    postings = defaultdict(list)
+    for index, grams in grams_original.items():
+        for gram in grams:
+            postings[gram].append(index)
+
+    candidates = []
+    for index in current_left:
+        if not descriptions_current[index]:
+            continue
+        grams = trigrams(descriptions_current[index])
+        shared = defaultdict(int)
+        for gram in grams:
+            posting = postings.get(gram)
+            if posting and len(posting) <= MAX_POSTING:
+                for original_index in posting:
+                    shared[original_index] += 1
+        # Score the items sharing the most distinctive trigrams exactly
+        best = sorted(shared, key=shared.get, reverse=True)[:MAX_CANDIDATES]
+        for original_index in best:
+            theirs = grams_original[original_index]
+            # Dice coefficient of the two trigram sets
+            score = 2 * len(grams & theirs) / (len(grams) + len(theirs))
+            if score >= threshold:
+                candidates.append((-score, abs(original_index - index), index, original_index))
+
+    candidates.sort()
+    taken = set()
+    for negative_score, _, index, original_index in candidates:
+        if index not in matches and original_index not in taken:
+            matches[index] = (original_index, SIMILARITY, round(-negative_score, 3))
+            taken.add(original_index)
+
+
+def align_items(original: List[Dict], current: List[Dict],
+                threshold: float = SIMILARITY_THRESHOLD) -> Dict[int, Tuple[int, str, float]]:
+    """Match edited line items to original ones.
+
+    Returns:
+        dict: Current index to ``(original index, matched by, score)`` for
+        every edited item that has an original counterpart
+    """
+    matches = {}
+    original_left = list(range(len(original)))
+    current_left = list(range(len(current)))
+
+    codes_original = [normalize(item.get('item_code')) for item in original]
+    codes_current = [normalize(item.get('item_code')) for item in current]
+    _pair_by_key(codes_original, codes_current, original_left, current_left, matches, CODE)
+
+    # Descriptions are only needed for the items item codes left unpaired
+    descriptions_original = {}
+    descriptions_current = {}
+    for method in (DESCRIPTION, SIMILARITY):
+        taken = {match[0] for match in matches.values()}
+        original_left = [index for index in original_left if index not in taken]
+        current_left = [index for index in current_left if index not in matches]
+        if not original_left or not current_left:
+            break
+        if method == DESCRIPTION:
+            for index in original_left:
+                descriptions_original[index] = normalize(original[index].get('description'))
+            for index in current_left:
+                descriptions_current[index] = normalize(current[index].get('description'))
+            _pair_by_key(descriptions_original, descriptions_current, original_left,
+                         current_left, matches, DESCRIPTION)
+        else:
+            _pair_by_similarity(descriptions_original, descriptions_current, original_left,
+                                current_left, matches, threshold)
+    return matches
+
+
+def _field_changes(original: Dict, current: Dict, numeric: Tuple[str, ...],
+                   text: Tuple[str, ...] = ()) -> List[Dict]:
+    changes = []
+    for field in text:
+        before, after = original.get(field), current.get(field)
+        if before == after:
+            continue
+        before, after = _text(before), _text(after)
+        if before != after:
+            changes.append({'field': field, 'original': before, 'current': after})
+    for field in numeric:
+        before, after = original.get(field), current.get(field)
+        if before == after:
+            continue
+        before, after = _number(before), _number(after)
+        if before is None or after is None:
+            continue
+        if abs(after - before) > TOLERANCE:
+            changes.append({'field': field, 'original': before, 'current': after,
+                            'difference': round(after - before, 2)})
+    return changes
+
+
+def _line_total(item: Dict) -> float:
+    return _number(item.get('total')) or 0.0
+
+
+def diff_invoices(original_values: Dict, current_values: Dict,
+                  threshold: float = SIMILARITY_THRESHOLD) -> Dict[str, Any]:
+    """Compare two invoices (the API's invoice JSON) and build the report.
+
+    Args:
+        original_values: The invoice as extracted
+        current_values: The invoice after editing
+        threshold: Smallest description similarity accepted as a match
+
+    Returns:
+        dict: ``line_items`` and ``totals`` (original and current),
+        ``changes`` (``line_item``, ``added``, ``removed``, ``detail`` and
+        ``total`` entries), ``changes_by_item`` keyed by the edited item's
+        index (as a string, like JSON object keys), ``alignment`` (the
+        original index or None per edited item), ``totals_impact``,
+        ``summary`` and the original company and invoice details
+    """
+    original_items = [item for item in original_values.get('line_items') or []
+                      if isinstance(item, dict)]
+    current_items = [item for item in current_values.get('line_items') or []
+                     if isinstance(item, dict)]
+    matches = align_items(original_items, current_items, threshold)
+
+    changes = []
+    changes_by_item = {}
+    alignment = []
+    impact = {'changed': 0.0, 'added': 0.0, 'removed': 0.0}
+    matched_by = {CODE: 0, DESCRIPTION: 0, SIMILARITY: 0}
+    for index, item in enumerate(current_items):
+        match = matches.get(index)
+        if match is None:
+            alignment.append(None)
+            impact['added'] += _line_total(item)
+            changes.append({'type': 'added', 'index': index,
+                            'description': _text(item.get('description')), 'item': item})
+            continue
+
+        original_index, method, score = match
+        alignment.append(original_index)
+        matched_by[method] += 1
+        item_changes = _field_changes(original_items[original_index], item,
+                                      NUMERIC_FIELDS, TEXT_FIELDS)
+        if item_changes:
+            changes_by_item[str(index)] = item_changes
+            impact['changed'] += _line_total(item) - _line_total(original_items[original_index])
+            change = {'type': 'line_item', 'index': index, 'original_index': original_index,
+                      'description': _text(item.get('description')), 'changes': item_changes,
+                      'matched_by': method}
+            if method == SIMILARITY:
+                change['similarity'] = score
+            changes.append(change)
+
+    matched = set(alignment)
+    for original_index, item in enumerate(original_items):
+        if original_index not in matched:
+            impact['removed'] -= _line_total(item)
+            changes.append({'type': 'removed', 'original_index': original_index,
+                            'description': _text(item.get('description')), 'item': item})
+
+    for section, fields in DETAIL_FIELDS.items():
+        before = original_values.get(section) or {}
+        after = current_values.get(section)
+        if isinstance(before, dict) and isinstance(after, dict):
+            for change in _field_changes(before, after, (), fields):
+                changes.append({'type': 'detail', 'section': section, **change})
+
+    empty_totals = {'subtotal': 0, 'tax': 0, 'total': 0}
+    totals_original = original_values.get('totals') or empty_totals
+    totals_current = current_values.get('totals') or empty_totals
+    for change in _field_changes(totals_original, totals_current, TOTAL_FIELDS):
+        changes.append({'type': 'total', **change})
+
+    line_sum_original = round(sum(_line_total(item) for item in original_items), 2)
+    line_sum_current = round(sum(_line_total(item) for item in current_items), 2)
+    totals_impact = {
+        'line_items': {'original': line_sum_original, 'current': line_sum_current,
+                       'difference': round(line_sum_current - line_sum_original, 2),
+                       **{cause: round(amount, 2) for cause, amount in impact.items()}}
+    }
+    for field in TOTAL_FIELDS:
+        before, after = _number(totals_original.get(field)), _number(totals_current.get(field))
+        if before is not None and after is not None:
+            totals_impact[field] = {'original': before, 'current': after,
+                                    'difference': round(after - before, 2)}
+
+    added = sum(1 for position in alignment if position is None)
+    return {
+        'line_items': {'original': original_items, 'current': current_items},
+        'totals': {'original': totals_original, 'current': totals_current},
+        'changes': changes,
+        'changes_by_item': changes_by_item,
+        'alignment': alignment,
+        'totals_impact': totals_impact,
+        'summary': {
+            'original_items': len(original_items),
+            'current_items': len(current_items),
+            'matched': len(current_items) - added,
+            'matched_by': matched_by,
+            'changed': len(changes_by_item),
+            'added': added,
+            'removed': len(original_items) - len(matched - {None})
+        },
+        'company_details': original_values.get('company_details', {}),
+        'invoice_details': original_values.get('invoice_details', {})
+    }
@@ -0,0 +1,308 @@
+"""
+Typed invoice model and single-pass parser for Gemini output.
+
+``parse_invoice`` turns the model's raw text into an :class:`Invoice` in one
+walk over the line items: numbers are normalized and each line's arithmetic
+is checked. Only when a line or the reported subtotal does not add up are the
+columns reconciled (see ``reconciliation``): swapped numbers are put back, and
+lines nothing fits get quantity x price as their total. Line items and
+invoices are ``__slots__`` classes, which keeps 1000-line invoices cheap to
+hold in caches and jobs; ``to_dict`` produces the exact JSON shape the API has
+always returned.
+"""
+
+import logging
+import re
+from typing import Any, Dict, List, Optional, Sequence
+
+import fast_json
+from reconciliation import (
+    LINE_TOLERANCE, PERMUTATION_NAMES, matches, reconcile, reported_subtotals
+)
+
+logger = logging.getLogger(__name__)
+
+VAT_RATE = 0.17
+REQUIRED_KEYS = frozenset(('company_details', 'invoice_details', 'line_items', 'totals'))
+EMPTY_VALUES = frozenset(('none', 'null', '', 'undefined', 'nan'))
+
+# Already a plain number: converted without cleanup
+_plain_number = re.compile(r'-?\d+(?:\.\d+)?').fullmatch
+# Currency symbols, thousands separators, units...
+_non_numeric = re.compile(r'[^\d.-]').sub
+
+
+def parse_amount(value: Any, field_name: str = '') -> float:
+    """Convert a model-supplied amount to a float rounded to 2 decimals.
+
+    Numbers are kept as they are (sign included); text is stripped of
+    anything but digits, dots and minus signs and made positive. Missing or
+    unparseable values become 0.0.
+    """
+    value_type = type(value)
+    if value_type is float or value_type is int:
+        if value != value:  # NaN
+            logger.warning(f"Empty or None value for {field_name}, using 0.0")
+            return 0.0
+        return round(float(value), 2)
+
+    if value is None:
+        logger.warning(f"Empty or None value for {field_name}, using 0.0")
+        return 0.0
+
+    text = (value if value_type is str else str(value)).strip()
+    if text.lower() in EMPTY_VALUES:
+        logger.warning(f"Empty or None value for {field_name}, using 0.0")
+        return 0.0
+    if isinstance(value, (int, float)):
+        # bool and other numeric subclasses
+        return round(float(value), 2)
+
+    try:
+        if _plain_number(text):
+            return round(abs(float(text)), 2)
+        cleaned = _non_numeric('', text)
+        if not cleaned:
+            logger.warning(f"No numeric value found in '{value}' for {field_name}, using 0.0")
+            return 0.0
+        return round(abs(float(cleaned)), 2)
+    except ValueError as e:
+        logger.warning(f"Could not convert value '{value}' for {field_name}: {str(e)}, using 0.0")
+        return 0.0
+
+
+class LineItem:
+    """One validated invoice line."""
+
+    __slots__ = ('item_code', 'description', 'quantity', 'price', 'total')
+
+    def __init__(self, item_code: str = '', description: str = '', quantity: float = 0.0,
+                 price: float = 0.0, total: float = 0.0):
+        self.item_code = item_code
+        self.description = description
+        self.quantity = quantity
+        self.price = price
+        self.total = total
+
+    @classmethod
+    def from_raw(cls, item: Any, idx: int,
+                 issues: Optional[List[str]] = None) -> Optional['LineItem']:
+        """Validate one raw line item, or None if it is unusable.
+
+        Numbers read into the wrong columns are put back; a total that fits
+        no assignment is replaced by quantity x price. Problems found are
+        appended to ``issues`` when a list is given.
+        """
+        line = cls.read(item, idx, issues)
+        if line is not None and not line.fits():
+            reconcile_lines([line], [idx], issues=issues)
+        return line
+
+    @classmethod
+    def read(cls, item: Any, idx: int,
+             issues: Optional[List[str]] = None) -> Optional['LineItem']:
+        """Normalize one raw line item as read, without checking its arithmetic."""
+        if not isinstance(item, dict):
+            logger.warning(f"Invalid line item format at index {idx}: {item}")
+            if issues is not None:
+                issues.append(f'line item {idx}: not an object')
+            return None
+
+        try:
+            line = cls(str(item.get('item_code', '')), str(item.get('description', '')),
+                       parse_amount(item.get('quantity'), f'quantity_{idx}'),
+                       parse_amount(item.get('price'), f'price_{idx}'),
+                       parse_amount(item.get('total'), f'total_{idx}'))
+        except Exception as e:
+            logger.error(f"Error processing line item {idx}: {str(e)}")
+            if issues is not None:
+                issues.append(f'line item {idx}: {str(e)}')
+            return None
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Line item {idx}: {item} -> {line.to_dict()}")
+        return line
+
+    def fits(self) -> bool:
+        """Whether quantity x price = total."""
+        return abs(round(self.quantity * self.price, 2) - self.total) <= LINE_TOLERANCE + 1e-9
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'item_code': self.item_code,
+            'description': self.description,
+            'quantity': self.quantity,
+            'price': self.price,
+            'total': self.total
+        }
+
+
+class Invoice:
+    """A validated invoice with totals recomputed from its line items."""
+
+    __slots__ = ('name', 'address', 'tax_id', 'invoice_number', 'date', 'line_items',
+                 'subtotal', 'tax', 'total')
+
+    def __init__(self, name: str = '', address: str = '', tax_id: str = '',
+                 invoice_number: str = '', date: str = '',
+                 line_items: Optional[List[LineItem]] = None, subtotal: float = 0.0):
+        self.name = name
+        self.address = address
+        self.tax_id = tax_id
+        self.invoice_number = invoice_number
+        self.date = date
+        self.line_items = line_items if line_items is not None else []
+        self.subtotal = subtotal
+        self.tax = round(subtotal * VAT_RATE, 2)
+        self.total = round(subtotal + self.tax, 2)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The API's invoice JSON shape."""
+        return {
+            'company_details': {
+                'name': self.name,
+                'address': self.address,
+                'tax_id': self.tax_id
+            },
+            'invoice_details': {
+                'invoice_number': self.invoice_number,
+                'date': self.date
+            },
+            'line_items': [item.to_dict() for item in self.line_items],
+            'totals': {'subtotal': self.subtotal, 'tax': self.tax, 'total': self.total}
+        }
+
+    def to_json(self) -> str:
+        return fast_json.dumps(self.to_dict())
+
+
+def reconcile_lines(lines: List[LineItem], indices: List[int], subtotals: Sequence[float] = (),
+                    issues: Optional[List[str]] = None) -> Optional[bool]:
+    """Put the numbers of ``lines`` in the columns they fit, in place.
+
+    Args:
+        lines: Line items as read
+        indices: Index of each line in the response, for messages
+        subtotals: Subtotals the invoice may have (see ``reported_subtotals``)
+        issues: Optional list collecting the lines no assignment fits
+
+    Returns:
+        Whether the line totals match one of ``subtotals``, None without any
+    """
+    result = reconcile([line.quantity for line in lines], [line.price for line in lines],
+                       [line.total for line in lines], subtotals)
+    for position in result.changed().tolist():
+        line = lines[position]
+        quantity, price, total = (result.quantities[position].item(),
+                                  result.prices[position].item(),
+                                  result.totals[position].item())
+        logger.warning(
+            f"Columns of line item {indices[position]} were read "
+            f"{PERMUTATION_NAMES[result.assignments[position]]}: "
+            f"quantity={line.quantity}, price={line.price}, total={line.total} -> "
+            f"quantity={quantity}, price={price}, total={total}"
+        )
+        line.quantity, line.price, line.total = quantity, price, total
+    for position in result.unreconciled().tolist():
+        line = lines[position]
+        idx = indices[position]
+        kept = ' (kept: it matches the subtotal)' if result.printed[position] else ''
+        logger.warning(
+            f"Total mismatch at index {idx}: "
+            f"quantity={line.quantity}, price={line.price}, "
+            f"calculated={round(line.quantity * line.price, 2)}, given={line.total}{kept}"
+        )
+        if issues is not None:
+            issues.append(f'line item {idx}: quantity x price != total')
+        line.total = result.totals[position].item()
+    return result.matches_subtotal
+
+
+def _field(section: Any, key: str) -> str:
+    return str(section.get(key, '')) if isinstance(section, dict) else ''
+
+
+def parse_invoice(response_text: str, issues: Optional[List[str]] = None,
+                  reported: Optional[Dict[str, float]] = None) -> Invoice:
+    """Parse and validate Gemini's response in a single pass.
+
+    Args:
+        response_text: Raw model output; text around the outermost JSON
+            object (e.g. a markdown fence) is ignored
+        issues: Optional list collecting failed arithmetic checks (lines no
+            column assignment fits, reported subtotal); swapped columns that
+            were put back are not issues, an unusable response yields no
+            line items instead
+        reported: Optional dict filled with the ``subtotal``, ``tax`` and
+            ``total`` as the model read them, before they are recomputed
+
+    Returns:
+        Invoice: The parsed invoice, empty if the response is unusable
+    """
+    json_start = response_text.find('{')
+    json_end = response_text.rfind('}')
+    if json_start == -1 or json_end == -1:
+        logger.error(f"No valid JSON object found in response: {response_text.strip()}")
+        return Invoice()
+
+    try:
+        data = fast_json.loads(response_text[json_start:json_end + 1])
+    except ValueError as e:
+        logger.error(f"JSON decode error: {str(e)}")
+        logger.error(f"Attempted to parse: {response_text[json_start:json_end + 1]}")
+        return Invoice()
+
+    if not isinstance(data, dict):
+        logger.error(f"Response is not a dictionary: {type(data)}")
+        return Invoice()
+    missing_keys = REQUIRED_KEYS.difference(data)
+    if missing_keys:
+        logger.error(f"Missing required keys in response: {missing_keys}")
+        return Invoice()
+
+    raw_items = data['line_items']
+    if not isinstance(raw_items, list):
+        logger.error(f"line_items is not a list: {type(raw_items)}")
+        return Invoice()
+
+    line_items = []
+    indices = []
+    mismatched = False
+    for idx, raw in enumerate(raw_items):
+        line = LineItem.read(raw, idx, issues)
+        if line is not None:
+            line_items.append(line)
+            indices.append(idx)
+            if not mismatched and not line.fits():
+                mismatched = True
+    subtotal = round(sum(line.total for line in line_items), 2)
+
+    totals = data['totals'] if isinstance(data['totals'], dict) else {}
+    printed = {field: parse_amount(totals.get(field), f'reported_{field}')
+               for field in ('subtotal', 'tax', 'total')}
+    subtotals = reported_subtotals(printed)
+    if mismatched or subtotals and not matches(subtotal, subtotals):
+        reconcile_lines(line_items, indices, subtotals, issues)
+        subtotal = round(sum(line.total for line in line_items), 2)
+
+    if reported is not None:
+        reported.update(printed)
+    # Invoices without a printed subtotal come back as 0
+    if (issues is not None and printed['subtotal']
+            and abs(printed['subtotal'] - subtotal) > max(0.05, subtotal * 0.005)):
+        issues.append(f"reported subtotal {printed['subtotal']} != sum of line totals {subtotal}")
+
+    company = data['company_details']
+    details = data['invoice_details']
+    invoice = Invoice(
+        name=_field(company, 'name'),
+        address=_field(company, 'address'),
+        tax_id=_field(company, 'tax_id'),
+        invoice_number=_field(details, 'invoice_number'),
+        date=_field(details, 'date'),
+        line_items=line_items,
+        subtotal=subtotal
+    )
+    logger.info(f"Parsed invoice with {len(line_items)} line items: "
+                f"subtotal={invoice.subtotal}, tax={invoice.tax}, total={invoice.total}")
+    return invoice
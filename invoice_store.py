@@ -0,0 +1,455 @@
+"""
+Persistent store for saved (reviewed and edited) invoices.
+
+``/save_changes`` hands invoices to the store: a background writer
+collects them and commits them in batches, one transaction per batch, so a
+burst of saves costs a handful of commits. The endpoint waits a moment for
+its batch (``wait_saved``) and says whether it was written. A batch that
+fails stays queued and is retried with backoff. Reads see saves that are
+still queued.
+
+Invoices are indexed by supplier tax id, invoice number, date and the
+SHA-256 of the uploaded file (``image_hash``), so an invoice that was
+already reviewed can be reopened by id or recognized on re-upload without
+calling the model.
+
+Backends (``INVOICE_STORE_BACKEND``):
+
+* ``sqlite`` (``auto``): a database file in WAL mode, shared by all workers
+  on the host (``INVOICE_STORE_PATH``);
+* ``memory``: process memory only, for tests and throwaway deployments;
+* ``off``: saving is a no-op.
+
+Other backends implement ``InvoiceStore._write_batch``, ``_read`` and
+``_query``. Listeners (``add_listener``) see every committed batch; the
+search index (``search_index``) is kept up to date that way.
+"""
+
+import os
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+STORE_BACKEND = os.getenv('INVOICE_STORE_BACKEND', 'auto')  # auto, sqlite, memory, off
+STORE_PATH = os.getenv('INVOICE_STORE_PATH', '/tmp/invoices.db' if os.getenv('VERCEL_REGION')
+                       else os.path.join('data', 'invoices.db'))
+# Saves committed together, and how long the writer waits to fill a batch
+STORE_BATCH_SIZE = int(os.getenv('INVOICE_STORE_BATCH_SIZE', 500))
+STORE_BATCH_DELAY = float(os.getenv('INVOICE_STORE_BATCH_DELAY_MS', 20)) / 1000
+# Saves waiting for the writer before new ones are refused
+STORE_MAX_PENDING = int(os.getenv('INVOICE_STORE_MAX_PENDING', 10000))
+# Seconds /save_changes waits for its save to be written
+STORE_SAVE_WAIT = float(os.getenv('INVOICE_STORE_SAVE_WAIT', 2))
+# First and longest wait before a failed batch is written again
+STORE_RETRY_DELAY = float(os.getenv('INVOICE_STORE_RETRY_DELAY_MS', 100)) / 1000
+STORE_RETRY_MAX_DELAY = float(os.getenv('INVOICE_STORE_RETRY_MAX_DELAY_MS', 5000)) / 1000
+# Page cache per connection; keeps the indexes' hot pages in memory
+STORE_CACHE_MB = int(os.getenv('INVOICE_STORE_CACHE_MB', 32))
+
+# Indexed fields and where they live in the invoice JSON
+INDEXED_FIELDS = {
+    'tax_id': ('company_details', 'tax_id'),
+    'invoice_number': ('invoice_details', 'invoice_number'),
+    'date': ('invoice_details', 'date'),
+}
+QUERY_FIELDS = tuple(INDEXED_FIELDS) + ('image_hash',)
+MAX_QUERY_LIMIT = 100
+
+_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS invoices (
+        id TEXT PRIMARY KEY,
+        tax_id TEXT,
+        invoice_number TEXT,
+        date TEXT,
+        image_hash TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        data TEXT NOT NULL
+    )''',
+    # With updated_at, the newest matches are read straight off the index
+    'CREATE INDEX IF NOT EXISTS invoices_tax_id ON invoices (tax_id, updated_at)',
+    'CREATE INDEX IF NOT EXISTS invoices_invoice_number ON invoices (invoice_number, updated_at)',
+    'CREATE INDEX IF NOT EXISTS invoices_date ON invoices (date, updated_at)',
+    'CREATE INDEX IF NOT EXISTS invoices_image_hash ON invoices (image_hash, updated_at)',
+)
+_UPSERT = '''INSERT INTO invoices
+    (id, tax_id, invoice_number, date, image_hash, created_at, updated_at, data)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        tax_id = excluded.tax_id, invoice_number = excluded.invoice_number,
+        date = excluded.date, image_hash = COALESCE(excluded.image_hash, invoices.image_hash),
+        updated_at = excluded.updated_at, data = excluded.data'''
+_COLUMNS = 'id, tax_id, invoice_number, date, image_hash, created_at, updated_at, data'
+
+
+class StoreBusyError(Exception):
+    """Raised when too many saves are waiting to be written."""
+
+
+def _index_value(invoice: Dict, section: str, field: str) -> Optional[str]:
+    value = invoice.get(section)
+    value = value.get(field) if isinstance(value, dict) else None
+    value = str(value).strip() if value is not None else ''
+    return value or None
+
+
+def new_invoice_id() -> str:
+    """32 hex digits that sort by creation time, so inserts append to the id index."""
+    return f'{time.time_ns() // 1000:014x}{os.urandom(9).hex()}'
+
+
+def make_record(invoice: Dict, invoice_id: Optional[str] = None,
+                image_hash: Optional[str] = None) -> Dict[str, Any]:
+    """The stored form of an invoice: its id, index fields and JSON."""
+    now = time.time()
+    record = {'id': invoice_id or new_invoice_id(), 'image_hash': image_hash or None,
+              'created_at': now, 'updated_at': now,
+              'data': json.dumps(invoice, ensure_ascii=False, separators=(',', ':'))}
+    for column, (section, field) in INDEXED_FIELDS.items():
+        record[column] = _index_value(invoice, section, field)
+    return record
+
+
+def record_response(record: Dict[str, Any]) -> Dict[str, Any]:
+    """A stored record as returned by the API."""
+    return {
+        'id': record['id'],
+        'image_hash': record['image_hash'],
+        'created_at': record['created_at'],
+        'updated_at': record['updated_at'],
+        'invoice_data': json.loads(record['data'])
+    }
+
+
+class InvoiceStore:
+    """Queued, batched writes and reads that see queued saves.
+
+    Subclasses implement ``_write_batch`` (commit records atomically),
+    ``_read`` (one record by id) and ``_query`` (records by index fields).
+    The writer thread starts on first use and again after ``fork()``.
+    """
+
+    backend = 'off'
+
+    def __init__(self, batch_size: int = STORE_BATCH_SIZE,
+                 batch_delay: float = STORE_BATCH_DELAY, max_pending: int = STORE_MAX_PENDING,
+                 retry_delay: float = STORE_RETRY_DELAY,
+                 retry_max_delay: float = STORE_RETRY_MAX_DELAY):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self._queue = None
+        self._pending = {}
+        self._writer = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._listeners = []
+        self._stats = {'saved': 0, 'batches': 0, 'rejected': 0, 'errors': 0,
+                       'write_seconds': 0.0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend != 'off'
+
+    def _ensure_writer(self) -> None:
+        if self._writer is None or self._pid != os.getpid():
+            with self._lock:
+                if self._writer is None or self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    self._pending = {}
+                    self._writer = threading.Thread(target=self._write_loop,
+                                                    name='invoice-store-writer', daemon=True)
+                    self._pid = os.getpid()
+                    self._writer.start()
+
+    def add_listener(self, listener: Callable[[List[Dict[str, Any]]], None]) -> None:
+        """Call ``listener`` with each batch of records once it is committed.
+
+        Listeners run on the writer thread, in commit order, before
+        ``flush`` returns; a slow listener delays the next batch.
+        """
+        self._listeners.append(listener)
+
+    def save(self, invoice: Dict, invoice_id: Optional[str] = None,
+             image_hash: Optional[str] = None) -> str:
+        """Queue an invoice for writing and return its id.
+
+        Args:
+            invoice: Invoice JSON as returned by ``/upload`` and edited
+            invoice_id: Id of a saved invoice to replace; a new id otherwise
+            image_hash: SHA-256 of the uploaded file, to recognize re-uploads
+
+        Raises:
+            StoreBusyError: If ``max_pending`` saves are already queued
+        """
+        record = make_record(invoice, invoice_id, image_hash)
+        if not self.enabled:
+            return record['id']
+        self._ensure_writer()
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self._stats['rejected'] += 1
+                raise StoreBusyError(f'{len(self._pending)} invoices are waiting to be saved')
+            previous = self._pending.get(record['id'])
+            if previous is not None:
+                record['created_at'] = previous['created_at']
+            self._pending[record['id']] = record
+        self._queue.put(record)
+        return record['id']
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            start_time = time.perf_counter()
+            self._write_with_retry(batch)
+            # Before the batch leaves _pending, so flush() also waits for listeners
+            for listener in self._listeners:
+                try:
+                    listener(batch)
+                except Exception as e:
+                    logger.error(f"Invoice store listener failed: {str(e)}")
+            with self._lock:
+                for record in batch:
+                    # A newer save of the same invoice stays pending
+                    if self._pending.get(record['id']) is record:
+                        del self._pending[record['id']]
+                self._stats['saved'] += len(batch)
+                self._stats['batches'] += 1
+                self._stats['write_seconds'] += time.perf_counter() - start_time
+                self._idle.notify_all()
+
+    def _write_with_retry(self, batch: List[Dict[str, Any]]) -> None:
+        """Write a batch, retrying with backoff until it commits.
+
+        The batch stays in ``_pending`` meanwhile, so its invoices can still
+        be read, and new saves are refused once ``max_pending`` pile up.
+        """
+        delay = self.retry_delay
+        while True:
+            try:
+                self._write_batch(batch)
+                return
+            except Exception as e:
+                with self._lock:
+                    self._stats['errors'] += 1
+                logger.error(f"Could not save {len(batch)} invoices, "
+                             f"retrying in {delay:.1f}s: {str(e)}")
+            time.sleep(delay)
+            delay = min(delay * 2, self.retry_max_delay)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued save is written; False on timeout."""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def wait_saved(self, invoice_id: str, timeout: Optional[float] = None) -> bool:
+        """Wait until the queued saves of ``invoice_id`` are written; False on timeout."""
+        if not self.enabled:
+            return True
+        with self._lock:
+            if self._pid != os.getpid():
+                return True
+            return self._idle.wait_for(lambda: invoice_id not in self._pending, timeout)
+
+    def get(self, invoice_id: str) -> Optional[Dict[str, Any]]:
+        """A saved invoice by id (see ``record_response``), or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            record = self._pending.get(invoice_id) if self._pid == os.getpid() else None
+        if record is None:
+            record = self._read(invoice_id)
+        return record_response(record) if record is not None else None
+
+    def find(self, limit: int = 20, **criteria: str) -> List[Dict[str, Any]]:
+        """Saved invoices matching every given index field, newest first.
+
+        Args:
+            limit: Most invoices returned (at most ``MAX_QUERY_LIMIT``)
+            criteria: ``tax_id``, ``invoice_number``, ``date`` and/or
+                ``image_hash`` values
+
+        Raises:
+            ValueError: If no criteria or an unknown field is given
+        """
+        unknown = set(criteria) - set(QUERY_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        criteria = {field: value for field, value in criteria.items() if value}
+        if not criteria:
+            raise ValueError(f"Give at least one of {', '.join(QUERY_FIELDS)}")
+        if not self.enabled:
+            return []
+        limit = max(1, min(limit, MAX_QUERY_LIMIT))
+
+        with self._lock:
+            pending = [record for record in self._pending.values()
+                       if all(record[field] == value for field, value in criteria.items())
+                       ] if self._pid == os.getpid() else []
+        records = {record['id']: record for record in self._query(criteria, limit)}
+        records.update((record['id'], record) for record in pending)
+        newest = sorted(records.values(), key=lambda record: record['updated_at'], reverse=True)
+        return [record_response(record) for record in newest[:limit]]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        stats['avg_batch'] = round(stats['saved'] / stats['batches'], 1) if stats['batches'] else 0
+        stats['write_seconds'] = round(stats['write_seconds'], 3)
+        stats['backend'] = self.backend
+        return stats
+
+    def shutdown(self) -> None:
+        """Write what is still queued (called at exit)."""
+        if self._writer is not None and self._pid == os.getpid():
+            self.flush(timeout=10)
+
+    def _write_batch(self, records: List[Dict[str, Any]]) -> None:
+        pass
+
+    def _read(self, invoice_id: str) -> Optional[Dict[str, Any]]:
+        return None
+
+    def _query(self, criteria: Dict[str, str], limit: int) -> List[Dict[str, Any]]:
+        return []
+
+
+class MemoryInvoiceStore(InvoiceStore):
+    """Invoices kept in process memory with dictionary indexes."""
+
+    backend = 'memory'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._records = {}
+        self._indexes = {field: {} for field in QUERY_FIELDS}
+        self._data_lock = threading.Lock()
+
+    def _write_batch(self, records: List[Dict[str, Any]]) -> None:
+        with self._data_lock:
+            for record in records:
+                previous = self._records.get(record['id'])
+                if previous is not None:
+                    record = {**record, 'created_at': previous['created_at'],
+                              'image_hash': record['image_hash'] or previous['image_hash']}
+                    for field in QUERY_FIELDS:
+                        self._indexes[field].get(previous[field], set()).discard(record['id'])
+                self._records[record['id']] = record
+                for field in QUERY_FIELDS:
+                    if record[field] is not None:
+                        self._indexes[field].setdefault(record[field], set()).add(record['id'])
+
+    def _read(self, invoice_id: str) -> Optional[Dict[str, Any]]:
+        with self._data_lock:
+            return self._records.get(invoice_id)
+
+    def _query(self, criteria: Dict[str, str], limit: int) -> List[Dict[str, Any]]:
+        with self._data_lock:
+            ids = set.intersection(*(self._indexes[field].get(value, set())
+                                     for field, value in criteria.items()))
+            records = [self._records[invoice_id] for invoice_id in ids]
+        records.sort(key=lambda record: record['updated_at'], reverse=True)
+        return records[:limit]
+
+
+class SQLiteInvoiceStore(InvoiceStore):
+    """Invoices in an SQLite database in WAL mode.
+
+    The writer thread owns one connection; readers use one connection per
+    thread. WAL lets every worker on the host read while one of them writes.
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, path: str = STORE_PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        connection = self._connect()
+        with connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+        connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # Durable at checkpoints, not every commit: a power loss may drop the last batches
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(f'PRAGMA cache_size=-{STORE_CACHE_MB * 1024}')
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's connection (a new one after ``fork()``)."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = self._connect()
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _write_batch(self, records: List[Dict[str, Any]]) -> None:
+        rows = [(record['id'], record['tax_id'], record['invoice_number'], record['date'],
+                 record['image_hash'], record['created_at'], record['updated_at'],
+                 record['data']) for record in records]
+        connection = self._connection()
+        with connection:
+            connection.executemany(_UPSERT, rows)
+
+    def _read(self, invoice_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(f'SELECT {_COLUMNS} FROM invoices WHERE id = ?',
+                                         (invoice_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def _query(self, criteria: Dict[str, str], limit: int) -> List[Dict[str, Any]]:
+        # Field names come from QUERY_FIELDS, never from the request
+        where = ' AND '.join(f'{field} = ?' for field in criteria)
+        rows = self._connection().execute(
+            f'SELECT {_COLUMNS} FROM invoices WHERE {where} ORDER BY updated_at DESC LIMIT ?',
+            (*criteria.values(), limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM invoices').fetchone()[0]
+
+
+def create_invoice_store() -> InvoiceStore:
+    """Create the invoice store according to ``INVOICE_STORE_BACKEND``.
+
+    ``auto`` uses SQLite, falling back to memory if the database cannot be
+    opened (e.g. a read-only filesystem).
+    """
+    backend = STORE_BACKEND.lower()
+    if backend not in ('auto', 'sqlite', 'memory', 'off'):
+        logger.warning(f"Unknown INVOICE_STORE_BACKEND '{backend}', using memory")
+        backend = 'memory'
+    if backend in ('auto', 'sqlite'):
+        try:
+            store = SQLiteInvoiceStore(STORE_PATH)
+            logger.info(f"Invoice store: sqlite at {STORE_PATH}")
+            return store
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Invoice store at {STORE_PATH} unavailable, using memory: {str(e)}")
+            backend = 'memory'
+    logger.info(f"Invoice store: {backend}")
+    return MemoryInvoiceStore() if backend == 'memory' else InvoiceStore()
@@ -0,0 +1,285 @@
+"""
+Asynchronous extraction jobs.
+
+``POST /jobs`` hands the work to a small background worker pool and returns a
+job id at once, so slow Gemini calls no longer pin a gunicorn worker for the
+whole round trip. Job state lives in Redis when available, so any worker can
+answer ``GET /jobs/<id>``; otherwise it is kept in process memory.
+
+Queue depth is counted from the jobs themselves: with Redis, every worker
+refreshes a heartbeat for the jobs it holds, and a job whose heartbeat is
+older than ``JOB_HEARTBEAT_TIMEOUT`` (its worker was killed) is neither
+counted nor reported as still running.
+"""
+
+import os
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Any, Callable, Dict, Optional
+
+from redis_client import get_redis, resolve_backend
+
+logger = logging.getLogger(__name__)
+
+JOB_BACKEND = os.getenv('JOB_BACKEND', 'auto')  # auto, redis or memory
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_TTL = int(os.getenv('JOB_TTL', 3600))
+JOB_MAX_QUEUE = int(os.getenv('JOB_MAX_QUEUE', 100))
+# Longest long-poll; it holds a request thread, so keep it short
+JOB_MAX_WAIT = float(os.getenv('JOB_MAX_WAIT', 5))
+# Seconds a client is asked to wait before polling an unfinished job again
+JOB_RETRY_AFTER = int(os.getenv('JOB_RETRY_AFTER', 2))
+# Seconds between heartbeats of a worker's jobs, and without one before they are lost
+JOB_HEARTBEAT_INTERVAL = float(os.getenv('JOB_HEARTBEAT_INTERVAL', 10))
+JOB_HEARTBEAT_TIMEOUT = float(os.getenv('JOB_HEARTBEAT_TIMEOUT', 30))
+JOB_PREFIX = 'invoice:job:'
+# Sorted sets of job ids by last heartbeat, one per unfinished state
+JOB_ACTIVE_PREFIX = 'invoice:jobs:'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+TIMED_OUT = 'timeout'
+FINISHED_STATES = (SUCCEEDED, FAILED, TIMED_OUT)
+ACTIVE_STATES = (QUEUED, RUNNING)
+LOST_ERROR = 'Worker stopped before the job finished'
+
+
+class QueueFullError(Exception):
+    """Raised when too many jobs are waiting to run."""
+
+
+class MemoryJobStore:
+    """Job records held in this process, expired lazily."""
+
+    name = 'memory'
+
+    def __init__(self, ttl: int = JOB_TTL):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _expire(self) -> None:
+        now = time.time()
+        for job_id in [k for k, (expires_at, _) in self._jobs.items() if expires_at < now]:
+            del self._jobs[job_id]
+
+    def save(self, job: Dict[str, Any]) -> None:
+        with self._lock:
+            self._expire()
+            self._jobs[job['id']] = (time.time() + self.ttl, dict(job))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            if entry is None or entry[0] < time.time():
+                return None
+            return dict(entry[1])
+
+    def heartbeat(self, active: Dict[str, str]) -> None:
+        # Jobs live and die with this process
+        pass
+
+    def counters(self) -> Dict[str, int]:
+        with self._lock:
+            self._expire()
+            states = [job['state'] for _, job in self._jobs.values()]
+        return {state: states.count(state) for state in ACTIVE_STATES}
+
+
+class RedisJobStore:
+    """Job records in Redis, visible to every worker."""
+
+    name = 'redis'
+
+    def __init__(self, ttl: int = JOB_TTL):
+        self.ttl = ttl
+
+    @staticmethod
+    def _client():
+        client = get_redis()
+        if client is None:
+            raise RuntimeError('Job store unavailable: cannot reach Redis')
+        return client
+
+    def save(self, job: Dict[str, Any]) -> None:
+        """Write the record and move the job to the active set of its state."""
+        payload = json.dumps(job, ensure_ascii=False)
+        with self._client().pipeline() as pipe:
+            pipe.set(JOB_PREFIX + job['id'], payload, ex=self.ttl)
+            for state in ACTIVE_STATES:
+                if state == job['state']:
+                    pipe.zadd(JOB_ACTIVE_PREFIX + state, {job['id']: time.time()})
+                else:
+                    pipe.zrem(JOB_ACTIVE_PREFIX + state, job['id'])
+            pipe.execute()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        client = self._client()
+        raw = client.get(JOB_PREFIX + job_id)
+        if raw is None:
+            return None
+        job = json.loads(raw)
+        if job['state'] in ACTIVE_STATES:
+            beat = client.zscore(JOB_ACTIVE_PREFIX + job['state'], job_id)
+            if beat is None or beat < time.time() - JOB_HEARTBEAT_TIMEOUT:
+                job.update(state=FAILED, error=LOST_ERROR)
+        return job
+
+    def heartbeat(self, active: Dict[str, str]) -> None:
+        """Refresh the heartbeat of this worker's unfinished jobs (id to state)."""
+        now = time.time()
+        with self._client().pipeline(transaction=False) as pipe:
+            for job_id, state in active.items():
+                # xx: a job finished meanwhile is not brought back
+                pipe.zadd(JOB_ACTIVE_PREFIX + state, {job_id: now}, xx=True)
+            pipe.execute()
+
+    def counters(self) -> Dict[str, int]:
+        stale = time.time() - JOB_HEARTBEAT_TIMEOUT
+        with self._client().pipeline(transaction=False) as pipe:
+            for state in ACTIVE_STATES:
+                # Jobs of a killed worker drop out here
+                pipe.zremrangebyscore(JOB_ACTIVE_PREFIX + state, '-inf', stale)
+                pipe.zcard(JOB_ACTIVE_PREFIX + state)
+            results = pipe.execute()
+        return {state: results[index * 2 + 1] for index, state in enumerate(ACTIVE_STATES)}
+
+
+class JobManager:
+    """Runs submitted callables on a bounded worker pool and tracks their state."""
+
+    def __init__(self, store, workers: int = JOB_WORKERS, max_queue: int = JOB_MAX_QUEUE,
+                 heartbeat_interval: float = JOB_HEARTBEAT_INTERVAL):
+        self.store = store
+        self.workers = workers
+        self.max_queue = max_queue
+        self.heartbeat_interval = heartbeat_interval
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        # This worker's unfinished jobs and their states, for the heartbeat
+        self._active = {}
+        self._heartbeat_pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_heartbeat(self) -> None:
+        if self._heartbeat_pid != os.getpid():
+            with self._lock:
+                if self._heartbeat_pid != os.getpid():
+                    self._heartbeat_pid = os.getpid()
+                    threading.Thread(target=self._heartbeat_loop, name='job-heartbeat',
+                                     daemon=True).start()
+
+    def _heartbeat_loop(self) -> None:
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            try:
+                self.store.heartbeat(active)
+            except Exception as e:
+                logger.warning(f"Job heartbeat failed: {str(e)}")
+
+    def _set_state(self, job: Dict[str, Any], **changes) -> None:
+        job.update(changes)
+        with self._lock:
+            if job['state'] in ACTIVE_STATES:
+                self._active[job['id']] = job['state']
+        self.store.save(job)
+
+    def submit(self, func: Callable[..., Dict], *args, source: str = '',
+               **kwargs) -> Dict[str, Any]:
+        """Queue ``func(*args, **kwargs)`` and return the new job record.
+
+        Raises:
+            QueueFullError: If this worker already has ``max_queue`` jobs pending
+        """
+        job = {
+            'id': uuid.uuid4().hex,
+            'state': QUEUED,
+            'source': source,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None
+        }
+        with self._lock:
+            if len(self._active) >= self.max_queue:
+                raise QueueFullError(f'Job queue is full ({len(self._active)} pending)')
+            self._active[job['id']] = QUEUED
+        self._ensure_heartbeat()
+        try:
+            self.store.save(job)
+        except Exception:
+            with self._lock:
+                self._active.pop(job['id'], None)
+            raise
+        self._executor.submit(self._run, dict(job), func, args, kwargs)
+        return job
+
+    def _run(self, job: Dict[str, Any], func: Callable[..., Dict], args, kwargs) -> None:
+        try:
+            self._set_state(job, state=RUNNING, started_at=time.time())
+            try:
+                job.update(state=SUCCEEDED, result=func(*args, **kwargs))
+            except TimeoutError:
+                job.update(state=TIMED_OUT, error='Processing timeout')
+            except Exception as e:
+                logger.error(f"Job {job['id']} failed: {str(e)}")
+                job.update(state=FAILED, error=str(e))
+            self._set_state(job, finished_at=time.time())
+            logger.info(f"Job {job['id']} {job['state']} in "
+                        f"{job['finished_at'] - job['started_at']:.2f}s")
+        except Exception as e:
+            logger.error(f"Could not record state of job {job['id']}: {str(e)}")
+        finally:
+            with self._lock:
+                self._active.pop(job['id'], None)
+
+    def get(self, job_id: str, wait: float = 0) -> Optional[Dict[str, Any]]:
+        """Fetch a job, optionally long-polling until it finishes.
+
+        Args:
+            job_id: Id returned by ``submit``
+            wait: Seconds to wait for a finished state (capped at ``JOB_MAX_WAIT``)
+
+        Returns:
+            dict or None: The job record, or None if unknown or expired
+        """
+        deadline = time.time() + min(max(wait, 0), JOB_MAX_WAIT)
+        interval = 0.05
+        while True:
+            job = self.store.get(job_id)
+            if job is None or job['state'] in FINISHED_STATES or time.time() >= deadline:
+                return job
+            time.sleep(min(interval, max(0, deadline - time.time())))
+            interval = min(interval * 2, 0.5)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth for the cluster (or process) and this worker."""
+        counters = self.store.counters()
+        with self._lock:
+            pending = len(self._active)
+        return {
+            'backend': self.store.name,
+            'queued': counters[QUEUED],
+            'running': counters[RUNNING],
+            'worker_pending': pending,
+            'worker_threads': self.workers,
+            'max_queue': self.max_queue
+        }
+
+
+def create_job_manager() -> JobManager:
+    """Create the job manager according to ``JOB_BACKEND``."""
+    backend = resolve_backend(JOB_BACKEND)
+    store = RedisJobStore() if backend == 'redis' else MemoryJobStore()
+    logger.info(f"Job store backend: {store.name}, {JOB_WORKERS} worker threads")
+    return JobManager(store)
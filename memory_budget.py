@@ -0,0 +1,169 @@
+"""
+Per-request accounting of payload memory.
+
+Each request (or background job) gets a ``RequestMemory`` in a context
+variable. The extraction pipeline charges the large buffers it holds to it:
+the uploaded or downloaded file, decoded images while they are being
+encoded, and the JPEG payloads sent to the model. The request's current and
+peak bytes are tracked, and so are the bytes held by all requests of the
+worker together.
+
+With ``REQUEST_MEMORY_BUDGET_MB`` set, a charge that takes a request over it
+raises ``MemoryBudgetExceeded``; with ``WORKER_MEMORY_BUDGET_MB`` set, so
+does a charge that takes the worker over its budget, which bounds the
+uploads a worker holds at once. Charges made outside a tracked context are
+ignored.
+"""
+
+import os
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+MB = 1024 * 1024
+
+REQUEST_MEMORY_BUDGET = int(float(os.getenv('REQUEST_MEMORY_BUDGET_MB', 0)) * MB)  # 0 disables
+WORKER_MEMORY_BUDGET = int(float(os.getenv('WORKER_MEMORY_BUDGET_MB', 0)) * MB)  # 0 disables
+
+REQUEST = 'request'
+WORKER = 'worker'
+
+_current = contextvars.ContextVar('request_memory', default=None)
+
+
+class MemoryBudgetExceeded(Exception):
+    """A request or the worker would hold more payload memory than allowed."""
+
+    def __init__(self, message: str, scope: str, budget: int):
+        super().__init__(message)
+        self.scope = scope
+        self.budget = budget
+
+
+class WorkerMemory:
+    """Payload bytes held by all tracked requests of this process."""
+
+    def __init__(self, budget: int = WORKER_MEMORY_BUDGET):
+        self.budget = budget
+        self.current = 0
+        self.peak = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def charge(self, nbytes: int) -> None:
+        with self._lock:
+            if self.budget and nbytes > 0 and self.current + nbytes > self.budget:
+                self.rejected += 1
+                raise MemoryBudgetExceeded(
+                    f'Server is busy ({(self.current + nbytes) / MB:.1f}MB of payloads > '
+                    f'{self.budget / MB:g}MB worker budget)', WORKER, self.budget
+                )
+            self.current += nbytes
+            self.peak = max(self.peak, self.current)
+
+    def release(self, nbytes: int) -> None:
+        with self._lock:
+            self.current -= nbytes
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                'current_mb': round(self.current / MB, 2),
+                'peak_mb': round(self.peak / MB, 2),
+                'budget_mb': round(self.budget / MB, 2) if self.budget else None,
+                'rejected': self.rejected
+            }
+
+
+worker_memory = WorkerMemory()
+
+
+class RequestMemory:
+    """Payload bytes held by one request, by kind, with the peak total."""
+
+    def __init__(self, budget: int = REQUEST_MEMORY_BUDGET, worker: WorkerMemory = worker_memory):
+        self.budget = budget
+        self.worker = worker
+        self.current = 0
+        self.peak = 0
+        self.by_kind = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def charge(self, kind: str, nbytes: int) -> None:
+        """Count ``nbytes`` of ``kind`` as held until released or the request ends.
+
+        Raises:
+            MemoryBudgetExceeded: If the request or worker budget would be exceeded
+        """
+        with self._lock:
+            if self._closed:
+                return
+            if self.budget and self.current + nbytes > self.budget:
+                raise MemoryBudgetExceeded(
+                    f'Request needs too much memory ({(self.current + nbytes) / MB:.1f}MB > '
+                    f'{self.budget / MB:g}MB)', REQUEST, self.budget
+                )
+            self.worker.charge(nbytes)
+            self.current += nbytes
+            self.peak = max(self.peak, self.current)
+            self.by_kind[kind] = self.by_kind.get(kind, 0) + nbytes
+
+    def release(self, kind: str, nbytes: int) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self.worker.release(nbytes)
+            self.current -= nbytes
+            self.by_kind[kind] = self.by_kind.get(kind, 0) - nbytes
+
+    def close(self) -> None:
+        """Release everything still held; later charges are ignored."""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self.worker.release(self.current)
+                self.current = 0
+
+
+def start_request(budget: int = REQUEST_MEMORY_BUDGET) -> RequestMemory:
+    """Track payload memory for the request running in this context."""
+    memory = RequestMemory(budget)
+    _current.set(memory)
+    return memory
+
+
+def charge(kind: str, nbytes: int) -> None:
+    """Charge the current request (see ``RequestMemory.charge``)."""
+    memory = _current.get()
+    if memory is not None:
+        memory.charge(kind, nbytes)
+
+
+def release(kind: str, nbytes: int) -> None:
+    memory = _current.get()
+    if memory is not None:
+        memory.release(kind, nbytes)
+
+
+@contextmanager
+def hold(kind: str, nbytes: int) -> Iterator[None]:
+    """Charge ``nbytes`` for the duration of the block."""
+    charge(kind, nbytes)
+    try:
+        yield
+    finally:
+        release(kind, nbytes)
+
+
+@contextmanager
+def tracked(budget: int = REQUEST_MEMORY_BUDGET) -> Iterator[RequestMemory]:
+    """Track a unit of work outside a Flask request, such as a background job."""
+    memory = RequestMemory(budget)
+    token = _current.set(memory)
+    try:
+        yield memory
+    finally:
+        memory.close()
+        _current.reset(token)
@@ -0,0 +1,318 @@
+"""
+Prometheus metrics and per-request stage timings.
+
+Every stage of an extraction (download, decode, JPEG encode, cache lookup,
+rate-limit queueing, the model call, parsing) is timed into a histogram, next
+to request counts and durations, timeout and error counters by cause,
+in-flight gauges, image sizes before and after compression and the peak
+payload memory of each request.
+``render`` produces the Prometheus text format served on ``/metrics``.
+
+Workers aggregate through Redis, like the other cluster-wide stats: counters
+and histograms are buffered locally and added to one hash every
+``METRICS_FLUSH_INTERVAL`` seconds, and each worker publishes its gauges
+under a key that expires when the worker goes away. Without Redis every
+worker reports its own numbers.
+
+The stages of the current request are also collected in a ``RequestTimings``
+held in a context variable, which the app turns into a ``Server-Timing``
+header.
+"""
+
+import os
+import contextvars
+import json
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+
+from redis_client import get_redis, resolve_backend
+
+logger = logging.getLogger(__name__)
+
+METRICS_BACKEND = os.getenv('METRICS_BACKEND', 'auto')  # auto, redis, memory or off
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+METRICS_KEY = 'invoice:metrics'
+METRICS_GAUGES_PREFIX = 'invoice:metrics:gauges:'
+METRICS_WORKERS_KEY = 'invoice:metrics:workers'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+BYTE_BUCKETS = tuple(1024 * 2 ** power for power in range(4, 14))  # 16KB - 8MB
+MEMORY_BUCKETS = tuple(1024 * 2 ** power for power in range(6, 19))  # 64KB - 256MB
+
+# name: (type, help, buckets)
+FAMILIES = {
+    'invoice_requests_total': ('counter', 'Requests by endpoint and status code', None),
+    'invoice_request_duration_seconds': ('histogram', 'Request duration by endpoint',
+                                         LATENCY_BUCKETS),
+    'invoice_stage_duration_seconds': ('histogram', 'Time spent in each processing stage',
+                                       LATENCY_BUCKETS),
+    'invoice_image_bytes': ('histogram', 'Image size before (original) and after '
+                            '(compressed) preprocessing', BYTE_BUCKETS),
+    'invoice_request_memory_bytes': ('histogram', 'Peak payload memory held by a request',
+                                     MEMORY_BUCKETS),
+    'invoice_timeouts_total': ('counter', 'Timeouts by cause', None),
+    'invoice_errors_total': ('counter', 'Failures by cause', None),
+    'invoice_model_hedges_total': ('counter', 'Hedged model calls by outcome', None),
+    'invoice_in_flight': ('gauge', 'Requests and model calls in progress', None),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_current_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """Seconds spent per stage during one request, in first-seen order."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        # PDF pages run stages concurrently
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        """``Server-Timing`` header value, durations in milliseconds."""
+        with self._lock:
+            stages = list(self.stages.items())
+        stages.append(('total', time.perf_counter() - self.start))
+        return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in stages)
+
+
+def start_request() -> RequestTimings:
+    """Collect stage timings for the request running in this context."""
+    timings = RequestTimings()
+    _current_timings.set(timings)
+    return timings
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metrics:
+    """Counters, histograms and gauges for this worker and the cluster."""
+
+    def __init__(self, backend: str = 'memory', flush_interval: float = METRICS_FLUSH_INTERVAL):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # Series are keyed by (name, labels, part); part is 'value' for counters
+        # and gauges, a bucket index, 'sum' or 'count' for histograms
+        self._totals = {}
+        self._pending = {}
+        self._gauges = {}
+        self._flusher_pid = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend != 'off'
+
+    def _redis(self):
+        return get_redis() if self.backend == 'redis' else None
+
+    def _add(self, key: Tuple, amount: float) -> None:
+        self._totals[key] = self._totals.get(key, 0) + amount
+        self._pending[key] = self._pending.get(key, 0) + amount
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        """Increase a counter."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._add((name, tuple(sorted(labels.items())), 'value'), amount)
+        self._ensure_flusher()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Record one observation in a histogram."""
+        if not self.enabled:
+            return
+        buckets = FAMILIES[name][2]
+        index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+        series = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._add(series + (index,), 1)
+            self._add(series + ('sum',), value)
+            self._add(series + ('count',), 1)
+        self._ensure_flusher()
+
+    def add_gauge(self, name: str, amount: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())), 'value')
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+        self._ensure_flusher()
+
+    @contextmanager
+    def in_flight(self, what: str, **labels: str) -> Iterator[None]:
+        """Count the enclosed block in the ``invoice_in_flight`` gauge."""
+        self.add_gauge('invoice_in_flight', 1, what=what, **labels)
+        try:
+            yield
+        finally:
+            self.add_gauge('invoice_in_flight', -1, what=what, **labels)
+
+    def record_stage(self, stage: str, seconds: float) -> None:
+        """Count time spent in ``stage``, also for the current request's timings."""
+        self.observe('invoice_stage_duration_seconds', seconds, stage=stage)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add(stage, seconds)
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Time the enclosed block as ``stage`` (failed attempts included)."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start_time)
+
+    # Cluster aggregation
+    # -------------------
+
+    @staticmethod
+    def _field(key: Tuple) -> str:
+        name, labels, part = key
+        return json.dumps([name, labels, part], separators=(',', ':'))
+
+    def _ensure_flusher(self) -> None:
+        if self.backend != 'redis' or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            # Also after fork(): the parent's thread does not exist here
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    def _flush_loop(self) -> None:
+        pid = os.getpid()
+        while self._flusher_pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _worker_id(self) -> str:
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def flush(self) -> None:
+        """Push buffered counts and current gauges to Redis."""
+        client = self._redis()
+        if client is None:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            gauges = dict(self._gauges)
+        worker = self._worker_id()
+        expiry = max(int(self.flush_interval * 3), 10)
+        try:
+            pipe = client.pipeline(transaction=False)
+            for key, amount in pending.items():
+                pipe.hincrbyfloat(METRICS_KEY, self._field(key), amount)
+            gauge_key = METRICS_GAUGES_PREFIX + worker
+            pipe.delete(gauge_key)
+            if gauges:
+                pipe.hset(gauge_key, mapping={self._field(key): value
+                                              for key, value in gauges.items()})
+            pipe.expire(gauge_key, expiry)
+            pipe.zadd(METRICS_WORKERS_KEY, {worker: time.time()})
+            pipe.zremrangebyscore(METRICS_WORKERS_KEY, 0, time.time() - expiry)
+            pipe.execute()
+        except Exception as e:
+            # Keep the counts for the next attempt
+            with self._lock:
+                for key, amount in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + amount
+            logger.warning(f"Could not flush metrics: {str(e)}")
+
+    def _cluster(self, client) -> Tuple[Dict[Tuple, float], Dict[Tuple, float], int]:
+        """Counters/histograms and summed gauges of all live workers."""
+        self.flush()
+        totals = {}
+        for field, value in client.hgetall(METRICS_KEY).items():
+            name, labels, part = json.loads(field)
+            totals[(name, tuple(tuple(pair) for pair in labels), part)] = float(value)
+
+        workers = client.zrangebyscore(METRICS_WORKERS_KEY,
+                                       time.time() - max(self.flush_interval * 3, 10), '+inf')
+        pipe = client.pipeline(transaction=False)
+        for worker in workers:
+            pipe.hgetall(METRICS_GAUGES_PREFIX + worker.decode())
+        gauges = {}
+        for worker_gauges in pipe.execute():
+            for field, value in worker_gauges.items():
+                name, labels, part = json.loads(field)
+                key = (name, tuple(tuple(pair) for pair in labels), part)
+                gauges[key] = gauges.get(key, 0) + float(value)
+        return totals, gauges, len(workers)
+
+    # Exposition
+    # ----------
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        workers = 1
+        client = self._redis()
+        totals = gauges = None
+        if client is not None:
+            try:
+                totals, gauges, workers = self._cluster(client)
+            except Exception as e:
+                logger.warning(f"Could not read cluster metrics, reporting this worker: {str(e)}")
+        if totals is None:
+            with self._lock:
+                totals, gauges = dict(self._totals), dict(self._gauges)
+
+        values = {**totals, **gauges}
+        lines = []
+        for name, (kind, help_text, buckets) in FAMILIES.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            series = sorted({key[1] for key in values if key[0] == name})
+            for labels in series:
+                if kind != 'histogram':
+                    value = values[(name, labels, 'value')]
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for index, bound in enumerate(buckets + (float('inf'),)):
+                    cumulative += values.get((name, labels, index), 0)
+                    le = '+Inf' if index == len(buckets) else _format_value(bound)
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} '
+                                 f'{_format_value(cumulative)}')
+                lines.append(f"{name}_sum{_format_labels(labels)} "
+                             f"{_format_value(values.get((name, labels, 'sum'), 0))}")
+                lines.append(f"{name}_count{_format_labels(labels)} "
+                             f"{_format_value(values.get((name, labels, 'count'), 0))}")
+        lines.append('# HELP invoice_metrics_workers Workers included in these metrics')
+        lines.append('# TYPE invoice_metrics_workers gauge')
+        lines.append(f'invoice_metrics_workers {workers}')
+        return '\n'.join(lines) + '\n'
+
+
+def create_metrics() -> Metrics:
+    """Create the metrics registry according to ``METRICS_BACKEND``."""
+    backend = resolve_backend(METRICS_BACKEND)
+    if backend not in ('redis', 'memory', 'off'):
+        logger.warning(f"Unknown METRICS_BACKEND '{backend}', using memory")
+        backend = 'memory'
+    logger.info(f"Metrics backend: {backend}")
+    return Metrics(backend=backend)
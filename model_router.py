@@ -0,0 +1,311 @@
+"""
+Model cascade: a fast model first, a stronger one only when it is needed.
+
+Most invoices, clean two-line receipts above all, extract correctly with a
+light model in a fraction of the time the strongest one takes. The router
+tries the tiers of ``GEMINI_MODEL_TIERS`` in order (fastest first) and
+scores each result with the checks ``parse_invoice`` already makes: line
+arithmetic, the reported subtotal and the required fields. A result scoring
+at least ``MODEL_CASCADE_MIN_CONFIDENCE`` is accepted, otherwise the next
+tier is tried, but only if its recent latency still fits in the request's
+deadline. After the last tier, the image ladder continues at that tier.
+
+Latencies are tracked live per model (``LatencyTracker``). Attempts and the
+tier that served each extraction are counted per worker and, when Redis is
+reachable, for the cluster.
+"""
+
+import os
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import TimeoutError
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from rate_limiter import RateLimitExceeded
+from redis_client import BufferedCounters, get_redis
+from resolution_ladder import ACCEPTED, ERROR, REJECTED, TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Lowest share of passed checks accepted without trying the next tier
+MODEL_CASCADE_MIN_CONFIDENCE = float(os.getenv('MODEL_CASCADE_MIN_CONFIDENCE', 0.95))
+# Recent calls per model the latency percentiles are taken from
+MODEL_LATENCY_WINDOW = int(os.getenv('MODEL_LATENCY_WINDOW', 200))
+# Calls of a model before its latency is trusted
+MODEL_LATENCY_MIN_SAMPLES = 5
+# Percentile of a tier's latency that must fit in what is left to escalate to it
+ESCALATION_PERCENTILE = 0.9
+CASCADE_STATS_KEY = 'invoice:cascade:stats'
+
+# Fields every usable extraction has
+REQUIRED_FIELDS = (('company_details', 'name'), ('invoice_details', 'invoice_number'))
+
+# Tier attempts skipped because they could not finish in time, and
+# extractions a tier's result was returned for
+SKIPPED = 'skipped'
+SERVED = 'served'
+COUNTERS = ('attempts', ACCEPTED, REJECTED, TIMEOUT, ERROR, SKIPPED, SERVED)
+
+
+def parse_tiers(spec: str) -> List[str]:
+    """Parse a cascade such as ``'gemini-1.5-flash-latest,gemini-1.5-pro-latest'``.
+
+    Raises:
+        ValueError: If no model is named
+    """
+    tiers = []
+    for name in spec.split(','):
+        name = name.strip()
+        if name and name not in tiers:
+            tiers.append(name)
+    if not tiers:
+        raise ValueError('Model cascade is empty')
+    return tiers
+
+
+def score_extraction(invoice_data: Dict, issues: Sequence[str]) -> float:
+    """Share of the checks an extraction passes (0 without line items).
+
+    The checks are each line's quantity x price = total, the reported
+    subtotal against the line totals and the presence of ``REQUIRED_FIELDS``.
+    """
+    items = invoice_data['line_items']
+    if not items:
+        return 0.0
+    checks = len(items) + 1 + len(REQUIRED_FIELDS)
+    failed = len(issues) + sum(1 for section, field in REQUIRED_FIELDS
+                               if not invoice_data[section][field])
+    return round(max(checks - failed, 0) / checks, 4)
+
+
+class LatencyTracker:
+    """Latencies of the most recent calls of each model, for live percentiles."""
+
+    def __init__(self, window: int = MODEL_LATENCY_WINDOW,
+                 min_samples: int = MODEL_LATENCY_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, model: str, fraction: float) -> Optional[float]:
+        """Latency ``fraction`` of the recent calls finished within, or None
+        before ``min_samples`` calls."""
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, math.ceil(fraction * len(samples)) - 1)]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Sample count and p50/p90/p99 (seconds) per model."""
+        with self._lock:
+            counts = {model: len(samples) for model, samples in self._samples.items()}
+        stats = {}
+        for model, count in counts.items():
+            stats[model] = {'samples': count}
+            for fraction in (0.5, 0.9, 0.99):
+                value = self.percentile(model, fraction)
+                stats[model][f'p{round(fraction * 100)}_s'] = (
+                    None if value is None else round(value, 3)
+                )
+        return stats
+
+
+class CascadeStats:
+    """Per-tier attempt counters for this worker and the cluster."""
+
+    def __init__(self, tiers: List[str]):
+        self.tiers = tiers
+        self._lock = threading.Lock()
+        self._stats = {tier: self._empty() for tier in tiers}
+        self._shared = BufferedCounters(CASCADE_STATS_KEY)
+
+    @staticmethod
+    def _empty() -> Dict[str, float]:
+        return dict(dict.fromkeys(COUNTERS, 0), seconds=0.0)
+
+    def record(self, tier: str, outcome: str, seconds: float = 0.0) -> None:
+        """Count one attempt (or a skipped or served extraction) at ``tier``."""
+        changes = {outcome: 1}
+        if outcome not in (SKIPPED, SERVED):
+            changes['attempts'] = 1
+        with self._lock:
+            counters = self._stats.setdefault(tier, self._empty())
+            for key, amount in changes.items():
+                counters[key] += amount
+            counters['seconds'] += seconds
+        # Buffered: this runs on the event loop, between model calls
+        for key, amount in changes.items():
+            self._shared.add(f'{tier}:{key}', amount)
+        self._shared.add(f'{tier}:seconds', float(seconds))
+
+    @staticmethod
+    def _summary(tier: str, counters: Dict[str, float], served: int) -> Dict[str, Any]:
+        attempts = counters.get('attempts', 0)
+        summary = {'tier': tier, **{k: v for k, v in counters.items() if k != 'seconds'}}
+        # Share of this tier's attempts that were good enough to stop at
+        summary['hit_rate'] = round(counters.get(ACCEPTED, 0) / attempts, 4) if attempts else None
+        # Share of all extractions whose result came from this tier
+        summary['served_share'] = round(counters.get(SERVED, 0) / served, 4) if served else None
+        summary['avg_seconds'] = (
+            round(counters.get('seconds', 0) / attempts, 3) if attempts else None
+        )
+        return summary
+
+    @classmethod
+    def _summaries(cls, stats: Dict[str, Dict[str, float]]) -> List[Dict[str, Any]]:
+        served = sum(counters.get(SERVED, 0) for counters in stats.values())
+        return [cls._summary(tier, counters, served) for tier, counters in stats.items()]
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit rate, share of extractions served and latency per tier."""
+        with self._lock:
+            worker = {tier: dict(counters) for tier, counters in self._stats.items()}
+        result = {'tiers': self.tiers, 'worker': self._summaries(worker)}
+
+        client = get_redis()
+        if client is not None:
+            try:
+                cluster = {}
+                for field, value in self._shared.read(client).items():
+                    tier, key = field.decode().rsplit(':', 1)
+                    number = float(value) if key == 'seconds' else int(value)
+                    cluster.setdefault(tier, {})[key] = number
+                result['cluster'] = self._summaries(cluster)
+            except Exception as e:
+                logger.warning(f"Could not read cluster cascade stats: {str(e)}")
+        return result
+
+
+# Model call of one step: (tier, rung, seconds left) -> dict with at least
+# ``invoice_data`` and ``issues``
+Call = Callable[[str, Any, float], Awaitable[Dict]]
+# Told about every attempt: (tier, rung, outcome, seconds)
+AttemptHook = Callable[[str, Any, str, float], None]
+
+
+class ModelRouter:
+    """Runs an extraction through the model tiers, then the image rungs.
+
+    Args:
+        tiers: Model names, fastest first
+        min_confidence: ``score_extraction`` result accepted without escalating
+        latency: Live per-model latencies (shared with other users of them)
+        record_latency: Record each attempt's latency; off when whoever makes
+            the model calls records them in ``latency`` (e.g. the hedger)
+    """
+
+    def __init__(self, tiers: List[str], min_confidence: float = MODEL_CASCADE_MIN_CONFIDENCE,
+                 latency: Optional[LatencyTracker] = None, record_latency: bool = True):
+        self.tiers = tiers
+        self.min_confidence = min_confidence
+        self.latency = latency or LatencyTracker()
+        self.record_latency = record_latency
+        self._stats = CascadeStats(tiers)
+
+    @property
+    def version(self) -> str:
+        """Identifies the cascade in cache keys: its models in order."""
+        return '>'.join(self.tiers)
+
+    def steps(self, rungs: Sequence[Any]) -> List[Tuple[str, Any]]:
+        """Every tier at the first rung, then the remaining rungs at the last tier."""
+        return ([(tier, rungs[0]) for tier in self.tiers]
+                + [(self.tiers[-1], rung) for rung in rungs[1:]])
+
+    def can_finish(self, tier: str, previous: Tuple[str, float], remaining: float) -> bool:
+        """Whether a step at ``tier`` is likely to finish in ``remaining`` seconds.
+
+        A larger image at the same tier is expected to take half as long
+        again as the previous attempt; another tier takes its recent
+        ``ESCALATION_PERCENTILE`` latency (unknown latencies are tried).
+        """
+        previous_tier, previous_seconds = previous
+        if tier == previous_tier:
+            return remaining >= previous_seconds * 1.5
+        expected = self.latency.percentile(tier, ESCALATION_PERCENTILE)
+        return expected is None or remaining >= expected
+
+    async def run(self, call: Call, deadline: float, rungs: Sequence[Any] = (None,),
+                  on_attempt: Optional[AttemptHook] = None) -> Dict:
+        """Call the model step by step until a result is confident enough.
+
+        The best result is returned either way. An error ends the cascade,
+        and is raised when no earlier step produced a result.
+
+        Returns:
+            dict: the accepted (or best) call result plus ``tier``, ``rung``,
+            ``level`` (index of the step), ``confidence`` and ``attempts``
+
+        Raises:
+            RateLimitExceeded: If capacity for the first call was not available
+            TimeoutError: If the first call timed out
+            Exception: If the first call failed
+        """
+        best = None
+        attempts = 0
+        previous = None
+        for level, (tier, rung) in enumerate(self.steps(rungs)):
+            remaining = deadline - time.time()
+            if previous is not None and not self.can_finish(tier, previous, remaining):
+                logger.info(f"No time left to escalate to {tier} at {rung}")
+                self._stats.record(tier, SKIPPED)
+                break
+
+            attempts += 1
+            start_time = time.time()
+            try:
+                result = await call(tier, rung, remaining)
+            except RateLimitExceeded:
+                if best is None:
+                    raise
+                break
+            except Exception as e:
+                outcome = TIMEOUT if isinstance(e, TimeoutError) else ERROR
+                self._attempted(tier, rung, outcome, time.time() - start_time, on_attempt)
+                if best is None:
+                    raise
+                break
+
+            seconds = time.time() - start_time
+            if self.record_latency:
+                self.latency.record(tier, seconds)
+            confidence = score_extraction(result['invoice_data'], result['issues'])
+            outcome = ACCEPTED if confidence >= self.min_confidence else REJECTED
+            self._attempted(tier, rung, outcome, seconds, on_attempt)
+
+            if best is None or confidence > best['confidence']:
+                best = {**result, 'tier': tier, 'rung': rung, 'level': level,
+                        'confidence': confidence}
+            if outcome == ACCEPTED:
+                break
+            logger.info(f"Extraction with {tier} at {rung} scored {confidence}: "
+                        f"{'; '.join(result['issues'][:3]) or 'missing fields'}")
+            previous = (tier, seconds)
+
+        self._stats.record(best['tier'], SERVED)
+        best['attempts'] = attempts
+        return best
+
+    def _attempted(self, tier: str, rung: Any, outcome: str, seconds: float,
+                   on_attempt: Optional[AttemptHook]) -> None:
+        self._stats.record(tier, outcome, seconds)
+        if on_attempt is not None:
+            on_attempt(tier, rung, outcome, seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self._stats.stats()
+        stats['min_confidence'] = self.min_confidence
+        stats['latency'] = self.latency.stats()
+        return stats
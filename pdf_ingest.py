@@ -0,0 +1,175 @@
+"""
+Page-at-a-time access to PDF invoices.
+
+Multi-page invoices arrive as PDFs. Rasterizing a whole document up front at
+print resolution would cost hundreds of megabytes for a 50-page file, so each
+page is turned into model input only when it is needed, in the cheapest form
+available:
+
+* ``text``: the page has a real text layer, which is sent as text and never
+  rendered;
+* ``image``: the page is a single scanned JPEG, whose original stream is
+  handed to the regular image pipeline (draft decoding applies);
+* ``render``: anything else is rendered directly at the size the model sees.
+
+PDFium is not thread-safe, so every call into it holds a process-wide lock;
+callers can still overlap rendering of one page with model calls for others.
+``pypdfium2`` is imported lazily, only when a PDF is actually processed.
+"""
+
+import os
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', 50))
+PDF_USE_TEXT_LAYER = os.getenv('PDF_USE_TEXT_LAYER', 'true').lower() in ('1', 'true', 'yes')
+PDF_MIN_TEXT_CHARS = int(os.getenv('PDF_MIN_TEXT_CHARS', 200))
+# Minimum share of the page a scanned image must cover to be used as the page
+PDF_IMAGE_COVERAGE = float(os.getenv('PDF_IMAGE_COVERAGE', 0.85))
+
+PDF_MAGIC = b'%PDF-'
+
+# PDFium keeps global state; all calls into it are serialized
+_pdfium_lock = threading.Lock()
+
+
+def is_pdf(file_data: bytes) -> bool:
+    """Whether the data is a PDF (the header may follow up to 1KB of junk)."""
+    return PDF_MAGIC in file_data[:1024]
+
+
+def _pdfium():
+    try:
+        import pypdfium2
+    except ImportError:
+        raise RuntimeError('PDF support requires the pypdfium2 package')
+    return pypdfium2
+
+
+class PdfDocument:
+    """An open PDF whose pages are converted to model input one at a time.
+
+    Example:
+        with PdfDocument(file_data) as document:
+            for index in range(document.page_count):
+                content = document.page_content(index, 600)
+    """
+
+    def __init__(self, file_data: bytes, max_pages: int = PDF_MAX_PAGES):
+        """Open the document from memory.
+
+        Raises:
+            ValueError: If the PDF cannot be opened or has too many pages
+            RuntimeError: If pypdfium2 is not installed
+        """
+        pdfium = _pdfium()
+        self._closed = False
+        with _pdfium_lock:
+            try:
+                self._pdf = pdfium.PdfDocument(file_data)
+            except pdfium.PdfiumError as e:
+                raise ValueError(f'Invalid PDF: {str(e)}')
+            self.page_count = len(self._pdf)
+
+        if self.page_count == 0:
+            self.close()
+            raise ValueError('PDF has no pages')
+        if self.page_count > max_pages:
+            self.close()
+            raise ValueError(f'PDF has too many pages ({self.page_count} > {max_pages})')
+
+    def page_content(self, index: int, max_dimension: int) -> Dict[str, Any]:
+        """Model input for one page.
+
+        Args:
+            index: Zero-based page number
+            max_dimension: Longest side of a rendered page in pixels
+
+        Returns:
+            dict: ``kind`` (``text``, ``image`` or ``render``) plus ``text``,
+            the original image bytes as ``data``, or a PIL ``image``
+
+        Raises:
+            ValueError: If the document has already been closed
+        """
+        with _pdfium_lock:
+            if self._closed:
+                raise ValueError('PDF document is closed')
+            page = self._pdf[index]
+            try:
+                if PDF_USE_TEXT_LAYER:
+                    text = self._text(page)
+                    if len(text.strip()) >= PDF_MIN_TEXT_CHARS:
+                        return {'kind': 'text', 'text': text}
+
+                data = self._scanned_jpeg(page)
+                if data is not None:
+                    return {'kind': 'image', 'data': data}
+
+                return {'kind': 'render', 'image': self._render(page, max_dimension)}
+            finally:
+                page.close()
+
+    @staticmethod
+    def _text(page) -> str:
+        textpage = page.get_textpage()
+        try:
+            return textpage.get_text_range()
+        finally:
+            textpage.close()
+
+    def _scanned_jpeg(self, page) -> Optional[bytes]:
+        """Original JPEG stream of a page that is one upright full-page scan."""
+        if page.get_rotation() != 0:
+            return None
+
+        images = list(page.get_objects(filter=(self._image_type(),), max_depth=1))
+        if len(images) != 1:
+            return None
+        image = images[0]
+
+        matrix = image.get_matrix()
+        if matrix.b != 0 or matrix.c != 0 or matrix.a <= 0 or matrix.d <= 0:
+            return None
+
+        left, bottom, right, top = image.get_bounds()
+        width, height = page.get_size()
+        if (right - left) * (top - bottom) < PDF_IMAGE_COVERAGE * width * height:
+            return None
+
+        if image.get_filters() != ['DCTDecode']:
+            return None
+        return bytes(image.get_data(decode_simple=False))
+
+    @staticmethod
+    def _image_type() -> int:
+        return _pdfium().raw.FPDF_PAGEOBJ_IMAGE
+
+    @staticmethod
+    def _render(page, max_dimension: int) -> Image.Image:
+        # PDF units are 1/72 inch; render straight at the target size
+        scale = max_dimension / max(page.get_size())
+        bitmap = page.render(scale=scale)
+        try:
+            # Copy out of the PDFium buffer before it is released
+            return bitmap.to_pil().convert('RGB')
+        finally:
+            bitmap.close()
+
+    def close(self) -> None:
+        """Release the document; pages still being converted finish first."""
+        with _pdfium_lock:
+            if not self._closed:
+                self._closed = True
+                self._pdf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,390 @@
+"""
+Extraction prompts: a compact base prompt plus learned per-supplier profiles.
+
+Every model call sends the prompt with the image, so its length adds to the
+input tokens, and with them to latency and cost, of every extraction. The
+base prompt says what the model needs once: the JSON shape, the right-to-left
+column order and the arithmetic that tells quantity from total.
+
+Once a supplier (``company_details.tax_id``) has been extracted, what its
+invoices look like is learned from the results and added to the prompt as a
+short profile: its name, whether the model tends to confuse its quantity and
+total columns, whether quantities are weights, its most frequent item codes
+and how it charges VAT. The supplier of a new upload is recognized by a
+perceptual hash of its letterhead (the top of the page), or given by the
+client as ``tax_id``. A letterhead only names a supplier while no other
+supplier's invoices have been seen with it.
+
+Each prompt carries a version (a hash of its text) that is part of the
+result cache key. A profile's text is only rebuilt after 1, 2, 4, ... 64
+invoices and then every 64, so its version, and the cache keys using it,
+change rarely.
+
+Backends (``PROMPT_PROFILE_BACKEND``):
+
+* ``redis`` (``auto`` with Redis): profiles shared by every worker, so all
+  of them send (and cache under) the same prompt version;
+* ``memory``: per worker;
+* ``off``: the base prompt only.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Iterable, NamedTuple, Optional
+
+from image_hash import DuplicateIndex
+from redis_client import get_redis, resolve_backend
+
+logger = logging.getLogger(__name__)
+
+PROFILE_BACKEND = os.getenv('PROMPT_PROFILE_BACKEND', 'auto')  # auto, redis, memory, off
+# Invoices of a supplier extracted before its profile is used
+PROFILE_MIN_INVOICES = int(os.getenv('PROMPT_PROFILE_MIN_INVOICES', 1))
+# Item codes listed in a profile
+PROFILE_KNOWN_CODES = int(os.getenv('PROMPT_PROFILE_KNOWN_CODES', 8))
+# Letterhead hashes within this many bits (of 64) are the same supplier; 0 disables.
+# Different invoices printed on one template differ by only 0-2 bits, and two
+# suppliers' letterheads can be as close, so a match has to be near-exact.
+LETTERHEAD_THRESHOLD = int(os.getenv('PROMPT_PROFILE_LETTERHEAD_THRESHOLD', 2))
+PROFILE_MAX_VENDORS = int(os.getenv('PROMPT_PROFILE_MAX_VENDORS', 10000))
+# Seconds a worker reuses a profile read from Redis
+PROFILE_LOCAL_TTL = float(os.getenv('PROMPT_PROFILE_LOCAL_TTL', 30))
+PROFILE_PREFIX = 'invoice:profile:'
+LETTERHEAD_LOG_KEY = 'invoice:letterhead:log'
+
+# Item codes remembered per supplier (the most frequent are kept)
+MAX_CODES = 64
+# Share of lines failing quantity x price = total that earns the column rule
+MISMATCH_RATE = 0.1
+# Share of fractional quantities that marks a supplier selling by weight
+DECIMAL_RATE = 0.2
+# Share of lines with an item code below which the supplier has none
+CODED_RATE = 0.1
+# VAT behaviour seen on at least this share of invoices is stated
+VAT_SHARE = 0.6
+VAT_RATES = (0.17, 0.18)
+
+BASE_PROMPT = """Extract this Hebrew invoice as JSON, exactly this shape:
+{"company_details":{"name":"","address":"","tax_id":""},"invoice_details":{"invoice_number":"","date":""},"line_items":[{"item_code":"","description":"","quantity":0,"price":0,"total":0}],"totals":{"subtotal":0,"tax":0,"total":0}}
+
+Rules:
+- Line columns run right to left: תיאור/פריט (description), כמות (quantity), מחיר/מחיר יחידה (price), סה"כ/סכום (total).
+- quantity x price = total on every line. If not, you swapped כמות and סה"כ: quantity is the smaller number.
+- Numbers are JSON numbers; missing text is "". Never null.
+- totals as printed: subtotal before VAT, tax (מע"מ), total."""
+
+BASE_PROFILE = 'base'
+
+
+def prompt_version(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+
+
+class Prompt(NamedTuple):
+    """A prompt, its version (part of cache keys) and the profile behind it."""
+    text: str
+    version: str
+    profile: str = BASE_PROFILE
+
+
+BASE_VERSION = prompt_version(BASE_PROMPT)
+BASE = Prompt(BASE_PROMPT, BASE_VERSION)
+
+_word = re.compile(r'\w+|[^\w\s]')
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a text: ~4 characters per token for Latin script
+    and digits, ~2 for Hebrew, one per symbol. Offline stand-in for the
+    model's ``count_tokens``."""
+    tokens = 0
+    for piece in _word.findall(text):
+        if piece.isascii():
+            tokens += math.ceil(len(piece) / 4)
+        else:
+            tokens += math.ceil(len(piece) / (2 if piece[0].isalnum() else 1))
+    return tokens
+
+
+def normalize_tax_id(value: Any) -> Optional[str]:
+    """Digits of a tax id, or None when it cannot be one."""
+    digits = ''.join(ch for ch in str(value or '') if ch.isdigit())
+    return digits if 5 <= len(digits) <= 12 else None
+
+
+def _vat_behaviour(reported: Dict[str, float], line_sum: float) -> Optional[str]:
+    """How an invoice charged VAT: ``added_17``, ``added_18``, ``included``,
+    ``none``, or None when the printed totals do not say."""
+    subtotal, tax, total = (reported.get(field) or 0 for field in ('subtotal', 'tax', 'total'))
+    if not total:
+        return None
+    if not tax:
+        return 'none' if abs(total - line_sum) <= max(0.05, total * 0.005) else None
+    if subtotal:
+        for rate in VAT_RATES:
+            if abs(tax / subtotal - rate) < 0.003:
+                # Line prices already include VAT when they add up to the total
+                if abs(total - line_sum) <= max(0.05, total * 0.005):
+                    return 'included'
+                return f'added_{round(rate * 100)}'
+    return None
+
+
+VAT_TEXT = {
+    'added_17': 'VAT 17% is added to the subtotal.',
+    'added_18': 'VAT 18% is added to the subtotal.',
+    'included': 'Line prices include VAT; the totals section separates it.',
+    'none': 'No VAT is charged: tax is 0 and total = subtotal.',
+}
+
+
+def new_profile(tax_id: str) -> Dict[str, Any]:
+    return {'tax_id': tax_id, 'name': '', 'invoices': 0, 'lines': 0, 'mismatched_lines': 0,
+            'decimal_quantities': 0, 'coded_lines': 0, 'codes': {}, 'vat': {}, 'prompt': None}
+
+
+_mismatch = re.compile(r'line item (\d+): quantity x price != total')
+
+
+def update_profile(profile: Dict[str, Any], invoice_data: Dict, issues: Iterable[str] = (),
+                   reported: Optional[Dict[str, float]] = None) -> None:
+    """Add one extraction to a supplier's profile."""
+    items = invoice_data['line_items']
+    profile['name'] = invoice_data['company_details'].get('name') or profile['name']
+    profile['invoices'] += 1
+    profile['lines'] += len(items)
+    mismatched = {int(match.group(1)) for match in map(_mismatch.match, issues) if match}
+    profile['mismatched_lines'] += len(mismatched)
+    codes = profile['codes']
+    for index, item in enumerate(items):
+        # A swapped total in the quantity says nothing about weights
+        if index not in mismatched and item['quantity'] != int(item['quantity']):
+            profile['decimal_quantities'] += 1
+        code = str(item.get('item_code') or '').strip()
+        if code:
+            profile['coded_lines'] += 1
+            seen = codes.get(code)
+            codes[code] = [seen[0] + 1 if seen else 1, str(item.get('description') or '')[:24]]
+    if len(codes) > MAX_CODES * 2:
+        profile['codes'] = dict(sorted(codes.items(), key=lambda entry: -entry[1][0])[:MAX_CODES])
+    if reported:
+        vat = _vat_behaviour(reported, sum(item['total'] for item in items))
+        if vat is not None:
+            profile['vat'][vat] = profile['vat'].get(vat, 0) + 1
+
+    count = profile['invoices']
+    # Rebuilt at 1, 2, 4 ... 64 invoices, then every 64: versions change rarely
+    if count & (count - 1) == 0 and count <= 64 or count % 64 == 0:
+        text = render_profile(profile)
+        profile['prompt'] = {'text': text, 'version': prompt_version(text), 'invoices': count}
+
+
+def render_profile(profile: Dict[str, Any]) -> str:
+    """The supplier section appended to the base prompt."""
+    lines = [f"Supplier profile from {profile['invoices']} earlier invoice(s); "
+             "ignore it if this invoice's header shows another supplier.",
+             f"- Supplier: {profile['name']}, tax id {profile['tax_id']}."]
+    item_lines = max(profile['lines'], 1)
+    if profile['mismatched_lines'] / item_lines >= MISMATCH_RATE:
+        lines.append('- Quantity and total were often swapped on this layout: the כמות column '
+                     'is right of מחיר, סה"כ is leftmost. Check quantity x price = total.')
+    if profile['decimal_quantities'] / item_lines >= DECIMAL_RATE:
+        lines.append('- Quantities are often weights with decimals (e.g. 2.35).')
+    if profile['coded_lines'] / item_lines < CODED_RATE:
+        lines.append('- Lines have no item codes: item_code is "".')
+    elif profile['codes']:
+        known = sorted(profile['codes'].items(), key=lambda entry: -entry[1][0])
+        lines.append('- Known item codes: ' + '; '.join(
+            f'{code} {description}'.strip()
+            for code, (_, description) in known[:PROFILE_KNOWN_CODES]) + '.')
+    vat_total = sum(profile['vat'].values())
+    if vat_total:
+        behaviour, seen = Counter(profile['vat']).most_common(1)[0]
+        if seen / vat_total >= VAT_SHARE:
+            lines.append(f'- {VAT_TEXT[behaviour]}')
+    return '\n'.join(lines)
+
+
+class ProfileStore:
+    """Learned supplier profiles and the prompt to use for an upload.
+
+    With Redis, profiles are JSON under ``invoice:profile:<tax id>`` and
+    letterhead hashes are shared through a log like the near-duplicate
+    index; each worker keeps what it read for ``PROFILE_LOCAL_TTL``.
+    """
+
+    def __init__(self, backend: str = 'memory', min_invoices: int = PROFILE_MIN_INVOICES,
+                 letterhead_threshold: int = LETTERHEAD_THRESHOLD,
+                 max_vendors: int = PROFILE_MAX_VENDORS):
+        self.backend = backend
+        self.min_invoices = max(min_invoices, 1)
+        self.max_vendors = max_vendors
+        self.letterheads = DuplicateIndex(threshold=letterhead_threshold,
+                                          log_key=LETTERHEAD_LOG_KEY)
+        self._profiles = OrderedDict()
+        self._read_at = {}
+        self._lock = threading.Lock()
+        self._stats = {'base': 0, 'vendor': 0, 'by_hint': 0, 'by_letterhead': 0,
+                       'ambiguous_letterhead': 0, 'observed': 0, 'other_supplier': 0,
+                       'errors': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend != 'off'
+
+    def _redis(self):
+        return get_redis() if self.backend == 'redis' else None
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def _remember(self, tax_id: str, profile: Dict[str, Any]) -> None:
+        with self._lock:
+            self._profiles[tax_id] = profile
+            self._profiles.move_to_end(tax_id)
+            self._read_at[tax_id] = time.monotonic()
+            while len(self._profiles) > self.max_vendors:
+                evicted, _ = self._profiles.popitem(last=False)
+                self._read_at.pop(evicted, None)
+
+    def profile(self, tax_id: str) -> Optional[Dict[str, Any]]:
+        """A supplier's profile, or None if it was never extracted."""
+        client = self._redis()
+        with self._lock:
+            profile = self._profiles.get(tax_id)
+            fresh = time.monotonic() - self._read_at.get(tax_id, 0) < PROFILE_LOCAL_TTL
+        if client is None or (profile is not None and fresh):
+            return profile
+        try:
+            raw = client.get(PROFILE_PREFIX + tax_id)
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"Prompt profile read failed: {str(e)}")
+            return profile
+        if raw is None:
+            return None
+        profile = json.loads(raw)
+        self._remember(tax_id, profile)
+        return profile
+
+    def select(self, tax_id: Any = None, letterhead: Optional[int] = None) -> Prompt:
+        """The prompt for an upload: its supplier's profile when one is known.
+
+        Args:
+            tax_id: Supplier tax id given by the client, if any
+            letterhead: ``letterhead_hash`` of the page, to recognize the supplier
+        """
+        if not self.enabled:
+            return BASE
+        tax_id = normalize_tax_id(tax_id)
+        if tax_id is not None:
+            self._count('by_hint')
+        elif letterhead is not None:
+            match = self.letterheads.find(letterhead)
+            if match is not None and len(match['keys']) > 1:
+                # A stock template several suppliers print on: it names none of them
+                self._count('ambiguous_letterhead')
+            elif match is not None:
+                tax_id = match['key']
+                self._count('by_letterhead')
+        profile = self.profile(tax_id) if tax_id is not None else None
+        if profile is None or profile['prompt'] is None or \
+                profile['prompt']['invoices'] < self.min_invoices:
+            self._count('base')
+            return BASE
+        self._count('vendor')
+        section = profile['prompt']
+        return Prompt(f"{BASE_PROMPT}\n\n{section['text']}",
+                      f"{BASE_VERSION}-{section['version']}", f'vendor:{tax_id}')
+
+    def observe(self, invoice_data: Dict, issues: Iterable[str] = (),
+                reported: Optional[Dict[str, float]] = None, letterhead: Optional[int] = None,
+                prompt: Prompt = BASE) -> None:
+        """Learn from a fresh extraction (see ``update_profile``).
+
+        Args:
+            invoice_data: The parsed invoice
+            issues: Its failed arithmetic checks
+            reported: Totals as the model read them (see ``parse_invoice``)
+            letterhead: ``letterhead_hash`` of the page
+            prompt: The prompt the extraction used
+        """
+        tax_id = normalize_tax_id(invoice_data['company_details'].get('tax_id'))
+        if not self.enabled or tax_id is None or not invoice_data['line_items']:
+            return
+        if prompt.profile != BASE_PROFILE and prompt.profile != f'vendor:{tax_id}':
+            # The letterhead looked like another supplier's
+            self._count('other_supplier')
+        client = self._redis()
+        try:
+            if client is None:
+                with self._lock:
+                    profile = self._profiles.get(tax_id) or new_profile(tax_id)
+                    update_profile(profile, invoice_data, issues, reported)
+                self._remember(tax_id, profile)
+            else:
+                profile = self._update_shared(client, tax_id, invoice_data, issues, reported)
+            self._count('observed')
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"Could not update prompt profile: {str(e)}")
+            return
+
+        # A letterhead that turns out to be another supplier's too is recorded
+        # for both, which stops it from naming either (see ``select``)
+        if letterhead is not None and self.letterheads.enabled:
+            match = self.letterheads.find(letterhead)
+            if match is None or tax_id not in match['keys']:
+                self.letterheads.add(letterhead, tax_id)
+
+    def _update_shared(self, client, tax_id: str, invoice_data: Dict, issues: Iterable[str],
+                       reported: Optional[Dict[str, float]]) -> Dict[str, Any]:
+        """Read-modify-write of a Redis profile, retried if another worker wrote it."""
+        key = PROFILE_PREFIX + tax_id
+        issues = list(issues)
+        for _ in range(3):
+            with client.pipeline() as pipe:
+                try:
+                    pipe.watch(key)
+                    raw = pipe.get(key)
+                    profile = json.loads(raw) if raw is not None else new_profile(tax_id)
+                    update_profile(profile, invoice_data, issues, reported)
+                    pipe.multi()
+                    pipe.set(key, json.dumps(profile, ensure_ascii=False))
+                    pipe.execute()
+                    self._remember(tax_id, profile)
+                    return profile
+                except Exception as e:
+                    if type(e).__name__ != 'WatchError':
+                        raise
+        raise RuntimeError(f'Profile {tax_id} kept changing')
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats, vendors=len(self._profiles))
+        stats['backend'] = self.backend
+        stats['base_version'] = BASE_VERSION
+        stats['letterheads'] = self.letterheads.stats()['size']
+        return stats
+
+
+def create_profile_store() -> ProfileStore:
+    """Create the profile store according to ``PROMPT_PROFILE_BACKEND``.
+
+    ``auto`` uses Redis when ``REDIS_URL`` is set, otherwise
+    each worker learns on its own.
+    """
+    backend = resolve_backend(PROFILE_BACKEND)
+    if backend not in ('redis', 'memory', 'off'):
+        logger.warning(f"Unknown PROMPT_PROFILE_BACKEND '{backend}', using memory")
+        backend = 'memory'
+    logger.info(f"Prompt profiles: {backend} (base prompt {BASE_VERSION})")
+    return ProfileStore(backend=backend)
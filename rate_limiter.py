@@ -0,0 +1,527 @@
+"""
+Cluster-wide rate limiting for Gemini calls.
+
+Every gunicorn worker on every instance calls Gemini independently, so a
+burst of uploads turns into provider throttling and cascading errors. The
+limiter enforces two budgets shared by all workers:
+
+* a token bucket of ``GEMINI_RPM`` requests per minute (``GEMINI_BURST`` deep);
+* at most ``GEMINI_MAX_CONCURRENT`` calls in flight, held as expiring leases
+  so a crashed worker cannot leak slots.
+
+Calls run in one of two lanes. ``interactive`` (a user waiting on
+``/upload``) always goes first: ``bulk`` work (batches, background jobs) may
+only use ``RATE_LIMIT_BULK_SHARE`` of either budget and steps aside while any
+interactive caller in the cluster is waiting.
+
+State lives in Redis (updated atomically by Lua scripts, using the Redis
+clock) when available, otherwise in this process. While Redis is
+unreachable each process enforces its share of the budgets, 1/
+``RATE_LIMIT_PROCESSES`` of them, so together they stay within the limits. A caller whose estimated
+wait exceeds its budget is rejected at once with a ``retry_after`` hint
+instead of queueing until it times out.
+"""
+
+import os
+import asyncio
+import logging
+import math
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+from redis_client import get_redis, resolve_backend
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'auto')  # auto, redis, memory or off
+GEMINI_RPM = float(os.getenv('GEMINI_RPM', 120))  # 0 disables the rate budget
+GEMINI_BURST = int(os.getenv('GEMINI_BURST', 10))
+GEMINI_MAX_CONCURRENT = int(os.getenv('GEMINI_MAX_CONCURRENT', 24))  # 0 disables
+RATE_LIMIT_BULK_SHARE = float(os.getenv('RATE_LIMIT_BULK_SHARE', 0.7))
+# Leases expire on their own after this long (longer than any model call)
+RATE_LIMIT_LEASE_TTL = float(os.getenv('RATE_LIMIT_LEASE_TTL', 60))
+# Processes sharing the budgets (gunicorn workers on every instance), which
+# split them while Redis is unreachable
+RATE_LIMIT_PROCESSES = max(1, int(os.getenv('RATE_LIMIT_PROCESSES',
+                                            os.getenv('WEB_CONCURRENCY', 1))))
+RATE_LIMIT_KEY_PREFIX = 'invoice:ratelimit:'
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+LANES = (INTERACTIVE, BULK)
+
+# Poll interval while the concurrency budget is exhausted (no ETA available)
+_SLOT_POLL = 0.05
+_MAX_POLL = 0.5
+# How long an interactive waiter stays visible to bulk callers without refresh
+_WAITER_TTL = 2.0
+# Minimum seconds between "falling back to the local budget" warnings
+_FALLBACK_WARNING_INTERVAL = 30
+
+# KEYS: bucket, leases, interactive waiters
+# ARGV: rate per second, burst, max concurrent, lease id, lease ttl, lane, bulk share
+_ACQUIRE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_concurrent = tonumber(ARGV[3])
+local bulk = ARGV[6] == 'bulk'
+local share = tonumber(ARGV[7])
+
+if bulk then
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+    if redis.call('ZCARD', KEYS[3]) > 0 then
+        return {0, '-1'}
+    end
+end
+
+if max_concurrent > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+    local limit = max_concurrent
+    if bulk then
+        limit = math.max(1, math.floor(max_concurrent * share))
+    end
+    if redis.call('ZCARD', KEYS[2]) >= limit then
+        return {0, '-1'}
+    end
+end
+
+if rate > 0 then
+    local tokens = burst
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    if state[1] then
+        tokens = math.min(burst, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+    end
+    local reserve = 0
+    if bulk then
+        reserve = math.min(burst * (1 - share), burst - 1)
+    end
+    if tokens - 1 < reserve then
+        return {0, tostring((reserve + 1 - tokens) / rate)}
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+end
+
+if max_concurrent > 0 then
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[5]), ARGV[4])
+    redis.call('EXPIRE', KEYS[2], math.ceil(tonumber(ARGV[5])) + 60)
+end
+return {1, '0'}
+"""
+
+# KEYS: interactive waiters; ARGV: waiter id, ttl
+_WAITING_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2])) + 60)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+return redis.call('ZCARD', KEYS[1])
+"""
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call would wait longer than its budget for capacity."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Lease:
+    """Permission for one model call; release it when the call finishes."""
+
+    def __init__(self, budget, lease_id: str, lane: str, waited: float):
+        self.budget = budget
+        self.id = lease_id
+        self.lane = lane
+        self.waited = waited
+        self._released = budget is None
+
+    def release(self) -> None:
+        """Give the concurrency slot back to the budget that granted it."""
+        if self._released:
+            return
+        self._released = True
+        try:
+            self.budget.release(self.id)
+        except Exception as e:
+            # The lease expires on its own after RATE_LIMIT_LEASE_TTL
+            logger.warning(f"Could not release rate limit lease: {str(e)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class LocalBudget:
+    """In-process token bucket and concurrency budget (single node)."""
+
+    name = 'memory'
+
+    def __init__(self, rpm: float, burst: int, max_concurrent: int, bulk_share: float):
+        self.rate = rpm / 60.0
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.bulk_share = bulk_share
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._in_flight = set()
+        self._interactive_waiters = set()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, lease_id: str, lane: str) -> Tuple[bool, float]:
+        """Take a token and a slot if the lane may; else ``(False, eta or -1)``."""
+        bulk = lane == BULK
+        with self._lock:
+            if bulk and self._interactive_waiters:
+                return False, -1
+            if self.max_concurrent > 0:
+                limit = self.max_concurrent
+                if bulk:
+                    limit = max(1, math.floor(self.max_concurrent * self.bulk_share))
+                if len(self._in_flight) >= limit:
+                    return False, -1
+            if self.rate > 0:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                reserve = min(self.burst * (1 - self.bulk_share), self.burst - 1) if bulk else 0
+                if self._tokens - 1 < reserve:
+                    return False, (reserve + 1 - self._tokens) / self.rate
+                self._tokens -= 1
+            if self.max_concurrent > 0:
+                self._in_flight.add(lease_id)
+            return True, 0.0
+
+    def release(self, lease_id: str) -> None:
+        with self._lock:
+            self._in_flight.discard(lease_id)
+
+    def waiting(self, waiter_id: str, active: bool) -> None:
+        """Mark an interactive caller as waiting (or done waiting)."""
+        with self._lock:
+            if active:
+                self._interactive_waiters.add(waiter_id)
+            else:
+                self._interactive_waiters.discard(waiter_id)
+
+    def state(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'in_flight': len(self._in_flight),
+                'tokens': round(self._tokens, 2) if self.rate > 0 else None,
+                'interactive_waiting': len(self._interactive_waiters)
+            }
+
+
+class RedisBudget:
+    """Token bucket and concurrency budget shared through Redis."""
+
+    name = 'redis'
+
+    def __init__(self, rpm: float, burst: int, max_concurrent: int, bulk_share: float,
+                 lease_ttl: float = RATE_LIMIT_LEASE_TTL, prefix: str = RATE_LIMIT_KEY_PREFIX):
+        self.rate = rpm / 60.0
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.bulk_share = bulk_share
+        self.lease_ttl = lease_ttl
+        self.keys = [prefix + 'bucket', prefix + 'leases', prefix + 'waiting']
+        self._scripts = None
+
+    def _client(self):
+        client = get_redis()
+        if client is None:
+            raise RuntimeError('Rate limiter unavailable: cannot reach Redis')
+        if self._scripts is None:
+            self._scripts = (client.register_script(_ACQUIRE_SCRIPT),
+                             client.register_script(_WAITING_SCRIPT))
+        return client
+
+    def try_acquire(self, lease_id: str, lane: str) -> Tuple[bool, float]:
+        client = self._client()
+        acquired, eta = self._scripts[0](keys=self.keys, args=[
+            self.rate, self.burst, self.max_concurrent, lease_id, self.lease_ttl, lane,
+            self.bulk_share
+        ], client=client)
+        return bool(int(acquired)), float(eta)
+
+    def release(self, lease_id: str) -> None:
+        self._client().zrem(self.keys[1], lease_id)
+
+    def waiting(self, waiter_id: str, active: bool) -> None:
+        client = self._client()
+        if active:
+            self._scripts[1](keys=[self.keys[2]], args=[waiter_id, _WAITER_TTL], client=client)
+        else:
+            client.zrem(self.keys[2], waiter_id)
+
+    def state(self) -> Dict[str, Any]:
+        client = self._client()
+        now = client.time()
+        now = now[0] + now[1] / 1e6
+        tokens = None
+        if self.rate > 0:
+            raw_tokens, raw_ts = client.hmget(self.keys[0], 'tokens', 'ts')
+            tokens = self.burst
+            if raw_tokens is not None:
+                tokens = min(self.burst,
+                             float(raw_tokens) + (now - float(raw_ts)) * self.rate)
+            tokens = round(tokens, 2)
+        return {
+            'in_flight': client.zcount(self.keys[1], now, '+inf'),
+            'tokens': tokens,
+            'interactive_waiting': client.zcount(self.keys[2], now, '+inf')
+        }
+
+
+class RateLimiter:
+    """Admits model calls against the shared budgets, by lane priority.
+
+    Example:
+        lease = limiter.acquire(INTERACTIVE, max_wait=20)
+        try:
+            call_model()
+        finally:
+            lease.release()
+    """
+
+    def __init__(self, budget=None, fallback: Optional[LocalBudget] = None):
+        self.budget = budget
+        # Used whenever Redis cannot be reached
+        self.fallback = fallback
+        self._last_fallback_warning = 0.0
+        self._lock = threading.Lock()
+        self._stats = {lane: {'acquired': 0, 'rejected': 0, 'waited': 0,
+                              'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+                              'fallbacks': 0}
+                       for lane in LANES}
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget is not None
+
+    def _count(self, lane: str, **changes) -> None:
+        with self._lock:
+            stats = self._stats[lane]
+            for key, amount in changes.items():
+                if key == 'max_wait_seconds':
+                    stats[key] = max(stats[key], amount)
+                else:
+                    stats[key] += amount
+
+    def _call(self, method: str, *args) -> Tuple[Any, Any]:
+        """Run a budget operation, falling back to the local budget on errors."""
+        try:
+            return getattr(self.budget, method)(*args), self.budget
+        except Exception as e:
+            if self.fallback is None or self.budget is self.fallback:
+                raise
+            if time.monotonic() - self._last_fallback_warning > _FALLBACK_WARNING_INTERVAL:
+                self._last_fallback_warning = time.monotonic()
+                logger.warning(f"Rate limiter {method} failed, using local budget: {str(e)}")
+            return getattr(self.fallback, method)(*args), self.fallback
+
+    def _poll(self, attempt: Dict[str, Any]) -> Optional[float]:
+        """One acquisition attempt.
+
+        Returns:
+            float or None: Seconds to sleep before the next attempt, or None
+            once the lease is held (``attempt['lease']``)
+
+        Raises:
+            RateLimitExceeded: If capacity cannot be had within the budget
+        """
+        lane = attempt['lane']
+        (acquired, eta), budget = self._call('try_acquire', attempt['id'], lane)
+        if budget is not self.budget:
+            attempt['fallback'] = True
+        now = time.monotonic()
+        waited = now - attempt['start']
+
+        if acquired:
+            attempt['lease'] = Lease(budget, attempt['id'], lane, waited)
+            return None
+
+        remaining = attempt['deadline'] - now
+        # Reject early when the known wait already exceeds what is left
+        if eta > remaining or remaining <= 0:
+            retry_after = max(eta, _SLOT_POLL * 10)
+            detail = f'next token in {eta:.2f}s' if eta > 0 else 'all call slots busy'
+            raise RateLimitExceeded(
+                f'Gemini capacity unavailable for {lane} call '
+                f'(waited {waited:.2f}s, {detail})',
+                retry_after=round(retry_after, 2)
+            )
+
+        if lane == INTERACTIVE:
+            # Keep bulk callers cluster-wide out of the way while we wait
+            self._call('waiting', attempt['id'], True)
+            attempt['registered'] = True
+
+        delay = eta if eta > 0 else _SLOT_POLL
+        return min(delay, _MAX_POLL, max(remaining, 0.001))
+
+    def _start(self, lane: str, max_wait: float) -> Dict[str, Any]:
+        if lane not in LANES:
+            raise ValueError(f"Unknown rate limit lane '{lane}'")
+        start = time.monotonic()
+        return {'id': uuid.uuid4().hex, 'lane': lane, 'start': start,
+                'deadline': start + max_wait, 'lease': None, 'registered': False,
+                'fallback': False}
+
+    def _finish(self, attempt: Dict[str, Any], error: Optional[BaseException]) -> None:
+        if attempt['registered']:
+            try:
+                self._call('waiting', attempt['id'], False)
+            except Exception as e:
+                logger.warning(f"Could not clear rate limit waiter: {str(e)}")
+
+        lane = attempt['lane']
+        fallbacks = 1 if attempt['fallback'] else 0
+        if attempt['lease'] is None:
+            if isinstance(error, RateLimitExceeded):
+                self._count(lane, rejected=1, fallbacks=fallbacks)
+            return
+        waited = attempt['lease'].waited
+        self._count(lane, acquired=1, waited=1 if waited > 0.001 else 0,
+                    wait_seconds=waited, max_wait_seconds=waited, fallbacks=fallbacks)
+
+    def acquire(self, lane: str = INTERACTIVE, max_wait: float = 30) -> Lease:
+        """Block until the call may start.
+
+        Args:
+            lane: ``interactive`` or ``bulk``
+            max_wait: Longest acceptable queueing time in seconds
+
+        Returns:
+            Lease: Held capacity; ``waited`` is the queueing time
+
+        Raises:
+            RateLimitExceeded: If the wait would exceed ``max_wait``
+        """
+        if not self.enabled:
+            return Lease(None, '', lane, 0.0)
+        attempt = self._start(lane, max_wait)
+        error = None
+        try:
+            while True:
+                delay = self._poll(attempt)
+                if delay is None:
+                    return attempt['lease']
+                time.sleep(delay)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._finish(attempt, error)
+
+    async def acquire_async(self, lane: str = INTERACTIVE, max_wait: float = 30) -> Lease:
+        """Awaitable variant of ``acquire``.
+
+        Attempts on a shared budget make Redis round trips, so they run on
+        the default executor rather than block the event loop.
+        """
+        if not self.enabled:
+            return Lease(None, '', lane, 0.0)
+        attempt = self._start(lane, max_wait)
+        blocking = not isinstance(self.budget, LocalBudget)
+        error = None
+        try:
+            while True:
+                if blocking:
+                    delay = await self._poll_in_thread(attempt)
+                else:
+                    delay = self._poll(attempt)
+                if delay is None:
+                    return attempt['lease']
+                await asyncio.sleep(delay)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if blocking:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._finish, attempt, error)
+            else:
+                self._finish(attempt, error)
+
+    async def _poll_in_thread(self, attempt: Dict[str, Any]) -> Optional[float]:
+        """``_poll`` on the default executor."""
+        future = asyncio.get_running_loop().run_in_executor(None, self._poll, attempt)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The attempt may still take a lease in its thread: give it back
+            future.add_done_callback(
+                lambda _: attempt['lease'] is not None and attempt['lease'].release())
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        """Limits, current budget state and per-lane queueing statistics."""
+        if not self.enabled:
+            return {'backend': 'off'}
+        with self._lock:
+            lanes = {lane: dict(stats) for lane, stats in self._stats.items()}
+        for stats in lanes.values():
+            stats['avg_wait_seconds'] = (
+                round(stats['wait_seconds'] / stats['acquired'], 3) if stats['acquired'] else 0.0
+            )
+            stats['wait_seconds'] = round(stats['wait_seconds'], 3)
+            stats['max_wait_seconds'] = round(stats['max_wait_seconds'], 3)
+
+        result = {
+            'backend': self.budget.name,
+            'rpm': self.budget.rate * 60,
+            'burst': self.budget.burst,
+            'max_concurrent': self.budget.max_concurrent,
+            'bulk_share': self.budget.bulk_share,
+            'lanes': lanes
+        }
+        try:
+            result['current'] = self.budget.state()
+        except Exception as e:
+            logger.warning(f"Could not read rate limiter state: {str(e)}")
+        return result
+
+
+def create_rate_limiter() -> RateLimiter:
+    """Create the limiter according to ``RATE_LIMIT_BACKEND``."""
+    backend = RATE_LIMIT_BACKEND.lower()
+    if backend == 'off' or (GEMINI_RPM <= 0 and GEMINI_MAX_CONCURRENT <= 0):
+        logger.info("Gemini rate limiting disabled")
+        return RateLimiter()
+
+    if resolve_backend(backend) != 'redis':
+        budget = LocalBudget(GEMINI_RPM, GEMINI_BURST, GEMINI_MAX_CONCURRENT,
+                             RATE_LIMIT_BULK_SHARE)
+        logger.info(f"Gemini rate limiter backend: memory ({GEMINI_RPM:g} rpm, "
+                    f"{GEMINI_MAX_CONCURRENT} concurrent)")
+        return RateLimiter(budget, fallback=budget)
+
+    budget = RedisBudget(GEMINI_RPM, GEMINI_BURST, GEMINI_MAX_CONCURRENT, RATE_LIMIT_BULK_SHARE)
+    fallback = local_share(RATE_LIMIT_PROCESSES)
+    logger.info(f"Gemini rate limiter backend: redis ({GEMINI_RPM:g} rpm, "
+                f"{GEMINI_MAX_CONCURRENT} concurrent; {fallback.rate * 60:g} rpm and "
+                f"{fallback.max_concurrent} concurrent per process without Redis)")
+    return RateLimiter(budget, fallback=fallback)
+
+
+def local_share(processes: int) -> LocalBudget:
+    """This process's share of the cluster budgets, enforced while Redis is down.
+
+    Each of ``processes`` gets an equal part, at least one call at a time
+    and one token of burst (unless that budget is disabled).
+    """
+    return LocalBudget(GEMINI_RPM / processes,
+                       max(1, math.ceil(GEMINI_BURST / processes)),
+                       max(1, GEMINI_MAX_CONCURRENT // processes) if GEMINI_MAX_CONCURRENT > 0
+                       else 0,
+                       RATE_LIMIT_BULK_SHARE)
@@ -0,0 +1,168 @@
+"""
+Column reconciliation: puts a line's quantity, price and total back in place.
+
+The model sometimes reads a line's numbers into the wrong columns, most often
+quantity and total (כמות and סה"כ). Replacing the total with quantity x price
+then turns the swap into a wrong invoice. ``reconcile`` instead tries every
+assignment of each line's three numbers to the three columns, for all lines
+at once with NumPy, and keeps one that makes quantity x price = total: the
+order as read when it fits, otherwise the likeliest swap, quantity and total
+first. Weighed goods (2.2 kg at 160) are as common as counted ones, so a
+whole quantity only decides between equally likely assignments.
+
+The invoice is then checked against the subtotal the model read, or the ones
+its total and VAT allow. If the line totals miss it, the one line whose other
+fitting assignment (or, for a line no assignment fits, printed total) closes
+the gap is switched. Lines no assignment fits keep quantity x price as their
+total unless the subtotal shows the printed total was right; they are
+reported either way.
+"""
+
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+# Assignments of a line's (quantity, price, total) as read to the columns,
+# likeliest first; a row gives the position each column is taken from
+PERMUTATIONS = np.array([
+    (0, 1, 2),
+    (2, 1, 0),
+    (1, 0, 2),
+    (0, 2, 1),
+    (1, 2, 0),
+    (2, 0, 1),
+])
+PERMUTATION_NAMES = ('as read', 'quantity/total swapped', 'quantity/price swapped',
+                     'price/total swapped', 'rotated', 'rotated')
+AS_READ = 0
+UNRECONCILED = -1
+# Largest difference between quantity x price and the total of a fitting line
+LINE_TOLERANCE = 0.01
+# Largest difference between the line totals and a subtotal they match: the
+# totals of the printed lines add up to the printed subtotal to the agora
+SUBTOTAL_TOLERANCE = 0.05
+VAT_RATES = (0.17, 0.18)
+
+
+class Reconciliation(NamedTuple):
+    """Reconciled columns of an invoice's lines."""
+    quantities: np.ndarray
+    prices: np.ndarray
+    totals: np.ndarray
+    # Index into PERMUTATIONS per line, UNRECONCILED where none fits
+    assignments: np.ndarray
+    # Unreconciled lines whose printed total was kept because the subtotal confirms it
+    printed: np.ndarray
+    # Whether the line totals add up to a reported subtotal, None without one
+    matches_subtotal: Optional[bool]
+
+    def changed(self) -> np.ndarray:
+        """Indices of the lines read into the wrong columns."""
+        return np.flatnonzero(self.assignments > AS_READ)
+
+    def unreconciled(self) -> np.ndarray:
+        """Indices of the lines no assignment fits."""
+        return np.flatnonzero(self.assignments == UNRECONCILED)
+
+
+def matches(subtotal: float, subtotals: Sequence[float]) -> bool:
+    """Whether a sum of line totals matches one of ``subtotals``."""
+    return any(abs(candidate - subtotal) <= SUBTOTAL_TOLERANCE for candidate in subtotals)
+
+
+def reported_subtotals(reported: Dict[str, float],
+                       vat_rates: Sequence[float] = VAT_RATES) -> List[float]:
+    """Subtotals the totals the model read allow, the most direct first.
+
+    These are the printed subtotal, the total less the tax, and without
+    either the total with VAT at each rate taken off, or as it is (prices
+    including VAT, or no VAT charged).
+    """
+    subtotal, tax, total = (reported.get(field) or 0 for field in ('subtotal', 'tax', 'total'))
+    candidates = [subtotal] if subtotal else []
+    if total and tax:
+        candidates.append(round(total - tax, 2))
+    elif total and not subtotal:
+        candidates.extend(round(total / (1 + rate), 2) for rate in vat_rates)
+    if total:
+        candidates.append(total)
+    return list(dict.fromkeys(candidates))
+
+
+def reconcile(quantities: Sequence[float], prices: Sequence[float], totals: Sequence[float],
+              subtotals: Sequence[float] = ()) -> Reconciliation:
+    """Assign every line's numbers to the columns they fit.
+
+    Args:
+        quantities: Quantity of each line, as read
+        prices: Price of each line, as read
+        totals: Total of each line, as read
+        subtotals: Subtotals the invoice may have (see ``reported_subtotals``),
+            likeliest first; empty to reconcile lines on their own
+
+    Returns:
+        Reconciliation: The columns as assigned; lines no assignment fits
+        get quantity x price as their total unless the subtotal says otherwise
+    """
+    read = np.array([quantities, prices, totals], dtype=np.float64).reshape(3, -1)
+    count = read.shape[1]
+    # (assignment, column, line)
+    candidates = read[PERMUTATIONS]
+    products = np.round(candidates[:, 0] * candidates[:, 1], 2)
+    fits = np.abs(products - candidates[:, 2]) <= LINE_TOLERANCE + 1e-9
+
+    # The order as read whenever it fits, then the likelier assignment; a
+    # whole quantity only breaks ties
+    fractional = candidates[:, 0] != np.round(candidates[:, 0])
+    rank = 2 * np.arange(len(PERMUTATIONS))[:, None] + fractional
+    rank[AS_READ] = -1
+    assignments = np.where(fits, rank, np.iinfo(rank.dtype).max).argmin(axis=0)
+    reconciled = fits.any(axis=0)
+    lines = np.arange(count)
+    columns = candidates[assignments, :, lines].T.copy()
+    columns[:, ~reconciled] = read[:, ~reconciled]
+    columns[2, ~reconciled] = products[AS_READ, ~reconciled]
+    assignments[~reconciled] = UNRECONCILED
+    printed = np.zeros(count, dtype=bool)
+
+    if not len(subtotals) or not count:
+        return Reconciliation(*columns, assignments, printed, None)
+    targets = np.asarray(subtotals, dtype=np.float64)
+    gaps = targets - columns[2].sum()
+    if (np.abs(gaps) <= SUBTOTAL_TOLERANCE).any():
+        return Reconciliation(*columns, assignments, printed, True)
+
+    # Totals each line could switch to: its other fitting assignments, and
+    # the printed total of a line no assignment fits
+    alternatives = np.where(fits, candidates[:, 2], np.nan)
+    alternatives[AS_READ, ~reconciled] = read[2, ~reconciled]
+    deltas = alternatives - columns[2]
+    # (subtotal, assignment, line)
+    closes = ((np.abs(deltas[None] - gaps[:, None, None]) <= SUBTOTAL_TOLERANCE)
+              & (deltas[None] != 0))
+    for target_closes in closes:
+        _, switchable = np.nonzero(target_closes)
+        if not len(switchable):
+            continue
+        if (switchable != switchable[0]).any():
+            # Several lines could explain the gap: none is switched
+            break
+        line = switchable[0]
+        assignment = int(np.argmax(target_closes[:, line]))
+        if reconciled[line]:
+            columns[:, line] = candidates[assignment, :, line]
+            assignments[line] = assignment
+        else:
+            columns[2, line] = read[2, line]
+            printed[line] = True
+        return Reconciliation(*columns, assignments, printed, True)
+
+    unreconciled = ~reconciled
+    if unreconciled.sum() > 1:
+        # Every unreconciled line's printed total together
+        delta = (read[2, unreconciled] - columns[2, unreconciled]).sum()
+        if (np.abs(delta - gaps) <= SUBTOTAL_TOLERANCE).any():
+            columns[2, unreconciled] = read[2, unreconciled]
+            printed[unreconciled] = True
+            return Reconciliation(*columns, assignments, printed, True)
+    return Reconciliation(*columns, assignments, printed, False)
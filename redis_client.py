@@ -0,0 +1,152 @@
+"""
+Shared Redis connection helper.
+
+Redis is optional: every feature that uses it falls back to an in-process
+implementation when ``REDIS_URL`` is unset or the server cannot be reached.
+
+``BufferedCounters`` adds up cluster-wide statistics without a round trip
+per increment: request paths only update a dict, and a background thread
+adds the pending amounts to Redis every ``REDIS_STATS_FLUSH_INTERVAL``
+seconds.
+"""
+
+import os
+import logging
+import threading
+import time
+from typing import Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv('REDIS_URL')
+REDIS_RETRY_INTERVAL = float(os.getenv('REDIS_RETRY_INTERVAL', 30))
+REDIS_STATS_FLUSH_INTERVAL = float(os.getenv('REDIS_STATS_FLUSH_INTERVAL', 5))
+
+_client = None
+_last_failure = 0.0
+_lock = threading.Lock()
+
+
+def get_redis() -> Optional['redis.Redis']:
+    """Return the shared Redis client, or None if Redis is not available.
+
+    The client is created lazily and verified with a PING. After a failed
+    connection attempt, retries are throttled to once per
+    ``REDIS_RETRY_INTERVAL`` seconds so request paths never block on a dead
+    server.
+
+    Returns:
+        redis.Redis or None: A connected client, or None when Redis is
+        unconfigured, not installed, or unreachable.
+    """
+    global _client, _last_failure
+    if not REDIS_URL:
+        return None
+    if _client is not None:
+        return _client
+
+    with _lock:
+        if _client is not None:
+            return _client
+        if time.time() - _last_failure < REDIS_RETRY_INTERVAL:
+            return None
+        try:
+            import redis
+            client = redis.Redis.from_url(
+                REDIS_URL,
+                socket_connect_timeout=2,
+                socket_timeout=5,
+                health_check_interval=30
+            )
+            client.ping()
+            _client = client
+            logger.info("Connected to Redis")
+        except Exception as e:
+            _last_failure = time.time()
+            logger.warning(f"Redis unavailable, using in-process fallback: {str(e)}")
+            return None
+    return _client
+
+
+def resolve_backend(backend: str) -> str:
+    """The backend an ``auto`` setting stands for, decided without connecting.
+
+    ``auto`` is ``redis`` whenever ``REDIS_URL`` is set, else ``memory``.
+    The backend factories run at import, in the master when gunicorn
+    preloads the app: they must neither wait for an unreachable server nor
+    open a connection every forked worker would inherit. A server that is
+    down is handled per call by each feature's in-process fallback.
+    """
+    backend = backend.lower()
+    if backend == 'auto':
+        return 'redis' if REDIS_URL else 'memory'
+    return backend
+
+
+def reset_redis() -> None:
+    """Drop the shared client so the next call reconnects (e.g. after fork)."""
+    global _client, _last_failure
+    with _lock:
+        _client = None
+        _last_failure = 0.0
+
+
+class BufferedCounters:
+    """Increments of one Redis hash, buffered and flushed from a background thread.
+
+    ``add`` never touches the network, so it is safe on the event loop. The
+    flush thread is started on first use in each process (again after
+    ``fork()``). Amounts that fail to flush are kept for the next attempt.
+    """
+
+    def __init__(self, key: str, interval: float = REDIS_STATS_FLUSH_INTERVAL):
+        self.key = key
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    def add(self, field: str, amount: Union[int, float]) -> None:
+        if not REDIS_URL or not amount:
+            return
+        with self._lock:
+            self._pending[field] = self._pending.get(field, 0) + amount
+            if self._flusher_pid == os.getpid():
+                return
+            # Also after fork(): the parent's thread does not exist here
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name='stats-flush', daemon=True).start()
+
+    def _flush_loop(self) -> None:
+        pid = os.getpid()
+        while self._flusher_pid == pid:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self) -> None:
+        """Add the pending amounts to the hash now."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        client = get_redis()
+        try:
+            if client is None:
+                raise RuntimeError('Redis unavailable')
+            pipe = client.pipeline(transaction=False)
+            for field, amount in pending.items():
+                if isinstance(amount, float):
+                    pipe.hincrbyfloat(self.key, field, amount)
+                else:
+                    pipe.hincrby(self.key, field, amount)
+            pipe.execute()
+        except Exception as e:
+            with self._lock:
+                for field, amount in pending.items():
+                    self._pending[field] = self._pending.get(field, 0) + amount
+            logger.debug(f"Could not flush {self.key}: {str(e)}")
+
+    def read(self, client) -> Dict[bytes, bytes]:
+        """The cluster totals, this worker's pending amounts included."""
+        self.flush()
+        return client.hgetall(self.key)
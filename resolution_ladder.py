@@ -0,0 +1,131 @@
+"""
+Resolution ladder for invoice images.
+
+Most invoices extract correctly from a small, heavily compressed image; dense
+ones need more pixels. Rather than sending every upload at one size, the
+extraction starts at the cheapest rung of the ladder and only retries at the
+next rung when the result fails the arithmetic checks (quantity x price vs
+total, reported vs computed subtotal) or has no line items.
+
+Every attempt is counted per rung, locally and (when Redis is reachable) for
+the whole cluster, so the ladder can be tuned from real success rates.
+"""
+
+import logging
+import threading
+from typing import Any, Dict, List, NamedTuple
+
+from redis_client import BufferedCounters, get_redis
+
+logger = logging.getLogger(__name__)
+
+LADDER_STATS_KEY = 'invoice:ladder:stats'
+
+# Outcomes of one attempt at a rung
+ACCEPTED = 'accepted'
+REJECTED = 'rejected'
+TIMEOUT = 'timeout'
+ERROR = 'error'
+OUTCOMES = (ACCEPTED, REJECTED, TIMEOUT, ERROR)
+
+
+class Rung(NamedTuple):
+    """One step of the ladder: longest image side and JPEG quality."""
+
+    max_dimension: int
+    quality: int
+
+    @property
+    def name(self) -> str:
+        return f'{self.max_dimension}px@q{self.quality}'
+
+
+def parse_ladder(spec: str) -> List[Rung]:
+    """Parse a ladder such as ``'400:60,600:70,1000:80'``.
+
+    Raises:
+        ValueError: If a rung is malformed or out of range
+    """
+    rungs = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            dimension, quality = (int(value) for value in part.split(':'))
+        except ValueError:
+            raise ValueError(f"Invalid ladder rung '{part}', expected <max_dimension>:<quality>")
+        if dimension < 64 or not 1 <= quality <= 95:
+            raise ValueError(f"Ladder rung '{part}' is out of range")
+        rungs.append(Rung(dimension, quality))
+    if not rungs:
+        raise ValueError('Resolution ladder is empty')
+    return rungs
+
+
+class LadderStats:
+    """Per-rung attempt counters for this worker and the cluster."""
+
+    def __init__(self, rungs: List[Rung]):
+        self.rungs = rungs
+        self._lock = threading.Lock()
+        self._stats = {rung.name: self._empty() for rung in rungs}
+        self._shared = BufferedCounters(LADDER_STATS_KEY)
+
+    @staticmethod
+    def _empty() -> Dict[str, float]:
+        counters = dict.fromkeys(('attempts',) + OUTCOMES, 0)
+        counters.update(payload_bytes=0, seconds=0.0)
+        return counters
+
+    def record(self, rung: Rung, outcome: str, payload_bytes: int, seconds: float) -> None:
+        """Count one model call made at ``rung``."""
+        changes = {'attempts': 1, outcome: 1, 'payload_bytes': payload_bytes}
+        with self._lock:
+            counters = self._stats.setdefault(rung.name, self._empty())
+            for key, amount in changes.items():
+                counters[key] += amount
+            counters['seconds'] += seconds
+        # Buffered: attempts are recorded on the event loop
+        for key, amount in changes.items():
+            self._shared.add(f'{rung.name}:{key}', amount)
+        self._shared.add(f'{rung.name}:seconds', float(seconds))
+
+    @staticmethod
+    def _summary(name: str, counters: Dict[str, float]) -> Dict[str, Any]:
+        attempts = counters.get('attempts', 0)
+        summary = {'rung': name, **{k: v for k, v in counters.items()
+                                    if k not in ('payload_bytes', 'seconds')}}
+        summary['success_rate'] = (
+            round(counters.get(ACCEPTED, 0) / attempts, 4) if attempts else None
+        )
+        summary['avg_payload_kb'] = (
+            round(counters.get('payload_bytes', 0) / attempts / 1024, 1) if attempts else None
+        )
+        summary['avg_seconds'] = (
+            round(counters.get('seconds', 0) / attempts, 3) if attempts else None
+        )
+        return summary
+
+    def stats(self) -> Dict[str, Any]:
+        """Success rate, payload size and latency per rung."""
+        with self._lock:
+            worker = {name: dict(counters) for name, counters in self._stats.items()}
+        result = {
+            'ladder': [rung.name for rung in self.rungs],
+            'worker': [self._summary(name, counters) for name, counters in worker.items()]
+        }
+
+        client = get_redis()
+        if client is not None:
+            try:
+                cluster = {}
+                for field, value in self._shared.read(client).items():
+                    name, key = field.decode().rsplit(':', 1)
+                    number = float(value) if key == 'seconds' else int(value)
+                    cluster.setdefault(name, {})[key] = number
+                result['cluster'] = [self._summary(name, counters)
+                                     for name, counters in cluster.items()]
+            except Exception as e:
+                logger.warning(f"Could not read cluster ladder stats: {str(e)}")
+        return result
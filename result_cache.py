@@ -0,0 +1,200 @@
+"""
+Content-addressed cache for invoice extraction results.
+
+Results are keyed by a hash of the normalized image bytes sent to Gemini plus
+the prompt and model version, so a re-uploaded invoice is answered without a
+model call. A bounded in-process LRU tier sits in front of an optional shared
+Redis tier; without Redis the cache runs purely in memory.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Union
+
+from redis_client import BufferedCounters, get_redis, resolve_backend
+
+logger = logging.getLogger(__name__)
+
+# Bump when the shape of cached results changes
+RESULT_SCHEMA_VERSION = 1
+
+CACHE_BACKEND = os.getenv('RESULT_CACHE_BACKEND', 'auto')  # auto, redis, memory, off
+CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 7 * 24 * 3600))
+CACHE_LOCAL_SIZE = int(os.getenv('RESULT_CACHE_LOCAL_SIZE', 256))
+CACHE_LOCAL_TTL = int(os.getenv('RESULT_CACHE_LOCAL_TTL', 600))
+CACHE_PREFIX = 'invoice:result:'
+STATS_KEY = 'invoice:result:stats'
+
+
+def make_cache_key(image_data: Union[bytes, str], prompt_version: str, model_name: str) -> str:
+    """Build a content-addressed cache key.
+
+    Args:
+        image_data: Normalized image payload (raw bytes or base64 text)
+        prompt_version: Version identifier of the prompt in use
+        model_name: Name of the model producing the result
+
+    Returns:
+        str: Hex digest identifying this image/prompt/model combination
+    """
+    if isinstance(image_data, str):
+        image_data = image_data.encode('ascii')
+    digest = hashlib.sha256(image_data)
+    digest.update(f'|{prompt_version}|{model_name}|{RESULT_SCHEMA_VERSION}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """Thread-safe bounded LRU cache with per-entry TTL."""
+
+    def __init__(self, max_entries: int = 256, ttl: float = 600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value, or None if missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """Store a value, evicting the least recently used entry when full."""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        """Remove a key if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class ResultCache:
+    """Two-tier extraction result cache (local LRU in front of Redis)."""
+
+    def __init__(self, backend: str = 'memory', ttl: int = CACHE_TTL,
+                 local_size: int = CACHE_LOCAL_SIZE, local_ttl: int = CACHE_LOCAL_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.local = LRUCache(local_size, min(local_ttl, ttl)) if backend != 'off' else None
+        self._stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0, 'sets': 0, 'errors': 0}
+        self._stats_lock = threading.Lock()
+        self._shared = BufferedCounters(STATS_KEY)
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend != 'off'
+
+    def _redis(self):
+        return get_redis() if self.backend == 'redis' else None
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self._stats[name] += 1
+        # Buffered: a round trip per lookup would double the cost of a hit
+        if self.backend == 'redis':
+            self._shared.add(name, 1)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Look up a cached result.
+
+        Args:
+            key: Key produced by ``make_cache_key``
+
+        Returns:
+            dict or None: The cached invoice data, or None on a miss
+        """
+        if not self.enabled:
+            return None
+
+        value = self.local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return value
+
+        client = self._redis()
+        if client is not None:
+            try:
+                raw = client.get(CACHE_PREFIX + key)
+                if raw is not None:
+                    value = json.loads(raw)
+                    self.local.set(key, value)
+                    self._count('redis_hits')
+                    return value
+            except Exception as e:
+                self._count('errors')
+                logger.warning(f"Result cache read failed: {str(e)}")
+
+        self._count('misses')
+        return None
+
+    def set(self, key: str, value: Dict) -> None:
+        """Store an extraction result in all tiers."""
+        if not self.enabled:
+            return
+
+        self.local.set(key, value)
+        client = self._redis()
+        if client is not None:
+            try:
+                client.set(CACHE_PREFIX + key, json.dumps(value, ensure_ascii=False), ex=self.ttl)
+            except Exception as e:
+                self._count('errors')
+                logger.warning(f"Result cache write failed: {str(e)}")
+                return
+        self._count('sets')
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters for this worker and, with Redis, the cluster."""
+        with self._stats_lock:
+            worker = dict(self._stats)
+        lookups = worker['local_hits'] + worker['redis_hits'] + worker['misses']
+        hits = worker['local_hits'] + worker['redis_hits']
+        result = {
+            'backend': self.backend,
+            'local_entries': len(self.local) if self.local is not None else 0,
+            'worker': worker,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0
+        }
+        client = self._redis()
+        if client is not None:
+            try:
+                cluster = self._shared.read(client)
+                result['cluster'] = {k.decode(): int(v) for k, v in cluster.items()}
+            except Exception as e:
+                logger.warning(f"Could not read cluster cache stats: {str(e)}")
+        return result
+
+
+def create_result_cache() -> ResultCache:
+    """Create the result cache according to ``RESULT_CACHE_BACKEND``.
+
+    ``auto`` uses Redis when ``REDIS_URL`` is set, otherwise the
+    in-process tier only.
+    """
+    backend = resolve_backend(CACHE_BACKEND)
+    if backend not in ('redis', 'memory', 'off'):
+        logger.warning(f"Unknown RESULT_CACHE_BACKEND '{backend}', using memory")
+        backend = 'memory'
+    logger.info(f"Result cache backend: {backend}")
+    return ResultCache(backend=backend)
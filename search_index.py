@@ -0,0 +1,574 @@
+"""
+Full-text search over saved invoices: supplier names, line item
+descriptions and item codes.
+
+Every line item is a document holding its supplier's name and tax id, so a
+single query finds "this product from this supplier" without touching the
+invoice JSON. Text is normalized the same way when indexed and when
+searched (see ``normalize``): niqqud and accents are stripped, final letters
+folded (ך→כ, ם→מ, ן→נ, ף→פ, ץ→צ) and geresh and gershayim dropped, so סה״כ,
+סה"כ and סהכ are one word. Hebrew words are also indexed without their
+prefix letters (ו, ה, ב, כ, ל, מ, ש): והחלב is found by חלב, and a query for
+בחלב finds חלב.
+
+The index is fed by the invoice store's writer as batches are committed,
+so it grows with each save and never needs a full rebuild (``python -m
+search_index --rebuild`` indexes a store created before search existed).
+
+Backends (``INVOICE_SEARCH_BACKEND``):
+
+* ``sqlite`` (``auto`` with the SQLite store): an FTS5 index in the store's
+  database file; postings are delta-encoded and read through a memory map,
+  and results come newest first straight off the index;
+* ``memory`` (``auto`` with the memory store): dictionaries of postings;
+* ``off``: search returns nothing.
+"""
+
+import os
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SEARCH_BACKEND = os.getenv('INVOICE_SEARCH_BACKEND', 'auto')  # auto, sqlite, memory, off
+# Database pages read through a memory map rather than copied into the page cache
+SEARCH_MMAP_MB = int(os.getenv('INVOICE_SEARCH_MMAP_MB', 256))
+MAX_SEARCH_LIMIT = 100
+# Words kept from a query; the rest are ignored
+MAX_QUERY_TERMS = 8
+
+# Hebrew prefix letters, and how many may be stacked on a word (e.g. וכשה)
+PREFIX_LETTERS = frozenset('ובהכלמש')
+MAX_PREFIXES = 3
+# Shortest word left once prefixes are removed
+MIN_STEM = 2
+
+# Combining marks: Latin accents and Hebrew niqqud and cantillation (not
+# maqaf, paseq or sof pasuq, which separate words)
+_marks = re.compile('[\u0300-\u036f\u0591-\u05bd\u05bf\u05c1\u05c2\u05c4\u05c5\u05c7]')
+# Geresh, gershayim and the quotes typed in their place
+_quotes = re.compile('[\'"`\u05f3\u05f4\u2018\u2019\u201c\u201d]')
+_finals = str.maketrans('ךםןףץ', 'כמנפצ')
+_separators = re.compile(r'[\W_]+')
+_non_ascii = re.compile(r'[^\x00-\x7f]')
+
+SUPPLIER = 'supplier'
+ITEM = 'item'
+TAX_ID = 'tax_id'
+
+
+def normalize(text: Any) -> str:
+    """Text as indexed: unmarked, case-folded, final letters folded, quotes dropped."""
+    if not text:
+        return ''
+    text = str(text)
+    if _non_ascii.search(text):
+        text = _marks.sub('', unicodedata.normalize('NFKD', text)).translate(_finals)
+    return _quotes.sub('', text.casefold())
+
+
+def tokenize(text: Any) -> List[str]:
+    """The words of a text after ``normalize``."""
+    return [word for word in _separators.split(normalize(text)) if word]
+
+
+def tax_id_term(value: Any) -> str:
+    """A tax id as indexed and searched: its digits, so 51-320341-4 is
+    513203414 (like ``prompt_profiles.normalize_tax_id``), or its words
+    joined when it has none."""
+    digits = ''.join(ch for ch in str(value or '') if ch.isdigit())
+    return digits or ''.join(tokenize(value))
+
+
+def stems(word: str) -> List[str]:
+    """A word and the words left after removing up to ``MAX_PREFIXES`` prefix letters."""
+    forms = [word]
+    for count in range(1, MAX_PREFIXES + 1):
+        if len(word) - count < MIN_STEM or word[count - 1] not in PREFIX_LETTERS:
+            break
+        forms.append(word[count:])
+    return forms
+
+
+def index_terms(text: Any) -> List[str]:
+    """Every term a text is indexed under: its words, their stems, and words
+    joined by punctuation also as one (AB-12 is also ab12)."""
+    terms = []
+    for chunk in str(text or '').split():
+        words = tokenize(chunk)
+        for word in words:
+            terms.extend(stems(word))
+        if len(words) > 1:
+            terms.append(''.join(words))
+    return terms
+
+
+def _text(value: Any) -> str:
+    return '' if value is None else str(value).strip()
+
+
+def make_documents(record: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The documents of a stored invoice record: one per line item.
+
+    An invoice without line items still gets one document (``line`` None),
+    so it can be found by supplier.
+    """
+    invoice = record.get('invoice_data')
+    if invoice is None:
+        invoice = json.loads(record['data'])
+    company = invoice.get('company_details')
+    company = company if isinstance(company, dict) else {}
+    details = invoice.get('invoice_details')
+    details = details if isinstance(details, dict) else {}
+    shared = {
+        'invoice_id': record['id'],
+        'supplier': _text(company.get('name')),
+        'tax_id': _text(company.get('tax_id')),
+        'invoice_number': _text(details.get('invoice_number')),
+        'date': _text(details.get('date'))
+    }
+    items = [item for item in invoice.get('line_items') or [] if isinstance(item, dict)]
+    if not items:
+        return [dict(shared, line=None, item_code='', description='')]
+    return [dict(shared, line=line, item_code=_text(item.get('item_code')),
+                 description=_text(item.get('description')))
+            for line, item in enumerate(items)]
+
+
+def document_terms(document: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Terms per indexed column."""
+    return {
+        SUPPLIER: index_terms(document['supplier']),
+        ITEM: index_terms(document['description']) + index_terms(document['item_code']),
+        TAX_ID: [term for term in (tax_id_term(document['tax_id']),) if term]
+    }
+
+
+def parse_query(text: str) -> List[Tuple[List[str], bool]]:
+    """Query words as ``(alternatives, prefix)``: the word's stems, and
+    whether it ended with ``*`` to match words starting with it.
+
+    Words joined by punctuation (an item code like AB-12) are looked up as
+    one, the way ``index_terms`` also indexed them.
+    """
+    terms = []
+    for chunk in (text or '').split():
+        prefix = chunk.endswith('*')
+        words = tokenize(chunk)
+        if len(words) > 1:
+            words = [''.join(words)]
+        if words:
+            terms.append((words if prefix else stems(words[0]), prefix))
+    return terms[:MAX_QUERY_TERMS]
+
+
+def _group(rows: Iterable[Dict[str, Any]], limit: int) -> Dict[str, Any]:
+    """Matching line items grouped by invoice, newest first.
+
+    Rows come newest first and an invoice's lines are contiguous, so reading
+    stops at the first line of invoice ``limit + 1``.
+    """
+    invoices = []
+    has_more = False
+    for row in rows:
+        if not invoices or invoices[-1]['invoice_id'] != row['invoice_id']:
+            if len(invoices) == limit:
+                has_more = True
+                break
+            invoices.append({field: row[field] for field in
+                             ('invoice_id', 'supplier', 'tax_id', 'invoice_number', 'date')})
+            invoices[-1]['lines'] = []
+        if row['line'] is not None:
+            invoices[-1]['lines'].append({'index': row['line'], 'item_code': row['item_code'],
+                                          'description': row['description']})
+    for invoice in invoices:
+        invoice['lines'].sort(key=lambda line: line['index'])
+    return {'invoices': invoices, 'has_more': has_more}
+
+
+class SearchIndex:
+    """Indexing of committed store batches and grouped search results.
+
+    Subclasses implement ``_index`` (replace the documents of the given
+    invoices) and ``_search`` (matching documents, newest first).
+    """
+
+    backend = 'off'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {'indexed': 0, 'documents': 0, 'errors': 0, 'index_seconds': 0.0,
+                       'searches': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend != 'off'
+
+    def add_records(self, records: List[Dict[str, Any]]) -> None:
+        """Index invoice store records, replacing earlier versions of the same invoices.
+
+        Registered with ``InvoiceStore.add_listener``, so it runs on the
+        store's writer thread after each committed batch.
+        """
+        if not self.enabled or not records:
+            return
+        start_time = time.perf_counter()
+        # The last save of an invoice in a batch is the one committed
+        latest = {record['id']: record for record in records}
+        try:
+            documents = {invoice_id: make_documents(record)
+                         for invoice_id, record in latest.items()}
+            self._index(documents)
+            failed = False
+        except Exception as e:
+            failed = True
+            logger.error(f"Could not index {len(latest)} invoices: {str(e)}")
+        with self._lock:
+            if failed:
+                self._stats['errors'] += len(latest)
+            else:
+                self._stats['indexed'] += len(latest)
+                self._stats['documents'] += sum(len(docs) for docs in documents.values())
+            self._stats['index_seconds'] += time.perf_counter() - start_time
+
+    def search(self, query: str = '', supplier: str = '', tax_id: str = '',
+               limit: int = 20) -> Dict[str, Any]:
+        """Invoices with line items matching a query, newest first.
+
+        Args:
+            query: Words that must all appear in the line's description, item
+                code or supplier name; ``word*`` matches words starting with it
+            supplier: Words that must all appear in the supplier name
+            tax_id: Exact supplier tax id, with or without separators
+            limit: Most invoices returned (at most ``MAX_SEARCH_LIMIT``)
+
+        Returns:
+            dict: ``invoices`` (id, supplier, tax id, invoice number, date
+            and the matching ``lines``) and ``has_more``
+
+        Raises:
+            ValueError: If no searchable word is given
+        """
+        terms = parse_query(query)
+        supplier_terms = parse_query(supplier)
+        tax_id = tax_id_term(tax_id)
+        if not terms and not supplier_terms and not tax_id:
+            raise ValueError('Give a query, supplier or tax_id to search for')
+        limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+        with self._lock:
+            self._stats['searches'] += 1
+        if not self.enabled:
+            return {'invoices': [], 'has_more': False}
+        rows = self._search(terms, supplier_terms, tax_id)
+        try:
+            return _group(rows, limit)
+        finally:
+            # Reading stops early; release the database cursor now
+            if hasattr(rows, 'close'):
+                rows.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['index_seconds'] = round(stats['index_seconds'], 3)
+        stats['backend'] = self.backend
+        return stats
+
+    def _index(self, documents: Dict[str, List[Dict[str, Any]]]) -> None:
+        pass
+
+    def _search(self, terms: List[Tuple[List[str], bool]],
+                supplier_terms: List[Tuple[List[str], bool]],
+                tax_id: str) -> Iterable[Dict[str, Any]]:
+        return []
+
+
+class MemorySearchIndex(SearchIndex):
+    """Postings in process memory: a set of document numbers per column and term."""
+
+    backend = 'memory'
+
+    def __init__(self):
+        super().__init__()
+        self._documents = {}
+        self._by_invoice = {}
+        self._postings = {column: defaultdict(set) for column in (SUPPLIER, ITEM, TAX_ID)}
+        self._next = 0
+        self._data_lock = threading.Lock()
+
+    def _index(self, documents: Dict[str, List[Dict[str, Any]]]) -> None:
+        with self._data_lock:
+            for invoice_id, docs in documents.items():
+                for number in self._by_invoice.pop(invoice_id, ()):
+                    for column, terms in document_terms(self._documents.pop(number)).items():
+                        for term in terms:
+                            self._postings[column][term].discard(number)
+                numbers = []
+                for document in docs:
+                    self._next += 1
+                    self._documents[self._next] = document
+                    numbers.append(self._next)
+                    for column, terms in document_terms(document).items():
+                        for term in terms:
+                            self._postings[column][term].add(self._next)
+                self._by_invoice[invoice_id] = numbers
+
+    def _matching(self, columns: Tuple[str, ...], alternatives: List[str],
+                  prefix: bool) -> set:
+        matches = set()
+        for column in columns:
+            postings = self._postings[column]
+            if prefix:
+                for term in [term for term in postings if term.startswith(alternatives[0])]:
+                    matches |= postings[term]
+            else:
+                for term in alternatives:
+                    matches |= postings.get(term, set())
+        return matches
+
+    def _search(self, terms, supplier_terms, tax_id):
+        with self._data_lock:
+            sets = [self._matching((SUPPLIER, ITEM), alternatives, prefix)
+                    for alternatives, prefix in terms]
+            sets += [self._matching((SUPPLIER,), alternatives, prefix)
+                     for alternatives, prefix in supplier_terms]
+            if tax_id:
+                sets.append(self._matching((TAX_ID,), [tax_id], False))
+            numbers = set.intersection(*sets)
+            return [self._documents[number] for number in sorted(numbers, reverse=True)]
+
+
+_FTS_SCHEMA = (
+    # One row per invoice: the fields results show and the indexed line item text
+    '''CREATE TABLE IF NOT EXISTS search_invoices (
+        key INTEGER PRIMARY KEY,
+        invoice_id TEXT NOT NULL UNIQUE,
+        supplier TEXT,
+        tax_id TEXT,
+        invoice_number TEXT,
+        date TEXT,
+        items TEXT NOT NULL
+    )''',
+    # Contentless, positions not kept and no per-document sizes: only what
+    # term and column filters need, plus 2 and 3 letter prefixes for
+    # ``word*``. A line item's rowid is its invoice's key shifted left by
+    # LINE_BITS plus its index.
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS search_terms USING fts5(
+        supplier, item, tax_id, content='', detail=column, columnsize=0,
+        prefix='2 3', tokenize='unicode61 remove_diacritics 0'
+    )''',
+)
+_INVOICE_COLUMNS = ('invoice_id', 'supplier', 'tax_id', 'invoice_number', 'date')
+# Line items indexed per invoice: 65536
+LINE_BITS = 16
+
+
+def _fts_phrase(alternatives: List[str], prefix: bool) -> str:
+    # Terms are runs of word characters, so quoting them is always safe
+    if prefix:
+        return f'"{alternatives[0]}"*'
+    return '(' + ' OR '.join(f'"{term}"' for term in alternatives) + ')'
+
+
+def fts_query(terms: List[Tuple[List[str], bool]],
+              supplier_terms: List[Tuple[List[str], bool]], tax_id: str) -> str:
+    """The FTS5 MATCH expression for parsed query words."""
+    parts = [f'{{{SUPPLIER} {ITEM}}} : {_fts_phrase(*term)}' for term in terms]
+    parts += [f'{SUPPLIER} : {_fts_phrase(*term)}' for term in supplier_terms]
+    if tax_id:
+        parts.append(f'{TAX_ID} : "{tax_id}"')
+    return ' AND '.join(parts)
+
+
+class SQLiteSearchIndex(SearchIndex):
+    """An FTS5 index in the invoice store's SQLite database.
+
+    Stems are indexed as terms of their own, so a query word costs one
+    posting list per stem and no scan of the dictionary. Invoice fields and
+    line item text are stored once per invoice, next to the index. Like the
+    store, it uses one connection per thread; the writer thread's indexes.
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        connection = self._connect()
+        with connection:
+            for statement in _FTS_SCHEMA:
+                connection.execute(statement)
+        connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(f'PRAGMA mmap_size={SEARCH_MMAP_MB * 1024 * 1024}')
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's connection (a new one after ``fork()``)."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = self._connect()
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def _documents(row: sqlite3.Row) -> List[Dict[str, Any]]:
+        """The documents of a ``search_invoices`` row, as ``make_documents`` built them."""
+        shared = {column: row[column] for column in _INVOICE_COLUMNS}
+        items = json.loads(row['items'])
+        if not items:
+            return [dict(shared, line=None, item_code='', description='')]
+        return [dict(shared, line=line, item_code=code, description=description)
+                for line, (code, description) in enumerate(items)]
+
+    @staticmethod
+    def _fts_rows(key: int, documents: List[Dict[str, Any]]) -> List[Tuple]:
+        rows = []
+        for document in documents[:1 << LINE_BITS]:
+            terms = document_terms(document)
+            rows.append(((key << LINE_BITS) + (document['line'] or 0), ' '.join(terms[SUPPLIER]),
+                         ' '.join(terms[ITEM]), ' '.join(terms[TAX_ID])))
+        return rows
+
+    def _index(self, documents: Dict[str, List[Dict[str, Any]]]) -> None:
+        connection = self._connection()
+        with connection:
+            for invoice_id, docs in documents.items():
+                old = connection.execute('SELECT * FROM search_invoices WHERE invoice_id = ?',
+                                         (invoice_id,)).fetchone()
+                if old is not None:
+                    # A contentless index forgets a document given the terms it was indexed with
+                    connection.executemany(
+                        'INSERT INTO search_terms (search_terms, rowid, supplier, item, tax_id) '
+                        "VALUES ('delete', ?, ?, ?, ?)",
+                        self._fts_rows(old['key'], self._documents(old)))
+                    connection.execute('DELETE FROM search_invoices WHERE key = ?', (old['key'],))
+                items = [(document['item_code'], document['description']) for document in docs
+                         if document['line'] is not None]
+                # A new key, so the invoice sorts as the newest
+                key = connection.execute(
+                    'INSERT INTO search_invoices (invoice_id, supplier, tax_id, invoice_number, '
+                    'date, items) VALUES (?, ?, ?, ?, ?, ?)',
+                    (*(docs[0][column] for column in _INVOICE_COLUMNS),
+                     json.dumps(items, ensure_ascii=False, separators=(',', ':')))).lastrowid
+                connection.executemany(
+                    'INSERT INTO search_terms (rowid, supplier, item, tax_id) VALUES (?, ?, ?, ?)',
+                    self._fts_rows(key, docs))
+
+    def _search(self, terms, supplier_terms, tax_id):
+        connection = self._connection()
+        # Keys grow with every save, so rowid order is newest first
+        cursor = connection.execute(
+            'SELECT rowid FROM search_terms WHERE search_terms MATCH ? ORDER BY rowid DESC',
+            (fts_query(terms, supplier_terms, tax_id),))
+        try:
+            key, documents = None, None
+            for (rowid,) in cursor:
+                if rowid >> LINE_BITS != key:
+                    key = rowid >> LINE_BITS
+                    row = connection.execute('SELECT * FROM search_invoices WHERE key = ?',
+                                             (key,)).fetchone()
+                    documents = self._documents(row) if row is not None else None
+                if documents is not None:
+                    yield documents[rowid & ((1 << LINE_BITS) - 1)]
+        finally:
+            cursor.close()
+
+    def rebuild(self, batch_size: int = 1000) -> int:
+        """Index every invoice in the store's table; returns how many."""
+        connection = self._connect()
+        with connection:
+            connection.execute("INSERT INTO search_terms (search_terms) VALUES ('delete-all')")
+            connection.execute('DELETE FROM search_invoices')
+        count = 0
+        cursor = connection.execute('SELECT id, data FROM invoices ORDER BY updated_at')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            self.add_records([dict(row) for row in rows])
+            count += len(rows)
+        self.optimize()
+        connection.close()
+        return count
+
+    def optimize(self) -> None:
+        """Merge the index's segments into one, the most compact form."""
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT INTO search_terms (search_terms) VALUES ('optimize')")
+
+    def size_mb(self) -> float:
+        """Pages used by the index and the invoice rows it returns."""
+        try:
+            rows = self._connection().execute(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name LIKE 'search%'").fetchone()
+            return round((rows[0] or 0) / 1024 / 1024, 1)
+        except sqlite3.Error:
+            return 0.0
+
+
+def create_search_index(store) -> SearchIndex:
+    """Create the search index according to ``INVOICE_SEARCH_BACKEND`` and
+    register it with the invoice store's writer.
+
+    ``auto`` uses FTS5 in the SQLite store's database and memory with any
+    other store; it falls back to memory if SQLite lacks FTS5.
+    """
+    backend = SEARCH_BACKEND.lower()
+    if backend not in ('auto', 'sqlite', 'memory', 'off'):
+        logger.warning(f"Unknown INVOICE_SEARCH_BACKEND '{backend}', using memory")
+        backend = 'memory'
+    if not store.enabled:
+        backend = 'off'
+    elif backend == 'auto':
+        backend = 'sqlite' if store.backend == 'sqlite' else 'memory'
+    if backend == 'sqlite':
+        try:
+            index = SQLiteSearchIndex(store.path)
+            store.add_listener(index.add_records)
+            logger.info(f"Invoice search: sqlite FTS5 at {store.path}")
+            return index
+        except (AttributeError, OSError, sqlite3.Error) as e:
+            logger.warning(f"SQLite search index unavailable, using memory: {str(e)}")
+            backend = 'memory'
+    logger.info(f"Invoice search: {backend}")
+    index = MemorySearchIndex() if backend == 'memory' else SearchIndex()
+    if index.enabled:
+        store.add_listener(index.add_records)
+    return index
+
+
+if __name__ == '__main__':
+    import argparse
+    from invoice_store import STORE_PATH
+
+    parser = argparse.ArgumentParser(description='Maintain the invoice search index')
+    parser.add_argument('--path', default=STORE_PATH, help='Invoice store database')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Index every stored invoice from scratch')
+    parser.add_argument('--optimize', action='store_true', help='Merge index segments')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    search_index = SQLiteSearchIndex(args.path)
+    if args.rebuild:
+        start = time.perf_counter()
+        total = search_index.rebuild()
+        print(f'Indexed {total} invoices in {time.perf_counter() - start:.1f}s')
+    elif args.optimize:
+        search_index.optimize()
+    print(f'Index size: {search_index.size_mb()}MB')
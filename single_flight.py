@@ -0,0 +1,298 @@
+"""
+Single-flight coalescing of identical extractions.
+
+A double-clicked upload, or a frontend retry after a slow response, sends
+the same image again while the first extraction is still running. Instead
+of calling Gemini once per copy, the first request for a key becomes the
+leader and every identical request arriving meanwhile waits for its result:
+
+* within a worker, followers share the leader's future (any thread, any
+  coroutine);
+* across workers, the leader holds a short Redis lease and publishes its
+  outcome under the key; followers in other workers poll for it and take
+  over if the lease disappears without a result (e.g. the leader crashed).
+
+Failures are shared as well, so followers of a timed-out extraction time out
+together instead of retrying the same call one after another.
+"""
+
+import os
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future, TimeoutError
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from rate_limiter import RateLimitExceeded
+from redis_client import get_redis, resolve_backend
+
+logger = logging.getLogger(__name__)
+
+SINGLE_FLIGHT_BACKEND = os.getenv('SINGLE_FLIGHT_BACKEND', 'auto')  # auto, redis, memory or off
+# How long a finished outcome stays available to followers in other workers
+SINGLE_FLIGHT_RESULT_TTL = int(os.getenv('SINGLE_FLIGHT_RESULT_TTL', 30))
+FLIGHT_LEASE_PREFIX = 'invoice:flight:lease:'
+FLIGHT_RESULT_PREFIX = 'invoice:flight:result:'
+FLIGHT_STATS_KEY = 'invoice:flight:stats'
+
+# Role of a caller in a flight
+LEADER = 'leader'
+LOCAL_FOLLOWER = 'local_follower'
+REMOTE_FOLLOWER = 'remote_follower'
+
+_MAX_POLL = 0.5
+# Failures are only kept for followers polling right now, so a later retry
+# gets a fresh attempt
+_FAILURE_TTL = 5
+
+# Delete the lease only if we still own it
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """Run at most one extraction per key at a time across the cluster."""
+
+    def __init__(self, backend: str = 'memory', result_ttl: int = SINGLE_FLIGHT_RESULT_TTL):
+        self.backend = backend
+        self.result_ttl = result_ttl
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._release_script = None
+        self._stats = {
+            LEADER: 0,
+            LOCAL_FOLLOWER: 0,
+            REMOTE_FOLLOWER: 0,
+            'takeovers': 0,
+            'follower_wait_seconds': 0.0
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend != 'off'
+
+    def _redis(self):
+        return get_redis() if self.backend == 'redis' else None
+
+    def _count(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+        client = self._redis()
+        if client is not None:
+            try:
+                if isinstance(amount, float):
+                    client.hincrbyfloat(FLIGHT_STATS_KEY, name, amount)
+                else:
+                    client.hincrby(FLIGHT_STATS_KEY, name, amount)
+            except Exception:
+                pass
+
+    async def run(self, key: str, func: Callable[[], Awaitable[Dict]],
+                  timeout: float) -> Tuple[Dict, str]:
+        """Run ``func`` for ``key`` unless an identical call is in flight.
+
+        Args:
+            key: Identity of the work (image hash, prompt and model)
+            func: Coroutine function producing the result
+            timeout: Longest the work is expected to take; also bounds how
+                long followers wait and how long a lease can outlive a crash
+
+        Returns:
+            tuple: ``(result, role)``, where ``role`` is ``leader``,
+            ``local_follower`` or ``remote_follower``
+
+        Raises:
+            Whatever the leader raised (``TimeoutError``,
+            ``RateLimitExceeded`` or ``Exception``)
+        """
+        if not self.enabled:
+            return await func(), LEADER
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+
+        if not leader:
+            start_time = time.monotonic()
+            try:
+                # Shielded: a follower giving up must not cancel the flight
+                result = await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(flight)), timeout
+                )
+            except asyncio.TimeoutError:
+                raise TimeoutError(f'Timed out waiting for identical extraction after {timeout}s')
+            finally:
+                await self._off_loop(self._count, 'follower_wait_seconds',
+                                     time.monotonic() - start_time)
+            await self._off_loop(self._count, LOCAL_FOLLOWER)
+            return result, LOCAL_FOLLOWER
+
+        try:
+            result, role = await self._run_cluster(key, func, timeout)
+            flight.set_result(result)
+            return result, role
+        except asyncio.CancelledError:
+            flight.set_exception(TimeoutError('Identical extraction was cancelled'))
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+    async def _run_cluster(self, key: str, func: Callable[[], Awaitable[Dict]],
+                           timeout: float) -> Tuple[Dict, str]:
+        """Lead the flight cluster-wide, or follow a leader in another worker.
+
+        Redis round trips run on the default executor, never on the event
+        loop that every other extraction shares.
+        """
+        client = await self._off_loop(self._redis)
+        if client is None:
+            await self._off_loop(self._count, LEADER)
+            return await func(), LEADER
+
+        token = uuid.uuid4().hex
+        start_time = time.monotonic()
+        deadline = start_time + timeout
+        interval = 0.05
+        followed = False
+        while True:
+            try:
+                outcome, acquired = await self._off_loop(self._claim, client, key, token,
+                                                         timeout)
+            except Exception as e:
+                logger.warning(f"Single-flight lease unavailable, running locally: {str(e)}")
+                await self._off_loop(self._count, LEADER)
+                return await func(), LEADER
+
+            if outcome is not None:
+                await self._off_loop(self._count, 'follower_wait_seconds',
+                                     time.monotonic() - start_time)
+                await self._off_loop(self._count, REMOTE_FOLLOWER)
+                return self._decode(outcome), REMOTE_FOLLOWER
+
+            if acquired:
+                if followed:
+                    # The previous leader went away without publishing a result
+                    await self._off_loop(self._count, 'takeovers')
+                await self._off_loop(self._count, LEADER)
+                return await self._lead(client, key, token, func), LEADER
+
+            followed = True
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f'Timed out waiting for identical extraction after {timeout}s')
+            await asyncio.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+            interval = min(interval * 2, _MAX_POLL)
+
+    async def _off_loop(self, func: Callable, *args) -> Any:
+        """Run ``func`` on a thread when it may make Redis round trips."""
+        if self.backend != 'redis':
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    @staticmethod
+    def _claim(client, key: str, token: str, timeout: float) -> Tuple[Any, bool]:
+        """The outcome published for ``key``, or else whether we took its lease."""
+        outcome = client.get(FLIGHT_RESULT_PREFIX + key)
+        acquired = outcome is None and client.set(
+            FLIGHT_LEASE_PREFIX + key, token, nx=True, px=int((timeout + 5) * 1000)
+        )
+        return outcome, acquired
+
+    async def _lead(self, client, key: str, token: str,
+                    func: Callable[[], Awaitable[Dict]]) -> Dict:
+        """Run the work while holding the lease and publish its outcome."""
+        try:
+            result = await func()
+            await self._off_loop(self._publish, client, key,
+                                 {'status': 'success', 'result': result})
+            return result
+        except RateLimitExceeded as e:
+            await self._off_loop(self._publish, client, key,
+                                 {'status': 'rate_limited', 'error': str(e),
+                                  'retry_after': e.retry_after})
+            raise
+        except TimeoutError as e:
+            await self._off_loop(self._publish, client, key,
+                                 {'status': 'timeout', 'error': str(e)})
+            raise
+        except Exception as e:
+            await self._off_loop(self._publish, client, key,
+                                 {'status': 'error', 'error': str(e)})
+            raise
+        finally:
+            await self._off_loop(self._release, client, key, token)
+
+    def _release(self, client, key: str, token: str) -> None:
+        try:
+            if self._release_script is None:
+                self._release_script = client.register_script(_RELEASE_SCRIPT)
+            self._release_script(keys=[FLIGHT_LEASE_PREFIX + key], args=[token], client=client)
+        except Exception as e:
+            # The lease expires on its own
+            logger.warning(f"Could not release single-flight lease: {str(e)}")
+
+    def _publish(self, client, key: str, outcome: Dict[str, Any]) -> None:
+        ttl = self.result_ttl if outcome['status'] == 'success' else _FAILURE_TTL
+        try:
+            client.set(FLIGHT_RESULT_PREFIX + key, json.dumps(outcome, ensure_ascii=False),
+                       ex=ttl)
+        except Exception as e:
+            logger.warning(f"Could not publish single-flight result: {str(e)}")
+
+    @staticmethod
+    def _decode(raw: bytes) -> Dict:
+        """Result of a remote leader, re-raising its failure."""
+        outcome = json.loads(raw)
+        if outcome['status'] == 'success':
+            return outcome['result']
+        if outcome['status'] == 'rate_limited':
+            raise RateLimitExceeded(outcome['error'], retry_after=outcome['retry_after'])
+        if outcome['status'] == 'timeout':
+            raise TimeoutError(outcome['error'])
+        raise Exception(outcome['error'])
+
+    def stats(self) -> Dict[str, Any]:
+        """Leaders, followers and saved model calls for this worker and the cluster."""
+        with self._lock:
+            worker = dict(self._stats)
+            in_flight = len(self._flights)
+        worker['follower_wait_seconds'] = round(worker['follower_wait_seconds'], 3)
+        worker['saved_calls'] = worker[LOCAL_FOLLOWER] + worker[REMOTE_FOLLOWER]
+        result = {'backend': self.backend, 'in_flight': in_flight, 'worker': worker}
+
+        client = self._redis()
+        if client is not None:
+            try:
+                raw = client.hgetall(FLIGHT_STATS_KEY)
+                cluster = {k.decode(): float(v) if k == b'follower_wait_seconds' else int(v)
+                           for k, v in raw.items()}
+                if 'follower_wait_seconds' in cluster:
+                    cluster['follower_wait_seconds'] = round(cluster['follower_wait_seconds'], 3)
+                cluster['saved_calls'] = (cluster.get(LOCAL_FOLLOWER, 0)
+                                          + cluster.get(REMOTE_FOLLOWER, 0))
+                result['cluster'] = cluster
+            except Exception as e:
+                logger.warning(f"Could not read cluster single-flight stats: {str(e)}")
+        return result
+
+
+def create_single_flight() -> SingleFlight:
+    """Create the coalescer according to ``SINGLE_FLIGHT_BACKEND``."""
+    backend = resolve_backend(SINGLE_FLIGHT_BACKEND)
+    if backend not in ('redis', 'memory', 'off'):
+        logger.warning(f"Unknown SINGLE_FLIGHT_BACKEND '{backend}', using memory")
+        backend = 'memory'
+    logger.info(f"Single-flight backend: {backend}")
+    return SingleFlight(backend=backend)
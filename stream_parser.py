@@ -0,0 +1,155 @@
+"""
+Incremental parser for streamed invoice JSON.
+
+Gemini generates the invoice JSON token by token. ``IncrementalInvoiceParser``
+scans the text as it arrives and reports each top-level section
+(``company_details``, ``invoice_details``, ``totals``) and each ``line_items``
+entry as soon as its closing brace is seen, without re-parsing the whole
+buffer on every chunk.
+"""
+
+import json
+import logging
+from typing import Any, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+SECTION_KEYS = ('company_details', 'invoice_details', 'totals')
+
+ParserEvent = Tuple[str, Any]
+
+
+class IncrementalInvoiceParser:
+    """Emit completed invoice sections from a growing JSON text.
+
+    Text before the first ``{`` (such as a Markdown code fence) is ignored.
+
+    Example:
+        parser = IncrementalInvoiceParser()
+        for chunk in chunks:
+            for event, value in parser.feed(chunk):
+                ...
+    """
+
+    def __init__(self):
+        self.text = ''
+        self._pos = 0
+        self._started = False
+        self._done = False
+        # Stack of open containers: [kind, key_in_parent, start_offset, current_key]
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None
+        self._line_item_count = 0
+
+    @property
+    def line_item_count(self) -> int:
+        """Number of line items emitted so far."""
+        return self._line_item_count
+
+    def feed(self, chunk: str) -> List[ParserEvent]:
+        """Consume the next piece of text.
+
+        Args:
+            chunk: Newly generated text
+
+        Returns:
+            list: ``(event, value)`` tuples for sections completed by this
+            chunk. ``event`` is a section name or ``'line_item'``, in which
+            case ``value`` is ``(index, item)``.
+        """
+        self.text += chunk
+        events = []
+        text = self.text
+        length = len(text)
+        pos = self._pos
+
+        if not self._started:
+            start = text.find('{', pos)
+            if start == -1:
+                self._pos = length
+                return events
+            self._started = True
+            pos = start
+
+        while pos < length and not self._done:
+            char = text[pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = text[self._string_start:pos + 1]
+            elif char == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif char == ':':
+                if self._stack and self._last_string is not None:
+                    self._stack[-1][3] = self._decode_key(self._last_string)
+            elif char == ',':
+                if self._stack and self._stack[-1][0] == '{':
+                    self._stack[-1][3] = None
+            elif char in '{[':
+                key = None
+                if self._stack:
+                    parent = self._stack[-1]
+                    key = parent[3] if parent[0] == '{' else None
+                self._stack.append([char, key, pos, None])
+            elif char in '}]':
+                if not self._stack:
+                    self._done = True
+                    break
+                kind, key, start, _ = self._stack.pop()
+                depth = len(self._stack)
+                if depth == 0:
+                    self._done = True
+                elif kind == '{':
+                    event = self._completed_object(key, depth, text[start:pos + 1])
+                    if event is not None:
+                        events.append(event)
+
+            pos += 1
+
+        self._pos = pos
+        return events
+
+    def _completed_object(self, key: Any, depth: int, raw: str) -> Any:
+        """Build the event for an object that just closed, if it is one we report."""
+        if depth == 1 and key in SECTION_KEYS:
+            value = self._load(raw)
+            return (key, value) if value is not None else None
+
+        parent = self._stack[-1]
+        if depth == 2 and parent[0] == '[' and parent[1] == 'line_items':
+            value = self._load(raw)
+            if value is None:
+                return None
+            index = self._line_item_count
+            self._line_item_count += 1
+            return ('line_item', (index, value))
+        return None
+
+    @staticmethod
+    def _decode_key(raw: str) -> Any:
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _load(raw: str) -> Any:
+        try:
+            return json.loads(raw)
+        except ValueError as e:
+            logger.warning(f"Could not parse streamed section: {str(e)}")
+            return None
+
+    @property
+    def complete(self) -> bool:
+        """Whether the top-level object has been closed."""
+        return self._done
@@ -0,0 +1,33 @@
+"""
+Shared test setup: the app runs offline, on in-process backends, with the
+fake model from the benchmarks instead of Gemini.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Before anything imports the app: never reach a real Redis or the API (tests
+# that extract put the fake model in place, see ``fake_model``)
+os.environ['REDIS_URL'] = ''
+os.environ['GOOGLE_API_KEY'] = ''
+for backend, value in (('RESULT_CACHE_BACKEND', 'memory'), ('RATE_LIMIT_BACKEND', 'off'),
+                       ('SINGLE_FLIGHT_BACKEND', 'off'), ('INVOICE_STORE_BACKEND', 'off'),
+                       ('INVOICE_SEARCH_BACKEND', 'off'), ('PROMPT_PROFILE_BACKEND', 'off'),
+                       ('METRICS_BACKEND', 'memory'), ('JOB_BACKEND', 'memory')):
+    os.environ.setdefault(backend, value)
+
+import pytest
+
+from benchmarks.fake_model import FakeGenerativeModel
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    """The fake model in place of Gemini, returning ``CANNED_INVOICE``."""
+    import app as invoice_app
+
+    model = FakeGenerativeModel()
+    monkeypatch.setattr(invoice_app, 'model', model)
+    return model
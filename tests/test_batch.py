@@ -0,0 +1,99 @@
+import io
+import threading
+
+import pytest
+from PIL import Image
+
+from benchmarks.fake_model import FakeGenerativeModel
+
+
+class CountingModel(FakeGenerativeModel):
+    """Remembers the most calls it had in flight at once."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._flight_lock = threading.Lock()
+
+    def generate_content(self, *args, **kwargs):
+        with self._flight_lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return super().generate_content(*args, **kwargs)
+        finally:
+            with self._flight_lock:
+                self.in_flight -= 1
+
+
+def photo(shade: int) -> io.BytesIO:
+    output = io.BytesIO()
+    Image.new('RGB', (800, 1100), (shade, shade, shade)).save(output, format='JPEG')
+    output.seek(0)
+    return output
+
+
+@pytest.fixture
+def batch_app(monkeypatch):
+    import app as invoice_app
+    from result_cache import create_result_cache
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    model = CountingModel(latency=0.1)
+    monkeypatch.setattr(invoice_app, 'model', model)
+    return invoice_app, model
+
+
+def test_items_are_reported_separately_and_in_order(batch_app):
+    invoice_app, model = batch_app
+
+    response = invoice_app.app.test_client().post('/upload/batch', data={
+        'files': [(photo(250), 'a.jpg'), (io.BytesIO(b'notes'), 'b.txt'), (photo(240), 'c.jpg')]
+    })
+
+    body = response.get_json()
+    assert response.status_code == 200
+    assert [(result['index'], result['source'], result['status'])
+            for result in body['results']] == [
+        (0, 'a.jpg', 'success'), (1, 'b.txt', 'error'), (2, 'c.jpg', 'success')
+    ]
+    assert body['results'][1]['error'] == 'File type not allowed'
+    assert body['results'][0]['invoice_data']['line_items']
+    summary = body['summary']
+    assert (summary['total'], summary['succeeded'], summary['failed']) == (3, 2, 1)
+
+
+def test_concurrency_is_bounded(batch_app):
+    invoice_app, model = batch_app
+
+    response = invoice_app.app.test_client().post('/upload/batch', data={
+        'files': [(photo(255 - n), f'{n}.jpg') for n in range(6)], 'concurrency': '2'
+    })
+
+    body = response.get_json()
+    assert body['summary']['succeeded'] == 6 and body['summary']['concurrency'] == 2
+    assert model.max_in_flight == 2
+
+
+def test_concurrency_cannot_exceed_the_limit(batch_app):
+    invoice_app, _ = batch_app
+
+    response = invoice_app.app.test_client().post('/upload/batch', data={
+        'files': [(photo(250), 'a.jpg')], 'concurrency': '999'
+    })
+
+    assert response.get_json()['summary']['concurrency'] == invoice_app.BATCH_CONCURRENCY
+
+
+def test_rejected_batches(batch_app, monkeypatch):
+    invoice_app, model = batch_app
+    client = invoice_app.app.test_client()
+    monkeypatch.setattr(invoice_app, 'BATCH_MAX_ITEMS', 2)
+
+    assert client.post('/upload/batch', data={}).status_code == 400
+    too_many = client.post('/upload/batch', data={
+        'files': [(photo(250 - n), f'{n}.jpg') for n in range(3)]
+    })
+    assert too_many.status_code == 400 and 'Too many items' in too_many.get_json()['error']
+    assert model.calls == 0
@@ -0,0 +1,125 @@
+import io
+import json
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+import bulk
+from benchmarks.fake_model import CANNED_INVOICE, FakeGenerativeModel
+from bulk import Checkpoint, Progress, ResultWriter, Source, csv_rows, find_sources, run_bulk
+
+
+def photo(shade: int) -> bytes:
+    output = io.BytesIO()
+    Image.new('RGB', (800, 1100), (shade, shade, shade)).save(output, format='JPEG')
+    return output.getvalue()
+
+
+@pytest.fixture
+def scans(tmp_path):
+    """Three invoices: two in nested directories, one in a zip archive."""
+    (tmp_path / 'scans' / 'march').mkdir(parents=True)
+    (tmp_path / 'scans' / 'a.jpg').write_bytes(photo(250))
+    (tmp_path / 'scans' / 'march' / 'b.png').write_bytes(photo(240))
+    (tmp_path / 'scans' / 'notes.txt').write_text('not an invoice')
+    with zipfile.ZipFile(tmp_path / 'archive.zip', 'w') as archive:
+        archive.writestr('c.jpg', photo(230))
+        archive.writestr('readme.md', 'not an invoice')
+    return tmp_path
+
+
+@pytest.fixture
+def model(monkeypatch):
+    import app as invoice_app
+    from result_cache import create_result_cache
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    model = FakeGenerativeModel()
+    monkeypatch.setattr(invoice_app, 'model', model)
+    return model
+
+
+def test_find_sources(scans):
+    directory, archive = str(scans / 'scans'), str(scans / 'archive.zip')
+
+    sources = find_sources([directory, archive, str(scans / 'scans' / '*.jpg')])
+
+    assert [source.name for source in sources] == [
+        f'{directory}/a.jpg', f'{directory}/march/b.png', f'{archive}:c.jpg'
+    ]
+    assert sources[2] == Source(f'{archive}:c.jpg', archive, 'c.jpg')
+    assert bulk.read_source(sources[2]) == photo(230)
+
+
+def test_csv_has_a_row_per_line_item():
+    result = {'source': 'a.jpg', 'status': 'success', 'invoice_data': CANNED_INVOICE}
+
+    rows = csv_rows(result)
+
+    assert [(row['line'], row['item_code']) for row in rows] == [(1, '1001'), (2, '1002')]
+    assert rows[0]['tax_id'] == '513203414' and rows[0]['invoice_total'] == 723.06
+    assert csv_rows({'source': 'b.jpg', 'status': 'error', 'error': 'bad'}) == [
+        {'source': 'b.jpg', 'status': 'error', 'error': 'bad'}
+    ]
+
+
+def run(sources, output, progress=None):
+    import app as invoice_app
+
+    writer = ResultWriter(str(output), bulk.output_format(str(output), None))
+    checkpoint = Checkpoint(str(output) + '.checkpoint')
+    pending = [source for source in sources if source.name not in checkpoint.done]
+    progress = progress or Progress(len(pending), stream=io.StringIO())
+    try:
+        with ThreadPoolExecutor(2) as pool:
+            invoice_app.background_loop.run(
+                run_bulk(pending, pool, writer, checkpoint, progress, concurrency=2,
+                         read_ahead=2))
+    finally:
+        writer.close()
+        checkpoint.close()
+    return progress
+
+
+def test_rerun_skips_what_succeeded(scans, model):
+    sources = find_sources([str(scans)])
+    broken = scans / 'broken.jpg'
+    broken.write_bytes(b'not a jpeg')
+    sources.append(Source(str(broken), str(broken)))
+    output = scans / 'invoices.ndjson'
+
+    progress = run(sources, output)
+
+    assert progress.statuses == {'success': 3, 'error': 1}
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert {result['source'] for result in results} == {source.name for source in sources}
+    assert all(result['invoice_data']['line_items']
+               for result in results if result['status'] == 'success')
+
+    calls = model.calls
+    broken.write_bytes(photo(220))
+    progress = run(sources, output)
+
+    # Only the failed invoice is extracted again, and appended
+    assert progress.statuses == {'success': 1} and model.calls == calls + 1
+    assert len(output.read_text().splitlines()) == 5
+    assert len((scans / 'invoices.ndjson.checkpoint').read_text().splitlines()) == 4
+
+
+def test_cli_writes_csv_with_a_process_pool(scans, model, capsys):
+    output = scans / 'invoices.csv'
+
+    status = bulk.main([str(scans / 'scans'), '-o', str(output), '--workers', '1'])
+
+    assert status == 0
+    lines = output.read_text().splitlines()
+    assert lines[0].startswith('source,status,error,supplier')
+    # Two invoices of two line items each
+    assert len(lines) == 5
+    summary = json.loads(capsys.readouterr().err.splitlines()[-1])
+    assert (summary['finished'], summary['success'], summary['skipped']) == (2, 2, 0)
+
+    assert bulk.main([str(scans / 'scans'), '-o', str(output), '--workers', '1']) == 0
+    assert json.loads(capsys.readouterr().err.splitlines()[-1])['skipped'] == 2
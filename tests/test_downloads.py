@@ -0,0 +1,97 @@
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+import memory_budget
+from downloads import Downloader, DownloadError, DownloadTooLarge
+
+
+def invoice_jpeg() -> bytes:
+    output = io.BytesIO()
+    Image.new('RGB', (800, 1100), 'white').save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+FILES = {'/invoice.jpg': invoice_jpeg(), '/large.bin': bytes(300_000)}
+
+
+class StorageHandler(BaseHTTPRequestHandler):
+    """Serves ``FILES``; ``?chunked`` leaves out the Content-Length."""
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        body = FILES.get(path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if query != 'chunked':
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def storage():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StorageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_within_cap(storage):
+    downloader = Downloader(retries=0)
+
+    data, decoded = downloader.fetch(f'{storage}/invoice.jpg', 100_000,
+                                     decode=lambda body: Image.open(body).size)
+
+    assert data == FILES['/invoice.jpg']
+    assert decoded == (800, 1100)
+    assert downloader.stats()['downloads'] == 1
+
+
+@pytest.mark.parametrize('query', ['', '?chunked'])
+def test_fetch_over_cap_is_aborted(storage, query):
+    downloader = Downloader(retries=0)
+
+    with pytest.raises(DownloadTooLarge):
+        downloader.fetch(f'{storage}/large.bin{query}', 100_000)
+
+    assert downloader.stats()['too_large'] == 1
+
+
+def test_fetch_http_error(storage):
+    downloader = Downloader(retries=0)
+
+    with pytest.raises(DownloadError) as error:
+        downloader.fetch(f'{storage}/missing.jpg', 100_000)
+
+    assert error.value.status_code == 404
+    assert downloader.stats()['failed'] == 1
+
+
+def test_batch_prefetch_is_charged_to_the_request(storage, fake_model, monkeypatch):
+    import app as invoice_app
+    from result_cache import create_result_cache
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    items = [{'source': 'firebase_url', 'firebase_url': f'{storage}/invoice.jpg'}
+             for _ in range(3)]
+
+    with memory_budget.tracked() as memory:
+        results = invoice_app.background_loop.run(invoice_app.process_batch(items, 2))
+
+        assert [result['status'] for result in results] == ['success'] * 3
+        assert memory.peak >= len(FILES['/invoice.jpg'])
+        # Each item gave back its download once it was done
+        assert memory.by_kind['download'] == 0
+        assert memory.by_kind.get('upload', 0) == 0
@@ -0,0 +1,142 @@
+import asyncio
+import time
+
+import pytest
+
+from benchmarks.fake_model import FakeGenerativeModel
+from executors import ModelExecutor
+from hedging import Hedger
+from model_router import LatencyTracker
+from rate_limiter import LocalBudget, RateLimiter
+
+IMAGE_PARTS = [{'mime_type': 'image/jpeg', 'data': b'\xff\xd8'}]
+
+
+class SlowFirstCall(FakeGenerativeModel):
+    """Answers quickly, except for its first call."""
+
+    def _draw(self, input_tokens: int = 0):
+        call = super()._draw(input_tokens)
+        if self.calls == 1:
+            call['latency'] = 1.0
+        return call
+
+
+@pytest.fixture
+def hedged_app(monkeypatch):
+    import app as invoice_app
+
+    budget = LocalBudget(rpm=0, burst=1, max_concurrent=10, bulk_share=0.5)
+    monkeypatch.setattr(invoice_app, 'rate_limiter', RateLimiter(budget))
+    latency = LatencyTracker(min_samples=5)
+    for _ in range(5):
+        latency.record('fast-tier', 0.05)
+    monkeypatch.setattr(invoice_app, 'hedger', Hedger(enabled=True, min_delay=0, latency=latency))
+    return invoice_app, budget
+
+
+def test_app_shares_latency_with_router():
+    import app as invoice_app
+
+    assert invoice_app.hedger.latency is invoice_app.model_router.latency
+    assert not invoice_app.model_router.record_latency
+
+
+def test_lease_is_held_until_the_losing_call_ends(hedged_app):
+    invoice_app, budget = hedged_app
+    model = SlowFirstCall(latency=0.01)
+
+    start_time = time.monotonic()
+    response = invoice_app.background_loop.run(invoice_app.process_with_timeout(
+        model, 'prompt', IMAGE_PARTS, timeout=10, tier='fast-tier'))
+
+    assert response.text
+    assert time.monotonic() - start_time < 0.9
+    assert invoice_app.hedger.stats()['won'] == 1
+    # The first call still runs in its thread, and still holds its capacity
+    assert budget.state()['in_flight'] == 1
+    deadline = time.monotonic() + 5
+    while budget.state()['in_flight'] and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert budget.state()['in_flight'] == 0
+    assert invoice_app.hedger.latency.stats()['fast-tier']['samples'] == 7
+
+
+def test_unhedged_call_releases_its_lease(hedged_app):
+    invoice_app, budget = hedged_app
+
+    invoice_app.background_loop.run(invoice_app.process_with_timeout(
+        FakeGenerativeModel(), 'prompt', IMAGE_PARTS, timeout=10, tier='fast-tier'))
+
+    time.sleep(0.05)
+    assert budget.state()['in_flight'] == 0
+
+
+def test_on_done_runs_when_the_thread_finishes():
+    executor = ModelExecutor(max_workers=1)
+    done = []
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(executor.run_async(time.sleep, 0.3, timeout=0.05,
+                                       on_done=lambda: done.append(time.monotonic())))
+    assert done == []
+    time.sleep(0.4)
+    assert len(done) == 1
+    executor.shutdown()
+
+
+def test_on_done_runs_for_a_call_cancelled_before_it_started():
+    executor = ModelExecutor(max_workers=1)
+    done = []
+
+    async def main():
+        blocker = asyncio.ensure_future(executor.run_async(time.sleep, 0.3))
+        await asyncio.sleep(0)
+        with pytest.raises(TimeoutError):
+            await executor.run_async(time.sleep, 0, timeout=0.05,
+                                     on_done=lambda: done.append(1))
+        assert done == [1]
+        await blocker
+
+    asyncio.run(main())
+    executor.shutdown()
+
+
+def latency_samples(hedger, model='tier'):
+    return sorted(hedger.latency._samples.get(model, ()))
+
+
+def test_timed_out_calls_count_as_their_timeout():
+    hedger = Hedger(enabled=False)
+
+    async def times_out(timeout, lease):
+        await asyncio.sleep(0.01)
+        raise TimeoutError('model call timed out')
+
+    async def refused(timeout, lease):
+        raise ValueError('invalid image')
+
+    for call in (times_out, refused):
+        with pytest.raises(Exception):
+            asyncio.run(hedger.run('tier', call, timeout=8))
+
+    samples = latency_samples(hedger)
+    assert samples[0] < 1 and samples[1] == 8
+
+
+def test_failed_hedged_calls_are_recorded():
+    latency = LatencyTracker(min_samples=1)
+    latency.record('tier', 0.01)
+    hedger = Hedger(enabled=True, min_delay=0, latency=latency)
+
+    async def times_out(timeout, lease):
+        await asyncio.sleep(0.05)
+        raise TimeoutError('model call timed out')
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(hedger.run('tier', times_out, timeout=3))
+
+    assert hedger.stats()['fired'] == hedger.stats()['wasted'] == 1
+    # Both calls timed out: each counts with the time it was given
+    samples = latency_samples(hedger)
+    assert samples[0] == 0.01 and samples[-1] == 3 and 2.9 < samples[1] < 3
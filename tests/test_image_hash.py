@@ -0,0 +1,138 @@
+import io
+import random
+
+import fakeredis
+import pytest
+from PIL import Image, ImageDraw
+
+import image_hash
+from image_hash import DuplicateIndex, MultiIndexHash, dhash, hamming_distance
+
+
+def template_invoice(seed: int) -> bytes:
+    """A page on one supplier's template: same letterhead and grid, other amounts."""
+    rng = random.Random(seed)
+    img = Image.new('RGB', (1240, 1754), 'white')
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((60, 60, 1180, 260), fill=(30, 60, 120))
+    for y in range(400, 1500, 60):
+        draw.line((60, y, 1180, y), fill=(0, 0, 0), width=2)
+    for x in (60, 300, 800, 1000, 1180):
+        draw.line((x, 400, x, 1460), fill=(0, 0, 0), width=2)
+    for y in range(410, 1450, 60):
+        for x in (70, 310, 810):
+            draw.rectangle((x, y + 15, x + 120, y + 40), fill=(40, 40, 40))
+        draw.rectangle((1010, y + 15, 1010 + rng.randint(60, 150), y + 40), fill=(40, 40, 40))
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+def distinct_hashes(count: int):
+    """Informative hashes far apart from each other."""
+    rng = random.Random(3)
+    return [rng.getrandbits(64) | 1 << 63 for _ in range(count)]
+
+
+def test_multi_index_hash_finds_within_distance():
+    index = MultiIndexHash()
+    base = 0x0F0F_F0F0_3C3C_A5A5
+    index.add(base, 'a')
+    index.add(base ^ 0b111, 'b')
+    index.add(base ^ 0xFFFF, 'c')
+
+    matches = index.search(base, 6)
+
+    assert [(distance, value) for distance, _, value in matches] == [(0, 'a'), (3, 'b')]
+
+
+def test_multi_index_hash_keep_latest():
+    index = MultiIndexHash()
+    hashes = distinct_hashes(10)
+    for value, hash_value in enumerate(hashes):
+        index.add(hash_value, value)
+
+    index.keep_latest(3)
+
+    assert len(index) == 3
+    assert [value for _, _, value in index.search(hashes[8], 0)] == [8]
+    assert index.search(hashes[0], 0) == []
+
+
+def test_disabled_by_default():
+    assert image_hash.DUPLICATE_HASH_THRESHOLD == 0
+    assert not DuplicateIndex().enabled
+
+
+def test_local_index_is_capped():
+    index = DuplicateIndex(threshold=6, max_entries=8)
+    hashes = distinct_hashes(20)
+    for value, hash_value in enumerate(hashes):
+        index.add(hash_value, f'key-{value}')
+
+    assert index.stats()['size'] <= 8
+    assert index.find(hashes[19])['key'] == 'key-19'
+    assert index.find(hashes[0]) is None
+
+
+def test_shared_log_is_capped_and_replayed(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(image_hash, 'get_redis', lambda: client)
+    writer = DuplicateIndex(threshold=6, sync_interval=0, max_entries=5)
+    hashes = distinct_hashes(201)
+    for value, hash_value in enumerate(hashes[:200]):
+        writer.add(hash_value, f'key-{value}')
+
+    # Trimmed approximately: a little over the cap is kept
+    assert client.xlen(image_hash.PHASH_LOG_KEY) < 200
+    reader = DuplicateIndex(threshold=6, sync_interval=0, max_entries=5)
+    assert reader.find(hashes[199])['key'] == 'key-199'
+    assert reader.stats()['size'] <= 5
+    writer.add(hashes[200], 'key-200')
+    assert reader.find(hashes[200])['key'] == 'key-200'
+
+
+def test_template_invoices_hash_alike():
+    from app import IMAGE_LADDER, process_image_memory
+
+    first, second = (
+        dhash(process_image_memory(template_invoice(seed), IMAGE_LADDER[0])[0]['data'])
+        for seed in (1, 2)
+    )
+
+    assert hamming_distance(first, second) <= 6
+
+
+@pytest.fixture
+def duplicate_index(monkeypatch):
+    import app as invoice_app
+    from result_cache import create_result_cache
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    index = DuplicateIndex(threshold=8)
+    monkeypatch.setattr(invoice_app, 'duplicate_index', index)
+    return index
+
+
+def test_near_duplicate_is_offered_not_served(fake_model, duplicate_index):
+    import app as invoice_app
+
+    first = invoice_app.background_loop.run(invoice_app.extract_invoice(template_invoice(1)))
+    second = invoice_app.background_loop.run(invoice_app.extract_invoice(template_invoice(2)))
+
+    # Another invoice on the same template is extracted, not answered from the first
+    assert fake_model.calls == 2
+    assert 'probable_duplicate' not in first
+    assert not second.get('cached')
+    assert second['probable_duplicate']['invoice_data'] == first['invoice_data']
+    assert second['probable_duplicate']['distance'] <= duplicate_index.threshold
+
+
+def test_identical_image_is_served_from_cache(fake_model, duplicate_index):
+    import app as invoice_app
+
+    invoice_app.background_loop.run(invoice_app.extract_invoice(template_invoice(1)))
+    again = invoice_app.background_loop.run(invoice_app.extract_invoice(template_invoice(1)))
+
+    assert fake_model.calls == 1
+    assert again['cached']
@@ -0,0 +1,83 @@
+import io
+
+import pytest
+from PIL import Image
+
+import image_pipeline
+from image_pipeline import choose_resample, encode_jpeg, fit_size, load_image
+
+
+def encoded(size, format='JPEG', orientation=None, mode='RGB') -> bytes:
+    img = Image.new(mode, size, 'white' if mode != 'P' else 0)
+    # Dark top-left corner, to see where it ends up after rotation
+    img.paste('black' if mode != 'P' else 1, (0, 0, size[0] // 4, size[1] // 4))
+    output = io.BytesIO()
+    if orientation is not None:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        img.save(output, format=format, exif=exif)
+    else:
+        img.save(output, format=format)
+    return output.getvalue()
+
+
+def test_fit_size_never_upscales():
+    assert fit_size((4000, 3000), (1000, 1000)) == (1000, 750)
+    assert fit_size((300, 200), (1000, 1000)) == (300, 200)
+
+
+def test_choose_resample():
+    assert choose_resample(4.0) == (Image.Resampling.LANCZOS, 2.0)
+    assert choose_resample(2.0) == (Image.Resampling.LANCZOS, None)
+    assert choose_resample(1.2) == (Image.Resampling.BICUBIC, None)
+
+
+def test_jpeg_is_decoded_from_a_draft(monkeypatch):
+    from PIL.JpegImagePlugin import JpegImageFile
+
+    drafts = []
+    original = JpegImageFile.draft
+
+    def draft(self, mode, size):
+        result = original(self, mode, size)
+        drafts.append(self.size)
+        return result
+
+    monkeypatch.setattr(JpegImageFile, 'draft', draft)
+
+    img = load_image(encoded((4000, 3000)), (600, 600))
+
+    assert img.size == (600, 450) and img.mode == 'RGB'
+    # Decoded at 1/4 scale (1000x750), the smallest draft still covering 600px
+    assert drafts == [(1000, 750)]
+
+
+def test_png_is_resized_without_a_draft():
+    img = load_image(encoded((1200, 1600), format='PNG', mode='P'), (600, 600))
+
+    assert img.size == (450, 600) and img.mode == 'RGB'
+
+
+@pytest.mark.parametrize('orientation, size, dark_corner', [
+    (1, (800, 600), (0, 0)),
+    (6, (600, 800), (599, 0)),  # Rotated 90 degrees clockwise by the camera
+    (3, (800, 600), (799, 599)),
+])
+def test_exif_orientation_is_applied(orientation, size, dark_corner):
+    img = load_image(encoded((1600, 1200), orientation=orientation), (800, 800))
+
+    assert img.size == size
+    assert img.getpixel(dark_corner)[0] < 64
+
+
+def test_decompression_bombs_are_rejected_from_the_header(monkeypatch):
+    monkeypatch.setattr(image_pipeline, 'IMAGE_MAX_PIXELS', 1000 * 1000)
+
+    with pytest.raises(ValueError, match='Image too large'):
+        load_image(encoded((2000, 1000)), (600, 600))
+
+
+def test_encode_jpeg_round_trips():
+    data = encode_jpeg(Image.new('RGB', (64, 48), 'white'), quality=70)
+
+    assert Image.open(io.BytesIO(data)).size == (64, 48)
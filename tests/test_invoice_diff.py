@@ -0,0 +1,74 @@
+import json
+
+from benchmarks.fake_model import CANNED_INVOICE
+from invoice_diff import CODE, DESCRIPTION, SIMILARITY, align_items, diff_invoices
+
+
+def item(code, description, quantity=1.0, price=10.0):
+    return {'item_code': code, 'description': description, 'quantity': quantity,
+            'price': price, 'total': round(quantity * price, 2)}
+
+
+def test_align_by_code_then_description_then_similarity():
+    original = [item('1001', 'גבינה צהובה'), item('', 'Olive oil 1L'),
+                item('', 'Tomatoes cherry box'), item('2002', 'Bread')]
+    current = [item('', 'tomato cherry box'), item('2002', 'Bread rolls'),
+               item('', 'OLIVE  oil, 1L'), item('1001', 'גבינה')]
+
+    matches = align_items(original, current)
+
+    assert matches[3] == (0, CODE, 1.0)
+    assert matches[1] == (3, CODE, 1.0)
+    assert matches[2] == (1, DESCRIPTION, 1.0)
+    assert matches[0][:2] == (2, SIMILARITY)
+
+
+def test_duplicate_codes_pair_in_order():
+    original = [item('7', 'Box'), item('7', 'Box'), item('8', 'Lid')]
+    current = [item('7', 'Box', quantity=2), item('7', 'Box', quantity=3)]
+
+    assert align_items(original, current) == {0: (0, CODE, 1.0), 1: (1, CODE, 1.0)}
+
+
+def test_ties_go_to_the_closer_position():
+    original = [item('', 'Paper towels'), item('', 'Soap'), item('', 'Paper towels')]
+    current = [item('', 'Soap'), item('', 'Paper towel'), item('', 'Paper towel')]
+
+    matches = align_items(original, current)
+
+    assert [matches[index][0] for index in (1, 2)] == [0, 2]
+
+
+def test_dissimilar_items_are_added_and_removed():
+    original = [item('', 'Coffee beans')]
+    current = [item('', 'Printer paper')]
+
+    report = diff_invoices({'line_items': original}, {'line_items': current})
+
+    assert report['alignment'] == [None]
+    assert [change['type'] for change in report['changes']] == ['added', 'removed']
+    assert report['summary']['added'] == report['summary']['removed'] == 1
+
+
+def test_report_of_an_edited_invoice():
+    original = json.loads(json.dumps(CANNED_INVOICE))
+    current = json.loads(json.dumps(CANNED_INVOICE))
+    # Reordered, one quantity corrected, one line added and the name fixed
+    current['line_items'].reverse()
+    current['line_items'][1].update(quantity=2.5, total=400.0)
+    current['line_items'].append(item('1003', 'חמאה', 2, 12.5))
+    current['company_details']['name'] = 'כרמל מעדנים'
+
+    report = diff_invoices(original, current)
+
+    assert report['alignment'] == [1, 0, None]
+    assert report['changes_by_item'] == {'1': [
+        {'field': 'quantity', 'original': 2.2, 'current': 2.5, 'difference': 0.3},
+        {'field': 'total', 'original': 352.0, 'current': 400.0, 'difference': 48.0},
+    ]}
+    impact = report['totals_impact']['line_items']
+    assert (impact['changed'], impact['added'], impact['removed']) == (48.0, 25.0, 0.0)
+    assert impact['difference'] == 73.0
+    assert {'type': 'detail', 'section': 'company_details', 'field': 'name',
+            'original': 'כרמל מעדנים בע"מ', 'current': 'כרמל מעדנים'} in report['changes']
+    assert report['summary']['matched_by'] == {CODE: 2, DESCRIPTION: 0, SIMILARITY: 0}
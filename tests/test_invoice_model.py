@@ -0,0 +1,89 @@
+import json
+
+from benchmarks.fake_model import CANNED_INVOICE
+from invoice_model import LineItem, parse_amount, parse_invoice
+
+
+def response(line_items, subtotal=0, tax=0, total=0):
+    invoice = dict(CANNED_INVOICE, line_items=line_items,
+                   totals={'subtotal': subtotal, 'tax': tax, 'total': total})
+    return json.dumps(invoice, ensure_ascii=False)
+
+
+def test_canned_invoice():
+    issues = []
+    reported = {}
+
+    invoice = parse_invoice(json.dumps(CANNED_INVOICE, ensure_ascii=False), issues, reported)
+
+    assert issues == []
+    assert invoice.name == 'כרמל מעדנים בע"מ'
+    assert [line.to_dict() for line in invoice.line_items] == CANNED_INVOICE['line_items']
+    assert invoice.subtotal == 618.0
+    assert reported == {'subtotal': 618.0, 'tax': 105.06, 'total': 723.06}
+
+
+def test_swapped_weight_quantity_is_put_back():
+    issues = []
+    text = response([{'item_code': '1001', 'description': 'גבינה צהובה', 'quantity': 352,
+                      'price': 160, 'total': 2.2}])
+
+    invoice = parse_invoice(text, issues)
+
+    line = invoice.line_items[0]
+    assert (line.quantity, line.price, line.total) == (2.2, 160.0, 352.0)
+    assert invoice.subtotal == 352.0
+    assert issues == []
+
+
+def test_swapped_line_is_put_back_without_subtotal():
+    line = LineItem.from_raw({'quantity': 352, 'price': 160, 'total': 2.2}, 0)
+
+    assert (line.quantity, line.price, line.total) == (2.2, 160.0, 352.0)
+
+
+def test_unreconciled_line_is_reported():
+    issues = []
+    text = response([{'quantity': 3, 'price': 10, 'total': 31},
+                     {'quantity': 1, 'price': 5, 'total': 5}], subtotal=40)
+
+    invoice = parse_invoice(text, issues)
+
+    assert invoice.line_items[0].total == 30.0
+    assert issues == ['line item 0: quantity x price != total',
+                      'reported subtotal 40.0 != sum of line totals 35.0']
+
+
+def test_subtotal_keeps_printed_total_of_unreconciled_line():
+    issues = []
+    text = response([{'quantity': 3, 'price': 10, 'total': 31},
+                     {'quantity': 1, 'price': 5, 'total': 5}], subtotal=36)
+
+    invoice = parse_invoice(text, issues)
+
+    assert invoice.line_items[0].total == 31.0
+    assert invoice.subtotal == 36.0
+    assert issues == ['line item 0: quantity x price != total']
+
+
+def test_text_around_json_and_bad_items():
+    issues = []
+    text = '```json\n' + response(['oops', {'quantity': '2', 'price': '₪1,250.50',
+                                            'total': '2501'}]) + '\n```'
+
+    invoice = parse_invoice(text, issues)
+
+    assert len(invoice.line_items) == 1
+    assert invoice.line_items[0].price == 1250.5
+    assert issues == ['line item 0: not an object']
+
+
+def test_unusable_response():
+    assert parse_invoice('no json here').line_items == []
+    assert parse_invoice('{"line_items": []}').line_items == []
+
+
+def test_parse_amount():
+    assert parse_amount('1,234.5') == 1234.5
+    assert parse_amount(None) == 0.0
+    assert parse_amount(7) == 7.0
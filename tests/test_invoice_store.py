@@ -0,0 +1,148 @@
+import copy
+import threading
+
+import pytest
+
+from benchmarks.fake_model import CANNED_INVOICE
+from invoice_store import MemoryInvoiceStore, SQLiteInvoiceStore
+
+
+def invoice(number='INV-2024-001'):
+    data = copy.deepcopy(CANNED_INVOICE)
+    data['invoice_details']['invoice_number'] = number
+    return data
+
+
+class FlakyStore(MemoryInvoiceStore):
+    """Fails its writes while ``broken`` is set, or until ``gate`` is open."""
+
+    def __init__(self, **kwargs):
+        super().__init__(retry_delay=0.01, retry_max_delay=0.02, **kwargs)
+        self.broken = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.attempts = 0
+
+    def _write_batch(self, records):
+        self.gate.wait()
+        self.attempts += 1
+        if self.broken.is_set():
+            raise OSError('disk I/O error')
+        super()._write_batch(records)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryInvoiceStore(batch_delay=0.05)
+    return SQLiteInvoiceStore(str(tmp_path / 'invoices.db'), batch_delay=0.05)
+
+
+def test_save_then_get_and_find(store):
+    invoice_id = store.save(invoice(), image_hash='ab' * 32)
+
+    # Readable while queued, and after it is written
+    assert store.get(invoice_id)['invoice_data'] == invoice()
+    assert store.wait_saved(invoice_id, timeout=5)
+    saved = store.get(invoice_id)
+    assert saved['invoice_data'] == invoice() and saved['image_hash'] == 'ab' * 32
+    assert [found['id'] for found in store.find(tax_id='513203414')] == [invoice_id]
+
+
+def test_update_keeps_created_at(store):
+    invoice_id = store.save(invoice())
+    store.flush(timeout=5)
+    created_at = store.get(invoice_id)['created_at']
+
+    store.save(invoice('INV-2024-002'), invoice_id=invoice_id)
+    store.flush(timeout=5)
+
+    saved = store.get(invoice_id)
+    assert saved['invoice_data']['invoice_details']['invoice_number'] == 'INV-2024-002'
+    assert saved['created_at'] == created_at
+    assert store.find(invoice_number='INV-2024-001') == []
+
+
+def test_saves_are_written_in_batches(store):
+    batches = []
+    store.add_listener(batches.append)
+
+    ids = [store.save(invoice(f'INV-{n}')) for n in range(20)]
+    assert store.flush(timeout=5)
+
+    stats = store.stats()
+    assert (stats['saved'], stats['pending'], stats['errors']) == (20, 0, 0)
+    assert stats['batches'] < 5
+    # Listeners see each committed batch, in order
+    assert [record['id'] for batch in batches for record in batch] == ids
+    assert len(store.find(tax_id='513203414', limit=100)) == 20
+
+
+def test_failed_batch_is_retried_and_stays_readable():
+    store = FlakyStore()
+    committed = []
+    store.add_listener(committed.append)
+    store.broken.set()
+
+    invoice_id = store.save(invoice())
+    assert not store.wait_saved(invoice_id, timeout=0.1)
+
+    # Still pending (and readable), not dropped
+    assert store.get(invoice_id)['id'] == invoice_id
+    assert store.stats()['pending'] == 1 and committed == []
+
+    store.broken.clear()
+    assert store.wait_saved(invoice_id, timeout=5)
+    stats = store.stats()
+    assert stats['errors'] >= 2 and (stats['saved'], stats['pending']) == (1, 0)
+    assert store._read(invoice_id)['id'] == invoice_id
+    assert [record['id'] for record in committed[0]] == [invoice_id]
+
+
+def test_full_queue_is_refused():
+    from invoice_store import StoreBusyError
+
+    store = FlakyStore(max_pending=2)
+    store.gate.clear()
+    store.save(invoice())
+    store.save(invoice())
+
+    with pytest.raises(StoreBusyError):
+        store.save(invoice())
+    store.gate.set()
+    assert store.flush(timeout=5)
+
+
+@pytest.fixture
+def app_store(monkeypatch):
+    import app as invoice_app
+
+    store = FlakyStore()
+    monkeypatch.setattr(invoice_app, 'invoice_store', store)
+    monkeypatch.setattr(invoice_app, 'STORE_SAVE_WAIT', 0.1)
+    return invoice_app, store
+
+
+def test_save_changes_waits_for_the_write(app_store):
+    invoice_app, store = app_store
+    client = invoice_app.app.test_client()
+
+    response = client.post('/save_changes', json=invoice())
+    body = response.get_json()
+
+    assert response.status_code == 200 and body['written'] is True
+    assert store._read(body['invoice_id']) is not None
+
+
+def test_save_changes_reports_a_queued_write(app_store):
+    invoice_app, store = app_store
+    client = invoice_app.app.test_client()
+    store.broken.set()
+
+    response = client.post('/save_changes', json=invoice())
+    body = response.get_json()
+
+    assert response.status_code == 202 and body['written'] is False
+    assert client.get(f"/invoices/{body['invoice_id']}").status_code == 200
+    store.broken.clear()
+    assert store.flush(timeout=5)
@@ -0,0 +1,158 @@
+import io
+import threading
+import time
+
+import fakeredis
+import pytest
+from PIL import Image
+
+import jobs
+from jobs import (FAILED, LOST_ERROR, QUEUED, RUNNING, SUCCEEDED, TIMED_OUT, JobManager,
+                  MemoryJobStore, QueueFullError, RedisJobStore)
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def store(request, monkeypatch):
+    if request.param == 'memory':
+        return MemoryJobStore()
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(jobs, 'get_redis', lambda: client)
+    return RedisJobStore()
+
+
+def test_submit_and_poll(store):
+    manager = JobManager(store, workers=1)
+    release = threading.Event()
+
+    job = manager.submit(lambda: release.wait(5) and {'invoice_data': {}}, source='a.jpg')
+    assert job['state'] == QUEUED
+    assert manager.get(job['id'], wait=0.1)['state'] in (QUEUED, RUNNING)
+    assert manager.stats()['worker_pending'] == 1
+
+    release.set()
+    finished = manager.get(job['id'], wait=5)
+    assert finished['state'] == SUCCEEDED and finished['result'] == {'invoice_data': {}}
+    assert finished['started_at'] <= finished['finished_at']
+    stats = manager.stats()
+    assert (stats['queued'], stats['running'], stats['worker_pending']) == (0, 0, 0)
+
+
+def test_failures_and_timeouts_are_recorded(store):
+    manager = JobManager(store)
+
+    def timeout():
+        raise jobs.TimeoutError()
+
+    def broken():
+        raise ValueError('bad image')
+
+    assert manager.get(manager.submit(timeout)['id'], wait=5)['state'] == TIMED_OUT
+    failed = manager.get(manager.submit(broken)['id'], wait=5)
+    assert (failed['state'], failed['error']) == (FAILED, 'bad image')
+
+
+def test_queue_is_bounded():
+    manager = JobManager(MemoryJobStore(), workers=1, max_queue=2)
+    release = threading.Event()
+    for _ in range(2):
+        manager.submit(release.wait, 5)
+
+    with pytest.raises(QueueFullError):
+        manager.submit(release.wait, 5)
+    release.set()
+
+
+def test_long_poll_is_capped(monkeypatch):
+    monkeypatch.setattr(jobs, 'JOB_MAX_WAIT', 0.2)
+    manager = JobManager(MemoryJobStore(), workers=1)
+    release = threading.Event()
+    job = manager.submit(release.wait, 5)
+
+    start = time.monotonic()
+    assert manager.get(job['id'], wait=30)['state'] != SUCCEEDED
+    assert time.monotonic() - start < 1
+    release.set()
+
+
+def test_records_expire():
+    manager = JobManager(MemoryJobStore(ttl=0.2))
+    job = manager.submit(dict)
+    assert manager.get(job['id'], wait=5)['state'] == SUCCEEDED
+
+    time.sleep(0.3)
+    assert manager.get(job['id']) is None
+
+
+def test_jobs_of_a_killed_worker_are_not_counted(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(jobs, 'get_redis', lambda: client)
+    store = RedisJobStore()
+    # Jobs another worker was running when it was killed
+    for job_id in ('lost-1', 'lost-2'):
+        store.save({'id': job_id, 'state': RUNNING})
+    assert store.counters() == {QUEUED: 0, RUNNING: 2}
+
+    monkeypatch.setattr(jobs, 'JOB_HEARTBEAT_TIMEOUT', 0.1)
+    store.heartbeat({'lost-2': RUNNING})
+    time.sleep(0.2)
+    store.heartbeat({'lost-2': RUNNING})
+
+    assert store.counters() == {QUEUED: 0, RUNNING: 1}
+    lost = store.get('lost-1')
+    assert (lost['state'], lost['error']) == (FAILED, LOST_ERROR)
+    assert store.get('lost-2')['state'] == RUNNING
+
+
+def test_heartbeat_keeps_long_jobs_alive(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(jobs, 'get_redis', lambda: client)
+    monkeypatch.setattr(jobs, 'JOB_HEARTBEAT_TIMEOUT', 0.2)
+    manager = JobManager(RedisJobStore(), workers=1, heartbeat_interval=0.05)
+    release = threading.Event()
+    job = manager.submit(release.wait, 5)
+
+    time.sleep(0.5)
+    assert manager.get(job['id'])['state'] == RUNNING
+    assert manager.stats()['running'] == 1
+    release.set()
+    assert manager.get(job['id'], wait=5)['state'] == SUCCEEDED
+    # A finished job is not brought back by a late heartbeat
+    manager.store.heartbeat({job['id']: RUNNING})
+    assert manager.stats()['running'] == 0
+
+
+def test_jobs_endpoints(fake_model, monkeypatch):
+    import app as invoice_app
+    from result_cache import create_result_cache
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    monkeypatch.setattr(invoice_app, 'job_manager', JobManager(MemoryJobStore(), workers=1))
+    client = invoice_app.app.test_client()
+    image = io.BytesIO()
+    Image.new('RGB', (800, 1100), 'white').save(image, format='JPEG')
+
+    submitted = client.post('/jobs', data={'file': (io.BytesIO(image.getvalue()), 'a.jpg')})
+    assert submitted.status_code == 202
+    body = submitted.get_json()
+    assert body['state'] == QUEUED and body['job_url'] == f"/jobs/{body['job_id']}"
+
+    polled = client.get(f"{body['job_url']}?wait=5")
+    result = polled.get_json()
+    assert result['state'] == SUCCEEDED and result['invoice_data']['line_items']
+    assert 'Retry-After' not in polled.headers
+    assert client.get('/jobs/unknown').status_code == 404
+
+
+def test_unfinished_job_asks_to_retry(monkeypatch):
+    import app as invoice_app
+
+    manager = JobManager(MemoryJobStore(), workers=1)
+    monkeypatch.setattr(invoice_app, 'job_manager', manager)
+    release = threading.Event()
+    job = manager.submit(release.wait, 5)
+
+    response = invoice_app.app.test_client().get(f"/jobs/{job['id']}")
+
+    assert response.get_json()['state'] in (QUEUED, RUNNING)
+    assert response.headers['Retry-After'] == str(jobs.JOB_RETRY_AFTER)
+    release.set()
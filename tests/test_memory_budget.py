@@ -0,0 +1,123 @@
+import io
+import json
+from functools import partial
+
+import pytest
+from PIL import Image
+
+import memory_budget
+from benchmarks.fake_model import CANNED_INVOICE, FakeGenerativeModel
+from memory_budget import (MB, REQUEST, WORKER, MemoryBudgetExceeded, RequestMemory,
+                           WorkerMemory)
+
+
+def photo() -> bytes:
+    output = io.BytesIO()
+    Image.new('RGB', (800, 1100), 'white').save(output, format='JPEG')
+    return output.getvalue()
+
+
+def test_request_tracks_current_and_peak_by_kind():
+    worker = WorkerMemory()
+    memory = RequestMemory(worker=worker)
+    memory.charge('upload', 3 * MB)
+    memory.charge('payload', MB)
+    memory.release('upload', 3 * MB)
+
+    assert (memory.current, memory.peak) == (MB, 4 * MB)
+    assert memory.by_kind == {'upload': 0, 'payload': MB}
+    assert (worker.current, worker.peak) == (MB, 4 * MB)
+
+    memory.close()
+    memory.charge('payload', MB)
+    assert worker.current == memory.current == 0
+
+
+def test_request_budget_rejects_before_charging_the_worker():
+    worker = WorkerMemory()
+    memory = RequestMemory(budget=2 * MB, worker=worker)
+    memory.charge('upload', MB)
+
+    with pytest.raises(MemoryBudgetExceeded) as raised:
+        memory.charge('payload', 2 * MB)
+
+    assert (raised.value.scope, raised.value.budget) == (REQUEST, 2 * MB)
+    assert worker.current == memory.current == MB and worker.rejected == 0
+
+
+def test_worker_budget_is_shared_by_requests():
+    worker = WorkerMemory(budget=3 * MB)
+    first, second = RequestMemory(worker=worker), RequestMemory(worker=worker)
+    first.charge('upload', 2 * MB)
+
+    with pytest.raises(MemoryBudgetExceeded) as raised:
+        second.charge('upload', 2 * MB)
+    assert raised.value.scope == WORKER and worker.stats()['rejected'] == 1
+
+    first.close()
+    second.charge('upload', 2 * MB)
+    assert worker.stats()['current_mb'] == 2
+
+
+def test_charges_outside_a_tracked_context_are_ignored():
+    # Not in a request here (see ``start_request``), so nothing is counted
+    memory_budget._current.set(None)
+    before = memory_budget.worker_memory.current
+    memory_budget.charge('upload', MB)
+
+    with memory_budget.tracked() as memory:
+        with memory_budget.hold('decoded', 2 * MB):
+            assert memory.current == 2 * MB
+        memory_budget.charge('payload', MB)
+        assert memory.peak == 2 * MB
+    assert memory_budget.worker_memory.current == before
+
+
+def test_model_receives_raw_jpeg_bytes(monkeypatch):
+    import app as invoice_app
+    from result_cache import create_result_cache
+
+    sent = []
+
+    def respond(contents):
+        sent.extend(part for part in contents if isinstance(part, dict))
+        return json.dumps(CANNED_INVOICE, ensure_ascii=False)
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    monkeypatch.setattr(invoice_app, 'model', FakeGenerativeModel(respond=respond))
+    client = invoice_app.app.test_client()
+
+    response = client.post('/upload', data={'file': (io.BytesIO(photo()), 'a.jpg')})
+
+    assert response.status_code == 200
+    assert [part['mime_type'] for part in sent] == ['image/jpeg']
+    assert isinstance(sent[0]['data'], bytes) and sent[0]['data'][:2] == b'\xff\xd8'
+    # Everything the request held is released when it ends
+    assert client.get('/health').get_json()['memory']['current_mb'] == 0
+
+
+def test_upload_over_the_request_budget_is_413(fake_model, monkeypatch):
+    import app as invoice_app
+
+    monkeypatch.setattr(memory_budget, 'start_request',
+                        partial(memory_budget.start_request, 1024))
+
+    response = invoice_app.app.test_client().post(
+        '/upload', data={'file': (io.BytesIO(photo()), 'a.jpg')})
+
+    assert response.status_code == 413
+    assert 'too much memory' in response.get_json()['error']
+    assert fake_model.calls == 0
+
+
+def test_upload_while_the_worker_is_full_is_503(fake_model, monkeypatch):
+    import app as invoice_app
+
+    monkeypatch.setattr(memory_budget.worker_memory, 'budget', 1024)
+
+    response = invoice_app.app.test_client().post(
+        '/upload', data={'file': (io.BytesIO(photo()), 'a.jpg')})
+
+    assert response.status_code == 503
+    assert 'Server is busy' in response.get_json()['error']
+    assert fake_model.calls == 0
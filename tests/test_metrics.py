@@ -0,0 +1,115 @@
+import io
+import re
+
+import fakeredis
+import pytest
+from PIL import Image
+
+import metrics as metrics_module
+import redis_client
+from metrics import Metrics, RequestTimings, start_request
+
+
+def sample(text: str, series: str) -> float:
+    """Value of one series in the exposition text."""
+    match = re.search(rf'^{re.escape(series)} (\S+)$', text, re.MULTILINE)
+    assert match, f'{series} not in metrics'
+    return float(match.group(1))
+
+
+def test_render_counters_histograms_and_gauges():
+    metrics = Metrics()
+    metrics.inc('invoice_requests_total', endpoint='upload', status='200')
+    metrics.inc('invoice_requests_total', 2, endpoint='upload', status='200')
+    for seconds in (0.02, 0.3, 200):
+        metrics.observe('invoice_stage_duration_seconds', seconds, stage='model')
+    with metrics.in_flight('model_call'):
+        inside = metrics.render()
+
+    assert sample(inside, 'invoice_in_flight{what="model_call"}') == 1
+    text = metrics.render()
+    assert '# TYPE invoice_stage_duration_seconds histogram' in text
+    assert sample(text, 'invoice_requests_total{endpoint="upload",status="200"}') == 3
+    # Buckets are cumulative; 200s only falls in +Inf
+    assert sample(text, 'invoice_stage_duration_seconds_bucket{stage="model",le="0.025"}') == 1
+    assert sample(text, 'invoice_stage_duration_seconds_bucket{stage="model",le="0.5"}') == 2
+    assert sample(text, 'invoice_stage_duration_seconds_bucket{stage="model",le="120"}') == 2
+    assert sample(text, 'invoice_stage_duration_seconds_bucket{stage="model",le="+Inf"}') == 3
+    assert sample(text, 'invoice_stage_duration_seconds_count{stage="model"}') == 3
+    assert sample(text, 'invoice_stage_duration_seconds_sum{stage="model"}') == 200.32
+    assert sample(text, 'invoice_in_flight{what="model_call"}') == 0
+    assert sample(text, 'invoice_metrics_workers') == 1
+
+
+def test_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.inc('invoice_errors_total', cause='bad "quote"\nline')
+
+    assert 'invoice_errors_total{cause="bad \\"quote\\"\\nline"} 1' in metrics.render()
+
+
+def test_off_backend_records_nothing():
+    metrics = Metrics(backend='off')
+    metrics.inc('invoice_requests_total', endpoint='upload', status='200')
+
+    assert 'invoice_requests_total{' not in metrics.render()
+
+
+def test_workers_aggregate_through_redis(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis_client, 'REDIS_URL', 'redis://metrics')
+    monkeypatch.setattr(metrics_module, 'get_redis', lambda: client)
+    first, second = Metrics('redis'), Metrics('redis')
+    monkeypatch.setattr(second, '_worker_id', lambda: 'other-host:1')
+    first.inc('invoice_errors_total', cause='image')
+    second.inc('invoice_errors_total', 2, cause='image')
+    second.add_gauge('invoice_in_flight', 1, what='request')
+    second.flush()
+
+    text = first.render()
+
+    assert sample(text, 'invoice_errors_total{cause="image"}') == 3
+    assert sample(text, 'invoice_in_flight{what="request"}') == 1
+    assert sample(text, 'invoice_metrics_workers') == 2
+
+
+def test_server_timing_lists_stages_then_total():
+    timings = RequestTimings()
+    timings.add('decode', 0.012)
+    timings.add('model', 0.5)
+    timings.add('decode', 0.003)
+
+    header = timings.server_timing()
+
+    assert re.fullmatch(r'decode;dur=15\.0, model;dur=500\.0, total;dur=\d+\.\d', header)
+
+
+def test_stages_are_timed_into_the_current_request():
+    metrics = Metrics()
+    timings = start_request()
+
+    with pytest.raises(ValueError):
+        with metrics.stage('parse'):
+            raise ValueError('failed attempts count too')
+
+    assert list(timings.stages) == ['parse']
+    assert sample(metrics.render(), 'invoice_stage_duration_seconds_count{stage="parse"}') == 1
+
+
+def test_upload_response_carries_server_timing(fake_model, monkeypatch):
+    import app as invoice_app
+    from result_cache import create_result_cache
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    monkeypatch.setattr(invoice_app, 'metrics', Metrics())
+    image = io.BytesIO()
+    Image.new('RGB', (800, 1100), 'white').save(image, format='JPEG')
+    client = invoice_app.app.test_client()
+
+    response = client.post('/upload', data={'file': (io.BytesIO(image.getvalue()), 'a.jpg')})
+
+    stages = [part.split(';')[0] for part in response.headers['Server-Timing'].split(', ')]
+    assert response.status_code == 200
+    assert {'decode', 'model', 'total'} <= set(stages) and stages[-1] == 'total'
+    text = client.get('/metrics').get_data(as_text=True)
+    assert sample(text, 'invoice_requests_total{endpoint="upload_file",status="200"}') == 1
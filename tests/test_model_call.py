@@ -0,0 +1,51 @@
+import pytest
+
+from benchmarks.fake_model import FakeGenerativeModel
+
+
+class RecordingModel(FakeGenerativeModel):
+    """Remembers the ``request_options`` of every call."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.request_options = []
+
+    def generate_content(self, contents, generation_config=None, stream=False,
+                         request_options=None, **kwargs):
+        self.request_options.append(request_options)
+        return super().generate_content(contents, generation_config, stream,
+                                        request_options, **kwargs)
+
+
+IMAGE_PARTS = [{'mime_type': 'image/jpeg', 'data': b'\xff\xd8'}]
+
+
+@pytest.mark.parametrize('timeout, expected', [(30, 28), (3, 1), (2, 1), (1, 1)])
+def test_api_deadline_stays_positive(timeout, expected):
+    import app as invoice_app
+
+    model = RecordingModel()
+    invoice_app.background_loop.run(
+        invoice_app.generate_with_timeout(model, 'prompt', IMAGE_PARTS, timeout))
+
+    assert model.request_options == [{'timeout': expected}]
+
+
+def test_short_budget_still_calls_the_model():
+    import app as invoice_app
+
+    model = RecordingModel(latency=0.2)
+    response = invoice_app.background_loop.run(
+        invoice_app.generate_with_timeout(model, 'prompt', IMAGE_PARTS, 1))
+
+    assert response.text == model.response_text
+
+
+def test_streaming_deadline_stays_positive():
+    import app as invoice_app
+
+    model = RecordingModel(latency=0.05)
+    text = ''.join(invoice_app.stream_model_text(model, 'prompt', IMAGE_PARTS, timeout=2))
+
+    assert text == model.response_text
+    assert model.request_options == [{'timeout': 1}]
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from benchmarks.fake_model import CANNED_INVOICE, FakeGenerativeModel
+from invoice_model import parse_invoice
+from model_router import ModelRouter, score_extraction
+
+FAST = 'fast-model'
+STRONG = 'strong-model'
+
+
+def misread_invoice() -> str:
+    """An invoice with a line no column assignment can explain."""
+    invoice = json.loads(json.dumps(CANNED_INVOICE))
+    invoice['line_items'][1].update(quantity=3.0, price=10.0, total=47.0)
+    return json.dumps(invoice, ensure_ascii=False)
+
+
+def caller(models, seen):
+    async def call(tier, rung, remaining):
+        seen.append((tier, rung))
+        response = await asyncio.wait_for(
+            asyncio.to_thread(models[tier].generate_content, ['prompt', b'']), remaining)
+        issues = []
+        invoice_data = parse_invoice(response.text, issues).to_dict()
+        return {'invoice_data': invoice_data, 'issues': issues}
+    return call
+
+
+def run(router, models, budget=5.0, rungs=(None,)):
+    seen = []
+    best = asyncio.run(router.run(caller(models, seen), time.time() + budget, rungs))
+    return best, seen
+
+
+def test_score_extraction():
+    invoice_data = parse_invoice(json.dumps(CANNED_INVOICE)).to_dict()
+
+    assert score_extraction(invoice_data, []) == 1.0
+    assert score_extraction(invoice_data, ['line item 1: quantity x price != total']) == 0.8
+    assert score_extraction({**invoice_data, 'line_items': []}, []) == 0.0
+
+
+def test_confident_fast_result_is_accepted():
+    router = ModelRouter([FAST, STRONG])
+    models = {FAST: FakeGenerativeModel(FAST), STRONG: FakeGenerativeModel(STRONG)}
+
+    best, seen = run(router, models)
+
+    assert (best['tier'], best['attempts'], best['confidence']) == (FAST, 1, 1.0)
+    assert models[STRONG].calls == 0
+
+
+def test_unsure_fast_result_escalates():
+    router = ModelRouter([FAST, STRONG])
+    models = {FAST: FakeGenerativeModel(FAST, response_text=misread_invoice()),
+              STRONG: FakeGenerativeModel(STRONG)}
+
+    best, seen = run(router, models)
+
+    assert seen == [(FAST, None), (STRONG, None)]
+    assert (best['tier'], best['level'], best['attempts']) == (STRONG, 1, 2)
+    tiers = {tier['tier']: tier for tier in router.stats()['worker']}
+    assert tiers[FAST]['rejected'] == 1 and tiers[STRONG]['served'] == 1
+
+
+def test_then_climbs_rungs_on_the_last_tier():
+    router = ModelRouter([FAST, STRONG])
+    models = {FAST: FakeGenerativeModel(FAST, response_text=misread_invoice()),
+              STRONG: FakeGenerativeModel(STRONG, response_text=misread_invoice())}
+
+    best, seen = run(router, models, rungs=('small', 'large'))
+
+    assert seen == [(FAST, 'small'), (STRONG, 'small'), (STRONG, 'large')]
+    # Nothing passed: the first of the equally good results is kept
+    assert (best['tier'], best['rung'], best['attempts']) == (FAST, 'small', 3)
+
+
+def test_no_escalation_that_cannot_finish():
+    router = ModelRouter([FAST, STRONG])
+    for _ in range(router.latency.min_samples):
+        router.latency.record(STRONG, 10.0)
+    models = {FAST: FakeGenerativeModel(FAST, response_text=misread_invoice()),
+              STRONG: FakeGenerativeModel(STRONG)}
+
+    best, seen = run(router, models, budget=2.0)
+
+    assert best['tier'] == FAST and best['confidence'] < router.min_confidence
+    assert models[STRONG].calls == 0
+    tiers = {tier['tier']: tier for tier in router.stats()['worker']}
+    assert tiers[STRONG]['skipped'] == 1
+
+
+def test_failed_escalation_keeps_the_earlier_result():
+    router = ModelRouter([FAST, STRONG])
+    models = {FAST: FakeGenerativeModel(FAST, response_text=misread_invoice()),
+              STRONG: FakeGenerativeModel(STRONG, failure_rate=1.0, failures=['unavailable'])}
+
+    best, seen = run(router, models)
+
+    assert best['tier'] == FAST and len(seen) == 2
+
+
+def test_first_failure_is_raised():
+    router = ModelRouter([FAST, STRONG])
+    models = {FAST: FakeGenerativeModel(FAST, latency=1.0), STRONG: FakeGenerativeModel(STRONG)}
+
+    with pytest.raises(asyncio.TimeoutError):
+        run(router, models, budget=0.1)
+
+    assert models[STRONG].calls == 0
+
+
+def test_cluster_stats_are_buffered(monkeypatch):
+    import fakeredis
+
+    import model_router
+    import redis_client
+
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis_client, 'REDIS_URL', 'redis://stats')
+    monkeypatch.setattr(redis_client, 'get_redis', lambda: client)
+    monkeypatch.setattr(model_router, 'get_redis', lambda: client)
+    router = ModelRouter([FAST, STRONG])
+    models = {FAST: FakeGenerativeModel(FAST, response_text=misread_invoice()),
+              STRONG: FakeGenerativeModel(STRONG)}
+
+    run(router, models)
+
+    # Nothing was sent to Redis from the extraction itself
+    assert client.hgetall(model_router.CASCADE_STATS_KEY) == {}
+    cluster = {tier['tier']: tier for tier in router.stats()['cluster']}
+    assert cluster[FAST]['rejected'] == 1 and cluster[STRONG]['served'] == 1
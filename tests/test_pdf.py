@@ -0,0 +1,74 @@
+import io
+
+import pytest
+from PIL import Image, ImageDraw
+
+from benchmarks.fake_model import FakeGenerativeModel
+
+pytest.importorskip('pypdfium2')
+
+
+def scanned_pdf(page_count: int) -> bytes:
+    """A PDF of full-page scans, each page a little different."""
+    pages = []
+    for index in range(page_count):
+        page = Image.new('RGB', (620, 877), 'white')
+        ImageDraw.Draw(page).rectangle((40, 40 + index * 30, 580, 60 + index * 30), fill='black')
+        pages.append(page)
+    output = io.BytesIO()
+    pages[0].save(output, format='PDF', save_all=True, append_images=pages[1:])
+    return output.getvalue()
+
+
+class StallsAfterFirstCall(FakeGenerativeModel):
+    """Answers its first call at once and hangs on the others."""
+
+    def _draw(self, input_tokens: int = 0):
+        call = super()._draw(input_tokens)
+        if self.calls > 1:
+            call['latency'] = 30.0
+        return call
+
+
+@pytest.fixture
+def pdf_app(monkeypatch):
+    import app as invoice_app
+    from result_cache import create_result_cache
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    return invoice_app
+
+
+def test_pages_are_merged_and_cached(fake_model, pdf_app):
+    file_data = scanned_pdf(3)
+
+    result = pdf_app.background_loop.run(pdf_app.extract_invoice(file_data))
+    again = pdf_app.background_loop.run(pdf_app.extract_invoice(file_data))
+
+    assert [page['status'] for page in result['pages']] == ['success'] * 3
+    assert len(result['invoice_data']['line_items']) == 6
+    assert 'partial' not in result
+    assert again['cached'] and fake_model.calls == 3
+
+
+def test_force_extracts_again(fake_model, pdf_app):
+    file_data = scanned_pdf(2)
+
+    pdf_app.background_loop.run(pdf_app.extract_invoice(file_data))
+    result = pdf_app.background_loop.run(pdf_app.extract_invoice(file_data, force=True))
+
+    assert not result.get('cached')
+    assert fake_model.calls == 4
+
+
+def test_deadline_returns_finished_pages(monkeypatch, pdf_app):
+    model = StallsAfterFirstCall()
+    monkeypatch.setattr(pdf_app, 'model', model)
+    monkeypatch.setattr(pdf_app, 'PDF_PAGE_CONCURRENCY', 1)
+    monkeypatch.setattr(pdf_app, 'PDF_TIME_BUDGET', 1.5)
+
+    result = pdf_app.background_loop.run(pdf_app.extract_invoice(scanned_pdf(3)), timeout=5)
+
+    assert result['partial']
+    assert [page['status'] for page in result['pages']] == ['success', 'timeout', 'timeout']
+    assert len(result['invoice_data']['line_items']) == 2
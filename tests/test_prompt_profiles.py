@@ -0,0 +1,104 @@
+import io
+import json
+
+import pytest
+from PIL import Image
+
+from benchmarks.fake_model import CANNED_INVOICE
+from invoice_model import parse_invoice
+from prompt_profiles import BASE, BASE_VERSION, ProfileStore
+
+TAX_ID = CANNED_INVOICE['company_details']['tax_id']
+LETTERHEAD = 0x9f3a5c7e1b2d4f60
+
+
+def invoice(tax_id: str = TAX_ID) -> dict:
+    invoice_data = json.loads(json.dumps(CANNED_INVOICE))
+    invoice_data['company_details']['tax_id'] = tax_id
+    return parse_invoice(json.dumps(invoice_data)).to_dict()
+
+
+def test_select_by_tax_id():
+    store = ProfileStore()
+    assert store.select(TAX_ID) is BASE
+
+    store.observe(invoice())
+    prompt = store.select('51-320341-4')
+
+    assert prompt.profile == f'vendor:{TAX_ID}'
+    assert prompt.version.startswith(f'{BASE_VERSION}-')
+    assert f'tax id {TAX_ID}' in prompt.text
+    assert store.select('999999999') is BASE
+
+
+def test_letterhead_fallback_is_near_exact():
+    store = ProfileStore(letterhead_threshold=2)
+    store.observe(invoice(), letterhead=LETTERHEAD)
+
+    assert store.select(letterhead=LETTERHEAD ^ 0b1).profile == f'vendor:{TAX_ID}'
+    assert store.select(letterhead=LETTERHEAD ^ 0b111) is BASE
+    assert store.stats()['by_letterhead'] == 1
+
+
+def test_letterhead_shared_by_two_suppliers_names_neither():
+    store = ProfileStore(letterhead_threshold=2)
+    store.observe(invoice(), letterhead=LETTERHEAD)
+    prompt = store.select(letterhead=LETTERHEAD ^ 0b1)
+
+    # The extraction shows the same template printed by another supplier
+    store.observe(invoice('514444444'), letterhead=LETTERHEAD ^ 0b1, prompt=prompt)
+
+    assert store.select(letterhead=LETTERHEAD) is BASE
+    stats = store.stats()
+    assert (stats['other_supplier'], stats['ambiguous_letterhead']) == (1, 1)
+    assert store.select('514444444').profile == 'vendor:514444444'
+
+
+def test_version_changes_only_at_powers_of_two():
+    store = ProfileStore()
+    versions = []
+    for _ in range(8):
+        store.observe(invoice())
+        versions.append(store.select(TAX_ID).version)
+
+    assert [versions[i] != versions[i - 1] for i in range(1, 8)] == [
+        True, False, True, False, False, False, True
+    ]
+
+
+@pytest.mark.parametrize('min_invoices, vendor_after', [(1, 1), (2, 2)])
+def test_profile_used_after_min_invoices(min_invoices, vendor_after):
+    store = ProfileStore(min_invoices=min_invoices)
+    for count in range(1, 3):
+        store.observe(invoice())
+        assert (store.select(TAX_ID) is not BASE) == (count >= vendor_after)
+
+
+def test_repeat_upload_finds_result_cached_under_the_base_version(fake_model, monkeypatch):
+    import app as invoice_app
+    from result_cache import create_result_cache
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    monkeypatch.setattr(invoice_app, 'prompt_profiles', ProfileStore())
+    image = io.BytesIO()
+    Image.new('RGB', (800, 1100), 'white').save(image, format='JPEG')
+
+    def upload():
+        return invoice_app.background_loop.run(
+            invoice_app.extract_invoice(image.getvalue(), tax_id=TAX_ID))
+
+    first = upload()
+    assert not first.get('cached') and fake_model.calls == 1
+
+    # The supplier now has a profile, so the same image has a new cache key...
+    prepared = invoice_app.background_loop.run(
+        invoice_app.prepare_extraction(image.getvalue(), rung=invoice_app.IMAGE_LADDER[0],
+                                       tax_id=TAX_ID))
+    assert prepared['prompt'].version != BASE_VERSION
+    assert prepared['cache_key'] != invoice_app.make_cache_key(
+        prepared['image_parts'][0]['data'], BASE_VERSION, invoice_app.model_router.version)
+
+    # ...and its earlier result is still found under the base one
+    second = upload()
+    assert second['cached'] and fake_model.calls == 1
+    assert second['invoice_data'] == first['invoice_data']
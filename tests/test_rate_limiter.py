@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+
+import fakeredis
+import pytest
+
+import rate_limiter
+from rate_limiter import INTERACTIVE, RateLimiter, RedisBudget
+
+
+class SlowRedisBudget(RedisBudget):
+    """A Redis budget on a slow link, remembering which threads called it."""
+
+    def __init__(self, *args, delay: float = 0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delay = delay
+        self.threads = set()
+
+    def try_acquire(self, lease_id, lane):
+        self.threads.add(threading.current_thread())
+        time.sleep(self.delay)
+        return super().try_acquire(lease_id, lane)
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(rate_limiter, 'get_redis', lambda: client)
+    return client
+
+
+def test_redis_attempts_run_off_the_event_loop(redis_client):
+    budget = SlowRedisBudget(rpm=0, burst=1, max_concurrent=1, bulk_share=0.5, delay=0.2)
+    limiter = RateLimiter(budget)
+
+    async def main():
+        ticks = 0
+
+        async def heartbeat():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        beat = asyncio.ensure_future(heartbeat())
+        lease = await limiter.acquire_async(INTERACTIVE, max_wait=1)
+        beat.cancel()
+        return lease, ticks
+
+    lease, ticks = asyncio.run(main())
+
+    assert threading.main_thread() not in budget.threads
+    assert ticks >= 10
+    assert budget.state()['in_flight'] == 1
+    lease.release()
+    assert budget.state()['in_flight'] == 0
+
+
+def test_redis_waiter_gets_released_slot(redis_client):
+    budget = RedisBudget(rpm=0, burst=1, max_concurrent=1, bulk_share=0.5)
+    limiter = RateLimiter(budget)
+    held = limiter.acquire(INTERACTIVE, max_wait=0)
+
+    async def main():
+        asyncio.get_running_loop().call_later(0.1, held.release)
+        return await limiter.acquire_async(INTERACTIVE, max_wait=2)
+
+    lease = asyncio.run(main())
+
+    assert lease.waited >= 0.1
+    lease.release()
+
+
+def test_cancelled_attempt_gives_its_lease_back(redis_client):
+    budget = SlowRedisBudget(rpm=0, burst=1, max_concurrent=1, bulk_share=0.5, delay=0.2)
+    limiter = RateLimiter(budget)
+
+    async def main():
+        task = asyncio.ensure_future(limiter.acquire_async(INTERACTIVE, max_wait=1))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.3)
+
+    asyncio.run(main())
+
+    assert budget.state()['in_flight'] == 0
+
+
+def test_fallback_is_this_process_share(monkeypatch):
+    import redis_client as redis_settings
+
+    monkeypatch.setattr(redis_settings, 'REDIS_URL', 'redis://unreachable')
+    monkeypatch.setattr(rate_limiter, 'RATE_LIMIT_BACKEND', 'auto')
+    monkeypatch.setattr(rate_limiter, 'RATE_LIMIT_PROCESSES', 8)
+    monkeypatch.setattr(rate_limiter, 'get_redis', lambda: None)
+
+    limiter = rate_limiter.create_rate_limiter()
+
+    assert limiter.budget.name == 'redis'
+    fallback = limiter.fallback
+    assert fallback.rate * 60 == rate_limiter.GEMINI_RPM / 8
+    assert fallback.max_concurrent == rate_limiter.GEMINI_MAX_CONCURRENT // 8
+    assert fallback.burst == -(-rate_limiter.GEMINI_BURST // 8)
+    # Never less than one call at a time
+    assert rate_limiter.local_share(1000).max_concurrent == 1
+    # While Redis is down, calls take capacity from the share
+    lease = asyncio.run(limiter.acquire_async(INTERACTIVE, 1.0))
+    assert fallback.state()['in_flight'] == 1
+    lease.release()
+    assert limiter.stats()['lanes'][INTERACTIVE]['fallbacks'] == 1
@@ -0,0 +1,83 @@
+import numpy as np
+
+from reconciliation import (AS_READ, PERMUTATIONS, UNRECONCILED, matches, reconcile,
+                            reported_subtotals)
+
+
+def test_lines_as_read_are_kept():
+    result = reconcile([2, 7], [160.0, 38.0], [320.0, 266.0])
+
+    assert result.assignments.tolist() == [AS_READ, AS_READ]
+    assert result.changed().size == 0
+    assert result.matches_subtotal is None
+
+
+def test_quantity_total_swap_with_weight_quantity():
+    # 2.2 kg at 160, read with quantity and total swapped
+    result = reconcile([352.0], [160.0], [2.2])
+
+    assert (result.quantities[0], result.prices[0], result.totals[0]) == (2.2, 160.0, 352.0)
+    assert tuple(PERMUTATIONS[result.assignments[0]]) == (2, 1, 0)
+
+
+def test_quantity_total_swap_with_whole_quantity():
+    result = reconcile([266.0], [38.0], [7.0])
+
+    assert (result.quantities[0], result.prices[0], result.totals[0]) == (7.0, 38.0, 266.0)
+    assert result.changed().tolist() == [0]
+
+
+def test_unreconciled_line_gets_computed_total():
+    result = reconcile([3.0], [10.0], [31.0])
+
+    assert result.totals[0] == 30.0
+    assert result.unreconciled().tolist() == [0]
+    assert result.assignments[0] == UNRECONCILED
+
+
+def test_subtotal_confirms_printed_total():
+    # The price was misread, the printed total is right
+    result = reconcile([2.0, 1.0], [10.0, 5.0], [21.0, 5.0], subtotals=[26.0])
+
+    assert result.totals.tolist() == [21.0, 5.0]
+    assert result.printed.tolist() == [True, False]
+    assert result.matches_subtotal
+
+
+def test_subtotal_picks_the_assignment_that_closes_the_gap():
+    # 4 x 5 = 20 also fits read as (20, 5, 4) with a rotation; the subtotal decides
+    result = reconcile([20.0, 1.0], [5.0, 10.0], [4.0, 10.0], subtotals=[30.0])
+
+    assert result.totals.tolist() == [20.0, 10.0]
+    assert result.matches_subtotal
+
+
+def test_empty_invoice():
+    result = reconcile([], [], [], subtotals=[0.0])
+
+    assert result.quantities.shape == (0,)
+    assert result.matches_subtotal is None
+
+
+def test_reported_subtotals():
+    assert reported_subtotals({'subtotal': 100.0, 'tax': 17.0, 'total': 117.0}) == [100.0, 117.0]
+    assert reported_subtotals({'total': 118.0}, vat_rates=(0.18,)) == [100.0, 118.0]
+    assert reported_subtotals({}) == []
+    assert matches(100.04, [100.0])
+    assert not matches(100.1, [100.0])
+
+
+def test_many_lines_at_once():
+    rng = np.random.default_rng(0)
+    quantities = rng.integers(1, 20, 1000).astype(float)
+    prices = np.round(rng.uniform(1, 100, 1000), 2)
+    totals = np.round(quantities * prices, 2)
+    swapped = np.arange(0, 1000, 50)
+    read_quantities, read_totals = quantities.copy(), totals.copy()
+    read_quantities[swapped], read_totals[swapped] = totals[swapped], quantities[swapped]
+
+    result = reconcile(read_quantities, prices, read_totals, subtotals=[totals.sum()])
+
+    assert result.changed().tolist() == swapped.tolist()
+    np.testing.assert_allclose(result.totals, totals)
+    assert result.matches_subtotal
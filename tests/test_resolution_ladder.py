@@ -0,0 +1,103 @@
+import io
+import json
+
+import fakeredis
+import pytest
+from PIL import Image
+
+import redis_client
+import resolution_ladder
+from benchmarks.fake_model import CANNED_INVOICE, FakeGenerativeModel
+from resolution_ladder import ACCEPTED, REJECTED, LadderStats, Rung, parse_ladder
+
+
+def test_parse_ladder_keeps_order():
+    assert parse_ladder(' 400:60, 600:70,,1000:80 ') == [
+        Rung(400, 60), Rung(600, 70), Rung(1000, 80)
+    ]
+    assert Rung(600, 70).name == '600px@q70'
+
+
+@pytest.mark.parametrize('spec', ['', '400', '400:60:1', '32:60', '400:99'])
+def test_parse_ladder_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_ladder(spec)
+
+
+def test_stats_per_rung(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis_client, 'REDIS_URL', 'redis://stats')
+    monkeypatch.setattr(redis_client, 'get_redis', lambda: client)
+    monkeypatch.setattr(resolution_ladder, 'get_redis', lambda: client)
+    small, large = Rung(400, 60), Rung(1000, 80)
+    stats = LadderStats([small, large])
+
+    stats.record(small, REJECTED, 20_000, 0.5)
+    stats.record(large, ACCEPTED, 80_000, 1.5)
+
+    # Buffered rather than written from the event loop
+    assert client.hgetall(resolution_ladder.LADDER_STATS_KEY) == {}
+    result = stats.stats()
+    worker = {rung['rung']: rung for rung in result['worker']}
+    assert worker[small.name]['success_rate'] == 0.0
+    assert worker[large.name]['success_rate'] == 1.0
+    assert worker[large.name]['avg_payload_kb'] == 78.1
+    cluster = {rung['rung']: rung for rung in result['cluster']}
+    assert cluster[large.name]['success_rate'] == 1.0
+    assert cluster[small.name]['attempts'] == cluster[small.name]['rejected'] == 1
+
+
+def image_size(contents) -> int:
+    return max(Image.open(io.BytesIO(contents[1]['data'])).size)
+
+
+class SharpEyes(FakeGenerativeModel):
+    """Misreads a line until the image is at least ``needed`` pixels."""
+
+    def __init__(self, needed: int):
+        self.sizes = []
+
+        def respond(contents):
+            self.sizes.append(image_size(contents))
+            invoice = json.loads(json.dumps(CANNED_INVOICE))
+            if self.sizes[-1] < needed:
+                invoice['line_items'][1].update(quantity=3.0, price=10.0, total=47.0)
+            return json.dumps(invoice, ensure_ascii=False)
+
+        super().__init__(respond=respond)
+
+
+@pytest.fixture
+def ladder_app(monkeypatch):
+    import app as invoice_app
+    from model_router import ModelRouter
+    from result_cache import create_result_cache
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    monkeypatch.setattr(invoice_app, 'ladder_stats', LadderStats(invoice_app.IMAGE_LADDER))
+    monkeypatch.setattr(invoice_app, 'model_router',
+                        ModelRouter(['fast-tier', 'strong-tier'], record_latency=False))
+    return invoice_app
+
+
+def invoice_photo() -> bytes:
+    output = io.BytesIO()
+    Image.new('RGB', (1240, 1754), 'white').save(output, format='JPEG')
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('needed, attempts', [(0, 1), (600, 3), (1000, 4)])
+def test_extraction_climbs_only_as_far_as_needed(ladder_app, monkeypatch, needed, attempts):
+    model = SharpEyes(needed)
+    monkeypatch.setattr(ladder_app, 'model', model)
+    ladder = [rung.max_dimension for rung in ladder_app.IMAGE_LADDER]
+
+    result = ladder_app.background_loop.run(ladder_app.extract_invoice(invoice_photo()))
+
+    # Both tiers at the smallest rung, then the larger rungs in order
+    assert model.sizes == ([ladder[0], ladder[0]] + ladder[1:])[:attempts]
+    resolution = result['resolution']
+    assert (resolution['attempts'], resolution['validated']) == (attempts, True)
+    assert resolution['rung'] == ladder_app.IMAGE_LADDER[max(attempts - 2, 0)].name
+    counted = {rung['rung']: rung['attempts'] for rung in ladder_app.ladder_stats.stats()['worker']}
+    assert sum(counted.values()) == attempts
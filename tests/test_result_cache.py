@@ -0,0 +1,123 @@
+import time
+
+import fakeredis
+import pytest
+
+import redis_client
+import result_cache
+from result_cache import CACHE_PREFIX, STATS_KEY, LRUCache, ResultCache, make_cache_key
+
+INVOICE = {'line_items': [{'description': 'גבינה', 'total': 10.0}]}
+
+
+class BrokenRedis:
+    """A Redis client whose every command fails, as when the server is down."""
+
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise ConnectionError('Connection refused')
+        return fail
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis_client, 'REDIS_URL', 'redis://cache')
+    monkeypatch.setattr(redis_client, 'get_redis', lambda: client)
+    monkeypatch.setattr(result_cache, 'get_redis', lambda: client)
+    return client
+
+
+def test_cache_key_covers_prompt_and_model():
+    key = make_cache_key(b'image', 'v1', 'flash')
+
+    assert len(key) == 64 and key == make_cache_key('image', 'v1', 'flash')
+    assert len({key, make_cache_key(b'image', 'v2', 'flash'),
+                make_cache_key(b'image', 'v1', 'pro'), make_cache_key(b'other', 'v1', 'flash')}) == 4
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    cache.set('c', 3)
+
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    assert len(cache) == 2
+
+
+def test_lru_entries_expire():
+    cache = LRUCache(ttl=0.05)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=10)
+
+    time.sleep(0.1)
+
+    assert (cache.get('a'), cache.get('b')) == (None, 2)
+
+
+def test_memory_backend_counts_hits_and_misses():
+    cache = ResultCache()
+    assert cache.get('key') is None
+    cache.set('key', INVOICE)
+
+    assert cache.get('key') == INVOICE
+    stats = cache.stats()
+    assert (stats['worker']['local_hits'], stats['worker']['misses']) == (1, 1)
+    assert stats['hit_rate'] == 0.5 and 'cluster' not in stats
+
+
+def test_redis_tier_is_shared_and_expires(client):
+    writer, reader = ResultCache('redis', ttl=60), ResultCache('redis')
+    writer.set('key', INVOICE)
+
+    assert reader.get('key') == INVOICE
+    assert 0 < client.ttl(CACHE_PREFIX + 'key') <= 60
+    # Read through into the reader's local tier
+    assert reader.get('key') == INVOICE
+    assert reader.stats()['worker']['redis_hits'] == reader.stats()['worker']['local_hits'] == 1
+
+
+def test_stats_are_buffered(client):
+    cache = ResultCache('redis')
+    cache.set('key', INVOICE)
+    for _ in range(5):
+        cache.get('key')
+    cache.get('missing')
+
+    # No round trip per lookup
+    assert client.hgetall(STATS_KEY) == {}
+    assert cache.stats()['cluster'] == {'sets': 1, 'local_hits': 5, 'misses': 1}
+
+
+def test_local_tier_serves_while_redis_is_down(monkeypatch):
+    monkeypatch.setattr(result_cache, 'get_redis', lambda: BrokenRedis())
+    cache = ResultCache('redis')
+
+    cache.set('key', INVOICE)
+    assert cache.get('key') == INVOICE
+    assert cache.get('missing') is None
+
+    worker = cache.stats()['worker']
+    assert (worker['local_hits'], worker['misses'], worker['errors']) == (1, 1, 2)
+
+
+def test_off_backend_caches_nothing():
+    cache = ResultCache('off')
+    cache.set('key', INVOICE)
+
+    assert cache.get('key') is None and not cache.enabled
+
+
+def test_auto_backend_follows_redis_url_without_connecting(monkeypatch):
+    def connect():
+        raise AssertionError('connected at import')
+
+    monkeypatch.setattr(result_cache, 'get_redis', connect)
+    monkeypatch.setattr(result_cache, 'CACHE_BACKEND', 'auto')
+    monkeypatch.setattr(redis_client, 'REDIS_URL', 'redis://unreachable')
+    assert result_cache.create_result_cache().backend == 'redis'
+    monkeypatch.setattr(redis_client, 'REDIS_URL', '')
+    assert result_cache.create_result_cache().backend == 'memory'
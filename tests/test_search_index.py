@@ -0,0 +1,88 @@
+import copy
+
+import pytest
+
+from benchmarks.fake_model import CANNED_INVOICE
+from search_index import (MemorySearchIndex, SQLiteSearchIndex, index_terms, normalize,
+                          parse_query, tax_id_term, tokenize)
+
+
+def record(invoice_id, name='כרמל מעדנים בע"מ', tax_id='513203414',
+           descriptions=('גבינה צהובה', 'זיתים')):
+    invoice = copy.deepcopy(CANNED_INVOICE)
+    invoice['company_details'].update(name=name, tax_id=tax_id)
+    invoice['line_items'] = [{'item_code': f'AB-{line}', 'description': description,
+                              'quantity': 1, 'price': 1, 'total': 1}
+                             for line, description in enumerate(descriptions)]
+    return {'id': invoice_id, 'invoice_data': invoice}
+
+
+def test_normalize():
+    assert normalize('שָׁלוֹם') == 'שלומ'
+    assert normalize('סה״כ') == normalize('סה"כ') == 'סהכ'
+    assert normalize('Café') == 'cafe'
+    assert tokenize('חלב 3%, ביצים') == ['חלב', '3', 'ביצימ']
+
+
+def test_prefixes_and_joined_words():
+    assert index_terms('והחלב') == ['והחלב', 'החלב', 'חלב']
+    assert 'ab12' in index_terms('AB-12')
+    assert parse_query('בחלב AB-12 גבי*') == [(['בחלב', 'חלב'], False), (['ab12'], False),
+                                             (['גבי'], True)]
+
+
+def test_tax_id_term():
+    assert tax_id_term('51-320341-4') == tax_id_term('513203414') == '513203414'
+    assert tax_id_term(' 513 203 414 ') == '513203414'
+    assert tax_id_term('') == ''
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def index(request, tmp_path):
+    if request.param == 'memory':
+        return MemorySearchIndex()
+    return SQLiteSearchIndex(str(tmp_path / 'invoices.db'))
+
+
+def found(result):
+    return [invoice['invoice_id'] for invoice in result['invoices']]
+
+
+def test_search_by_tax_id_with_separators(index):
+    index.add_records([record('a', tax_id='51-320341-4'), record('b', tax_id='512345678')])
+
+    assert found(index.search(tax_id='51-320341-4')) == ['a']
+    assert found(index.search(tax_id='513203414')) == ['a']
+    assert found(index.search(tax_id='512345678')) == ['b']
+    assert found(index.search(tax_id='5132')) == []
+
+
+def test_search_words_prefixes_and_suppliers(index):
+    index.add_records([record('a', descriptions=('גבינה צהובה', 'זיתים')),
+                       record('b', name='מחלבות גד', descriptions=('והחלב הטרי',))])
+
+    result = index.search('גבינה')
+    assert found(result) == ['a']
+    assert result['invoices'][0]['lines'] == [
+        {'index': 0, 'item_code': 'AB-0', 'description': 'גבינה צהובה'}]
+    assert found(index.search('חלב')) == ['b']
+    assert found(index.search('גבי*')) == ['a']
+    assert found(index.search('ab-1')) == ['a']
+    assert found(index.search('', supplier='גד')) == ['b']
+    assert found(index.search('זיתים', supplier='גד')) == []
+
+
+def test_results_newest_first_and_reindexed(index):
+    index.add_records([record('a'), record('b')])
+    assert found(index.search('זיתים')) == ['b', 'a']
+    assert index.search('זיתים', limit=1)['has_more']
+
+    # Saving an invoice again replaces its lines and makes it the newest
+    index.add_records([record('a', descriptions=('קפה',))])
+    assert found(index.search('זיתים')) == ['b']
+    assert found(index.search('קפה')) == ['a']
+
+
+def test_search_needs_a_term(index):
+    with pytest.raises(ValueError):
+        index.search('  ', tax_id='--')
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+import time
+
+import fakeredis
+import pytest
+
+import single_flight
+from single_flight import LEADER, LOCAL_FOLLOWER, REMOTE_FOLLOWER, SingleFlight
+
+
+class SlowRedis(fakeredis.FakeRedis):
+    """A Redis client on a slow link, remembering which threads read through it."""
+
+    delay = 0.0
+
+    def get(self, name):
+        self.threads.add(threading.current_thread())
+        time.sleep(self.delay)
+        return super().get(name)
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = SlowRedis()
+    client.threads = set()
+    monkeypatch.setattr(single_flight, 'get_redis', lambda: client)
+    return client
+
+
+def extraction(calls, seconds=0.2, error=None):
+    async def run():
+        calls.append(1)
+        await asyncio.sleep(seconds)
+        if error is not None:
+            raise error
+        return {'invoice_data': {'line_items': []}}
+    return run
+
+
+def test_redis_round_trips_run_off_the_event_loop(redis_client):
+    redis_client.delay = 0.2
+    flights = SingleFlight(backend='redis')
+
+    async def main():
+        ticks = 0
+
+        async def heartbeat():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        beat = asyncio.ensure_future(heartbeat())
+        result = await flights.run('key', extraction([], seconds=0), timeout=5)
+        beat.cancel()
+        return result, ticks
+
+    (_, role), ticks = asyncio.run(main())
+
+    assert role == LEADER
+    assert threading.main_thread() not in redis_client.threads
+    assert ticks >= 10
+
+
+def test_followers_share_the_leaders_result(redis_client):
+    calls = []
+    worker, other_worker = SingleFlight(backend='redis'), SingleFlight(backend='redis')
+
+    async def main():
+        leader = asyncio.ensure_future(worker.run('key', extraction(calls), timeout=5))
+        await asyncio.sleep(0.05)
+        return await asyncio.gather(
+            leader,
+            worker.run('key', extraction(calls), timeout=5),
+            other_worker.run('key', extraction(calls), timeout=5))
+
+    outcomes = asyncio.run(main())
+
+    assert [role for _, role in outcomes] == [LEADER, LOCAL_FOLLOWER, REMOTE_FOLLOWER]
+    assert len(calls) == 1
+    assert outcomes[2][0] == outcomes[0][0]
+
+
+def test_followers_share_the_leaders_failure(redis_client):
+    calls = []
+    worker, other_worker = SingleFlight(backend='redis'), SingleFlight(backend='redis')
+
+    async def main():
+        leader = asyncio.ensure_future(
+            worker.run('key', extraction(calls, error=TimeoutError('slow')), timeout=5))
+        await asyncio.sleep(0.05)
+        return await asyncio.gather(leader, other_worker.run('key', extraction(calls), timeout=5),
+                                    return_exceptions=True)
+
+    outcomes = asyncio.run(main())
+
+    assert all(isinstance(outcome, TimeoutError) for outcome in outcomes)
+    assert len(calls) == 1
@@ -0,0 +1,87 @@
+import io
+import json
+
+import pytest
+from PIL import Image
+
+from benchmarks.fake_model import CANNED_INVOICE, FakeGenerativeModel
+from stream_parser import IncrementalInvoiceParser
+
+TEXT = json.dumps(CANNED_INVOICE, ensure_ascii=False, indent=2)
+
+
+def feed_in_chunks(text: str, size: int):
+    parser = IncrementalInvoiceParser()
+    events = []
+    for start in range(0, len(text), size):
+        events.extend(parser.feed(text[start:start + size]))
+    return parser, events
+
+
+@pytest.mark.parametrize('size', [1, 7, 40, len(TEXT)])
+def test_sections_and_items_in_order(size):
+    parser, events = feed_in_chunks(TEXT, size)
+
+    assert events == [
+        ('company_details', CANNED_INVOICE['company_details']),
+        ('invoice_details', CANNED_INVOICE['invoice_details']),
+        ('line_item', (0, CANNED_INVOICE['line_items'][0])),
+        ('line_item', (1, CANNED_INVOICE['line_items'][1])),
+        ('totals', CANNED_INVOICE['totals']),
+    ]
+    assert parser.complete
+    assert parser.line_item_count == 2
+
+
+def test_fence_and_tricky_strings():
+    invoice = json.loads(TEXT)
+    invoice['line_items'][0]['description'] = 'קרטון "גדול" {2} [x] \\ סוף'
+    invoice['line_items'][0]['extra'] = {'unit': 'ק"ג'}
+    text = '```json\n' + json.dumps(invoice, ensure_ascii=False) + '\n```'
+
+    parser, events = feed_in_chunks(text, 5)
+
+    items = [value for event, value in events if event == 'line_item']
+    assert items == [(0, invoice['line_items'][0]), (1, invoice['line_items'][1])]
+    assert parser.complete
+
+
+def test_incomplete_text_reports_only_closed_sections():
+    cut = TEXT.index('"line_items"')
+
+    parser, events = feed_in_chunks(TEXT[:cut + 60], 11)
+
+    assert [event for event, _ in events] == ['company_details', 'invoice_details']
+    assert not parser.complete
+
+
+def parse_sse(body: str):
+    events = []
+    for block in body.strip().split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.split('\n'))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+def test_upload_stream_events(monkeypatch):
+    import app as invoice_app
+    from result_cache import create_result_cache
+
+    monkeypatch.setattr(invoice_app, 'result_cache', create_result_cache())
+    monkeypatch.setattr(invoice_app, 'model', FakeGenerativeModel())
+    image = io.BytesIO()
+    Image.new('RGB', (800, 1100), 'white').save(image, format='JPEG')
+
+    response = invoice_app.app.test_client().post(
+        '/upload/stream', data={'file': (io.BytesIO(image.getvalue()), 'invoice.jpg')})
+    events = parse_sse(response.get_data(as_text=True))
+
+    assert [event for event, _ in events] == [
+        'status', 'company_details', 'invoice_details', 'line_item', 'line_item', 'totals',
+        'complete'
+    ]
+    complete = events[-1][1]
+    assert complete['status'] == 'success'
+    assert complete['invoice_data']['totals'] == events[-2][1]
+    assert [data['item'] for event, data in events if event == 'line_item'] == \
+        complete['invoice_data']['line_items']